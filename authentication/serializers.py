@@ -1,16 +1,17 @@
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
 from django.contrib.auth.password_validation import validate_password
+from src.serializers import ModelSerializer
 from .models import Profile
 
 User = get_user_model()
 
-class ProfileSerializer(serializers.ModelSerializer):
+class ProfileSerializer(ModelSerializer):
     class Meta:
         model = Profile
         fields = ('layout_preference', 'theme_color', 'theme_mode', 'allowed_pages')
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(ModelSerializer):
     profile = ProfileSerializer()
     user_permissions = serializers.SerializerMethodField()
     groups = serializers.SerializerMethodField()
@@ -45,7 +46,7 @@ class UserSerializer(serializers.ModelSerializer):
 
         return instance
 
-class UserListSerializer(serializers.ModelSerializer):
+class UserListSerializer(ModelSerializer):
     full_name = serializers.SerializerMethodField()
 
     class Meta:
@@ -60,7 +61,7 @@ class LoginSerializer(serializers.Serializer):
     username = serializers.CharField()
     password = serializers.CharField(write_only=True)
 
-class UpdateUserSerializer(serializers.ModelSerializer):
+class UpdateUserSerializer(ModelSerializer):
     profile = ProfileSerializer()
 
     class Meta:
@@ -12,6 +12,8 @@ then
 fi
 
 python manage.py migrate
+# Table of CACHE_BACKEND=database (does nothing for the other caches)
+python manage.py createcachetable
 python manage.py collectstatic --no-input
 
 exec "$@"
\ No newline at end of file
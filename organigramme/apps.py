@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class OrganigrammeConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'organigramme'
+
+    def ready(self):
+        from . import checks, signals  # noqa: F401
+        # Here for the whole project: src is not an installed app
+        from src.connections import check_pool_sizes
+        from src.pdf_service import install_render_caches
+        check_pool_sizes()
+        install_render_caches()
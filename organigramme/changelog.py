@@ -0,0 +1,288 @@
+"""
+Change log of the charts and incremental sync.
+
+Every write on a structure, position, edge or diagram position appends a
+ChangeLog entry (deletes included, as tombstones). Entries are written once
+the transaction commits, so a rolled back write is never logged; their id is
+the version token handed to the clients. The entries of a transaction are
+inserted in the order they were logged, in batches written in transactions
+of their own holding a lock shared by all log writers: ids become visible
+in order and batches as a whole, so a reader seeing an entry sees every
+entry below it.
+
+A client that lost its connection sends the last token it received to
+GET /api/structures/<main>/changes/?since=<token> and gets the current state
+of what changed in that diagram since then, instead of reloading the chart:
+the cost depends on the number of edits, not on the size of the chart.
+Without `since` the endpoint only returns the current token: read it before
+loading a chart, then sync from it.
+
+Entries are written by the signal receivers (signals.py) and by the bulk
+code paths that send no signal (moves, layout, cloning, import...).
+`prune_changelog` drops the old entries; a client whose token is older than
+the log gets "reset": true and reloads the chart.
+"""
+from django.db import transaction, router
+from django.db.models import Q, Max, Min
+
+from .hierarchy import get_structure_parent_map, get_children_map, get_subtree_structure_ids
+from .models import ChangeLog, Position, DiagramPosition, OrganigramEdge
+from .nodes import get_node_content_type_ids
+
+# Log entries read by one sync request; more are fetched with the next token
+MAX_CHANGES = 5000
+
+# Key of the PostgreSQL advisory lock serializing the log writers
+CHANGELOG_LOCK_KEY = 740001
+
+
+def write_entries(entries):
+    """
+    Insert `entries` in one transaction holding the log's write lock until
+    it commits. Without it, a transaction allocating lower ids could commit
+    after a later one, and a reader already past those ids would miss them.
+    SQLite serializes the writing transactions by itself.
+    """
+    using = router.db_for_write(ChangeLog)
+    with transaction.atomic(using=using):
+        connection = transaction.get_connection(using)
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)', [CHANGELOG_LOCK_KEY])
+        ChangeLog.objects.using(using).bulk_create(entries, batch_size=1000)
+
+
+def change(kind, action, object_id, structure_id=None, previous_structure_id=None, main_structure_id=None,
+           node_kind=''):
+    """Unsaved ChangeLog entry, to pass to `log_changes`."""
+    return ChangeLog(
+        kind=kind, action=action, object_id=object_id, node_kind=node_kind, structure_id=structure_id,
+        previous_structure_id=previous_structure_id, main_structure_id=main_structure_id,
+    )
+
+
+def diagram_changes(main_structure_id, action, keys):
+    """Entries for the diagram positions of the (kind, object_id) `keys`."""
+    return [
+        change('diagram_position', action, object_id, main_structure_id=main_structure_id, node_kind=kind)
+        for kind, object_id in keys
+    ]
+
+
+def log_changes(entries):
+    """
+    Append `entries` to the log once the current transaction commits. The
+    entries logged in a row at the same savepoint level are inserted
+    together: a cascade delete sending one signal per row still writes the
+    log in one bulk statement.
+    """
+    entries = list(entries)
+    if not entries:
+        return
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        write_entries(entries)
+        return
+
+    # One buffer per run of entries of a savepoint: rolling the savepoint back
+    # drops its hook, and the entries with it. The hooks run in the order
+    # they were registered, so the log keeps the order of the writes.
+    key = tuple(connection.savepoint_ids)
+    buffer = connection.__dict__.get('changelog_buffer')
+    if buffer is None or buffer[0] != key or all(item[1] is not buffer[2] for item in connection.run_on_commit):
+        rows = []
+
+        def flush():
+            if connection.__dict__.get('changelog_buffer') is buffer:
+                del connection.__dict__['changelog_buffer']
+            write_entries(rows)
+        buffer = connection.__dict__['changelog_buffer'] = (key, rows, flush)
+        transaction.on_commit(flush)
+    buffer[1].extend(entries)
+
+
+def log_diagram_reset(main_structure_id):
+    """The whole diagram was rewritten: syncing clients reload its coordinates."""
+    log_changes([change('diagram', 'reset', main_structure_id, main_structure_id=main_structure_id)])
+
+
+def get_current_token():
+    return ChangeLog.objects.aggregate(token=Max('id'))['token'] or 0
+
+
+def prune_changelog(older_than):
+    """Delete the entries created before `older_than`, always keeping the last one."""
+    last = get_current_token()
+    deleted, _ = ChangeLog.objects.filter(created_at__lt=older_than, id__lt=last).delete()
+    return deleted
+
+
+# Reading
+
+def _read_entries(since, limit):
+    """Entries after `since`, in order, and whether more are left."""
+    entries = list(ChangeLog.objects.filter(id__gt=since).order_by('id').values_list(
+        'id', 'kind', 'action', 'object_id', 'node_kind', 'structure_id', 'previous_structure_id',
+        'main_structure_id'
+    )[:limit + 1])
+    return entries[:limit], len(entries) > limit
+
+
+def _chart_structures(main_structure_id, entries, parent_map):
+    """
+    Structures of the chart now, plus the deleted ones that belonged to it
+    (their positions and edges were logged with them as their structure).
+    """
+    chart = set(get_subtree_structure_ids(main_structure_id, parent_map))
+    deleted = {
+        object_id: structure_id for _, kind, action, object_id, _, structure_id, _, _ in entries
+        if kind == 'structure' and action == 'deleted' and object_id not in parent_map
+    }
+    grown = True
+    while grown:
+        grown = False
+        for object_id, parent_id in deleted.items():
+            if object_id not in chart and parent_id in chart:
+                chart.add(object_id)
+                grown = True
+    return chart
+
+
+def _edge_data(row, kinds):
+    edge_id, structure_id, edge_type, source_ct, source_id, target_ct, target_id = row
+    return {
+        "id": edge_id,
+        "structure": structure_id,
+        "edge_type": edge_type,
+        "source": {"type": kinds.get(source_ct), "id": source_id},
+        "target": {"type": kinds.get(target_ct), "id": target_id},
+    }
+
+
+def get_changes(main_structure_id, since, limit=MAX_CHANGES):
+    """
+    What changed in the chart and diagram of `main_structure_id` after the
+    token `since`:
+
+        {"main_structure", "since", "token", "has_more", "reset",
+         "structures": {"upserted": [...], "deleted": [ids]},
+         "positions": {"upserted": [...], "deleted": [ids]},
+         "edges": {"upserted": [...], "deleted": [ids]},
+         "diagram_positions": {"reset", "upserted": [...], "deleted": [{"type", "id"}]}}
+
+    Upserted objects carry their current data. "deleted" also lists what
+    left the chart (moved under another main structure). A structure moved
+    into the chart comes with its whole subtree. With "has_more" the client
+    asks again from "token". With "reset" the token is unknown (pruned from
+    the log): the client reloads the chart and syncs from "token".
+    """
+    # viewport imports layout, which logs its changes here
+    from .viewport import load_node_data
+
+    bounds = ChangeLog.objects.aggregate(first=Min('id'), last=Max('id'))
+    first, last = bounds['first'], bounds['last'] or 0
+    if since > last or (first is not None and since < first - 1):
+        return {"main_structure": main_structure_id, "since": since, "token": last, "reset": True}
+
+    entries, has_more = _read_entries(since, limit)
+    parent_map = get_structure_parent_map()
+    chart = _chart_structures(main_structure_id, entries, parent_map)
+
+    touched = {'structure': set(), 'position': set(), 'edge': set(), 'diagram_position': set()}
+    moved_in, moved_out = set(), set()
+    diagram_reset = False
+    for _, kind, action, object_id, node_kind, structure_id, previous_id, entry_main_id in entries:
+        if kind == 'diagram':
+            diagram_reset = diagram_reset or entry_main_id == main_structure_id
+        elif kind == 'diagram_position':
+            if entry_main_id == main_structure_id:
+                touched[kind].add((node_kind, object_id))
+        elif (kind == 'structure' and object_id in chart) or structure_id in chart or previous_id in chart:
+            touched[kind].add(object_id)
+            if kind == 'structure' and action == 'updated' and (structure_id in chart) != (previous_id in chart):
+                (moved_in if structure_id in chart else moved_out).add(object_id)
+
+    # Subtrees entering or leaving the chart: every node in them changed for the client
+    children_map = get_children_map(parent_map)
+    moved_structures = set()
+    for root_id in moved_in | moved_out:
+        stack = [root_id]
+        while stack:
+            structure_id = stack.pop()
+            moved_structures.add(structure_id)
+            stack.extend(children_map.get(structure_id, []))
+    touched['structure'] |= moved_structures
+    if moved_structures:
+        touched['position'] |= set(
+            Position.objects.filter(structure_id__in=moved_structures).values_list('id', flat=True)
+        )
+        touched['edge'] |= set(
+            OrganigramEdge.objects.filter(structure_id__in=moved_structures).values_list('id', flat=True)
+        )
+
+    data = load_node_data(touched['structure'], touched['position'])
+    structures = {'upserted': [], 'deleted': []}
+    for structure_id in sorted(touched['structure']):
+        if structure_id in data['structure'] and structure_id in chart:
+            structures['upserted'].append(data['structure'][structure_id])
+        else:
+            structures['deleted'].append(structure_id)
+    positions = {'upserted': [], 'deleted': []}
+    for position_id in sorted(touched['position']):
+        row = data['position'].get(position_id)
+        if row is not None and row['structure_id'] in chart:
+            positions['upserted'].append(row)
+        else:
+            positions['deleted'].append(position_id)
+
+    content_type_ids = get_node_content_type_ids()
+    kinds = {content_type_id: kind for kind, content_type_id in content_type_ids.items()}
+    edges = {'upserted': [], 'deleted': []}
+    if touched['edge']:
+        current = {
+            row[0]: row for row in OrganigramEdge.objects.filter(id__in=touched['edge']).values_list(
+                'id', 'structure_id', 'edge_type',
+                'source_content_type_id', 'source_object_id', 'target_content_type_id', 'target_object_id'
+            )
+        }
+        for edge_id in sorted(touched['edge']):
+            row = current.get(edge_id)
+            if row is not None and row[1] in chart:
+                edges['upserted'].append(_edge_data(row, kinds))
+            else:
+                edges['deleted'].append(edge_id)
+
+    diagram_positions = {'reset': diagram_reset, 'upserted': [], 'deleted': []}
+    rows = DiagramPosition.objects.filter(main_structure_id=main_structure_id)
+    if not diagram_reset:
+        by_kind = {}
+        for kind, object_id in touched['diagram_position']:
+            by_kind.setdefault(kind, set()).add(object_id)
+        condition = Q()
+        for kind, object_ids in by_kind.items():
+            condition |= Q(content_type_id=content_type_ids[kind], object_id__in=object_ids)
+        rows = rows.filter(condition) if condition else rows.none()
+    found = set()
+    for content_type_id, object_id, x, y in rows.order_by('id').values_list(
+        'content_type_id', 'object_id', 'position_x', 'position_y'
+    ):
+        found.add((kinds.get(content_type_id), object_id))
+        diagram_positions['upserted'].append(
+            {"type": kinds.get(content_type_id), "id": object_id, "position_x": x, "position_y": y}
+        )
+    if not diagram_reset:
+        diagram_positions['deleted'] = [
+            {"type": kind, "id": object_id} for kind, object_id in sorted(touched['diagram_position'] - found)
+        ]
+
+    return {
+        "main_structure": main_structure_id,
+        "since": since,
+        "token": entries[-1][0] if entries else since,
+        "has_more": has_more,
+        "reset": False,
+        "structures": structures,
+        "positions": positions,
+        "edges": edges,
+        "diagram_positions": diagram_positions,
+    }
@@ -0,0 +1,32 @@
+"""System checks of the deployment settings (`manage.py check`, run before the commands)."""
+from django.conf import settings
+from django.core import checks
+
+# Caches held by each process: not seen by the other processes
+PROCESS_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@checks.register(checks.Tags.caches)
+def check_job_backend(app_configs, **kwargs):
+    """
+    JOB_BACKEND 'database' runs the jobs in `run_jobs` processes: the diagram
+    versions they bump and the export progress they report are in the cache,
+    which must be shared with the web processes.
+    """
+    backend = getattr(settings, 'JOB_BACKEND', 'local')
+    if backend not in ('local', 'database'):
+        return [checks.Error(
+            f"Unknown JOB_BACKEND {backend!r}", hint="Use 'local' or 'database'", id='organigramme.E001',
+        )]
+    cache_backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if backend == 'database' and cache_backend in PROCESS_CACHES:
+        return [checks.Error(
+            f"JOB_BACKEND 'database' runs the jobs in other processes, which do not share the {cache_backend} "
+            "cache of the web processes: dashboards, diagram extents and export progress would stay stale",
+            hint="Configure a shared cache (CACHE_BACKEND=database, Redis, Memcached) or use JOB_BACKEND 'local'",
+            id='organigramme.E002',
+        )]
+    return []
@@ -0,0 +1,239 @@
+"""
+Set-based cloning of positions and structure subtrees.
+
+Every table is read once and written with one bulk statement, so the number
+of queries depends on the number of tables involved, not on the number of
+rows being copied.
+"""
+from django.db import transaction
+from django.db.models import Q
+
+from src.utils import bulk_create_with_pks
+from .hierarchy import get_subtree_structure_ids
+from .models import (
+    Structure, Position, Mission, Competence, Task, OrganigramEdge, DiagramPosition
+)
+from .nodes import get_node_content_type_ids, get_node_kind
+from .changelog import change, log_changes
+from .feed import publish_change, diagrams_of_structure
+from .versions import bump_chart_version
+from .rollups import rollup_signals_suspended, update_position_rollups
+
+# Rows attached to a position and copied along with it
+POSITION_CHILD_MODELS = (Mission, Competence, Task)
+
+COPY_SUFFIX = " (Copie)"
+
+
+def copy_instance(instance, **overrides):
+    """
+    Return an unsaved copy of `instance`.
+    The primary key and the auto_now/auto_now_add fields are left unset.
+    """
+    model = type(instance)
+    values = {}
+    for field in model._meta.concrete_fields:
+        if field.primary_key or getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False):
+            continue
+        values[field.attname] = getattr(instance, field.attname)
+    values.update(overrides)
+    return model(**values)
+
+
+def copy_position_children(position_id_map):
+    """
+    Copy the missions, competences and tasks of the positions in
+    `position_id_map` ({original_id: copy_id}), one read and one bulk
+    insert per table.
+    """
+    for model in POSITION_CHILD_MODELS:
+        rows = model.objects.filter(
+            position_id__in=list(position_id_map)
+        ).order_by('id').values_list('position_id', 'description')
+        model.objects.bulk_create(
+            [
+                model(position_id=position_id_map[position_id], description=description)
+                for position_id, description in rows
+            ],
+            batch_size=500
+        )
+
+
+@transaction.atomic
+def clone_position(position):
+    """
+    Clone a position with its missions, competences and tasks, and recreate
+    the edge linking it to its parent.
+    """
+    content_type_ids = get_node_content_type_ids()
+
+    position_copy = copy_instance(position, title=f"{position.title}{COPY_SUFFIX}")
+    position_copy.save()
+
+    copy_position_children({position.id: position_copy.id})
+
+    edge = OrganigramEdge.objects.filter(
+        target_content_type_id=content_type_ids['position'],
+        target_object_id=position.id
+    ).first()
+    if edge:
+        OrganigramEdge.objects.create(
+            structure_id=edge.structure_id,
+            source_content_type_id=edge.source_content_type_id,
+            source_object_id=edge.source_object_id,
+            target_content_type_id=content_type_ids['position'],
+            target_object_id=position_copy.id,
+            edge_type=edge.edge_type
+        )
+
+    return position_copy
+
+
+@transaction.atomic
+@rollup_signals_suspended()
+def clone_structure_subtree(root, parent_id=None, offset_x=0, offset_y=0):
+    """
+    Clone a structure with all its descendant structures, their positions
+    (with missions, competences and tasks), edges and diagram positions.
+
+    The copy of `root` is attached to `parent_id`. Edges pointing into the
+    subtree from outside (from the parent structure or its manager) are
+    copied from the new parent and its manager, or dropped when there is
+    none. Diagram positions of diagrams whose main structure is inside the
+    subtree are remapped to the copied diagram; positions in enclosing
+    diagrams are copied and shifted by (offset_x, offset_y).
+
+    Returns the copy of `root` and the {original_id: copy_id} maps.
+    """
+    content_type_ids = get_node_content_type_ids()
+    subtree_ids = get_subtree_structure_ids(root.id)
+
+    # Structures: insert without parents/managers first, then link them
+    structures = Structure.objects.in_bulk(subtree_ids)
+    originals = [structures[structure_id] for structure_id in subtree_ids]
+    copies = [
+        copy_instance(structure, parent_id=None, manager_id=None)
+        for structure in originals
+    ]
+    copies[0].name = f"{root.name}{COPY_SUFFIX}"
+    bulk_create_with_pks(Structure, copies)
+    structure_map = {
+        original.id: copy.id for original, copy in zip(originals, copies)
+    }
+
+    for original, copy in zip(originals, copies):
+        copy.parent_id = structure_map.get(original.parent_id) if original.id != root.id else parent_id
+
+    # Positions
+    positions = list(Position.objects.filter(structure_id__in=subtree_ids).order_by('id'))
+    position_copies = [
+        copy_instance(position, structure_id=structure_map[position.structure_id])
+        for position in positions
+    ]
+    bulk_create_with_pks(Position, position_copies)
+    position_map = {
+        original.id: copy.id for original, copy in zip(positions, position_copies)
+    }
+
+    for original, copy in zip(originals, copies):
+        copy.manager_id = position_map.get(original.manager_id, original.manager_id)
+    Structure.objects.bulk_update(copies, ['parent', 'manager'], batch_size=500)
+
+    copy_position_children(position_map)
+
+    id_maps = {
+        content_type_ids['structure']: structure_map,
+        content_type_ids['position']: position_map,
+    }
+
+    def map_node(content_type_id, object_id):
+        return id_maps.get(content_type_id, {}).get(object_id)
+
+    new_parent_manager_id = None
+    if parent_id is not None:
+        new_parent_manager_id = Structure.objects.filter(id=parent_id).values_list('manager_id', flat=True).first()
+
+    def map_outside_source(edge):
+        """(source id, structure id) of the copy of an edge entering the subtree, None to drop it."""
+        structure_id = structure_map.get(edge.structure_id)
+        if parent_id == root.parent_id:
+            return edge.source_object_id, structure_id or edge.structure_id
+        if edge.source_content_type_id == content_type_ids['structure']:
+            source_id = parent_id
+        else:
+            source_id = new_parent_manager_id
+        return (source_id, structure_id or parent_id) if source_id is not None else None
+
+    # Edges of the subtree and edges pointing into it
+    edges = OrganigramEdge.objects.filter(
+        Q(structure_id__in=subtree_ids)
+        | Q(target_content_type_id=content_type_ids['structure'], target_object_id__in=subtree_ids)
+        | Q(target_content_type_id=content_type_ids['position'], target_object_id__in=list(position_map))
+    )
+    edge_copies = []
+    for edge in edges:
+        source_id = map_node(edge.source_content_type_id, edge.source_object_id)
+        target_id = map_node(edge.target_content_type_id, edge.target_object_id)
+        if target_id is None:
+            # The edge only leaves the subtree, there is nothing to copy
+            continue
+        structure_id = structure_map.get(edge.structure_id, edge.structure_id)
+        if source_id is None:
+            outside_source = map_outside_source(edge)
+            if outside_source is None:
+                continue
+            source_id, structure_id = outside_source
+        edge_copies.append(OrganigramEdge(
+            structure_id=structure_id,
+            source_content_type_id=edge.source_content_type_id,
+            source_object_id=source_id,
+            target_content_type_id=edge.target_content_type_id,
+            target_object_id=target_id,
+            edge_type=edge.edge_type
+        ))
+    bulk_create_with_pks(OrganigramEdge, edge_copies)
+
+    # Diagram positions of the copied nodes
+    diagram_positions = DiagramPosition.objects.filter(
+        Q(main_structure_id__in=subtree_ids)
+        | Q(content_type_id=content_type_ids['structure'], object_id__in=subtree_ids)
+        | Q(content_type_id=content_type_ids['position'], object_id__in=list(position_map))
+    )
+    diagram_copies = []
+    for diagram_position in diagram_positions:
+        object_id = map_node(diagram_position.content_type_id, diagram_position.object_id)
+        if object_id is None:
+            continue
+        main_structure_id = structure_map.get(diagram_position.main_structure_id)
+        if main_structure_id is not None:
+            x, y = diagram_position.position_x, diagram_position.position_y
+        else:
+            main_structure_id = diagram_position.main_structure_id
+            x = diagram_position.position_x + offset_x
+            y = diagram_position.position_y + offset_y
+        diagram_copies.append(DiagramPosition(
+            content_type_id=diagram_position.content_type_id,
+            object_id=object_id,
+            main_structure_id=main_structure_id,
+            position_x=x,
+            position_y=y
+        ))
+    DiagramPosition.objects.bulk_create(diagram_copies, batch_size=500)
+
+    bump_chart_version()
+    log_changes(
+        [change('structure', 'created', copy.id, structure_id=copy.parent_id) for copy in copies]
+        + [change('position', 'created', copy.id, structure_id=copy.structure_id) for copy in position_copies]
+        + [change('edge', 'created', copy.id, structure_id=copy.structure_id) for copy in edge_copies]
+        + [
+            change('diagram_position', 'created', copy.object_id, main_structure_id=copy.main_structure_id,
+                   node_kind=get_node_kind(copy.content_type_id))
+            for copy in diagram_copies
+        ]
+    )
+    publish_change(diagrams_of_structure(parent_id), {"op": "refresh"})
+    update_position_rollups(added=[
+        (position.structure_id, position.grade_id, position.quantity) for position in position_copies
+    ])
+
+    return copies[0], {'structures': structure_map, 'positions': position_map}
@@ -0,0 +1,117 @@
+"""
+Dashboard statistics.
+
+The whole dashboard is computed with one aggregate query per model (plus
+the recent changes) and kept in the cache under the chart version (see
+versions.py): any write to a structure, position or grade makes the next
+request compute a fresh snapshot. A dashboard request is therefore one
+cache hit.
+"""
+import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Sum, Q
+from django.utils import timezone
+
+from .models import Structure, Position, Grade
+from .versions import get_cache_version, CHART_SCOPE
+
+RECENT_CHANGES_LIMIT = 10
+
+
+def get_dashboard_timeout():
+    return getattr(settings, 'DASHBOARD_CACHE_TIMEOUT', 300)
+
+
+def _change_action(row):
+    # auto_now_add and auto_now each take their own timestamp on creation
+    if row['updated_at'] - row['created_at'] < datetime.timedelta(seconds=1):
+        return "created"
+    return "updated"
+
+
+def _recent_changes():
+    structures = Structure.objects.order_by('-updated_at').values('id', 'name', 'created_at', 'updated_at')
+    positions = Position.objects.order_by('-updated_at').values(
+        'id', 'title', 'structure_id', 'created_at', 'updated_at'
+    )
+    changes = [
+        {
+            "type": "structure",
+            "id": row['id'],
+            "name": row['name'],
+            "action": _change_action(row),
+            "updated_at": row['updated_at'].isoformat(),
+        }
+        for row in structures[:RECENT_CHANGES_LIMIT]
+    ] + [
+        {
+            "type": "position",
+            "id": row['id'],
+            "name": row['title'],
+            "structure": row['structure_id'],
+            "action": _change_action(row),
+            "updated_at": row['updated_at'].isoformat(),
+        }
+        for row in positions[:RECENT_CHANGES_LIMIT]
+    ]
+    changes.sort(key=lambda change: change['updated_at'], reverse=True)
+    return changes[:RECENT_CHANGES_LIMIT]
+
+
+def compute_dashboard():
+    """Compute the dashboard statistics (one aggregate query per model)."""
+    structures = Structure.objects.aggregate(
+        total=Count('id'),
+        main=Count('id', filter=Q(is_main=True)),
+        roots=Count('id', filter=Q(parent__isnull=True)),
+    )
+    positions = Position.objects.aggregate(
+        total=Count('id'),
+        headcount=Sum('quantity'),
+        managers=Count('id', filter=Q(is_manager=True)),
+        unassigned=Count('id', filter=Q(structure__isnull=True)),
+    )
+    # Per category, the totals are summed from the grouped rows
+    grades_by_category = list(
+        Grade.objects.values('category').annotate(
+            grades_count=Count('id', distinct=True),
+            positions_count=Count('grades'),
+            headcount=Sum('grades__quantity'),
+        ).order_by('category')
+    )
+
+    return {
+        "total_structures": structures['total'],
+        "total_main_structures": structures['main'],
+        "total_root_structures": structures['roots'],
+        "total_positions": positions['total'],
+        "total_headcount": positions['headcount'] or 0,
+        "total_manager_positions": positions['managers'],
+        "total_unassigned_positions": positions['unassigned'],
+        "total_grades": sum(row['grades_count'] for row in grades_by_category),
+        "by_category": [
+            {
+                "category": row['category'],
+                "grades": row['grades_count'],
+                "positions": row['positions_count'],
+                "headcount": row['headcount'] or 0,
+            }
+            for row in grades_by_category
+        ],
+        "recent_changes": _recent_changes(),
+        "generated_at": timezone.now().isoformat(),
+    }
+
+
+def get_dashboard():
+    """Cached dashboard snapshot for the current version."""
+    version = get_cache_version(CHART_SCOPE)
+    key = f'organigramme:dashboard:{version}'
+    dashboard = cache.get(key)
+    if dashboard is None:
+        dashboard = compute_dashboard()
+        dashboard["version"] = version
+        cache.set(key, dashboard, get_dashboard_timeout())
+    return dashboard
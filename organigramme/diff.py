@@ -0,0 +1,275 @@
+"""
+Structural diff between two charts (snapshots or live charts).
+
+Both sides are flat chart payloads (see history.load_snapshot_chart). Nodes
+are matched by id first; the nodes left over on both sides (a chart rebuilt
+by an import, a unit deleted and recreated...) are then matched by path
+("DG / DRH / Paie") and by unique name, positions by structure and title.
+
+Every structure gets a signature hashing its own fields, its positions and
+the signatures of its children, computed bottom-up in one pass. When two
+matched structures have the same signature their whole subtree is
+identical and is not visited: the diff runs in O(n) and the detailed
+comparison is only spent on the subtrees that changed.
+"""
+import hashlib
+
+STRUCTURE_FIELDS = ('name', 'type_id', 'is_main', 'manager_id')
+POSITION_FIELDS = (
+    'title', 'abbreviation', 'is_manager', 'category', 'quantity', 'mission_principal', 'formation',
+    'experience', 'missions', 'competences', 'tasks',
+)
+PATH_SEPARATOR = ' / '
+
+
+def _digest(*parts):
+    # repr() of plain values (ids, strings, numbers, lists) is stable and much faster than json.dumps
+    return hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=16).digest()
+
+
+def _normalize(text):
+    return ' '.join(str(text or '').lower().split())
+
+
+class ChartIndex:
+    """Lookups and subtree signatures of one side of the diff."""
+
+    def __init__(self, chart):
+        self.structures = {structure['id']: structure for structure in chart['structures']}
+        self.positions = {position['id']: position for position in chart['positions']}
+        self.grades = {grade['id']: grade['name'] for grade in chart.get('grades', [])}
+
+        self.children, self.structure_positions = {}, {}
+        self.roots = []
+        for structure in chart['structures']:
+            if structure['parent_id'] in self.structures:
+                self.children.setdefault(structure['parent_id'], []).append(structure['id'])
+            else:
+                self.roots.append(structure['id'])
+        for position in chart['positions']:
+            self.structure_positions.setdefault(position['structure_id'], []).append(position['id'])
+
+        # Parents before children
+        self.order = []
+        stack = list(reversed(self.roots))
+        while stack:
+            structure_id = stack.pop()
+            self.order.append(structure_id)
+            stack.extend(reversed(self.children.get(structure_id, [])))
+        # Names from the root, computed on demand (reports and leftover matching)
+        self._paths = {}
+
+        self.position_signatures = {
+            position_id: _digest(position_id, [position.get(field) for field in POSITION_FIELDS], position['grade_id'])
+            for position_id, position in self.positions.items()
+        }
+        self.signatures = {}
+        for structure_id in reversed(self.order):
+            structure = self.structures[structure_id]
+            self.signatures[structure_id] = _digest(
+                structure_id,
+                [structure.get(field) for field in STRUCTURE_FIELDS],
+                sorted(self.position_signatures[position_id] for position_id in self.structure_positions.get(structure_id, [])),
+                sorted(self.signatures[child_id] for child_id in self.children.get(structure_id, [])),
+            )
+
+    def path_names(self, structure_id):
+        missing = []
+        while structure_id in self.structures and structure_id not in self._paths:
+            missing.append(structure_id)
+            structure_id = self.structures[structure_id]['parent_id']
+        path = self._paths.get(structure_id, ())
+        for structure_id in reversed(missing):
+            path = self._paths[structure_id] = path + (self.structures[structure_id]['name'],)
+        return path
+
+    def path(self, structure_id):
+        return PATH_SEPARATOR.join(self.path_names(structure_id))
+
+    def grade(self, grade_id):
+        return self.grades.get(grade_id, grade_id)
+
+    def headcount(self):
+        return sum(position.get('quantity') or 0 for position in self.positions.values())
+
+
+def _match_leftovers(base_ids, target_ids, keys, matched, how, matched_by):
+    """
+    Match the unmatched ids of both sides on each key function in turn;
+    only keys that are unique on both sides are used.
+    """
+    for name, key in keys:
+        base_left = [item for item in base_ids if item not in matched]
+        target_taken = set(matched.values())
+        target_left = [item for item in target_ids if item not in target_taken]
+        if not base_left or not target_left:
+            return
+        base_keys, target_keys = {}, {}
+        for item in base_left:
+            base_keys.setdefault(key('base', item), []).append(item)
+        for item in target_left:
+            target_keys.setdefault(key('target', item), []).append(item)
+        for value, items in base_keys.items():
+            candidates = target_keys.get(value, [])
+            if value is not None and len(items) == 1 and len(candidates) == 1:
+                matched[items[0]] = candidates[0]
+                matched_by[(how, items[0])] = name
+
+
+def match_charts(base, target):
+    """({base structure id: target id}, {base position id: target id}, {(kind, base id): heuristic})."""
+    matched_by = {}
+    structures = {structure_id: structure_id for structure_id in base.structures if structure_id in target.structures}
+    sides = {'base': base, 'target': target}
+    _match_leftovers(base.order, target.order, [
+        ('path', lambda side, item: tuple(_normalize(name) for name in sides[side].path_names(item))),
+        ('name', lambda side, item: _normalize(sides[side].structures[item]['name'])),
+    ], structures, 'structure', matched_by)
+
+    positions = {position_id: position_id for position_id in base.positions if position_id in target.positions}
+
+    def structure_title(side, item):
+        position = sides[side].positions[item]
+        structure_id = position['structure_id']
+        if side == 'base':
+            structure_id = structures.get(structure_id)
+        return (structure_id, _normalize(position['title'])) if structure_id is not None else None
+
+    _match_leftovers(list(base.positions), list(target.positions), [
+        ('structure_title', structure_title),
+        ('title', lambda side, item: _normalize(sides[side].positions[item]['title'])),
+    ], positions, 'position', matched_by)
+    return structures, positions, matched_by
+
+
+def diff_charts(base_chart, target_chart):
+    """
+    Differences from `base_chart` to `target_chart`:
+
+        {"summary": {"base": {...}, "target": {...}, "changes": {op: count}},
+         "changes": [{"op", ...}]}
+
+    Ops: structure_added, structure_removed, structure_moved,
+    structure_updated, position_added, position_removed,
+    position_reassigned, position_grade_changed, position_updated.
+    Entries matched by a heuristic instead of their id carry "matched_by"
+    and the "target_id" they were matched to.
+    """
+    base, target = ChartIndex(base_chart), ChartIndex(target_chart)
+    structures, positions, matched_by = match_charts(base, target)
+    reverse_structures = {target_id: base_id for base_id, target_id in structures.items()}
+    changes = []
+
+    def match_info(kind, base_id, target_id):
+        if (kind, base_id) in matched_by:
+            return {"target_id": target_id, "matched_by": matched_by[(kind, base_id)]}
+        return {}
+
+    # Structures, skipping the subtrees whose signature did not change
+    clean = set()
+    visited_positions = []
+    for structure_id in base.order:
+        parent_id = base.structures[structure_id]['parent_id']
+        if parent_id in clean:
+            clean.add(structure_id)
+            continue
+        structure = base.structures[structure_id]
+        if structure_id not in structures:
+            changes.append({
+                "op": "structure_removed", "id": structure_id, "name": structure['name'],
+                "path": base.path(structure_id),
+            })
+            visited_positions.extend(base.structure_positions.get(structure_id, []))
+            continue
+
+        target_id = structures[structure_id]
+        other = target.structures[target_id]
+        info = match_info('structure', structure_id, target_id)
+        base_parent = structures.get(parent_id) if parent_id in base.structures else None
+        target_parent = other['parent_id'] if other['parent_id'] in target.structures else None
+        if base_parent != target_parent:
+            changes.append(dict(
+                op="structure_moved", id=structure_id, name=other['name'],
+                **{"from": base.path(parent_id), "to": target.path(target_parent)}, **info
+            ))
+        updated = {}
+        for field in STRUCTURE_FIELDS:
+            value = structure.get(field)
+            # The manager is a position: compare it once matched to its target id
+            if field == 'manager_id' and value is not None:
+                value = positions.get(value)
+            if value != other.get(field):
+                updated[field] = [structure.get(field), other.get(field)]
+        if updated:
+            changes.append(dict(
+                op="structure_updated", id=structure_id, name=other['name'],
+                path=target.path(target_id), changes=updated, **info
+            ))
+        if base.signatures[structure_id] == target.signatures[target_id]:
+            clean.add(structure_id)
+        else:
+            visited_positions.extend(base.structure_positions.get(structure_id, []))
+
+    for target_id in target.order:
+        if target_id not in reverse_structures:
+            changes.append({
+                "op": "structure_added", "id": target_id, "name": target.structures[target_id]['name'],
+                "path": target.path(target_id),
+            })
+
+    # Positions of the structures that changed
+    for position_id in visited_positions:
+        position = base.positions[position_id]
+        if position_id not in positions:
+            changes.append({
+                "op": "position_removed", "id": position_id, "title": position['title'],
+                "structure": base.path(position['structure_id']),
+            })
+            continue
+        target_id = positions[position_id]
+        other = target.positions[target_id]
+        info = match_info('position', position_id, target_id)
+        if structures.get(position['structure_id']) != other['structure_id']:
+            changes.append(dict(
+                op="position_reassigned", id=position_id, title=other['title'],
+                **{"from": base.path(position['structure_id']), "to": target.path(other['structure_id'])}, **info
+            ))
+        if position['grade_id'] != other['grade_id']:
+            changes.append(dict(
+                op="position_grade_changed", id=position_id, title=other['title'],
+                structure=target.path(other['structure_id']),
+                **{"from": base.grade(position['grade_id']), "to": target.grade(other['grade_id'])}, **info
+            ))
+        updated = {
+            field: [position.get(field), other.get(field)]
+            for field in POSITION_FIELDS if position.get(field) != other.get(field)
+        }
+        if updated:
+            changes.append(dict(
+                op="position_updated", id=position_id, title=other['title'],
+                structure=target.path(other['structure_id']), changes=updated, **info
+            ))
+
+    matched_positions = set(positions.values())
+    for target_id, position in target.positions.items():
+        if target_id not in matched_positions:
+            changes.append({
+                "op": "position_added", "id": target_id, "title": position['title'],
+                "structure": target.path(position['structure_id']),
+            })
+
+    counts = {}
+    for entry in changes:
+        counts[entry["op"]] = counts.get(entry["op"], 0) + 1
+
+    def side_summary(index):
+        return {
+            "structures": len(index.structures),
+            "positions": len(index.positions),
+            "headcount": index.headcount(),
+        }
+
+    return {
+        "summary": {"base": side_summary(base), "target": side_summary(target), "changes": counts},
+        "changes": changes,
+    }
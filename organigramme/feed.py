@@ -0,0 +1,257 @@
+"""
+Real-time change feed of the diagrams.
+
+Editors of a chart subscribe to the feed of a main structure and apply the
+deltas they receive (node moved, edge added, node deleted...) instead of
+polling the lists. Deltas are published by the signal receivers and by the
+bulk code paths once their transaction commits, and delivered as
+Server-Sent Events by `diagram_feed_application`, mounted in src/asgi.py at
+/api/diagram-feed/<main_structure_id>/.
+
+The broker lives in the process: writes must be handled by the same ASGI
+process as the feeds (one uvicorn worker, see src/asgi.py). Each diagram
+keeps its last events so that a client reconnecting with Last-Event-ID
+receives what it missed; when too much was missed it gets a "refresh".
+
+Event data is one JSON object with an "op" key:
+
+    {"op": "node_moved", "kind": "position", "id": 3, "x": 10.0, "y": 20.0}
+    {"op": "nodes_moved", "nodes": [["position", 3, 10.0, 20.0], ...]}
+    {"op": "node_removed", "kind": "position", "id": 3}        # from the diagram
+    {"op": "nodes_removed", "nodes": [["position", 3], ...]}
+    {"op": "node_updated", "kind": "structure", "id": 2, "data": {...}}
+    {"op": "node_deleted", "kind": "structure", "id": 2}
+    {"op": "edge_added" | "edge_updated", "id": 7, "source": ["position", 1],
+     "target": ["position", 3], "edge_type": "smoothstep", "structure": 4}
+    {"op": "edge_deleted", "id": 7}
+    {"op": "refresh"}                                          # reload the diagram
+"""
+import asyncio
+import itertools
+import json
+import re
+import threading
+from collections import deque
+from importlib import import_module
+from http.cookies import SimpleCookie
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.db import transaction
+
+from src.async_views import run_in_db_pool
+
+from .hierarchy import get_ancestor_ids
+from .models import Structure
+from .nodes import get_node_kind
+
+# Events kept per diagram for reconnecting clients
+FEED_HISTORY_SIZE = 500
+# Comment line sent when nothing happened, so proxies keep the stream open
+FEED_KEEPALIVE_SECONDS = 15
+# Events waiting for a slow client before it is sent a "refresh"
+FEED_QUEUE_SIZE = 1000
+
+FEED_PATH = re.compile(r'^/api/diagram-feed/(?P<main_structure_id>\d+)/?$')
+
+# Deltas published for every diagram
+ALL_DIAGRAMS = '*'
+
+
+class ChangeBroker:
+    """
+    In-process publish/subscribe of diagram events. `publish` can be called
+    from any thread; subscribers are asyncio queues fed in their own loop.
+    """
+
+    def __init__(self, history_size=FEED_HISTORY_SIZE):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._subscribers = {}
+        self._history = {}
+        # Id of the last event dropped from each history
+        self._evicted = {}
+        self._history_size = history_size
+
+    def has_subscribers(self):
+        return bool(self._subscribers)
+
+    def subscribed_diagrams(self):
+        with self._lock:
+            return set(self._subscribers)
+
+    def subscribe(self, main_structure_id, loop):
+        queue = asyncio.Queue(FEED_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(main_structure_id, set()).add((loop, queue))
+        return queue
+
+    def unsubscribe(self, main_structure_id, queue):
+        with self._lock:
+            subscribers = self._subscribers.get(main_structure_id, set())
+            subscribers.difference_update({item for item in subscribers if item[1] is queue})
+            if not subscribers:
+                self._subscribers.pop(main_structure_id, None)
+
+    def history_since(self, main_structure_id, last_event_id):
+        """Events after `last_event_id`, or None when some were dropped."""
+        with self._lock:
+            if self._evicted.get(main_structure_id, 0) > last_event_id:
+                return None
+            return [item for item in self._history.get(main_structure_id, ()) if item[0] > last_event_id]
+
+    def publish(self, main_structure_ids, event):
+        with self._lock:
+            if ALL_DIAGRAMS in main_structure_ids:
+                main_structure_ids = set(self._subscribers) | set(self._history)
+            for main_structure_id in set(main_structure_ids):
+                item = (next(self._ids), event)
+                history = self._history.setdefault(main_structure_id, deque(maxlen=self._history_size))
+                if len(history) == history.maxlen:
+                    self._evicted[main_structure_id] = history[0][0]
+                history.append(item)
+                # Scheduled under the lock: the loops run the callbacks in
+                # order, so concurrent publishers cannot deliver ids out of order
+                for loop, queue in self._subscribers.get(main_structure_id, ()):
+                    loop.call_soon_threadsafe(_deliver, queue, item)
+
+
+def _deliver(queue, item):
+    try:
+        queue.put_nowait(item)
+    except asyncio.QueueFull:
+        # The client is too slow: drop what it has and let it reload
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait((item[0], {"op": "refresh"}))
+
+
+broker = ChangeBroker()
+
+
+def publish_change(main_structure_ids, event):
+    """Publish `event` to the feeds of `main_structure_ids` after commit."""
+    main_structure_ids = set(main_structure_ids)
+    if main_structure_ids:
+        transaction.on_commit(lambda: broker.publish(main_structure_ids, event))
+
+
+def diagrams_of_structure(structure_id, parent_map=None):
+    """
+    Main structures whose diagram can show `structure_id` (itself and its
+    ancestors), limited to the diagrams someone is following.
+    """
+    subscribed = broker.subscribed_diagrams()
+    if structure_id is None or not subscribed:
+        return set()
+    return subscribed & {structure_id, *get_ancestor_ids(structure_id, parent_map)}
+
+
+def edge_event(edge, op):
+    return {
+        "op": op, "id": edge.id,
+        "source": [get_node_kind(edge.source_content_type_id), edge.source_object_id],
+        "target": [get_node_kind(edge.target_content_type_id), edge.target_object_id],
+        "edge_type": edge.edge_type, "structure": edge.structure_id,
+    }
+
+
+# Server-Sent Events endpoint
+
+def _format_event(event_id, event):
+    data = json.dumps(event, separators=(',', ':'), default=str)
+    return f'id: {event_id}\nevent: change\ndata: {data}\n\n'.encode('utf-8')
+
+
+def _load_user(session_key):
+    engine = import_module(settings.SESSION_ENGINE)
+    return get_user(SimpleNamespace(session=engine.SessionStore(session_key)))
+
+
+def _main_structure_exists(main_structure_id):
+    return Structure.objects.filter(id=main_structure_id).exists()
+
+
+async def _send_error(send, status, message):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json')],
+    })
+    await send({'type': 'http.response.body', 'body': json.dumps({"error": message}).encode('utf-8')})
+
+
+async def diagram_feed_application(scope, receive, send):
+    """ASGI application streaming the change feed of one diagram."""
+    match = FEED_PATH.match(scope['path'])
+    main_structure_id = int(match.group('main_structure_id'))
+    headers = {name.decode('latin1').lower(): value.decode('latin1') for name, value in scope['headers']}
+
+    cookies = SimpleCookie(headers.get('cookie', ''))
+    session = cookies.get(settings.SESSION_COOKIE_NAME)
+    user = await run_in_db_pool(_load_user, session.value if session else None)
+    if not user.is_authenticated:
+        return await _send_error(send, 401, "Not authenticated")
+    if not await run_in_db_pool(_main_structure_exists, main_structure_id):
+        return await _send_error(send, 404, f"Structure with id {main_structure_id} not found")
+
+    query = parse_qs(scope.get('query_string', b'').decode('latin1'))
+    last_event_id = headers.get('last-event-id') or (query.get('last_event_id') or [None])[0]
+
+    queue = broker.subscribe(main_structure_id, asyncio.get_running_loop())
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                # Disable response buffering in nginx
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': b'retry: 3000\n\n', 'more_body': True})
+
+        # Events published since the subscription are both in the history and
+        # in the queue: those already replayed are skipped
+        replayed = 0
+        if last_event_id is not None and str(last_event_id).isdigit():
+            missed = broker.history_since(main_structure_id, int(last_event_id))
+            if missed is None:
+                missed = [(int(last_event_id), {"op": "refresh"})]
+            for event_id, event in missed:
+                replayed = max(replayed, event_id)
+                await send({'type': 'http.response.body', 'body': _format_event(event_id, event), 'more_body': True})
+
+        disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+        getter = asyncio.ensure_future(queue.get())
+        try:
+            while True:
+                done, _ = await asyncio.wait(
+                    {getter, disconnected}, timeout=FEED_KEEPALIVE_SECONDS, return_when=asyncio.FIRST_COMPLETED
+                )
+                if disconnected in done:
+                    break
+                if getter in done:
+                    event_id, event = getter.result()
+                    getter = asyncio.ensure_future(queue.get())
+                    if event_id <= replayed:
+                        continue
+                    body = _format_event(event_id, event)
+                else:
+                    body = b': keepalive\n\n'
+                await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+        finally:
+            getter.cancel()
+            disconnected.cancel()
+    finally:
+        broker.unsubscribe(main_structure_id, queue)
+
+
+async def _wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
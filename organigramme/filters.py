@@ -3,7 +3,7 @@ from .serializers import *
 from src.utils import generate_filter_set
 from django.db.models import Exists, OuterRef
 import django_filters
-from .models import StructureType,Structure, OrganigramEdge, Grade, Position, Task, Mission, Competence
+from .models import StructureType,Structure, OrganigramEdge, Grade, Position, Task, Mission, Competence, StructureHeadcount
 
 # Register custom filters for the Conteneur model
 
@@ -16,3 +16,4 @@ PositionFilter = generate_filter_set(Position)
 TaskFilter = generate_filter_set(Task)
 MissionFilter = generate_filter_set(Mission)
 CompetenceFilter = generate_filter_set(Competence)
+StructureHeadcountFilter = generate_filter_set(StructureHeadcount)
@@ -0,0 +1,60 @@
+"""
+Helpers to walk the Structure hierarchy in memory.
+
+The whole parent map is loaded with a single query, which is cheaper than
+following `children` / `parent` relations one level at a time.
+"""
+from collections import deque
+
+from .models import Structure
+
+
+def get_structure_parent_map():
+    """Return {structure_id: parent_id} for every structure (one query)."""
+    return dict(Structure.objects.values_list('id', 'parent_id'))
+
+
+def get_children_map(parent_map):
+    """
+    Invert a parent map into {parent_id: [child_id, ...]}.
+    Children keep the order of the parent map (the Structure ordering).
+    """
+    children_map = {}
+    for structure_id, parent_id in parent_map.items():
+        if parent_id is not None:
+            children_map.setdefault(parent_id, []).append(structure_id)
+    return children_map
+
+
+def get_subtree_structure_ids(root_id, parent_map=None):
+    """
+    Return the ids of `root_id` and all its descendant structures,
+    in breadth-first order (parents always come before their children).
+    """
+    if parent_map is None:
+        parent_map = get_structure_parent_map()
+    if root_id not in parent_map:
+        return []
+
+    children_map = get_children_map(parent_map)
+    subtree = []
+    queue = deque([root_id])
+    while queue:
+        structure_id = queue.popleft()
+        subtree.append(structure_id)
+        queue.extend(children_map.get(structure_id, []))
+    return subtree
+
+
+def get_ancestor_ids(structure_id, parent_map=None):
+    """Return the ancestors of a structure, nearest first."""
+    if parent_map is None:
+        parent_map = get_structure_parent_map()
+    ancestors = []
+    seen = {structure_id}
+    parent_id = parent_map.get(structure_id)
+    while parent_id is not None and parent_id not in seen:
+        ancestors.append(parent_id)
+        seen.add(parent_id)
+        parent_id = parent_map.get(parent_id)
+    return ancestors
@@ -0,0 +1,237 @@
+"""
+Named snapshots of a chart ("the organigram as of decree date X").
+
+A snapshot freezes the graph of a main structure: its structures, their
+positions with the mission, competence and task texts, the edges and the
+diagram coordinates. Rebuilding a past chart from the audit log would mean
+replaying every row diff; a snapshot is read back with two queries and a
+decode.
+
+Storage is content-addressed: each structure, with its positions, is
+serialized to canonical JSON and stored compressed in a SnapshotBlob keyed
+by the SHA-256 of that JSON. A structure left untouched between two
+snapshots is stored once. The snapshot itself only keeps a compressed
+manifest: the blob of each structure, the edges, the coordinates, and the
+grades and structure types referenced by the nodes.
+"""
+import hashlib
+import json
+import zlib
+
+from django.db import transaction
+
+from .hierarchy import get_structure_parent_map, get_subtree_structure_ids
+from .models import (
+    Structure, StructureType, Position, Grade, Mission, Competence, Task, OrganigramEdge, DiagramPosition,
+    ChartSnapshot, SnapshotBlob
+)
+from .nodes import get_node_content_type_ids
+
+MANIFEST_FORMAT = 1
+COMPRESSION_LEVEL = 6
+# Blob hashes per query
+BLOB_BATCH_SIZE = 500
+
+STRUCTURE_FIELDS = ('id', 'name', 'parent_id', 'is_main', 'initial_node', 'type_id', 'manager_id')
+POSITION_FIELDS = (
+    'id', 'structure_id', 'title', 'abbreviation', 'is_manager', 'grade_id', 'category', 'quantity',
+    'mission_principal', 'formation', 'experience',
+)
+POSITION_TEXT_MODELS = {'missions': Mission, 'competences': Competence, 'tasks': Task}
+
+
+def encode(data):
+    return zlib.compress(json.dumps(data, separators=(',', ':'), default=str).encode('utf-8'), COMPRESSION_LEVEL)
+
+
+def decode(data):
+    return json.loads(zlib.decompress(bytes(data)).decode('utf-8'))
+
+
+def _canonical(data):
+    return json.dumps(data, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')
+
+
+def collect_chart(main_structure_id):
+    """
+    Current graph of `main_structure_id`, with a constant number of queries:
+    {"structures": [{... "positions": [...]}], "edges", "coordinates", "grades", "types"}.
+    Structures come in tree order (parents first).
+    """
+    subtree_ids = get_subtree_structure_ids(main_structure_id, get_structure_parent_map())
+    structures = {row['id']: row for row in Structure.objects.filter(id__in=subtree_ids).values(*STRUCTURE_FIELDS)}
+
+    positions = list(Position.objects.filter(structure_id__in=subtree_ids).order_by('id').values(*POSITION_FIELDS))
+    texts = {}
+    for key, model in POSITION_TEXT_MODELS.items():
+        rows = model.objects.filter(position__structure_id__in=subtree_ids).order_by('id')
+        for position_id, description in rows.values_list('position_id', 'description'):
+            texts.setdefault((position_id, key), []).append(description)
+    structure_positions = {}
+    for position in positions:
+        for key in POSITION_TEXT_MODELS:
+            position[key] = texts.get((position['id'], key), [])
+        structure_positions.setdefault(position['structure_id'], []).append(position)
+
+    content_type_ids = get_node_content_type_ids()
+    kinds = {content_type_id: kind for kind, content_type_id in content_type_ids.items()}
+    edges = [
+        [edge_id, structure_id, edge_type, kinds.get(source_ct), source_id, kinds.get(target_ct), target_id]
+        for edge_id, structure_id, edge_type, source_ct, source_id, target_ct, target_id in
+        OrganigramEdge.objects.filter(structure_id__in=subtree_ids).order_by('id').values_list(
+            'id', 'structure_id', 'edge_type',
+            'source_content_type_id', 'source_object_id', 'target_content_type_id', 'target_object_id'
+        )
+    ]
+    coordinates = [
+        [kinds[content_type_id], object_id, x, y]
+        for content_type_id, object_id, x, y in DiagramPosition.objects.filter(
+            main_structure_id=main_structure_id, content_type_id__in=list(kinds)
+        ).order_by('id').values_list('content_type_id', 'object_id', 'position_x', 'position_y')
+    ]
+
+    grade_ids = {position['grade_id'] for position in positions}
+    type_ids = {structure['type_id'] for structure in structures.values()} - {None}
+    return {
+        "structures": [
+            dict(structures[structure_id], positions=structure_positions.get(structure_id, []))
+            for structure_id in subtree_ids if structure_id in structures
+        ],
+        "edges": edges,
+        "coordinates": coordinates,
+        "grades": list(Grade.objects.filter(id__in=grade_ids).order_by('id').values('id', 'name', 'color', 'category')),
+        "types": list(StructureType.objects.filter(id__in=type_ids).order_by('id').values('id', 'name', 'color')),
+    }
+
+
+def _existing_hashes(hashes):
+    hashes = list(hashes)
+    existing = set()
+    for start in range(0, len(hashes), BLOB_BATCH_SIZE):
+        existing.update(SnapshotBlob.objects.filter(
+            hash__in=hashes[start:start + BLOB_BATCH_SIZE]
+        ).values_list('hash', flat=True))
+    return existing
+
+
+@transaction.atomic
+def create_snapshot(main_structure, name, decree_date=None, description=None, user=None):
+    """Freeze the current chart of `main_structure`; only new blobs are written."""
+    chart = collect_chart(main_structure.id)
+
+    blobs, entries = {}, []
+    for structure in chart["structures"]:
+        content = _canonical(structure)
+        digest = hashlib.sha256(content).hexdigest()
+        blobs.setdefault(digest, content)
+        entries.append([structure["id"], digest])
+
+    new_hashes = set(blobs) - _existing_hashes(blobs)
+    # ignore_conflicts: a concurrent snapshot may write the same blob
+    SnapshotBlob.objects.bulk_create(
+        [SnapshotBlob(hash=digest, data=zlib.compress(blobs[digest], COMPRESSION_LEVEL)) for digest in new_hashes],
+        batch_size=BLOB_BATCH_SIZE, ignore_conflicts=True
+    )
+
+    manifest = {
+        "format": MANIFEST_FORMAT,
+        "main_structure": main_structure.id,
+        "structures": entries,
+        "edges": chart["edges"],
+        "coordinates": chart["coordinates"],
+        "grades": chart["grades"],
+        "types": chart["types"],
+    }
+    return ChartSnapshot.objects.create(
+        main_structure=main_structure,
+        main_structure_name=main_structure.name,
+        name=name,
+        decree_date=decree_date,
+        description=description,
+        manifest=encode(manifest),
+        structures_count=len(entries),
+        positions_count=sum(len(structure["positions"]) for structure in chart["structures"]),
+        new_blobs_count=len(new_hashes),
+        created_by=user if user is not None and user.is_authenticated else None,
+    )
+
+
+def _load_blobs(hashes):
+    hashes = list(hashes)
+    blobs = {}
+    for start in range(0, len(hashes), BLOB_BATCH_SIZE):
+        blobs.update(SnapshotBlob.objects.filter(
+            hash__in=hashes[start:start + BLOB_BATCH_SIZE]
+        ).values_list('hash', 'data'))
+    return blobs
+
+
+def _expand_chart(structures, edges, coordinates, grades, types):
+    """Flat chart payload from structures carrying their "positions"."""
+    return {
+        "structures": [
+            {key: value for key, value in structure.items() if key != "positions"} for structure in structures
+        ],
+        "positions": [position for structure in structures for position in structure["positions"]],
+        "edges": [
+            {
+                "id": edge_id, "structure": structure_id, "edge_type": edge_type,
+                "source": {"type": source_kind, "id": source_id},
+                "target": {"type": target_kind, "id": target_id},
+            }
+            for edge_id, structure_id, edge_type, source_kind, source_id, target_kind, target_id in edges
+        ],
+        "diagram_positions": [
+            {"type": kind, "id": object_id, "position_x": x, "position_y": y}
+            for kind, object_id, x, y in coordinates
+        ],
+        "grades": grades,
+        "types": types,
+    }
+
+
+def load_snapshot_chart(snapshot):
+    """
+    The chart frozen in `snapshot`:
+
+        {"structures": [...], "positions": [...], "edges": [...],
+         "diagram_positions": [...], "grades": [...], "types": [...]}
+
+    Positions carry their "missions", "competences" and "tasks" texts.
+    """
+    manifest = decode(snapshot.manifest)
+    blobs = _load_blobs({digest for _, digest in manifest["structures"]})
+
+    decoded = {}
+    for _, digest in manifest["structures"]:
+        if digest not in decoded:
+            decoded[digest] = decode(blobs[digest])
+    return _expand_chart(
+        [decoded[digest] for _, digest in manifest["structures"]],
+        manifest["edges"], manifest["coordinates"], manifest["grades"], manifest["types"],
+    )
+
+
+def load_live_chart(main_structure_id):
+    """The current chart of `main_structure_id`, in the shape of `load_snapshot_chart`."""
+    chart = collect_chart(main_structure_id)
+    return _expand_chart(chart["structures"], chart["edges"], chart["coordinates"], chart["grades"], chart["types"])
+
+
+@transaction.atomic
+def delete_snapshot(snapshot):
+    """
+    Delete `snapshot` and the blobs no other snapshot uses. Returns the
+    number of blobs deleted.
+    """
+    hashes = {digest for _, digest in decode(snapshot.manifest)["structures"]}
+    snapshot.delete()
+    for manifest in ChartSnapshot.objects.values_list('manifest', flat=True).iterator():
+        if not hashes:
+            break
+        hashes -= {digest for _, digest in decode(manifest)["structures"]}
+    hashes = list(hashes)
+    deleted = 0
+    for start in range(0, len(hashes), BLOB_BATCH_SIZE):
+        deleted += SnapshotBlob.objects.filter(hash__in=hashes[start:start + BLOB_BATCH_SIZE]).delete()[0]
+    return deleted
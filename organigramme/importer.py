@@ -0,0 +1,459 @@
+"""
+Bulk import of org charts from CSV or XLSX files.
+
+One row per position:
+
+    structure    path of the structure, e.g. "DG / DRH / Paie" (created if missing)
+    position     title of the position
+    grade        name of an existing grade (or a new one with `grade_category`)
+    parent       title of the parent position in the same structure (optional,
+                 parent references must not form cycles)
+    quantity     headcount (default 1)
+    missions     missions separated by "|"
+    competences  competences separated by "|"
+
+plus the optional `grade_category`, `abbreviation`, `formation`,
+`experience` and `mission_principal` columns.
+
+The file is read row by row and every reference is resolved against
+in-memory maps loaded with one query per table. Nothing is written unless
+the whole file is valid; the rows are then inserted with one bulk statement
+per table (per tree level for structures) in a single transaction.
+
+Imported structures get what the diagram expects of structures created
+from the UI: new root structures are main structures, every new structure
+has an edge from its parent, and the new nodes are placed in the diagrams:
+new charts are laid out, new nodes of existing charts are inserted under
+their parent as a moved subtree would be (see layout.relayout_after_move).
+"""
+import csv
+import io
+import os
+
+from django.db import transaction
+from openpyxl import load_workbook
+
+from src.utils import bulk_create_with_pks
+from .layout import auto_organize_structure, load_layout_tree, compute_layout, relayout_after_move, \
+    POSITION_WIDTH, X_SPACING
+from .models import Structure, Position, Grade, Mission, Competence, OrganigramEdge, DiagramPosition
+from .nodes import get_node_content_type_ids
+from .changelog import change, log_changes
+from .feed import publish_change, ALL_DIAGRAMS
+from .versions import bump_chart_version
+from .rollups import rollup_signals_suspended, update_position_rollups
+
+PATH_SEPARATOR = '/'
+LIST_SEPARATOR = '|'
+BATCH_SIZE = 1000
+
+# Accepted headers for each column
+COLUMN_ALIASES = {
+    'structure': ('structure', 'structure_path'),
+    'position': ('position', 'title', 'poste'),
+    'grade': ('grade',),
+    'grade_category': ('grade_category', 'category', 'categorie', 'catégorie'),
+    'parent': ('parent', 'parent_position'),
+    'quantity': ('quantity', 'effectif'),
+    'missions': ('missions',),
+    'competences': ('competences', 'compétences'),
+    'abbreviation': ('abbreviation', 'abreviation', 'abréviation'),
+    'formation': ('formation',),
+    'experience': ('experience', 'expérience'),
+    'mission_principal': ('mission_principal',),
+}
+REQUIRED_COLUMNS = ('structure', 'position', 'grade')
+
+
+class ChartImportError(ValueError):
+    """Raised when the file cannot be read at all (format, missing columns)."""
+
+
+def _read_csv(file):
+    text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    sample = text.read(4096)
+    text.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    for row in csv.reader(text, dialect):
+        yield row
+
+
+def _read_xlsx(file):
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        for row in workbook.active.rows:
+            yield [cell.value for cell in row]
+    finally:
+        # Read-only workbooks keep the archive open
+        if hasattr(workbook, '_archive'):
+            workbook._archive.close()
+
+
+def read_rows(file, filename):
+    """
+    Yield (line, {column: value}) for each non-empty data row of a CSV or
+    XLSX file, the columns being normalized with COLUMN_ALIASES.
+    """
+    extension = os.path.splitext(filename or '')[1].lower()
+    if extension == '.csv':
+        rows = _read_csv(file)
+    elif extension in ('.xlsx', '.xlsm'):
+        rows = _read_xlsx(file)
+    else:
+        raise ChartImportError("Unsupported file type, expected .csv or .xlsx")
+
+    aliases = {alias: column for column, names in COLUMN_ALIASES.items() for alias in names}
+    header = next(rows, None)
+    if header is None:
+        raise ChartImportError("The file is empty")
+    columns = [aliases.get(str(name or '').strip().lower()) for name in header]
+    missing = [column for column in REQUIRED_COLUMNS if column not in columns]
+    if missing:
+        raise ChartImportError(f"Missing columns: {', '.join(missing)}")
+
+    for line, values in enumerate(rows, start=2):
+        record = {}
+        for column, value in zip(columns, values):
+            if column is not None and value is not None:
+                record[column] = str(value).strip() if not isinstance(value, (int, float)) else value
+        if any(value not in ('', None) for value in record.values()):
+            yield line, record
+
+
+def _split(value, separator):
+    return [part.strip() for part in str(value or '').split(separator) if part.strip()]
+
+
+class ChartImport:
+    """
+    Validate then write the rows of an import. `errors` holds
+    {"line", "error"} dicts; `summary` the number of rows per table.
+    """
+
+    def __init__(self):
+        self.errors = []
+        self.rows = []
+        self.summary = {}
+
+    def error(self, line, message):
+        self.errors.append({"line": line, "error": message})
+
+    def load(self, records):
+        """Validate the rows and resolve every reference in memory."""
+        # {(parent_id, name): id} for the existing structures; a path through
+        # siblings of the same name cannot be resolved
+        self.structure_ids = {}
+        self.ambiguous_structures = set()
+        for structure_id, parent_id, name in Structure.objects.values_list('id', 'parent_id', 'name'):
+            if (parent_id, name) in self.structure_ids:
+                self.ambiguous_structures.add((parent_id, name))
+            self.structure_ids[(parent_id, name)] = structure_id
+        self.grades = {}
+        self.grade_categories = {}
+        for grade_id, name, category in Grade.objects.values_list('id', 'name', 'category'):
+            self.grades[name] = grade_id
+            self.grade_categories[name] = category
+        self.new_grades = {}
+        # {name: line} of the row defining each new grade's category
+        self.new_grade_lines = {}
+        # Structures to create, keyed by path (tuple of names)
+        self.new_structures = {}
+        # {(structure key, title): row index} for parent lookups
+        self.position_keys = {}
+
+        for line, record in records:
+            row = self.load_row(line, record)
+            if row is not None:
+                self.rows.append(row)
+
+        self.resolve_parents()
+
+    def resolve_structure(self, line, path):
+        """
+        Return the key of a structure path: the id of an existing structure,
+        or the path itself for a structure to create. None (and an error)
+        when the path goes through existing siblings of the same name.
+        """
+        parent = None
+        for depth, name in enumerate(path, start=1):
+            existing = None
+            if not isinstance(parent, tuple):
+                if (parent, name) in self.ambiguous_structures:
+                    return self.error(
+                        line, f"Ambiguous structure '{' / '.join(path[:depth])}': "
+                              f"several existing structures are named '{name}' at this level"
+                    )
+                existing = self.structure_ids.get((parent, name))
+            if existing is not None:
+                parent = existing
+            else:
+                key = path[:depth]
+                self.new_structures.setdefault(key, parent)
+                parent = key
+        return parent
+
+    def load_row(self, line, record):
+        path = tuple(_split(record.get('structure'), PATH_SEPARATOR))
+        title = str(record.get('position') or '').strip()
+        grade_name = str(record.get('grade') or '').strip()
+        if not path:
+            return self.error(line, "structure is required")
+        if not title:
+            return self.error(line, "position is required")
+        if not grade_name:
+            return self.error(line, "grade is required")
+
+        category = str(record.get('grade_category') or '').strip()[:20]
+        if grade_name in self.new_grades:
+            if category and category != self.new_grades[grade_name]:
+                return self.error(
+                    line, f"Conflicting grade_category '{category}' for the new grade '{grade_name}' "
+                          f"('{self.new_grades[grade_name]}' on line {self.new_grade_lines[grade_name]})"
+                )
+        elif grade_name not in self.grades:
+            if not category:
+                return self.error(line, f"Unknown grade '{grade_name}' (add a grade_category to create it)")
+            self.new_grades[grade_name] = category
+            self.new_grade_lines[grade_name] = line
+            self.grade_categories[grade_name] = category
+
+        try:
+            quantity = record.get('quantity')
+            quantity = int(float(quantity)) if quantity not in (None, '') else 1
+            if quantity < 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            return self.error(line, f"Invalid quantity '{record.get('quantity')}'")
+
+        structure_key = self.resolve_structure(line, path)
+        if structure_key is None:
+            return None
+        row = {
+            "line": line,
+            "structure": structure_key,
+            "grade": grade_name,
+            "parent": str(record.get('parent') or '').strip(),
+            "missions": _split(record.get('missions'), LIST_SEPARATOR),
+            "competences": _split(record.get('competences'), LIST_SEPARATOR),
+            "fields": {
+                "title": title[:255],
+                "category": category or self.grade_categories[grade_name],
+                "quantity": quantity,
+                "abbreviation": str(record.get('abbreviation') or '')[:255] or None,
+                "formation": str(record.get('formation') or '')[:255],
+                "experience": str(record.get('experience') or '')[:255],
+                "mission_principal": str(record.get('mission_principal') or ''),
+            },
+        }
+        self.position_keys.setdefault((structure_key, title), len(self.rows))
+        return row
+
+    def resolve_parents(self):
+        """
+        Parents are looked up among the imported positions of the same
+        structure first, then among the existing ones (one query).
+        """
+        existing_structure_ids = {
+            row['structure'] for row in self.rows if row['parent'] and isinstance(row['structure'], int)
+        }
+        existing_positions = {}
+        rows = Position.objects.filter(
+            structure_id__in=existing_structure_ids
+        ).order_by('id').values_list('structure_id', 'title', 'id')
+        for structure_id, title, position_id in rows:
+            existing_positions.setdefault((structure_id, title), position_id)
+
+        for index, row in enumerate(self.rows):
+            row['parent_index'] = row['parent_position_id'] = None
+            if not row['parent']:
+                continue
+            key = (row['structure'], row['parent'])
+            if key in self.position_keys and self.position_keys[key] != index:
+                row['parent_index'] = self.position_keys[key]
+            elif key in existing_positions:
+                row['parent_position_id'] = existing_positions[key]
+            else:
+                self.error(row['line'], f"Unknown parent position '{row['parent']}' in this structure")
+
+        self.check_parent_cycles()
+
+    def check_parent_cycles(self):
+        """Parent references between imported positions must form trees (no A -> B -> A)."""
+        visited = set()
+        for index in range(len(self.rows)):
+            path = []
+            current = index
+            while current is not None and current not in visited:
+                visited.add(current)
+                path.append(current)
+                current = self.rows[current]['parent_index']
+            if current is not None and current in path:
+                lines = sorted(self.rows[cycle_index]['line'] for cycle_index in path[path.index(current):])
+                self.error(lines[0], f"Circular parent references between lines {', '.join(map(str, lines))}")
+
+    @transaction.atomic
+    @rollup_signals_suspended()
+    def save(self):
+        """Insert everything with one bulk statement per table."""
+        grades = [
+            Grade(name=name, category=category) for name, category in self.new_grades.items()
+        ]
+        bulk_create_with_pks(Grade, grades, batch_size=BATCH_SIZE)
+        self.grades.update({grade.name: grade.id for grade in grades})
+
+        # Structures, one level at a time so parents have their ids
+        structure_map = {}
+        new_structures = []
+        by_depth = {}
+        for path in self.new_structures:
+            by_depth.setdefault(len(path), []).append(path)
+        for depth in sorted(by_depth):
+            paths = by_depth[depth]
+            structures = []
+            for path in paths:
+                parent_key = self.new_structures[path]
+                parent_id = structure_map[parent_key] if isinstance(parent_key, tuple) else parent_key
+                # New root structures start a chart of their own
+                structures.append(Structure(name=path[-1][:255], parent_id=parent_id, is_main=parent_id is None))
+            bulk_create_with_pks(Structure, structures, batch_size=BATCH_SIZE)
+            new_structures.extend(structures)
+            structure_map.update({path: structure.id for path, structure in zip(paths, structures)})
+
+        def structure_id(key):
+            return structure_map[key] if isinstance(key, tuple) else key
+
+        positions = [
+            Position(
+                structure_id=structure_id(row['structure']),
+                grade_id=self.grades[row['grade']],
+                **row['fields']
+            )
+            for row in self.rows
+        ]
+        bulk_create_with_pks(Position, positions, batch_size=BATCH_SIZE)
+
+        missions, competences = [], []
+        content_type_ids = get_node_content_type_ids()
+        edges = [
+            OrganigramEdge(
+                structure_id=structure.parent_id,
+                source_content_type_id=content_type_ids['structure'],
+                source_object_id=structure.parent_id,
+                target_content_type_id=content_type_ids['structure'],
+                target_object_id=structure.id
+            )
+            for structure in new_structures if structure.parent_id is not None
+        ]
+        for row, position in zip(self.rows, positions):
+            missions.extend(Mission(position_id=position.id, description=text) for text in row['missions'])
+            competences.extend(Competence(position_id=position.id, description=text) for text in row['competences'])
+            if row['parent_index'] is not None:
+                parent_id = positions[row['parent_index']].id
+            else:
+                parent_id = row['parent_position_id']
+            if parent_id is not None:
+                edges.append(OrganigramEdge(
+                    structure_id=position.structure_id,
+                    source_content_type_id=content_type_ids['position'],
+                    source_object_id=parent_id,
+                    target_content_type_id=content_type_ids['position'],
+                    target_object_id=position.id
+                ))
+        Mission.objects.bulk_create(missions, batch_size=BATCH_SIZE)
+        Competence.objects.bulk_create(competences, batch_size=BATCH_SIZE)
+        bulk_create_with_pks(OrganigramEdge, edges, batch_size=BATCH_SIZE)
+        bump_chart_version()
+        log_changes(
+            [change('structure', 'created', structure.id, structure_id=structure.parent_id) for structure in new_structures]
+            + [change('position', 'created', position.id, structure_id=position.structure_id) for position in positions]
+            + [change('edge', 'created', edge.id, structure_id=edge.structure_id) for edge in edges]
+        )
+        publish_change({ALL_DIAGRAMS}, {"op": "refresh"})
+        update_position_rollups(added=[
+            (position.structure_id, position.grade_id, position.quantity) for position in positions
+        ])
+        self.place_in_diagrams(new_structures, positions)
+
+        self.summary = {
+            "grades": len(grades),
+            "structures": len(structure_map),
+            "positions": len(positions),
+            "missions": len(missions),
+            "competences": len(competences),
+            "edges": len(edges),
+        }
+        return self.summary
+
+    def place_in_diagrams(self, new_structures, positions):
+        """
+        Lay out the new charts, and insert the new nodes of existing charts
+        under their parent in every diagram showing it.
+        """
+        new_structure_ids = {structure.id for structure in new_structures}
+        for structure in new_structures:
+            if structure.is_main:
+                auto_organize_structure(structure.id)
+
+        # New subtrees hung under an existing structure
+        insertions = []
+        for structure in new_structures:
+            if structure.parent_id is not None and structure.parent_id not in new_structure_ids:
+                structure_children, structure_positions = load_layout_tree(structure.id)
+                moved_nodes = {('structure', structure_id) for structure_id in structure_children}
+                moved_nodes |= {
+                    ('position', position_id)
+                    for position_ids in structure_positions.values() for position_id in position_ids
+                }
+                layout = compute_layout(structure.id, structure_children, structure_positions)
+                insertions.append((structure.parent_id, ('structure', structure.id), moved_nodes, layout))
+
+        # New positions of existing structures, side by side
+        added_positions = {}
+        for position in positions:
+            if position.structure_id not in new_structure_ids:
+                added_positions.setdefault(position.structure_id, []).append(position.id)
+        for structure_id, position_ids in added_positions.items():
+            layout = {
+                ('position', position_id): {'x': index * (POSITION_WIDTH + X_SPACING), 'y': 0}
+                for index, position_id in enumerate(position_ids)
+            }
+            insertions.append((structure_id, ('position', position_ids[0]), set(layout), layout))
+
+        content_type_ids = get_node_content_type_ids()
+        for parent_id, root, moved_nodes, layout in insertions:
+            main_structure_ids = set(DiagramPosition.objects.filter(
+                content_type_id=content_type_ids['structure'], object_id=parent_id
+            ).values_list('main_structure_id', flat=True))
+            for main_structure_id in sorted(main_structure_ids):
+                relayout_after_move(main_structure_id, moved_nodes, root, None, parent_id, relative_layout=layout)
+
+    def planned_summary(self):
+        return {
+            "grades": len(self.new_grades),
+            "structures": len(self.new_structures),
+            "positions": len(self.rows),
+            "missions": sum(len(row['missions']) for row in self.rows),
+            "competences": sum(len(row['competences']) for row in self.rows),
+            "edges": sum(
+                1 for row in self.rows
+                if row['parent_index'] is not None or row['parent_position_id'] is not None
+            ) + sum(1 for parent in self.new_structures.values() if parent is not None),
+        }
+
+
+def import_chart(file, filename, dry_run=False):
+    """
+    Import a CSV/XLSX org chart. Returns the ChartImport: when it has errors
+    or with `dry_run`, nothing is written and `summary` is what would be
+    created. Raises ChartImportError when the file cannot be read.
+    """
+    chart_import = ChartImport()
+    chart_import.load(read_rows(file, filename))
+    if chart_import.errors or dry_run:
+        chart_import.summary = chart_import.planned_summary()
+    else:
+        chart_import.save()
+    return chart_import
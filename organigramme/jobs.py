@@ -0,0 +1,454 @@
+"""
+Background jobs for the heavy operations: diagram and structure
+auto-organize, fiche de poste renderings and exports, chart imports and
+chart snapshots.
+
+Their endpoints enqueue a Job row and answer 202 with its id. The client
+follows it at /api/jobs/<id>/ and reads what it produced at
+/api/jobs/<id>/result/ (the JSON result, or the exported file).
+
+Jobs are run, depending on JOB_BACKEND, by:
+
+- 'local' (default): threads of the web process, started with it (see
+  `start_local_workers`, which picks up the jobs left queued by a stopped
+  process) and woken when an enqueuing transaction commits. Nothing else
+  to deploy, but the jobs take CPU time from the requests;
+- 'database': worker processes polling the table (`manage.py run_jobs`),
+  as many and on as many hosts as needed (the `worker` service of
+  docker-compose.yml). They need a cache shared with the web processes
+  (checked at startup, see organigramme.checks), and the deltas they
+  publish do not reach the change feeds of the web process: editors
+  resync through the change log.
+
+Each job type declares how many of its jobs may run at once: a running job
+holds one of the slots of its type, unique in the table, so the limit holds
+across workers. Failed attempts are retried with an exponential delay up
+to `max_attempts` (non idempotent jobs get one attempt); a JobError fails
+the job at once (invalid input). An attempt running longer than the type's
+timeout is presumed dead (worker killed) and handled as a failed attempt.
+"""
+import logging
+import os
+import signal
+import socket
+import tempfile
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from src.connections import healthy_connections
+from src.workers import submit_to_pool
+from .history import create_snapshot
+from .importer import import_chart, ChartImportError
+from .layout import auto_organize_structure, organize_structure_positions
+from .models import Job, Structure, Position
+from .pdf import load_structure_fiches_de_poste, stream_fiche_de_poste_zip, stream_fiche_de_poste_merged, \
+    get_export_progress, fiche_de_poste_filename, PDF_RENDER_WORKERS
+from .serializers import ChartSnapshotSerializer
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED = 'queued', 'running', 'succeeded', 'failed', 'cancelled'
+FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+# Queued jobs examined per claim
+CLAIM_BATCH_SIZE = 20
+
+
+class JobError(Exception):
+    """Permanent failure of a job: not retried. `result` is kept on the job (e.g. validation errors)."""
+
+    def __init__(self, message, result=None):
+        super().__init__(message)
+        self.result = result
+
+
+class JobType:
+    def __init__(self, name, function, concurrency, max_attempts, retry_delay, timeout, progress):
+        self.name = name
+        self.function = function
+        self.default_concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.progress = progress
+
+    @property
+    def concurrency(self):
+        # JOB_CONCURRENCY = {"export_fiches": 2} overrides the declared limits
+        return getattr(settings, 'JOB_CONCURRENCY', {}).get(self.name, self.default_concurrency)
+
+
+JOB_TYPES = {}
+
+
+def job_type(name, concurrency=1, max_attempts=3, retry_delay=30, timeout=600, progress=None):
+    """
+    Register the decorated function as the job type `name`. It is called
+    with the Job and returns its JSON result. `progress(job)` returns the
+    progress shown while it runs.
+    """
+    def register(function):
+        JOB_TYPES[name] = JobType(name, function, concurrency, max_attempts, retry_delay, timeout, progress)
+        return function
+    return register
+
+
+# Files
+
+def get_job_files_dir(job_id):
+    return f"{getattr(settings, 'JOB_FILES_DIR', 'jobs')}/{job_id}"
+
+
+def save_job_file(job_id, name, file):
+    """Store `file` with the job's files; returns its storage path."""
+    return default_storage.save(f"{get_job_files_dir(job_id)}/{name.replace('/', '-')}", file)
+
+
+def delete_job_files(job_id):
+    directory = get_job_files_dir(job_id)
+    try:
+        _, names = default_storage.listdir(directory)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    for name in names:
+        default_storage.delete(f"{directory}/{name}")
+
+
+# Queue
+
+def enqueue(kind, payload=None, user=None, files=None):
+    """
+    Queue a job of type `kind`. `files` ({payload key: uploaded file}) are
+    stored with the job and their storage path set in the payload. Workers
+    see the job once the current transaction commits.
+    """
+    job_type = JOB_TYPES[kind]
+    job = Job(
+        kind=kind, payload=dict(payload or {}), max_attempts=job_type.max_attempts,
+        created_by=user if user is not None and user.is_authenticated else None,
+    )
+    for key, file in (files or {}).items():
+        job.payload[key] = save_job_file(job.id, file.name, file)
+    job.save()
+    if getattr(settings, 'JOB_BACKEND', 'local') == 'local':
+        transaction.on_commit(get_local_workers().wake)
+    return job
+
+
+def cancel_job(job):
+    """Cancel a queued job; returns False when it already started."""
+    return bool(Job.objects.filter(id=job.id, status=QUEUED).update(status=CANCELLED, finished_at=timezone.now()))
+
+
+def get_job_progress(job):
+    job_type = JOB_TYPES.get(job.kind)
+    if job.status != RUNNING or job_type is None or job_type.progress is None:
+        return None
+    return job_type.progress(job)
+
+
+def _retry_or_fail(job, error, now):
+    job_type = JOB_TYPES.get(job.kind)
+    if job.attempts < job.max_attempts and job_type is not None:
+        delay = job_type.retry_delay * 2 ** (job.attempts - 1)
+        return dict(status=QUEUED, slot=None, error=error, run_after=now + timedelta(seconds=delay))
+    return dict(status=FAILED, slot=None, error=error, finished_at=now)
+
+
+def recover_stale_jobs():
+    """Attempts running past their type's timeout: their worker died, retry or fail them."""
+    now = timezone.now()
+    for kind, job_type in JOB_TYPES.items():
+        stale = Job.objects.filter(kind=kind, status=RUNNING, started_at__lt=now - timedelta(seconds=job_type.timeout))
+        for job in stale.only('id', 'kind', 'attempts', 'max_attempts', 'worker'):
+            logger.warning('Job %s timed out on %s', job.id, job.worker)
+            Job.objects.filter(id=job.id, status=RUNNING, attempts=job.attempts).update(
+                **_retry_or_fail(job, f'Timed out after {job_type.timeout} seconds', now)
+            )
+
+
+def claim_job(worker, kinds=None):
+    """
+    Take the oldest runnable job among `kinds` (default: all) whose type has
+    a free slot, and mark it running for `worker`. Returns None when there
+    is nothing to run.
+    """
+    recover_stale_jobs()
+    kinds = [kind for kind in (kinds or JOB_TYPES) if kind in JOB_TYPES]
+    free_slots = {}
+    for kind in kinds:
+        used = set(Job.objects.filter(kind=kind, status=RUNNING).values_list('slot', flat=True))
+        free_slots[kind] = [slot for slot in range(JOB_TYPES[kind].concurrency) if slot not in used]
+
+    now = timezone.now()
+    candidates = Job.objects.filter(
+        status=QUEUED, run_after__lte=now, kind__in=[kind for kind, slots in free_slots.items() if slots]
+    ).order_by('run_after', 'created_at').values_list('id', 'kind')[:CLAIM_BATCH_SIZE]
+    for job_id, kind in candidates:
+        slots = free_slots[kind]
+        while slots:
+            try:
+                # Another worker may take the job or the slot first
+                with transaction.atomic():
+                    claimed = Job.objects.filter(id=job_id, status=QUEUED).update(
+                        status=RUNNING, slot=slots[0], worker=worker, started_at=now, attempts=F('attempts') + 1
+                    )
+            except IntegrityError:
+                slots.pop(0)
+                continue
+            if claimed:
+                slots.pop(0)
+                return Job.objects.get(id=job_id)
+            break
+    return None
+
+
+def run_job(job, worker):
+    """Run a claimed job and record its outcome."""
+    job_type = JOB_TYPES.get(job.kind)
+    started = time.perf_counter()
+    try:
+        if job_type is None:
+            raise JobError(f'Unknown job type {job.kind}')
+        outcome = dict(status=SUCCEEDED, result=job_type.function(job), error='')
+    except JobError as error:
+        outcome = dict(status=FAILED, result=error.result, error=str(error))
+    except Exception as error:
+        logger.exception('Job %s (%s) failed, attempt %s of %s', job.id, job.kind, job.attempts, job.max_attempts)
+        outcome = _retry_or_fail(job, f'{type(error).__name__}: {error}', timezone.now())
+    if outcome['status'] != QUEUED:
+        outcome.update(slot=None, finished_at=timezone.now())
+    # A job recovered as stale meanwhile belongs to its new attempt
+    Job.objects.filter(id=job.id, status=RUNNING, worker=worker, attempts=job.attempts).update(**outcome)
+    logger.info('Job %s (%s): %s in %.1fs', job.id, job.kind, outcome['status'], time.perf_counter() - started)
+
+
+def work(worker, kinds=None, once=False, poll_interval=1, stop=None):
+    """
+    Claim and run jobs until `stop` (an Event) is set; with `once`, return
+    as soon as nothing is left to run. Returns the number of jobs run.
+    """
+    stop = stop or threading.Event()
+    count = 0
+    while not stop.is_set():
+        # A worker is a long running "request": recycle its connections the same way
+        close_old_connections()
+        with healthy_connections():
+            job = claim_job(worker, kinds)
+            if job is not None:
+                run_job(job, worker)
+                count += 1
+        if job is None:
+            if once:
+                break
+            stop.wait(poll_interval)
+    close_old_connections()
+    return count
+
+
+def get_worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}'[:100]
+
+
+def run_worker(kinds=None, once=False, poll_interval=1):
+    """Worker process of `manage.py run_jobs`: stops after the current job on SIGTERM or SIGINT."""
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stop.set())
+    return work(get_worker_name(), kinds=kinds, once=once, poll_interval=poll_interval, stop=stop)
+
+
+class LocalWorkers:
+    """Worker threads of the 'local' backend, started on the first wake up."""
+
+    def __init__(self, count, poll_interval):
+        self.count = count
+        self.poll_interval = poll_interval
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def wake(self):
+        with self.lock:
+            if not self.threads:
+                self.stopping = threading.Event()
+                self.threads = [
+                    threading.Thread(target=self.run, args=(self.stopping,), name=f'job-worker-{index}', daemon=True)
+                    for index in range(self.count)
+                ]
+                for thread in self.threads:
+                    thread.start()
+        self.wakeup.set()
+
+    def stop(self, timeout=None):
+        """Let the threads finish their current job, and wait for them."""
+        with self.lock:
+            threads, self.threads = self.threads, []
+            self.stopping.set()
+        self.wakeup.set()
+        for thread in threads:
+            thread.join(timeout)
+
+    def run(self, stopping):
+        name = get_worker_name()
+        while not stopping.is_set():
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+            try:
+                work(name, once=True, stop=stopping)
+            except Exception:
+                logger.exception('Job worker %s failed', name)
+
+
+_local_workers = None
+_local_workers_lock = threading.Lock()
+
+
+def get_local_workers():
+    global _local_workers
+    with _local_workers_lock:
+        if _local_workers is None:
+            _local_workers = LocalWorkers(
+                getattr(settings, 'JOB_LOCAL_WORKERS', 2), getattr(settings, 'JOB_POLL_INTERVAL', 1)
+            )
+        return _local_workers
+
+
+def start_local_workers():
+    """
+    Start the worker threads of the 'local' backend with the web process
+    (src/asgi.py, src/wsgi.py): the jobs it left queued when it stopped, or
+    queued for the retry of a failed attempt, run without waiting for a new
+    one to be enqueued.
+    """
+    if getattr(settings, 'JOB_BACKEND', 'local') == 'local':
+        get_local_workers().wake()
+
+
+def stop_local_workers(timeout=None):
+    """Let the worker threads of the 'local' backend finish their current job, and wait for them."""
+    if _local_workers is not None:
+        _local_workers.stop(timeout)
+
+
+def prune_jobs(older_than):
+    """Delete the jobs finished before `older_than`, and their files."""
+    jobs = Job.objects.filter(status__in=FINISHED, finished_at__lt=older_than)
+    job_ids = list(jobs.values_list('id', flat=True))
+    for job_id in job_ids:
+        delete_job_files(job_id)
+    Job.objects.filter(id__in=job_ids).delete()
+    return len(job_ids)
+
+
+# Job types
+
+@job_type('auto_organize', concurrency=2)
+def run_auto_organize(job):
+    structure_id = job.payload['structure']
+    try:
+        auto_organize_structure(structure_id)
+    except Structure.DoesNotExist:
+        raise JobError('Structure not found')
+    return {"structure": structure_id, "status": "Diagram auto-organized"}
+
+
+@job_type('organize_positions', concurrency=2)
+def run_organize_positions(job):
+    structure_id = job.payload['structure']
+    updates = organize_structure_positions(structure_id)
+    if updates is None:
+        raise JobError('No root positions found (circular references may exist)')
+    return {
+        "structure": structure_id,
+        "message": "Chart organized as hierarchical tree with children under parents" if updates else "No positions to organize",
+        "updates": updates,
+    }
+
+
+@job_type('render_fiche_de_poste', concurrency=PDF_RENDER_WORKERS, max_attempts=2, retry_delay=5, timeout=300)
+def run_render_fiche_de_poste(job):
+    position = Position.objects.filter(id=job.payload['position']).first()
+    if position is None:
+        raise JobError('Position not found')
+    # Rendered in the PDF process pool: with the 'local' backend, xhtml2pdf stays out of the web process
+    path = submit_to_pool('pdf', PDF_RENDER_WORKERS, 'organigramme.pdf.build_fiche_de_poste', position.id).result()
+    return {
+        "position": position.id,
+        "file": path,
+        "filename": fiche_de_poste_filename(position),
+        "content_type": 'application/pdf',
+    }
+
+
+@job_type(
+    'export_fiches', concurrency=1, timeout=3600,
+    # The export publishes its progress under the job id (see organigramme.pdf)
+    progress=lambda job: get_export_progress(str(job.id)),
+)
+def run_export_fiches(job):
+    structure = Structure.objects.filter(id=job.payload['structure']).first()
+    if structure is None:
+        raise JobError('Structure not found')
+    documents = load_structure_fiches_de_poste(structure.id)
+    if not documents:
+        raise JobError('No position found in this structure')
+
+    output = job.payload.get('output', 'zip')
+    stream = stream_fiche_de_poste_zip if output == 'zip' else stream_fiche_de_poste_merged
+    with tempfile.TemporaryFile() as file:
+        for chunk in stream(documents, str(job.id)):
+            file.write(chunk)
+        file.seek(0)
+        filename = f"FICHES_DE_POSTE_{structure.name}.{output}"
+        path = save_job_file(job.id, filename, File(file))
+    progress = get_export_progress(str(job.id)) or {}
+    return {
+        "file": path,
+        "filename": filename,
+        "content_type": 'application/zip' if output == 'zip' else 'application/pdf',
+        "documents": len(documents),
+        "failed": progress.get('failed', []),
+    }
+
+
+@job_type('import_chart', concurrency=1, max_attempts=1, timeout=1800)
+def run_import_chart(job):
+    try:
+        with default_storage.open(job.payload['file'], 'rb') as file:
+            chart_import = import_chart(file, job.payload['filename'])
+    except ChartImportError as e:
+        raise JobError(str(e))
+    if chart_import.errors:
+        raise JobError(
+            'The file contains errors, nothing was imported',
+            result={"errors": chart_import.errors, "summary": chart_import.summary}
+        )
+    return {
+        "message": f"Imported {chart_import.summary['positions']} positions",
+        "summary": chart_import.summary,
+    }
+
+
+@job_type('create_snapshot', concurrency=2, max_attempts=1)
+def run_create_snapshot(job):
+    payload = job.payload
+    main_structure = Structure.objects.filter(id=payload['main_structure'], is_main=True).first()
+    if main_structure is None:
+        raise JobError('Main structure not found')
+    snapshot = create_snapshot(
+        main_structure, payload['name'],
+        decree_date=parse_date(payload['decree_date']) if payload.get('decree_date') else None,
+        description=payload.get('description'), user=job.created_by,
+    )
+    return ChartSnapshotSerializer(snapshot).data
@@ -0,0 +1,454 @@
+"""
+Diagram layout of a structure tree.
+
+`compute_layout` works on in-memory maps loaded with one query per table;
+`auto_organize_structure` lays out a whole diagram and
+`relayout_after_move` only repositions the nodes affected by a move.
+`organize_structure_positions` lays out the positions of one structure
+outside of the diagrams.
+"""
+from django.db import transaction
+from django.utils import timezone
+
+from .hierarchy import get_structure_parent_map, get_children_map, get_subtree_structure_ids, get_ancestor_ids
+from .models import Structure, Position, DiagramPosition, OrganigramEdge
+from .nodes import get_node_content_type_ids
+from .changelog import diagram_changes, log_changes, log_diagram_reset
+from .feed import publish_change
+from .versions import bump_diagram_version
+
+# Define node dimensions
+NODE_WIDTH = 300
+NODE_HEIGHT = 60
+POSITION_WIDTH = 120
+POSITION_HEIGHT = 40
+
+X_SPACING = 250
+Y_SPACING = 500
+
+# Position tree of one structure (organize_structure_positions)
+TREE_NODE_WIDTH = 200  # Approximate width of a node in pixels
+TREE_HORIZONTAL_PADDING = 100  # Minimum space between nodes
+TREE_VERTICAL_SPACING = 250  # Vertical space between levels
+
+
+def load_layout_tree(root_id, parent_map=None):
+    """
+    Load the children of every structure under `root_id` and the positions
+    they hold, in display order (two queries).
+
+    Returns (structure_children, structure_positions), both keyed by structure id.
+    """
+    if parent_map is None:
+        parent_map = get_structure_parent_map()
+    subtree_ids = get_subtree_structure_ids(root_id, parent_map)
+    subtree = set(subtree_ids)
+
+    children_map = get_children_map(parent_map)
+    structure_children = {
+        structure_id: children_map.get(structure_id, []) for structure_id in subtree_ids
+    }
+
+    structure_positions = {}
+    rows = Position.objects.filter(structure_id__in=subtree).values_list('id', 'structure_id')
+    for position_id, structure_id in rows:
+        structure_positions.setdefault(structure_id, []).append(position_id)
+
+    return structure_children, structure_positions
+
+
+def compute_layout(root_id, structure_children, structure_positions, x_spacing=X_SPACING, y_spacing=Y_SPACING):
+    """
+    Lay out the tree rooted at `root_id`: children are placed side by side
+    under their parent structure, and each structure is centered above them.
+
+    Returns {(kind, id): {'x': x, 'y': y}} with kind 'structure' or 'position',
+    normalized so that every x is positive.
+    """
+    positions = {}
+    descendants_cache = {}
+
+    def get_all_descendants(structure_id):
+        if structure_id not in descendants_cache:
+            descendants = [structure_id]
+            for child_id in structure_children.get(structure_id, []):
+                descendants.extend(get_all_descendants(child_id))
+            descendants_cache[structure_id] = descendants
+        return descendants_cache[structure_id]
+
+    def get_subtree_extents(structure_id):
+        """
+        Returns (min_x, max_x) for the entire subtree rooted at `structure_id`,
+        structures and positions included.
+        """
+        key = ('structure', structure_id)
+        min_x = max_x = positions[key]['x'] if key in positions else 0
+
+        xs = []
+        for descendant_id in get_all_descendants(structure_id):
+            key = ('structure', descendant_id)
+            if key in positions:
+                xs.append(positions[key]['x'])
+            for position_id in structure_positions.get(descendant_id, []):
+                key = ('position', position_id)
+                if key in positions:
+                    xs.append(positions[key]['x'])
+        if xs:
+            min_x = min(xs)
+            max_x = max(xs)
+        return min_x, max_x
+
+    def shift_subtree(structure_id, shift_amount):
+        for descendant_id in get_all_descendants(structure_id):
+            key = ('structure', descendant_id)
+            if key in positions:
+                positions[key]['x'] += shift_amount
+            # Also shift associated positions
+            for position_id in structure_positions.get(descendant_id, []):
+                key = ('position', position_id)
+                if key in positions:
+                    positions[key]['x'] += shift_amount
+
+    def layout_dfs(structure_id, level=0):
+        # Unified children: structures and positions
+        child_structures = structure_children.get(structure_id, [])
+        child_positions = structure_positions.get(structure_id, [])
+        all_children = [('structure', child_id) for child_id in child_structures]
+        all_children += [('position', position_id) for position_id in child_positions]
+
+        # Recursively layout all Structure children
+        for child_id in child_structures:
+            layout_dfs(child_id, level + 1)
+
+        # Assign y position for all children
+        base_y = (level + 1) * (NODE_HEIGHT + y_spacing)
+        for position_id in child_positions:
+            positions[('position', position_id)] = {'x': 0, 'y': base_y}
+
+        # Calculate widths
+        child_widths = []
+        for kind, child_id in all_children:
+            if kind == 'structure':
+                # The width of a structure is the span of its subtree
+                min_x, max_x = get_subtree_extents(child_id)
+                width = max_x - min_x if max_x > min_x else NODE_WIDTH
+            else:
+                width = POSITION_WIDTH
+            child_widths.append(width)
+
+        # Layout all children horizontally, side by side
+        total_width = sum(child_widths) + (len(all_children) - 1) * x_spacing if all_children else 0
+        current_x = -total_width / 2
+        for (kind, child_id), width in zip(all_children, child_widths):
+            if kind == 'structure':
+                center = current_x + width / 2
+                shift_subtree(child_id, center - positions[('structure', child_id)]['x'])
+            else:
+                positions[('position', child_id)]['x'] = current_x + POSITION_WIDTH / 2
+            current_x += width + x_spacing
+
+        # Position the current structure node above its children
+        positions[('structure', structure_id)] = {'x': 0, 'y': level * (NODE_HEIGHT + y_spacing)}
+        if all_children:
+            xs = [positions[child]['x'] for child in all_children]
+            positions[('structure', structure_id)]['x'] = (min(xs) + max(xs)) / 2
+
+    layout_dfs(root_id)
+
+    # Normalize all positions to be positive
+    min_x_overall = min((p['x'] for p in positions.values()), default=0)
+    x_offset = -min_x_overall if min_x_overall < 0 else 0
+    for pos in positions.values():
+        pos['x'] += x_offset
+    return positions
+
+
+def auto_organize_structure(main_structure_id, x_spacing=X_SPACING, y_spacing=Y_SPACING):
+    """
+    Recompute the whole diagram of `main_structure_id` and replace its
+    DiagramPosition rows. Raises Structure.DoesNotExist for an unknown id.
+    """
+    main_structure = Structure.objects.get(id=main_structure_id)
+    structure_children, structure_positions = load_layout_tree(main_structure.id)
+    positions = compute_layout(
+        main_structure.id, structure_children, structure_positions, x_spacing, y_spacing
+    )
+
+    content_type_ids = get_node_content_type_ids()
+    with transaction.atomic():
+        # Clear old positions for this organigram
+        DiagramPosition.objects.filter(main_structure=main_structure).delete()
+        DiagramPosition.objects.bulk_create(
+            [
+                DiagramPosition(
+                    content_type_id=content_type_ids[kind],
+                    object_id=object_id,
+                    main_structure=main_structure,
+                    position_x=pos['x'],
+                    position_y=pos['y']
+                )
+                for (kind, object_id), pos in positions.items()
+            ],
+            batch_size=500
+        )
+        bump_diagram_version(main_structure.id)
+        log_diagram_reset(main_structure.id)
+        publish_change({main_structure.id}, {"op": "refresh"})
+    return positions
+
+
+def relayout_after_move(main_structure_id, moved_nodes, moved_root, old_parent_id, new_parent_id,
+                        relative_layout=None, x_spacing=X_SPACING, y_spacing=Y_SPACING):
+    """
+    Update one diagram after a subtree move, without a full re-layout.
+
+    `moved_nodes` is the set of (kind, id) nodes that moved and `moved_root`
+    the top node of that set. `old_parent_id` / `new_parent_id` are the
+    structures it hung under before and after the move. `relative_layout`
+    gives {(kind, id): {'x', 'y'}} coordinates to use for moved nodes that
+    were not in the diagram yet.
+
+    The gap left at the old location is closed by shifting the nodes to its
+    right, room is made to the right of the new parent's subtree by shifting
+    the nodes beyond it, and the moved subtree is translated there with its
+    shape unchanged. Ancestors of the old and new parents keep their place.
+    Only the rows whose coordinates changed are written.
+
+    Returns {"changed": [...], "removed": [...]} in the DiagramPosition format.
+    """
+    content_type_ids = get_node_content_type_ids()
+    kinds = {content_type_id: kind for kind, content_type_id in content_type_ids.items()}
+
+    rows = {}
+    for diagram_position in DiagramPosition.objects.filter(main_structure_id=main_structure_id):
+        kind = kinds.get(diagram_position.content_type_id)
+        if kind is not None:
+            rows[(kind, diagram_position.object_id)] = diagram_position
+    original = {key: (row.position_x, row.position_y) for key, row in rows.items()}
+    coords = {key: [x, y] for key, (x, y) in original.items()}
+
+    def extents(keys):
+        points = [coords[key] for key in keys if key in coords]
+        if not points:
+            return None
+        xs = [point[0] for point in points]
+        ys = [point[1] for point in points]
+        return min(xs), max(xs), min(ys), max(ys)
+
+    parent_map = get_structure_parent_map()
+
+    def lineage(structure_id):
+        if structure_id is None:
+            return set()
+        return {('structure', ancestor_id) for ancestor_id in [structure_id] + get_ancestor_ids(structure_id, parent_map)}
+
+    def shift(keys_filter, dx, fixed_keys):
+        for key, point in coords.items():
+            if key not in moved_nodes and key not in fixed_keys and keys_filter(point):
+                point[0] += dx
+
+    # 1. Close the gap left at the old location
+    old_extents = extents(moved_nodes)
+    if old_extents is not None:
+        old_min_x, old_max_x, _, _ = old_extents
+        gap = (old_max_x - old_min_x) + x_spacing
+        shift(lambda point: point[0] > old_max_x, -gap, lineage(old_parent_id))
+
+    removed = []
+    parent_key = ('structure', new_parent_id)
+    if new_parent_id is None or parent_key not in coords:
+        # The subtree left this diagram
+        removed = [key for key in moved_nodes if key in rows]
+        for key in removed:
+            del coords[key]
+    else:
+        # 2. Moved subtree shape: current coordinates, or the given layout
+        shape = {}
+        for key in moved_nodes:
+            if key in coords:
+                shape[key] = tuple(coords[key])
+            elif relative_layout and key in relative_layout:
+                shape[key] = (relative_layout[key]['x'], relative_layout[key]['y'])
+        if moved_root not in shape:
+            shape[moved_root] = (0, 0)
+        shape_min_x = min(point[0] for point in shape.values())
+        shape_max_x = max(point[0] for point in shape.values())
+        root_x, root_y = shape[moved_root]
+        width = shape_max_x - shape_min_x
+
+        # 3. Insert to the right of the new parent's current subtree
+        parent_x, parent_y = coords[parent_key]
+        parent_subtree = set(get_subtree_structure_ids(new_parent_id, parent_map))
+        parent_subtree_positions = _positions_under(parent_subtree, coords)
+        sibling_keys = [
+            key for key in coords
+            if key not in moved_nodes and key != parent_key and (
+                (key[0] == 'structure' and key[1] in parent_subtree)
+                or key in parent_subtree_positions
+            )
+        ]
+        sibling_extents = extents(sibling_keys)
+        if sibling_extents is None:
+            insert_x = parent_x - width / 2
+        else:
+            insert_x = sibling_extents[1] + x_spacing
+
+        # 4. Make room: shift what lies right of the insertion point
+        shift(lambda point: point[0] >= insert_x, width + x_spacing, lineage(new_parent_id))
+
+        # 5. Translate the moved subtree under its new parent
+        dx = insert_x - shape_min_x
+        dy = parent_y + (NODE_HEIGHT + y_spacing) - root_y
+        for key, (x, y) in shape.items():
+            coords[key] = [x + dx, y + dy]
+
+    # Write only what changed
+    now = timezone.now()
+    to_update, to_create, changed = [], [], []
+    for key, (x, y) in coords.items():
+        if original.get(key) == (x, y):
+            continue
+        kind, object_id = key
+        changed.append({"content_type": kind, "object_id": object_id, "position_x": x, "position_y": y})
+        if key in rows:
+            row = rows[key]
+            row.position_x, row.position_y, row.updated_at = x, y, now
+            to_update.append(row)
+        else:
+            to_create.append(DiagramPosition(
+                content_type_id=content_type_ids[kind],
+                object_id=object_id,
+                main_structure_id=main_structure_id,
+                position_x=x,
+                position_y=y
+            ))
+
+    with transaction.atomic():
+        if removed:
+            DiagramPosition.objects.filter(id__in=[rows[key].id for key in removed]).delete()
+        DiagramPosition.objects.bulk_update(to_update, ['position_x', 'position_y', 'updated_at'], batch_size=500)
+        DiagramPosition.objects.bulk_create(to_create, batch_size=500)
+        bump_diagram_version(main_structure_id)
+        changed_keys = [(node["content_type"], node["object_id"]) for node in changed]
+        log_changes(
+            diagram_changes(main_structure_id, 'updated', [key for key in changed_keys if key in rows])
+            + diagram_changes(main_structure_id, 'created', [key for key in changed_keys if key not in rows])
+            + diagram_changes(main_structure_id, 'deleted', removed)
+        )
+        if changed:
+            publish_change({main_structure_id}, {
+                "op": "nodes_moved",
+                "nodes": [[node["content_type"], node["object_id"], node["position_x"], node["position_y"]] for node in changed],
+            })
+        if removed:
+            publish_change({main_structure_id}, {"op": "nodes_removed", "nodes": [list(key) for key in removed]})
+
+    return {
+        "main_structure": main_structure_id,
+        "changed": changed,
+        "removed": [{"content_type": kind, "object_id": object_id} for kind, object_id in removed],
+    }
+
+
+def _positions_under(structure_ids, coords):
+    """Keys of the diagram positions held by the given structures."""
+    position_ids = [key[1] for key in coords if key[0] == 'position']
+    rows = Position.objects.filter(
+        id__in=position_ids, structure_id__in=structure_ids
+    ).values_list('id', flat=True)
+    return {('position', position_id) for position_id in rows}
+
+
+def organize_structure_positions(structure_id):
+    """
+    Lay out the positions of one structure as a tree, children under their
+    parents, on the coordinates of the positions themselves (not a diagram).
+    Returns the new coordinates [{"id", "position_x", "position_y"}], or None
+    when every position has a parent (circular references).
+    """
+    positions = list(Position.objects.filter(structure_id=structure_id))
+    if not positions:
+        return []
+
+    # Build parent-child mappings
+    children_map = {}
+    parent_map = {}
+    position_map = {p.id: p for p in positions}
+    position_type_id = get_node_content_type_ids()['position']
+    edges = OrganigramEdge.objects.filter(
+        structure_id=structure_id, source_content_type_id=position_type_id, target_content_type_id=position_type_id
+    ).order_by('id').values_list('source_object_id', 'target_object_id')
+
+    for source_id, target_id in edges:
+        if source_id in position_map and target_id in position_map:
+            children_map.setdefault(source_id, []).append(target_id)
+            parent_map[target_id] = source_id
+
+    # Find root nodes (nodes without parents)
+    root_ids = [p.id for p in positions if p.id not in parent_map]
+    if not root_ids:
+        return None
+
+    # Calculate positions using a tree-based approach
+    node_positions = {}
+    
+    def calculate_subtree_width(node_id):
+        """Calculate the width required for a subtree in units."""
+        if not children_map.get(node_id):
+            return 1  # Base unit for leaf nodes
+        
+        # Sum up all children's widths plus padding between them
+        children = children_map[node_id]
+        if not children:
+            return 1
+            
+        total = sum(calculate_subtree_width(child_id) for child_id in children)
+        # Add padding between children (N-1 gaps for N children)
+        return max(1, total + (len(children) - 1) * 0.5)
+
+    def position_node(node_id, x_offset, level):
+        """Recursively position nodes and return the next x_offset."""
+        if node_id in children_map and children_map[node_id]:
+            # This is a parent node with children
+            children = children_map[node_id]
+            
+            # Calculate positions of all children first
+            child_positions = []
+            current_x = x_offset
+            
+            for child_id in children:
+                child_width = calculate_subtree_width(child_id)
+                current_x = position_node(child_id, current_x, level + 1)
+                child_positions.append((child_id, current_x - child_width / 2))
+                current_x += 0.5  # Add padding between children
+            
+            # Position this node centered over its children
+            if child_positions:
+                first_child_x = child_positions[0][1]
+                last_child_x = child_positions[-1][1] + calculate_subtree_width(children[-1])
+                node_x = (first_child_x + last_child_x) / 2
+            else:
+                node_x = x_offset
+            
+            node_positions[node_id] = (node_x, level * TREE_VERTICAL_SPACING + 100)
+            return current_x
+        else:
+            # This is a leaf node
+            node_positions[node_id] = (x_offset, level * TREE_VERTICAL_SPACING + 100)
+            return x_offset + 1  # Leaf nodes take 1 unit width
+
+    # Position all root nodes
+    x_offset = 0
+    for root_id in root_ids:
+        x_offset = position_node(root_id, x_offset, 0)
+
+    # Apply the calculated positions
+    updates = []
+    for node_id, (x, y) in node_positions.items():
+        # Scale x position using the node width and padding
+        position = position_map[node_id]
+        position.position_x = x * (TREE_NODE_WIDTH + TREE_HORIZONTAL_PADDING) + 100
+        position.position_y = y
+        updates.append({"id": node_id, "position_x": position.position_x, "position_y": position.position_y})
+    Position.objects.bulk_update(positions, ['position_x', 'position_y'], batch_size=500)
+    return updates
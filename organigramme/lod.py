@@ -0,0 +1,264 @@
+"""
+Level-of-detail views of a diagram.
+
+At low zoom a large chart is shown collapsed: the structures down to a
+given depth are expanded, and every structure below is drawn as one
+summary node carrying the size of its subtree (structures, positions,
+headcount) and the bounding box it covers in the diagram.
+
+The subtree extents of a diagram are computed in one pass over the tree
+and cached under the chart and diagram versions (see versions.py), so they
+are recomputed only after a write. A collapsed view is then built from
+that snapshot and a few queries on the visible nodes: its size depends on
+the requested depth and expanded nodes, not on the size of the chart.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q, Sum
+
+from .hierarchy import get_structure_parent_map, get_children_map, get_subtree_structure_ids
+from .models import Position, DiagramPosition, OrganigramEdge, StructureHeadcount
+from .nodes import get_node_content_type_ids
+from .versions import get_cache_version, CHART_SCOPE, diagram_scope
+from .viewport import NODE_SIZES, load_node_data
+
+# Deepest level a collapsed view can be expanded to in one request
+MAX_SUMMARY_DEPTH = 20
+
+
+def get_extents_timeout():
+    return getattr(settings, 'DIAGRAM_EXTENTS_CACHE_TIMEOUT', 3600)
+
+
+def _union(box, other):
+    if box is None:
+        return other
+    if other is None:
+        return box
+    return min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3])
+
+
+def _node_box(kind, coordinates):
+    if coordinates is None:
+        return None
+    width, height = NODE_SIZES[kind]
+    x, y = coordinates
+    return x, y, x + width, y + height
+
+
+def compute_diagram_extents(main_structure_id):
+    """
+    Snapshot of the diagram of `main_structure_id` (three queries):
+
+        {"structures": {id: {"parent", "depth", "children", "positions",
+                             "bbox", "structures_count", "positions_count"}},
+         "coordinates": {(kind, id): (x, y)}}
+
+    `bbox` is (min_x, min_y, max_x, max_y) over the nodes of the subtree
+    that are placed in the diagram, None when none is.
+    """
+    parent_map = get_structure_parent_map()
+    subtree_ids = get_subtree_structure_ids(main_structure_id, parent_map)
+    children_map = get_children_map(parent_map)
+
+    structure_positions = {}
+    rows = Position.objects.filter(structure_id__in=subtree_ids).order_by('title', 'id').values_list('id', 'structure_id')
+    for position_id, structure_id in rows:
+        structure_positions.setdefault(structure_id, []).append(position_id)
+
+    content_type_ids = get_node_content_type_ids()
+    kinds = {content_type_id: kind for kind, content_type_id in content_type_ids.items()}
+    coordinates = {
+        (kinds[content_type_id], object_id): (x, y)
+        for content_type_id, object_id, x, y in DiagramPosition.objects.filter(
+            main_structure_id=main_structure_id, content_type_id__in=list(kinds)
+        ).values_list('content_type_id', 'object_id', 'position_x', 'position_y')
+    }
+
+    structures = {}
+    for structure_id in subtree_ids:
+        parent_id = parent_map.get(structure_id) if structure_id != main_structure_id else None
+        structures[structure_id] = {
+            "parent": parent_id,
+            "depth": structures[parent_id]["depth"] + 1 if parent_id is not None else 0,
+            "children": children_map.get(structure_id, []),
+            "positions": structure_positions.get(structure_id, []),
+        }
+
+    # Children come after their parent: aggregate bottom-up
+    for structure_id in reversed(subtree_ids):
+        entry = structures[structure_id]
+        bbox = _node_box('structure', coordinates.get(('structure', structure_id)))
+        for position_id in entry["positions"]:
+            bbox = _union(bbox, _node_box('position', coordinates.get(('position', position_id))))
+        structures_count = 0
+        positions_count = len(entry["positions"])
+        for child_id in entry["children"]:
+            child = structures[child_id]
+            bbox = _union(bbox, child["bbox"])
+            structures_count += 1 + child["structures_count"]
+            positions_count += child["positions_count"]
+        entry.update(bbox=bbox, structures_count=structures_count, positions_count=positions_count)
+
+    return {"structures": structures, "coordinates": coordinates}
+
+
+def get_diagram_extents(main_structure_id):
+    """Cached `compute_diagram_extents` for the current versions."""
+    key = 'organigramme:diagram-extents:{}:{}:{}'.format(
+        main_structure_id,
+        get_cache_version(CHART_SCOPE),
+        get_cache_version(diagram_scope(main_structure_id)),
+    )
+    extents = cache.get(key)
+    if extents is None:
+        extents = compute_diagram_extents(main_structure_id)
+        cache.set(key, extents, get_extents_timeout())
+    return extents
+
+
+def _bbox_data(bbox):
+    if bbox is None:
+        return None
+    return {"min_x": bbox[0], "min_y": bbox[1], "max_x": bbox[2], "max_y": bbox[3]}
+
+
+def collapse_diagram(main_structure_id, root_id=None, depth=1, expand=()):
+    """
+    Collapsed view of the diagram of `main_structure_id` from `root_id`
+    (default: the main structure).
+
+    Structures less than `depth` levels below the root, and those listed in
+    `expand` (when visible), are expanded: their positions and child
+    structures are shown. The other visible structures are collapsed into a
+    summary of their subtree. Edges to hidden nodes are redirected to the
+    summary node that contains them.
+
+    Returns {"nodes", "edges"}, or None when `root_id` is not in the diagram.
+    """
+    extents = get_diagram_extents(main_structure_id)
+    structures = extents["structures"]
+    coordinates = extents["coordinates"]
+    root_id = main_structure_id if root_id is None else root_id
+    if root_id not in structures:
+        return None
+
+    root_depth = structures[root_id]["depth"]
+    expand = set(expand)
+    visible_structures, expanded = [], set()
+    stack = [root_id]
+    while stack:
+        structure_id = stack.pop()
+        visible_structures.append(structure_id)
+        entry = structures[structure_id]
+        if entry["depth"] - root_depth < depth or structure_id in expand:
+            expanded.add(structure_id)
+            stack.extend(reversed(entry["children"]))
+    visible_positions = [
+        position_id for structure_id in visible_structures if structure_id in expanded
+        for position_id in structures[structure_id]["positions"]
+    ]
+
+    data = load_node_data(visible_structures, visible_positions)
+    headcounts = dict(
+        StructureHeadcount.objects.filter(structure_id__in=visible_structures).values('structure_id').annotate(
+            total=Sum('headcount')
+        ).values_list('structure_id', 'total')
+    )
+
+    def coordinate(kind, object_id):
+        return coordinates.get((kind, object_id), (None, None))
+
+    nodes = []
+    for structure_id in visible_structures:
+        entry = structures[structure_id]
+        x, y = coordinate('structure', structure_id)
+        nodes.append({
+            "type": "structure",
+            "id": structure_id,
+            "position_x": x,
+            "position_y": y,
+            "collapsed": structure_id not in expanded,
+            "summary": {
+                "children_count": len(entry["children"]),
+                "structures_count": entry["structures_count"],
+                "positions_count": entry["positions_count"],
+                "headcount": headcounts.get(structure_id, 0),
+                "bbox": _bbox_data(entry["bbox"]),
+            },
+            "data": data['structure'].get(structure_id),
+        })
+    for position_id in visible_positions:
+        x, y = coordinate('position', position_id)
+        nodes.append({
+            "type": "position",
+            "id": position_id,
+            "position_x": x,
+            "position_y": y,
+            "data": data['position'].get(position_id),
+        })
+
+    return {"nodes": nodes, "edges": _collapsed_edges(structures, visible_structures, expanded, visible_positions)}
+
+
+def _collapsed_edges(structures, visible_structures, expanded, visible_positions):
+    """
+    Edges with at least one visible end (one query). A hidden end is
+    replaced by the collapsed structure that contains it; edges falling
+    inside a single summary are dropped and duplicates merged.
+    """
+    if not visible_structures:
+        return []
+    content_type_ids = get_node_content_type_ids()
+    kinds = {content_type_id: kind for kind, content_type_id in content_type_ids.items()}
+    visible = {('structure', structure_id) for structure_id in visible_structures}
+    visible |= {('position', position_id) for position_id in visible_positions}
+
+    condition = Q()
+    for kind, ids in (('structure', visible_structures), ('position', visible_positions)):
+        if ids:
+            condition |= Q(source_content_type_id=content_type_ids[kind], source_object_id__in=ids)
+            condition |= Q(target_content_type_id=content_type_ids[kind], target_object_id__in=ids)
+    rows = list(OrganigramEdge.objects.filter(condition).values_list(
+        'id', 'edge_type', 'source_content_type_id', 'source_object_id', 'target_content_type_id', 'target_object_id'
+    ))
+
+    # Structures of the hidden position ends, in one query
+    hidden_positions = {
+        object_id
+        for _, _, source_ct, source_id, target_ct, target_id in rows
+        for content_type_id, object_id in ((source_ct, source_id), (target_ct, target_id))
+        if kinds.get(content_type_id) == 'position' and ('position', object_id) not in visible
+    }
+    position_structures = dict(
+        Position.objects.filter(id__in=hidden_positions).values_list('id', 'structure_id')
+    ) if hidden_positions else {}
+
+    def representative(kind, object_id):
+        if (kind, object_id) in visible:
+            return kind, object_id
+        structure_id = object_id if kind == 'structure' else position_structures.get(object_id)
+        # Nearest visible ancestor; it is collapsed since this node is hidden
+        while structure_id is not None and structure_id in structures:
+            if ('structure', structure_id) in visible:
+                return 'structure', structure_id
+            structure_id = structures[structure_id]["parent"]
+        return None
+
+    edges, seen = [], set()
+    for edge_id, edge_type, source_ct, source_id, target_ct, target_id in rows:
+        source = representative(kinds.get(source_ct), source_id) if source_ct in kinds else None
+        target = representative(kinds.get(target_ct), target_id) if target_ct in kinds else None
+        if source is None or target is None or source == target or (source, target) in seen:
+            continue
+        seen.add((source, target))
+        edges.append({
+            "id": edge_id,
+            "edge_type": edge_type,
+            "source": {"type": source[0], "id": source[1]},
+            "target": {"type": target[0], "id": target[1]},
+            # Drawn towards a summary instead of the real end
+            "aggregated": (source[0], source[1]) != (kinds[source_ct], source_id)
+            or (target[0], target[1]) != (kinds[target_ct], target_id),
+        })
+    return edges
@@ -0,0 +1,325 @@
+import json
+import platform
+import statistics
+import subprocess
+import time
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+
+from organigramme.hierarchy import get_subtree_structure_ids
+from organigramme.jobs import work, SUCCEEDED, FINISHED
+from organigramme.models import Position, DiagramPosition, Job
+from organigramme.nodes import get_node_kind
+from organigramme.synthetic import generate_chart, find_chart, delete_chart
+from organigramme.views import StructureViewSet
+from src.instrumentation import measure_queries
+from src.pdf_service import clear_render_caches
+
+DEFAULT_SIZES = '100,1000,10000,50000'
+# Rows sent to the bulk endpoints
+BULK_SIZE = 500
+PAGE_SIZE = 100
+JOB_POLL_SECONDS = 0.01
+# Slower than the compared run by more than this ratio: reported as a regression
+REGRESSION_THRESHOLD = 1.2
+
+GRAPHQL_QUERIES = {
+    'positionList': """
+        query positionList($pageSize: Int) {
+          positionList(pageSize: $pageSize) {
+            pageInfo { totalCount }
+            results { id title quantity grade { id name } structure { id name } }
+          }
+        }
+    """,
+    'structureList': """
+        query structureList($pageSize: Int) {
+          structureList(pageSize: $pageSize) {
+            pageInfo { totalCount }
+            results { id name parent { id name } manager { id title } }
+          }
+        }
+    """,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the API hot paths (tree, position list, auto-organize, PDF, bulk endpoints, GraphQL) '
+        'on synthetic charts of increasing size and write the timings and query counts as JSON. '
+        'Run it against a local database: the charts are created there and deleted at the end.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default=DEFAULT_SIZES, help=f'Positions per chart (default {DEFAULT_SIZES})')
+        parser.add_argument('--iterations', type=int, default=5)
+        parser.add_argument('--only', help='Comma separated benchmark names (default: all)')
+        parser.add_argument('--output', help='JSON file to write (default: stdout)')
+        parser.add_argument('--compare', help='JSON file of a previous run to compare with')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--keep', action='store_true',
+            help='Keep the generated charts; the next runs reuse them instead of generating them again'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',') if size.strip()]
+        except ValueError:
+            raise CommandError('--sizes must be a comma separated list of integers')
+        if options['iterations'] < 1:
+            raise CommandError('--iterations must be at least 1')
+        benchmarks = self.get_benchmarks()
+        if options['only']:
+            names = set(options['only'].split(','))
+            unknown = names - set(benchmarks)
+            if unknown:
+                raise CommandError(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+            benchmarks = {name: function for name, function in benchmarks.items() if name in names}
+
+        user = get_user_model().objects.filter(is_superuser=True).order_by('id').first()
+        if user is None:
+            raise CommandError('A superuser is needed to call the API')
+        self.user = user
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+        self.iterations = options['iterations']
+
+        results = []
+        for size in sizes:
+            started = time.perf_counter()
+            main = find_chart(size)
+            reused = main is not None
+            if not reused:
+                self.stderr.write(f'Generating a chart of {size} positions...')
+                main = generate_chart(size, seed=options['seed'])
+            chart = {
+                "positions": size,
+                "structures": len(self.structure_ids(main)),
+                "reused": reused,
+                "generation_seconds": round(time.perf_counter() - started, 3),
+                "benchmarks": {},
+            }
+            try:
+                for name, function in benchmarks.items():
+                    self.stderr.write(f'{size} positions: {name}')
+                    chart["benchmarks"][name] = function(main)
+            finally:
+                if not options['keep']:
+                    delete_chart(main)
+            results.append(chart)
+
+        report = {
+            "commit": self.git_commit(),
+            "created_at": timezone.now().isoformat(),
+            "database": connection.vendor,
+            "django": django.get_version(),
+            "python": platform.python_version(),
+            "iterations": self.iterations,
+            "charts": results,
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output + '\n')
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+        else:
+            self.stdout.write(output)
+        if options['compare']:
+            self.compare(options['compare'], report)
+
+    def get_benchmarks(self):
+        return {
+            'structures.tree': self.bench_tree,
+            'positions.list': self.bench_position_list,
+            'structures.auto_organize': self.bench_structure_auto_organize,
+            'diagram.auto_organize': self.bench_diagram_auto_organize,
+            'positions.generate_pdf': self.bench_generate_pdf,
+            'positions.bulk_update': self.bench_bulk_update,
+            'diagram_positions.bulk_sync': self.bench_bulk_sync,
+            'graphql.positionList': self.bench_graphql('positionList'),
+            'graphql.structureList': self.bench_graphql('structureList'),
+        }
+
+    # Measures
+
+    def measure(self, call, before=None):
+        """
+        Time `call` over the iterations. A failing path (exception or non 2xx
+        response) is reported with its error instead of timings.
+        """
+        timings, queries = [], []
+        for _ in range(self.iterations):
+            if before:
+                before()
+            # Also counts the queries of the views served in the async pool
+            with measure_queries() as metrics:
+                started = time.perf_counter()
+                try:
+                    response = call()
+                except Exception as error:
+                    return {"error": f'{type(error).__name__}: {error}'}
+                elapsed = time.perf_counter() - started
+            if not 200 <= response.status_code < 300:
+                return {"status": response.status_code, "error": str(getattr(response, 'data', ''))[:500]}
+            timings.append(elapsed * 1000)
+            queries.append(metrics.queries)
+        return {
+            "status": response.status_code,
+            "queries": max(queries),
+            "min_queries": min(queries),
+            "ms": {
+                "min": round(min(timings), 2),
+                "p50": round(statistics.median(timings), 2),
+                "mean": round(statistics.mean(timings), 2),
+                "max": round(max(timings), 2),
+            },
+        }
+
+    def run_job(self, job_id, kind):
+        """
+        Run the queued job here, or wait for it when the local workers
+        (JOB_BACKEND 'local') took it first. Raises if it did not succeed.
+        """
+        work('benchmark', kinds=[kind], once=True)
+        job = Job.objects.get(id=job_id)
+        while job.status not in FINISHED:
+            time.sleep(JOB_POLL_SECONDS)
+            job.refresh_from_db()
+        if job.status != SUCCEEDED:
+            raise RuntimeError(f'Job {job.status}: {job.error}')
+
+    def structure_ids(self, main):
+        return get_subtree_structure_ids(main.id)
+
+    def largest_structure(self, main):
+        """The unit of the chart with the most positions."""
+        counts = {}
+        for structure_id in Position.objects.filter(
+            structure_id__in=self.structure_ids(main)
+        ).values_list('structure_id', flat=True):
+            counts[structure_id] = counts.get(structure_id, 0) + 1
+        return max(counts, key=counts.get)
+
+    def bench_tree(self, main):
+        return self.measure(lambda: self.client.get(f'/api/structures/{main.id}/tree/'))
+
+    def bench_position_list(self, main):
+        # "parent" and "diagram_positions" are method fields, serialized for every position
+        return self.measure(lambda: self.client.get('/api/positions/', {'page_size': PAGE_SIZE}))
+
+    def bench_structure_auto_organize(self, main):
+        # The viewset action is shadowed by AutoOrganizeDiagramView in the urls: call it directly
+        view = StructureViewSet.as_view({'post': 'auto_organize'})
+        structure_id = self.largest_structure(main)
+        factory = APIRequestFactory()
+
+        def call():
+            request = factory.post(f'/api/structures/{structure_id}/auto-organize/', format='json')
+            force_authenticate(request, self.user)
+            response = view(request, pk=structure_id)
+            if response.status_code == 202:
+                self.run_job(response.data['job'], 'organize_positions')
+            return response
+        return dict(self.measure(call), structure=structure_id)
+
+    def bench_diagram_auto_organize(self, main):
+        # The endpoint queues a job: time the request and the job
+        def call():
+            response = self.client.post(f'/api/structures/{main.id}/auto-organize/')
+            if response.status_code == 202:
+                self.run_job(response.data['job'], 'auto_organize')
+            return response
+        return self.measure(call)
+
+    def bench_generate_pdf(self, main):
+        """Cold rendering: the stored document and the render caches are dropped each time."""
+        position_id = Position.objects.filter(structure_id=self.largest_structure(main)).order_by('id').values_list(
+            'id', flat=True
+        ).first()
+
+        def before():
+            clear_render_caches()
+            # A new updated_at changes the signature: the stored document is not used
+            Position.objects.filter(id=position_id).update(updated_at=timezone.now())
+
+        # A miss queues a rendering job: time the request, the job, run here, and the download
+        def call():
+            response = self.client.get(f'/api/positions/{position_id}/generate_pdf/')
+            if response.status_code == 202:
+                self.run_job(response.data['job'], 'render_fiche_de_poste')
+                response = self.client.get(f'/api/positions/{position_id}/generate_pdf/')
+            return response
+        return dict(self.measure(call, before), position=position_id)
+
+    def bench_bulk_update(self, main):
+        positions = list(Position.objects.filter(
+            structure_id__in=self.structure_ids(main)
+        ).order_by('id').values_list('id', 'position_x', 'position_y')[:BULK_SIZE])
+        payload = {"updates": [{"id": position_id, "x": x + 10, "y": y + 10} for position_id, x, y in positions]}
+        return dict(self.measure(lambda: self.client.post('/api/positions/bulk-update/', payload, format='json')),
+                    rows=len(positions))
+
+    def bench_bulk_sync(self, main):
+        rows = DiagramPosition.objects.filter(main_structure=main).order_by('id').values_list(
+            'content_type_id', 'object_id', 'position_x', 'position_y'
+        )[:BULK_SIZE]
+        payload = {
+            "main_structure": main.id,
+            "nodes": [
+                {"content_type": get_node_kind(content_type_id), "object_id": object_id,
+                 "position_x": x + 10, "position_y": y + 10}
+                for content_type_id, object_id, x, y in rows
+            ],
+        }
+        return dict(self.measure(lambda: self.client.post('/api/diagram-positions/bulk-sync/', payload, format='json')),
+                    rows=len(payload["nodes"]))
+
+    def bench_graphql(self, operation):
+        def bench(main):
+            payload = {
+                "query": GRAPHQL_QUERIES[operation], "operationName": operation, "variables": {"pageSize": PAGE_SIZE}
+            }
+
+            def call():
+                response = self.client.post('/graphql/', payload, format='json')
+                errors = json.loads(response.content).get('errors')
+                if errors:
+                    raise ValueError(errors[0].get('message'))
+                return response
+            return self.measure(call)
+        return bench
+
+    # Report
+
+    def git_commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def compare(self, path, report):
+        with open(path) as file:
+            previous = json.load(file)
+        previous_charts = {chart["positions"]: chart["benchmarks"] for chart in previous.get("charts", [])}
+        self.stdout.write(f"Compared with {previous.get('commit') or path}:")
+        for chart in report["charts"]:
+            for name, result in chart["benchmarks"].items():
+                before = previous_charts.get(chart["positions"], {}).get(name)
+                if before is None or "error" in before or "error" in result:
+                    continue
+                ratio = result["ms"]["p50"] / before["ms"]["p50"] if before["ms"]["p50"] else 1
+                line = (
+                    f'{chart["positions"]:>6} {name:<28} p50 {before["ms"]["p50"]:.1f} -> {result["ms"]["p50"]:.1f} ms '
+                    f'({ratio:.2f}x), queries {before["queries"]} -> {result["queries"]}'
+                )
+                regression = ratio > REGRESSION_THRESHOLD or result["queries"] > before["queries"]
+                self.stdout.write(self.style.WARNING(line) if regression else line)
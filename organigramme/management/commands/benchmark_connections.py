@@ -0,0 +1,132 @@
+import json
+import statistics
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client, RequestFactory
+
+from src.connections import PooledDatabaseWrapperMixin
+
+MODES = ('per_request', 'persistent', 'pool')
+# Polled by the frontend on every page
+DEFAULT_PATH = '/api/auth/verify/'
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure the database connection overhead per request: the same authenticated request served '
+        'through the WSGI handler (connections closed at the end of the request as in production) with '
+        'a new connection per request, persistent connections, and the in-process pool.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--path', default=DEFAULT_PATH)
+        parser.add_argument('--modes', default=','.join(MODES), help=f"Comma separated, among {', '.join(MODES)}")
+        parser.add_argument('--database', default='default')
+        parser.add_argument('--output', help='JSON file to write')
+
+    def handle(self, *args, **options):
+        modes = options['modes'].split(',')
+        unknown = set(modes) - set(MODES)
+        if unknown:
+            raise CommandError(f"Unknown modes: {', '.join(sorted(unknown))}")
+        if options['requests'] < 1:
+            raise CommandError('--requests must be at least 1')
+        user = get_user_model().objects.filter(is_superuser=True).order_by('id').first()
+        if user is None:
+            raise CommandError('A superuser is needed to authenticate the requests')
+
+        # A real session: the request reads it and the user from the database
+        client = Client()
+        client.force_login(user)
+        cookie = '; '.join(f'{name}={morsel.value}' for name, morsel in client.cookies.items())
+        environ = RequestFactory().get(options['path'], HTTP_COOKIE=cookie).environ
+
+        connection = connections[options['database']]
+        configured = {key: connection.settings_dict.get(key) for key in ('CONN_MAX_AGE', 'POOL')}
+        results = {}
+        try:
+            for mode in modes:
+                if mode == 'pool' and not isinstance(connection, PooledDatabaseWrapperMixin):
+                    results[mode] = {"skipped": "the database backend has no pool (ENGINE src.db_backends.*)"}
+                    continue
+                connection.close()
+                connection.settings_dict['CONN_MAX_AGE'] = (configured['CONN_MAX_AGE'] or 60) if mode == 'persistent' else 0
+                connection.settings_dict['POOL'] = (configured['POOL'] or {'MAX_SIZE': 10}) if mode == 'pool' else None
+                results[mode] = self.measure(connection, environ, options['requests'])
+        finally:
+            connection.close()
+            connection.settings_dict.update(configured)
+
+        report = {
+            "path": options['path'],
+            "vendor": connection.vendor,
+            "engine": connection.settings_dict['ENGINE'],
+            "requests": options['requests'],
+            "modes": results,
+        }
+        for mode, result in results.items():
+            if "skipped" in result:
+                self.stdout.write(f'{mode:<12} skipped: {result["skipped"]}')
+                continue
+            self.stdout.write(
+                f'{mode:<12} p50 {result["ms"]["p50"]:7.2f} ms  mean {result["ms"]["mean"]:7.2f} ms  '
+                f'connections opened {result["connections_opened"]:>5}  '
+                f'connect {result["connect_ms_per_request"]:6.3f} ms/request'
+            )
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(report, file, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+    def measure(self, connection, environ, requests):
+        handler = WSGIHandler()
+        connect_times = []
+        connect = connection.connect
+
+        def timed_connect():
+            started = time.perf_counter()
+            try:
+                return connect()
+            finally:
+                connect_times.append(time.perf_counter() - started)
+
+        def start_response(status, headers):
+            if not status.startswith('2'):
+                raise CommandError(f'{environ["PATH_INFO"]} answered {status}')
+
+        pool = connection.get_pool() if connection.settings_dict.get('POOL') else None
+        opened_before = pool.stats['opened'] if pool is not None else 0
+        timings = []
+        # The instance attribute shadows the method for the handler's connects
+        connection.connect = timed_connect
+        try:
+            for index in range(requests + 1):
+                started = time.perf_counter()
+                response = handler(dict(environ), start_response)
+                b''.join(response)
+                # Sends request_finished: connections are closed (or released) as by a WSGI server
+                response.close()
+                if index:
+                    timings.append((time.perf_counter() - started) * 1000)
+                else:
+                    # Warm-up request: URL resolution, imports
+                    connect_times.clear()
+                    opened_before = pool.stats['opened'] if pool is not None else 0
+        finally:
+            del connection.connect
+
+        return {
+            "ms": {
+                "p50": round(statistics.median(timings), 3),
+                "mean": round(statistics.mean(timings), 3),
+                "max": round(max(timings), 3),
+            },
+            "connects": len(connect_times),
+            "connections_opened": pool.stats['opened'] - opened_before if pool is not None else len(connect_times),
+            "connect_ms_per_request": round(sum(connect_times) * 1000 / requests, 3),
+        }
@@ -0,0 +1,51 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from organigramme.models import Position
+from organigramme.pdf import FICHE_DE_POSTE_TEMPLATE, load_fiche_de_poste_contexts
+from src.pdf_service import render_pdf, clear_render_caches, get_render_metrics, reset_render_metrics
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the fiche de poste PDF rendering latency, with cold and warm render caches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--position', type=int, help='Position id (default: the first position)')
+        parser.add_argument('--iterations', type=int, default=20)
+
+    def handle(self, *args, **options):
+        position_id = options['position'] or Position.objects.order_by('id').values_list('id', flat=True).first()
+        if position_id is None:
+            raise CommandError('No position to render')
+        context = load_fiche_de_poste_contexts([position_id]).get(position_id)
+        if context is None:
+            raise CommandError(f'Position with id {position_id} not found')
+
+        # Cold: every cache dropped before each rendering, as without the service
+        cold = self.run(context, options['iterations'], clear_render_caches)
+        warm = self.run(context, options['iterations'])
+
+        for label, timings in (('cold', cold), ('warm', warm)):
+            self.stdout.write(
+                f"{label}: avg {statistics.mean(timings):.1f} ms, "
+                f"p50 {statistics.median(timings):.1f} ms, max {max(timings):.1f} ms"
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f"speedup: {statistics.mean(cold) / statistics.mean(warm):.2f}x"
+        ))
+        metrics = get_render_metrics()[FICHE_DE_POSTE_TEMPLATE]
+        self.stdout.write(f"output size: {metrics['bytes'] // metrics['count']} bytes")
+
+    def run(self, context, iterations, before=None):
+        reset_render_metrics()
+        timings = []
+        for _ in range(iterations):
+            if before:
+                before()
+            started = time.perf_counter()
+            if render_pdf(FICHE_DE_POSTE_TEMPLATE, context) is None:
+                raise CommandError('Error generating PDF')
+            timings.append((time.perf_counter() - started) * 1000)
+        return timings
@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from organigramme.importer import import_chart, ChartImportError
+
+
+class Command(BaseCommand):
+    help = 'Import an org chart from a CSV or XLSX file (one row per position)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--dry-run', action='store_true', help='Only validate the file')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            with open(options['path'], 'rb') as file:
+                chart_import = import_chart(file, options['path'], dry_run=options['dry_run'])
+        except (OSError, ChartImportError) as e:
+            raise CommandError(str(e))
+
+        for error in chart_import.errors:
+            self.stdout.write(self.style.ERROR(f"line {error['line']}: {error['error']}"))
+        summary = ', '.join(f"{count} {table}" for table, count in chart_import.summary.items())
+        elapsed = time.perf_counter() - started
+        if chart_import.errors:
+            raise CommandError(f"{len(chart_import.errors)} errors, nothing was imported")
+        if options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f"Valid file ({summary}) in {elapsed:.2f}s"))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Imported {summary} in {elapsed:.2f}s"))
@@ -0,0 +1,21 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from organigramme.changelog import prune_changelog
+
+
+class Command(BaseCommand):
+    help = 'Delete the change log entries older than the retention period'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=getattr(settings, 'CHANGELOG_RETENTION_DAYS', 30),
+            help='Keep the entries of the last DAYS days'
+        )
+
+    def handle(self, *args, **options):
+        count = prune_changelog(timezone.now() - timedelta(days=options['days']))
+        self.stdout.write(self.style.SUCCESS(f'Deleted {count} change log entries'))
@@ -0,0 +1,21 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from organigramme.jobs import prune_jobs
+
+
+class Command(BaseCommand):
+    help = 'Delete the finished background jobs older than the retention period, and their files'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=getattr(settings, 'JOB_RETENTION_DAYS', 7),
+            help='Keep the jobs finished during the last DAYS days'
+        )
+
+    def handle(self, *args, **options):
+        count = prune_jobs(timezone.now() - timedelta(days=options['days']))
+        self.stdout.write(self.style.SUCCESS(f'Deleted {count} jobs'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from organigramme.rollups import rebuild_headcounts
+
+
+class Command(BaseCommand):
+    help = 'Recompute the headcount rollups of every structure from the positions'
+
+    def handle(self, *args, **options):
+        count = rebuild_headcounts()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {count} headcount rows'))
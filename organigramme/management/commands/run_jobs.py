@@ -0,0 +1,79 @@
+import multiprocessing
+import os
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from organigramme.jobs import JOB_TYPES, run_worker
+from src.workers import run_django_process
+
+
+class Command(BaseCommand):
+    help = (
+        'Run the background jobs (see organigramme.jobs) in worker processes. '
+        'Workers finish their current job on SIGTERM or SIGINT, then exit.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes', type=int, default=getattr(settings, 'JOB_WORKER_PROCESSES', 2),
+            help='Worker processes (default JOB_WORKER_PROCESSES)'
+        )
+        parser.add_argument('--kinds', help=f"Comma separated job types to run (default: all of {', '.join(JOB_TYPES)})")
+        parser.add_argument('--once', action='store_true', help='Exit once no job is left to run')
+        parser.add_argument(
+            '--poll-interval', type=float, default=getattr(settings, 'JOB_POLL_INTERVAL', 1),
+            help='Seconds between two polls of an idle worker'
+        )
+
+    def handle(self, *args, **options):
+        if getattr(settings, 'JOB_BACKEND', 'local') != 'database':
+            raise CommandError("JOB_BACKEND is not 'database': the jobs are run by the web processes")
+        if options['processes'] < 1:
+            raise CommandError('--processes must be at least 1')
+        kinds = options['kinds'].split(',') if options['kinds'] else None
+        unknown = set(kinds or []) - set(JOB_TYPES)
+        if unknown:
+            raise CommandError(f"Unknown job types: {', '.join(sorted(unknown))}")
+        worker_options = dict(kinds=kinds, once=options['once'], poll_interval=options['poll_interval'])
+
+        if options['processes'] == 1:
+            count = run_worker(**worker_options)
+            self.stdout.write(self.style.SUCCESS(f'Ran {count} jobs'))
+            return
+
+        context = multiprocessing.get_context('spawn')
+        settings_module = os.environ.get('DJANGO_SETTINGS_MODULE', 'src.settings')
+
+        def start():
+            process = context.Process(
+                target=run_django_process, args=(settings_module, 'organigramme.jobs.run_worker'),
+                kwargs=worker_options, name='job-worker',
+            )
+            process.start()
+            return process
+
+        stop = threading.Event()
+
+        def shutdown(*args):
+            stop.set()
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+
+        processes = [start() for _ in range(options['processes'])]
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+        self.stdout.write(f"Started {len(processes)} job workers")
+        while processes:
+            for process in list(processes):
+                process.join(timeout=1)
+                if process.exitcode is None:
+                    continue
+                processes.remove(process)
+                # A worker killed by a crash is replaced, until the queue is drained or stopped
+                if process.exitcode != 0 and not stop.is_set() and not options['once']:
+                    self.stderr.write(f'Job worker {process.pid} exited with {process.exitcode}, restarting it')
+                    processes.append(start())
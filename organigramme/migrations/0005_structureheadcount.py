@@ -0,0 +1,60 @@
+# Generated by Django 3.2 on 2026-10-18 20:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_headcounts(apps, schema_editor):
+    from organigramme.rollups import compute_headcounts
+
+    Structure = apps.get_model('organigramme', 'Structure')
+    Position = apps.get_model('organigramme', 'Position')
+    Grade = apps.get_model('organigramme', 'Grade')
+    StructureHeadcount = apps.get_model('organigramme', 'StructureHeadcount')
+
+    totals = compute_headcounts(
+        dict(Structure.objects.values_list('id', 'parent_id')),
+        Position.objects.values_list('structure_id', 'grade_id', 'quantity').order_by()
+    )
+    categories = dict(Grade.objects.values_list('id', 'category'))
+    StructureHeadcount.objects.bulk_create(
+        [
+            StructureHeadcount(
+                structure_id=structure_id, grade_id=grade_id, category=categories.get(grade_id, ''),
+                positions_count=count, headcount=headcount
+            )
+            for (structure_id, grade_id), (count, headcount) in totals.items()
+        ],
+        batch_size=500
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('organigramme', '0004_auto_20250716_1127'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StructureHeadcount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(max_length=20)),
+                ('positions_count', models.IntegerField(default=0)),
+                ('headcount', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('grade', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='structure_headcounts', to='organigramme.grade')),
+                ('structure', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='headcounts', to='organigramme.structure')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='structureheadcount',
+            index=models.Index(fields=['structure', 'category'], name='organigramm_structu_c62733_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='structureheadcount',
+            unique_together={('structure', 'grade')},
+        ),
+        migrations.RunPython(populate_headcounts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2 on 2026-10-18 21:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('organigramme', '0005_structureheadcount'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='diagramposition',
+            name='organigramm_main_st_1b6bea_idx',
+        ),
+        migrations.AddIndex(
+            model_name='diagramposition',
+            index=models.Index(fields=['main_structure', 'position_x', 'position_y'], name='organigramm_main_st_60ec94_idx'),
+        ),
+    ]
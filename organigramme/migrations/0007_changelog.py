@@ -0,0 +1,30 @@
+# Generated by Django 3.2 on 2026-10-18 21:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('organigramme', '0006_diagramposition_viewport_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLog',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('structure', 'Structure'), ('position', 'Position'), ('edge', 'Edge'), ('diagram_position', 'Diagram position'), ('diagram', 'Diagram')], max_length=20)),
+                ('action', models.CharField(choices=[('created', 'Created'), ('updated', 'Updated'), ('deleted', 'Deleted'), ('reset', 'Reset')], max_length=10)),
+                ('object_id', models.PositiveIntegerField()),
+                ('node_kind', models.CharField(blank=True, default='', max_length=20)),
+                ('structure_id', models.PositiveIntegerField(blank=True, null=True)),
+                ('previous_structure_id', models.PositiveIntegerField(blank=True, null=True)),
+                ('main_structure_id', models.PositiveIntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 3.2 on 2026-10-18 21:23
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('organigramme', '0007_changelog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SnapshotBlob',
+            fields=[
+                ('hash', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('data', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ChartSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('main_structure_name', models.CharField(max_length=255)),
+                ('name', models.CharField(max_length=255)),
+                ('decree_date', models.DateField(blank=True, null=True)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('manifest', models.BinaryField()),
+                ('structures_count', models.IntegerField(default=0)),
+                ('positions_count', models.IntegerField(default=0)),
+                ('new_blobs_count', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='chart_snapshots', to=settings.AUTH_USER_MODEL)),
+                ('main_structure', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='chart_snapshots', to='organigramme.structure')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='chartsnapshot',
+            index=models.Index(fields=['main_structure', 'decree_date'], name='organigramm_main_st_29ec18_idx'),
+        ),
+    ]
@@ -1,4 +1,7 @@
+import uuid
+
 from django.db import models
+from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 
@@ -6,6 +9,7 @@ from django.contrib.auth.models import AbstractUser
 
 from django.forms import ValidationError
 from django.db.models.functions import Lower
+from django.utils import timezone
 
 
 class Grade(models.Model):
@@ -123,6 +127,29 @@ class Competence(models.Model):
 
 
 
+class StructureHeadcount(models.Model):
+    """
+    Positions and headcount of a structure and all its descendants, for one grade.
+    Maintained incrementally (see organigramme.rollups) so that totals over
+    the hierarchy are read without walking the tree.
+    """
+    structure = models.ForeignKey(Structure, on_delete=models.CASCADE, related_name='headcounts')
+    grade = models.ForeignKey(Grade, on_delete=models.CASCADE, related_name='structure_headcounts')
+    category = models.CharField(max_length=20)  # Grade category, copied for grouping
+    positions_count = models.IntegerField(default=0)
+    headcount = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('structure', 'grade')
+        indexes = [
+            models.Index(fields=['structure', 'category']),
+        ]
+
+    def __str__(self):
+        return f"{self.structure} / {self.grade}: {self.headcount}"
+
+
 class DiagramPosition(models.Model):
     """
     Stores the position of a structure or position relative to its nearest main parent structure.
@@ -146,7 +173,8 @@ class DiagramPosition(models.Model):
         unique_together = ('content_type', 'object_id', 'main_structure')
         indexes = [
             models.Index(fields=['content_type', 'object_id']),
-            models.Index(fields=['main_structure']),
+            # Viewport queries: range on the coordinates of one diagram
+            models.Index(fields=['main_structure', 'position_x', 'position_y']),
         ]
     
     def __str__(self):
@@ -177,3 +205,140 @@ class OrganigramEdge(models.Model):
     
     def __str__(self):
         return f"Edge from {self.source} to {self.target}"
+
+
+class ChangeLog(models.Model):
+    """
+    Append-only log of the writes on the charts, read by the incremental
+    sync endpoint (see organigramme.changelog). The id is the version token
+    handed to the clients; deletes are kept as tombstones.
+    No foreign keys: the entries must outlive the rows they describe.
+    """
+    KIND_CHOICES = [
+        ('structure', 'Structure'),
+        ('position', 'Position'),
+        ('edge', 'Edge'),
+        ('diagram_position', 'Diagram position'),
+        ('diagram', 'Diagram'),
+    ]
+    ACTION_CHOICES = [
+        ('created', 'Created'),
+        ('updated', 'Updated'),
+        ('deleted', 'Deleted'),
+        ('reset', 'Reset'),
+    ]
+
+    id = models.BigAutoField(primary_key=True)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    object_id = models.PositiveIntegerField()
+    # Diagram positions: kind of the node ("structure" or "position")
+    node_kind = models.CharField(max_length=20, blank=True, default='')
+    # Structure holding the object (parent of a structure), before and after a move
+    structure_id = models.PositiveIntegerField(null=True, blank=True)
+    previous_structure_id = models.PositiveIntegerField(null=True, blank=True)
+    # Diagram positions and diagram resets
+    main_structure_id = models.PositiveIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self):
+        return f"#{self.id} {self.kind} {self.object_id} {self.action}"
+
+
+class SnapshotBlob(models.Model):
+    """
+    Compressed JSON of one structure and its positions, shared by every
+    chart snapshot where they are unchanged (see organigramme.history).
+    Addressed by the SHA-256 of the uncompressed JSON.
+    """
+    hash = models.CharField(max_length=64, primary_key=True)
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.hash
+
+
+class ChartSnapshot(models.Model):
+    """
+    Frozen copy of the chart of a main structure (e.g. as of a decree date).
+    The manifest lists the SnapshotBlob of each structure, the edges and the
+    diagram coordinates, compressed (see organigramme.history).
+    """
+    main_structure = models.ForeignKey(
+        Structure, on_delete=models.SET_NULL, related_name='chart_snapshots', null=True, blank=True
+    )
+    # Kept when the structure is deleted
+    main_structure_name = models.CharField(max_length=255)
+    name = models.CharField(max_length=255)
+    decree_date = models.DateField(null=True, blank=True)
+    description = models.TextField(blank=True, null=True)
+    manifest = models.BinaryField()
+    structures_count = models.IntegerField(default=0)
+    positions_count = models.IntegerField(default=0)
+    # Blobs written by this snapshot; the others were shared with earlier ones
+    new_blobs_count = models.IntegerField(default=0)
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, related_name='chart_snapshots', null=True, blank=True
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['main_structure', 'decree_date']),
+        ]
+
+    def __str__(self):
+        return f"{self.main_structure_name} - {self.name}"
+
+
+class Job(models.Model):
+    """
+    Background job of a heavy operation (see organigramme.jobs). A running
+    job holds one of the `slot`s of its kind: the slots bound how many jobs
+    of a kind run at once, across every worker.
+    """
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+        ('cancelled', 'Cancelled'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField(max_length=50)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    payload = models.JSONField(default=dict, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True, default='')
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=1)
+    slot = models.PositiveIntegerField(null=True, blank=True)
+    worker = models.CharField(max_length=100, blank=True, default='')
+    # Not claimed before this time (retries are delayed)
+    run_after = models.DateTimeField(default=timezone.now)
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, related_name='jobs', null=True, blank=True
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'run_after']),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['kind', 'slot'], condition=models.Q(status='running'), name='organigramme_job_running_slot'
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.id} ({self.status})"
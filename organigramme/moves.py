@@ -0,0 +1,247 @@
+"""
+Atomic re-parenting of structures and positions.
+
+A move updates the parent links and edges of the moved subtree, then
+repositions only the affected nodes of every diagram that shows them
+(see `layout.relayout_after_move`) instead of re-organizing whole charts.
+"""
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .hierarchy import get_structure_parent_map, get_subtree_structure_ids
+from .layout import (
+    load_layout_tree, compute_layout, relayout_after_move, POSITION_WIDTH, X_SPACING
+)
+from .models import Structure, Position, OrganigramEdge, DiagramPosition
+from .nodes import get_node_content_type_ids
+from .changelog import change, log_changes
+from .feed import broker, publish_change, diagrams_of_structure, edge_event
+from .versions import bump_chart_version
+from .rollups import update_position_rollups
+
+
+class MoveError(ValueError):
+    """Raised when a move is not allowed (unknown parent, cycle, ...)."""
+
+
+def get_position_descendant_ids(position_id):
+    """
+    Return the positions reachable from `position_id` through
+    position -> position edges (the position itself excluded).
+    """
+    content_type_ids = get_node_content_type_ids()
+    rows = OrganigramEdge.objects.filter(
+        source_content_type_id=content_type_ids['position'],
+        target_content_type_id=content_type_ids['position']
+    ).values_list('source_object_id', 'target_object_id')
+
+    children_map = {}
+    for source_id, target_id in rows:
+        children_map.setdefault(source_id, []).append(target_id)
+
+    descendants = []
+    seen = {position_id}
+    stack = list(children_map.get(position_id, []))
+    while stack:
+        child_id = stack.pop()
+        if child_id in seen:
+            continue
+        seen.add(child_id)
+        descendants.append(child_id)
+        stack.extend(children_map.get(child_id, []))
+    return descendants
+
+
+def _diagrams_to_update(moved_root, new_parent_id, moved_structure_ids=()):
+    """
+    Main structures whose diagram shows the moved node or its new parent.
+    Diagrams rooted inside the moved subtree move with it and are left alone.
+    """
+    content_type_ids = get_node_content_type_ids()
+    kind, object_id = moved_root
+    query = Q(content_type_id=content_type_ids[kind], object_id=object_id)
+    if new_parent_id is not None:
+        query |= Q(content_type_id=content_type_ids['structure'], object_id=new_parent_id)
+    main_structure_ids = DiagramPosition.objects.filter(query).exclude(
+        main_structure_id__in=list(moved_structure_ids)
+    ).values_list('main_structure_id', flat=True)
+    return sorted(set(main_structure_ids))
+
+
+def _relayout(moved_nodes, moved_root, old_parent_id, new_parent_id, relative_layout):
+    moved_structure_ids = [object_id for kind, object_id in moved_nodes if kind == 'structure']
+    return [
+        relayout_after_move(
+            main_structure_id, moved_nodes, moved_root, old_parent_id, new_parent_id,
+            relative_layout=relative_layout
+        )
+        for main_structure_id in _diagrams_to_update(moved_root, new_parent_id, moved_structure_ids)
+    ]
+
+
+@transaction.atomic
+def move_structure(structure, new_parent_id):
+    """
+    Re-parent `structure` (with its whole subtree) under `new_parent_id`,
+    or make it a root when `new_parent_id` is None.
+
+    Returns the per-diagram coordinate changes.
+    """
+    content_type_ids = get_node_content_type_ids()
+    parent_map = get_structure_parent_map()
+
+    if new_parent_id is not None and new_parent_id not in parent_map:
+        raise MoveError(f"Structure with id {new_parent_id} not found")
+
+    subtree_ids = get_subtree_structure_ids(structure.id, parent_map)
+    if new_parent_id in subtree_ids:
+        raise MoveError("A structure cannot be moved under its own subtree")
+
+    old_parent_id = structure.parent_id
+    if old_parent_id == new_parent_id:
+        return []
+
+    structure.parent_id = new_parent_id
+    structure.save(update_fields=['parent', 'updated_at'])
+
+    # Edges drawn from the old parent now come from the new one, which gets
+    # one when there was none (root structure, edge never drawn)
+    incoming = OrganigramEdge.objects.filter(
+        source_content_type_id=content_type_ids['structure'],
+        source_object_id=old_parent_id,
+        target_content_type_id=content_type_ids['structure'],
+        target_object_id=structure.id
+    )
+    if new_parent_id is None:
+        incoming.delete()
+    else:
+        moved_edges = list(incoming.values_list('id', 'structure_id'))
+        incoming.update(source_object_id=new_parent_id, structure_id=new_parent_id)
+        # update() sends no signal
+        log_changes(
+            change('edge', 'updated', edge_id, structure_id=new_parent_id, previous_structure_id=edge_structure_id)
+            for edge_id, edge_structure_id in moved_edges
+        )
+        if broker.has_subscribers():
+            for edge in OrganigramEdge.objects.filter(id__in=[edge_id for edge_id, _ in moved_edges]):
+                publish_change(diagrams_of_structure(new_parent_id), edge_event(edge, "edge_updated"))
+        if not moved_edges:
+            # Saved one by one: the signal receivers log and publish it
+            OrganigramEdge.objects.get_or_create(
+                source_content_type_id=content_type_ids['structure'],
+                source_object_id=new_parent_id,
+                target_content_type_id=content_type_ids['structure'],
+                target_object_id=structure.id,
+                defaults={'structure_id': new_parent_id}
+            )
+
+    structure_children, structure_positions = load_layout_tree(structure.id)
+    moved_nodes = {('structure', structure_id) for structure_id in subtree_ids}
+    moved_nodes |= {
+        ('position', position_id)
+        for position_ids in structure_positions.values() for position_id in position_ids
+    }
+    relative_layout = compute_layout(structure.id, structure_children, structure_positions)
+
+    return _relayout(
+        moved_nodes, ('structure', structure.id), old_parent_id, new_parent_id, relative_layout
+    )
+
+
+@transaction.atomic
+def move_position(position, parent_type, parent_id):
+    """
+    Move `position` (with the positions reporting to it) under a structure
+    (`parent_type` "structure") or under another position ("position").
+
+    The moved positions take the structure of their new parent, the edge
+    from the old parent position is replaced and the diagrams are updated.
+    Returns the per-diagram coordinate changes.
+    """
+    content_type_ids = get_node_content_type_ids()
+    descendant_ids = get_position_descendant_ids(position.id)
+
+    if parent_type == 'structure':
+        if not Structure.objects.filter(id=parent_id).exists():
+            raise MoveError(f"Structure with id {parent_id} not found")
+        new_structure_id = parent_id
+        parent_position_id = None
+    elif parent_type == 'position':
+        if parent_id == position.id or parent_id in descendant_ids:
+            raise MoveError("A position cannot be moved under itself or its own subordinates")
+        new_structure_id = Position.objects.filter(id=parent_id).values_list('structure_id', flat=True).first()
+        if new_structure_id is None:
+            raise MoveError(f"Position with id {parent_id} not found or not attached to a structure")
+        parent_position_id = parent_id
+    else:
+        raise MoveError(f"Unknown parent type '{parent_type}'")
+
+    old_structure_id = position.structure_id
+    moved_ids = [position.id] + descendant_ids
+
+    if new_structure_id != old_structure_id:
+        moved = list(
+            Position.objects.filter(id__in=moved_ids).values_list('id', 'structure_id', 'grade_id', 'quantity')
+        )
+        moved_rows = [row[1:] for row in moved]
+        # update() sends no signal: the headcount rollups and the change log are updated here
+        Position.objects.filter(id__in=moved_ids).update(
+            structure_id=new_structure_id, updated_at=timezone.now()
+        )
+        update_position_rollups(
+            removed=moved_rows,
+            added=[(new_structure_id, grade_id, quantity) for _, grade_id, quantity in moved_rows]
+        )
+        log_changes(
+            change('position', 'updated', position_id, structure_id=new_structure_id,
+                   previous_structure_id=structure_id)
+            for position_id, structure_id, _, _ in moved
+        )
+        bump_chart_version()
+        if broker.has_subscribers():
+            diagrams = diagrams_of_structure(old_structure_id) | diagrams_of_structure(new_structure_id)
+            for position_id in moved_ids:
+                publish_change(diagrams, {
+                    "op": "node_updated", "kind": "position", "id": position_id,
+                    "data": {"structure_id": new_structure_id},
+                })
+        # Edges between the moved positions follow them
+        following = OrganigramEdge.objects.filter(
+            target_content_type_id=content_type_ids['position'],
+            target_object_id__in=descendant_ids
+        )
+        following_edges = list(following.values_list('id', 'structure_id'))
+        following.update(structure_id=new_structure_id)
+        log_changes(
+            change('edge', 'updated', edge_id, structure_id=new_structure_id, previous_structure_id=structure_id)
+            for edge_id, structure_id in following_edges
+        )
+        position.structure_id = new_structure_id
+
+    # Replace the link to the old parent
+    OrganigramEdge.objects.filter(
+        target_content_type_id=content_type_ids['position'],
+        target_object_id=position.id
+    ).delete()
+    if parent_position_id is not None:
+        OrganigramEdge.objects.create(
+            structure_id=new_structure_id,
+            source_content_type_id=content_type_ids['position'],
+            source_object_id=parent_position_id,
+            target_content_type_id=content_type_ids['position'],
+            target_object_id=position.id
+        )
+
+    if new_structure_id == old_structure_id:
+        # Same structure: the diagram layout does not depend on position edges
+        return []
+
+    moved_nodes = {('position', position_id) for position_id in moved_ids}
+    relative_layout = {
+        ('position', position_id): {'x': index * (POSITION_WIDTH + X_SPACING), 'y': 0}
+        for index, position_id in enumerate(moved_ids)
+    }
+    return _relayout(
+        moved_nodes, ('position', position.id), old_structure_id, new_structure_id, relative_layout
+    )
@@ -0,0 +1,59 @@
+"""
+Registry of the node kinds that can appear in a diagram.
+
+Diagram positions and edges reference their nodes through generic foreign
+keys. The kind -> ContentType id mapping is resolved once per process, so
+request handlers do not need to query the ContentType table by model name.
+"""
+from django.contrib.contenttypes.models import ContentType
+
+from .models import Structure, Position
+
+
+NODE_MODELS = {
+    'structure': Structure,
+    'position': Position,
+}
+
+_content_type_ids = {}
+
+
+def get_node_model(kind):
+    """Return the model class of a node kind, or None if the kind is unknown."""
+    return NODE_MODELS.get(str(kind).lower())
+
+
+def get_node_content_type_id(kind):
+    """Return the ContentType id of a node kind, or None if the kind is unknown."""
+    kind = str(kind).lower()
+    if kind not in NODE_MODELS:
+        return None
+    if kind not in _content_type_ids:
+        _content_type_ids[kind] = ContentType.objects.get_for_model(NODE_MODELS[kind]).id
+    return _content_type_ids[kind]
+
+
+def get_node_content_type(kind):
+    """Return the (cached) ContentType instance of a node kind."""
+    content_type_id = get_node_content_type_id(kind)
+    if content_type_id is None:
+        return None
+    return ContentType.objects.get_for_id(content_type_id)
+
+
+def get_node_content_type_ids():
+    """Return {kind: content_type_id} for every registered node kind."""
+    return {kind: get_node_content_type_id(kind) for kind in NODE_MODELS}
+
+
+def get_node_kind(content_type_id):
+    """Return the node kind of a ContentType id, or None if it is not a node."""
+    for kind, node_content_type_id in get_node_content_type_ids().items():
+        if node_content_type_id == content_type_id:
+            return kind
+    return None
+
+
+def clear_node_registry():
+    """Forget the resolved ids (e.g. after the ContentType table was rebuilt)."""
+    _content_type_ids.clear()
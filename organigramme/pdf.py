@@ -0,0 +1,362 @@
+"""
+Fiche de poste (job description) PDF pipeline.
+
+Rendered PDFs are stored with the default storage under a key derived from
+everything the document shows: the position, its grade, its missions and
+competences and its parent. Repeated downloads are served from storage and
+cache misses are rendered by a background job (see organigramme.jobs), in
+a pool of worker processes, so xhtml2pdf does not run inside the request
+thread. The job table holds the rendering state, so any web process can
+answer the polls.
+
+Whole structure subtrees can be exported at once, as a ZIP archive or a
+merged PDF, with the progress published in the cache.
+"""
+import hashlib
+import io
+import os
+import tempfile
+import zipfile
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Count, Max
+from pypdf import PdfWriter
+
+from src.pdf_service import render_pdf
+from src.workers import submit_to_pool
+from .hierarchy import get_subtree_structure_ids
+from .models import Structure, Position, Mission, Competence, OrganigramEdge, Job
+from .nodes import get_node_content_type_ids
+
+FICHE_DE_POSTE_TEMPLATE = 'organigramme/fiche_de_poste.html'
+
+# Bump when the template changes, so cached documents are rendered again
+FICHE_DE_POSTE_TEMPLATE_VERSION = 1
+
+PDF_CACHE_DIR = getattr(settings, 'PDF_CACHE_DIR', 'pdf_cache')
+PDF_RENDER_WORKERS = getattr(settings, 'PDF_RENDER_WORKERS', 2)
+
+
+def fiche_de_poste_filename(position):
+    return f"FICHE_DE_POSTE_{position.title}.pdf"
+
+
+def get_parent_map(position_ids):
+    """
+    Return {position_id: parent} where the parent is the source (position
+    or structure) of the edge targeting the position (three queries at most).
+    """
+    content_type_ids = get_node_content_type_ids()
+    edges = OrganigramEdge.objects.filter(
+        target_content_type_id=content_type_ids['position'],
+        target_object_id__in=list(position_ids)
+    ).order_by('id').values_list('target_object_id', 'source_content_type_id', 'source_object_id')
+
+    sources = {}
+    for target_id, source_content_type_id, source_id in edges:
+        sources.setdefault(target_id, (source_content_type_id, source_id))
+
+    models = {
+        content_type_ids['position']: Position,
+        content_type_ids['structure']: Structure,
+    }
+    loaded = {}
+    for content_type_id, model in models.items():
+        ids = [source_id for ct_id, source_id in sources.values() if ct_id == content_type_id]
+        if ids:
+            loaded[content_type_id] = model.objects.in_bulk(ids)
+
+    return {
+        target_id: loaded.get(content_type_id, {}).get(source_id)
+        for target_id, (content_type_id, source_id) in sources.items()
+    }
+
+
+def load_fiche_de_poste_contexts(position_ids, parents=None):
+    """
+    Build the template context of every position in `position_ids` with a
+    constant number of queries. Returns {position_id: context}.
+    `parents` may be given when the parent map is already loaded.
+    """
+    position_ids = list(position_ids)
+    positions = Position.objects.filter(id__in=position_ids).select_related('grade', 'structure')
+
+    missions = {}
+    for mission in Mission.objects.filter(position_id__in=position_ids):
+        missions.setdefault(mission.position_id, []).append(mission)
+
+    competences = {}
+    for competence in Competence.objects.filter(position_id__in=position_ids):
+        competences.setdefault(competence.position_id, []).append(competence)
+
+    if parents is None:
+        parents = get_parent_map(position_ids)
+
+    return {
+        position.id: {
+            "position": position,
+            "missions": missions.get(position.id, []),
+            "competences": competences.get(position.id, []),
+            "parent": parents.get(position.id),
+        }
+        for position in positions
+    }
+
+
+def get_fiche_de_poste_signatures(position_ids, parents=None):
+    """
+    Return {position_id: digest} identifying the current content of each
+    document: the position and grade, the latest change and the number of
+    missions and competences, and the parent. Three queries at most.
+    """
+    position_ids = list(position_ids)
+    rows = Position.objects.filter(id__in=position_ids).annotate(
+        missions_updated=Max('missions__updated_at'),
+        missions_count=Count('missions', distinct=True),
+        competences_updated=Max('competences__updated_at'),
+        competences_count=Count('competences', distinct=True),
+    ).values_list(
+        'id', 'updated_at', 'grade__updated_at',
+        'missions_updated', 'missions_count', 'competences_updated', 'competences_count'
+    ).order_by()
+
+    if parents is None:
+        parents = get_parent_map(position_ids)
+
+    signatures = {}
+    for row in rows:
+        parent = parents.get(row[0])
+        parent_part = f"{type(parent).__name__}:{parent.pk}:{parent.updated_at.isoformat()}" if parent else "-"
+        raw = "|".join(str(value) for value in row) + f"|{parent_part}|v{FICHE_DE_POSTE_TEMPLATE_VERSION}"
+        signatures[row[0]] = hashlib.sha1(raw.encode('utf-8')).hexdigest()
+    return signatures
+
+
+def get_fiche_de_poste_path(position_id, signature):
+    return f"{PDF_CACHE_DIR}/fiche_de_poste/{position_id}/{signature}.pdf"
+
+
+def get_cached_fiche_de_poste(position_id, signature):
+    """Return the storage path of the cached document, or None."""
+    path = get_fiche_de_poste_path(position_id, signature)
+    return path if default_storage.exists(path) else None
+
+
+def store_fiche_de_poste(position_id, signature, pdf):
+    """Store a rendered document and drop the stale versions of it."""
+    path = get_fiche_de_poste_path(position_id, signature)
+    directory = os.path.dirname(path)
+    try:
+        _, stale_files = default_storage.listdir(directory)
+    except FileNotFoundError:
+        stale_files = []
+    for name in stale_files:
+        default_storage.delete(f"{directory}/{name}")
+    return default_storage.save(path, ContentFile(pdf))
+
+
+def render_fiche_de_poste(context):
+    """Render one document to PDF bytes (None on rendering error)."""
+    return render_pdf(FICHE_DE_POSTE_TEMPLATE, context)
+
+
+def build_fiche_de_poste(position_id):
+    """
+    Render and store the document of a position if it is not cached yet.
+    Returns the storage path. Runs in the worker processes.
+    """
+    signature = get_fiche_de_poste_signatures([position_id]).get(position_id)
+    if signature is None:
+        raise Position.DoesNotExist(f"Position {position_id} does not exist")
+
+    path = get_cached_fiche_de_poste(position_id, signature)
+    if path:
+        return path
+
+    context = load_fiche_de_poste_contexts([position_id])[position_id]
+    pdf = render_fiche_de_poste(context)
+    if not pdf:
+        raise RuntimeError("Error generating PDF")
+    return store_fiche_de_poste(position_id, signature, pdf)
+
+
+def get_render_job(signature):
+    """The latest rendering job of a version of a document, or None."""
+    return Job.objects.filter(kind='render_fiche_de_poste', payload__signature=signature).order_by(
+        '-created_at'
+    ).first()
+
+
+def submit_fiche_de_poste(position_id, signature, user=None):
+    """
+    Queue the rendering of a document, unless the same version is already
+    queued or being rendered. Returns the job.
+    """
+    # jobs imports this module
+    from .jobs import enqueue, QUEUED, RUNNING
+
+    job = get_render_job(signature)
+    if job is None or job.status not in (QUEUED, RUNNING):
+        job = enqueue('render_fiche_de_poste', {"position": position_id, "signature": signature}, user=user)
+    return job
+
+
+def get_fiche_de_poste_status(position_id, signature):
+    """Return a status dict for the document of a position."""
+    from .jobs import QUEUED, RUNNING, FAILED
+
+    job = get_render_job(signature)
+    job_id = str(job.id) if job is not None else None
+    if get_cached_fiche_de_poste(position_id, signature):
+        return {"status": "ready", "job": job_id}
+    if job is None or job.status not in (QUEUED, RUNNING, FAILED):
+        return {"status": "missing", "job": job_id}
+    if job.status == FAILED:
+        return {"status": "failed", "job": job_id, "error": job.error}
+    return {"status": "pending", "job": job_id}
+
+
+# Batch export
+
+EXPORT_PROGRESS_TIMEOUT = 60 * 60
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+def get_export_progress_key(job_id):
+    return f"fiche_de_poste_export:{job_id}"
+
+
+def get_export_progress(job_id):
+    return cache.get(get_export_progress_key(job_id))
+
+
+def _set_export_progress(progress):
+    cache.set(get_export_progress_key(progress['job']), progress, EXPORT_PROGRESS_TIMEOUT)
+
+
+def load_structure_fiches_de_poste(structure_id):
+    """
+    Load the fiches de poste of every position held by the subtree of
+    `structure_id`, in a constant number of queries.
+
+    Returns [(context, signature)] ordered by structure (parents first)
+    then by position title.
+    """
+    subtree_ids = get_subtree_structure_ids(structure_id)
+    structure_order = {structure_id: index for index, structure_id in enumerate(subtree_ids)}
+
+    position_ids = list(
+        Position.objects.filter(structure_id__in=subtree_ids).values_list('id', flat=True)
+    )
+    parents = get_parent_map(position_ids)
+    contexts = load_fiche_de_poste_contexts(position_ids, parents=parents)
+    signatures = get_fiche_de_poste_signatures(position_ids, parents=parents)
+
+    documents = sorted(
+        contexts.values(),
+        key=lambda context: (structure_order[context['position'].structure_id], context['position'].title)
+    )
+    return [(context, signatures[context['position'].id]) for context in documents]
+
+
+def iter_fiche_de_poste_pdfs(documents, job_id):
+    """
+    Yield (position, pdf) for every (context, signature) of `documents`, in
+    order. Cached documents are read from storage, the others are rendered
+    in parallel in the process pool and stored. Progress is published in
+    the cache under `job_id`; positions that fail to render are skipped.
+    """
+    progress = {
+        "job": job_id, "status": "running", "total": len(documents),
+        "done": 0, "cached": 0, "failed": [],
+    }
+    _set_export_progress(progress)
+
+    futures = {}
+    for context, signature in documents:
+        position_id = context['position'].id
+        if not get_cached_fiche_de_poste(position_id, signature):
+            futures[position_id] = submit_to_pool(
+                'pdf', PDF_RENDER_WORKERS, 'organigramme.pdf.render_fiche_de_poste', context
+            )
+
+    for context, signature in documents:
+        position = context['position']
+        future = futures.get(position.id)
+        pdf = None
+        try:
+            if future is None:
+                with default_storage.open(get_fiche_de_poste_path(position.id, signature), 'rb') as file:
+                    pdf = file.read()
+                progress['cached'] += 1
+            else:
+                pdf = future.result()
+                if pdf:
+                    store_fiche_de_poste(position.id, signature, pdf)
+        except Exception:
+            pdf = None
+
+        progress['done'] += 1
+        if not pdf:
+            progress['failed'].append(position.id)
+        _set_export_progress(progress)
+        if pdf:
+            yield position, pdf
+
+    progress['status'] = "done"
+    _set_export_progress(progress)
+
+
+class _StreamBuffer:
+    """Write-only file object whose content is drained after each write."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _archive_name(position):
+    structure = position.structure.name if position.structure else "Sans structure"
+    filename = f"{position.id} - {fiche_de_poste_filename(position)}"
+    return f"{structure.replace('/', '-')}/{filename.replace('/', '-')}"
+
+
+def stream_fiche_de_poste_zip(documents, job_id):
+    """Yield a ZIP archive of the documents chunk by chunk."""
+    buffer = _StreamBuffer()
+    # The buffer cannot seek: zipfile writes data descriptors instead
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for position, pdf in iter_fiche_de_poste_pdfs(documents, job_id):
+            archive.writestr(_archive_name(position), pdf)
+            yield buffer.drain()
+    yield buffer.drain()
+
+
+def stream_fiche_de_poste_merged(documents, job_id):
+    """
+    Yield the documents merged into one PDF, with a bookmark per position.
+    A PDF can only be written once complete, so it is spooled first.
+    """
+    writer = PdfWriter()
+    for position, pdf in iter_fiche_de_poste_pdfs(documents, job_id):
+        writer.append(io.BytesIO(pdf), outline_item=position.title)
+
+    with tempfile.SpooledTemporaryFile(max_size=10 * 1024 * 1024) as output:
+        writer.write(output)
+        output.seek(0)
+        for chunk in iter(lambda: output.read(EXPORT_CHUNK_SIZE), b""):
+            yield chunk
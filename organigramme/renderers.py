@@ -0,0 +1,157 @@
+"""
+Columnar shapes of the diagram and tree payloads.
+
+Nodes are sent as parallel arrays (ids, kinds, xs, ys, parent indices) and
+edges refer to the nodes by index, so a client can build its graph without
+any lookup by (kind, id). Kinds are indices into the "kinds" list of the
+payload. An index of -1 means "not in this payload" (root, or an edge end
+outside of the loaded nodes, identified by its kind and id columns).
+"""
+from src.renderers import (
+    ColumnarJSONRenderer, ColumnarMessagePackRenderer, columnar_renderer_classes,
+    records_to_columns, to_columnar
+)
+from .nodes import NODE_MODELS
+
+NODE_KINDS = list(NODE_MODELS)
+
+
+def _split_columns(records, keys):
+    """Pop `keys` from copies of `records`; return (popped values, columnar rest)."""
+    popped = {key: [] for key in keys}
+    rest = []
+    for record in records:
+        record = dict(record)
+        for key in keys:
+            popped[key].append(record.pop(key, None))
+        rest.append(record)
+    return popped, records_to_columns(rest)["columns"]
+
+
+def diagram_to_columnar(data):
+    """
+    Columnar form of a {"nodes", "edges", ...} diagram payload (viewport and
+    collapsed views). Other payloads (errors...) get the generic conversion.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("nodes"), list):
+        return to_columnar(data)
+
+    nodes = data["nodes"]
+    index = {(node["type"], node["id"]): position for position, node in enumerate(nodes)}
+
+    def parent_index(node):
+        node_data = node.get("data") or {}
+        if node["type"] == "structure":
+            parent = ("structure", node_data.get("parent_id"))
+        else:
+            parent = ("structure", node_data.get("structure_id"))
+        return index.get(parent, -1)
+
+    node_values, node_columns = _split_columns(nodes, ("type", "id", "position_x", "position_y"))
+    # Same as "ids"
+    node_columns.pop("data.id", None)
+    payload = {key: to_columnar(value) for key, value in data.items() if key not in ("nodes", "edges")}
+    payload["kinds"] = NODE_KINDS
+    payload["nodes"] = {
+        "count": len(nodes),
+        "ids": node_values["id"],
+        "kinds": [NODE_KINDS.index(kind) for kind in node_values["type"]],
+        "xs": node_values["position_x"],
+        "ys": node_values["position_y"],
+        "parents": [parent_index(node) for node in nodes],
+        "columns": node_columns,
+    }
+
+    edges = data.get("edges") or []
+    edge_values, edge_columns = _split_columns(edges, ("id", "source", "target"))
+    ends = {}
+    for end in ("source", "target"):
+        values = edge_values[end]
+        ends[end] = {
+            f"{end}s": [index.get((value["type"], value["id"]), -1) for value in values],
+            f"{end}_kinds": [NODE_KINDS.index(value["type"]) for value in values],
+            f"{end}_ids": [value["id"] for value in values],
+        }
+        # Extra end attributes, e.g. the coordinates of the viewport edges
+        extra = records_to_columns([
+            {key: item for key, item in value.items() if key not in ("type", "id")} for value in values
+        ])["columns"]
+        edge_columns.update({f"{end}.{key}": column for key, column in extra.items()})
+    payload["edges"] = dict(
+        count=len(edges),
+        ids=edge_values["id"],
+        **ends["source"],
+        **ends["target"],
+        columns=edge_columns,
+    )
+    return payload
+
+
+def tree_to_columnar(data):
+    """
+    Columnar form of a structure tree (nested "children" and "positions"):
+    a structures table with parent indices and a positions table with the
+    index of their structure.
+    """
+    if not isinstance(data, dict) or "children" not in data:
+        return to_columnar(data)
+
+    structures, parents, positions, position_structures = [], [], [], []
+    stack = [(data, -1)]
+    while stack:
+        structure, parent = stack.pop()
+        structure_index = len(structures)
+        record = {key: value for key, value in structure.items() if key not in ("children", "positions")}
+        structures.append(record)
+        parents.append(parent)
+        for position in structure.get("positions") or []:
+            if isinstance(position, dict):
+                positions.append(position)
+                position_structures.append(structure_index)
+        children = [child for child in structure.get("children") or [] if isinstance(child, dict)]
+        stack.extend((child, structure_index) for child in reversed(children))
+
+    structure_values, structure_columns = _split_columns(structures, ("id",))
+    position_values, position_columns = _split_columns(positions, ("id",))
+    return {
+        "structures": {
+            "count": len(structures),
+            "ids": structure_values["id"],
+            "parents": parents,
+            "columns": structure_columns,
+        },
+        "positions": {
+            "count": len(positions),
+            "ids": position_values["id"],
+            "structures": position_structures,
+            "columns": position_columns,
+        },
+    }
+
+
+class DiagramColumnarJSONRenderer(ColumnarJSONRenderer):
+    def to_columnar(self, data):
+        return diagram_to_columnar(data)
+
+
+class DiagramMessagePackRenderer(ColumnarMessagePackRenderer):
+    def to_columnar(self, data):
+        return diagram_to_columnar(data)
+
+
+class TreeColumnarJSONRenderer(ColumnarJSONRenderer):
+    def to_columnar(self, data):
+        return tree_to_columnar(data)
+
+
+class TreeMessagePackRenderer(ColumnarMessagePackRenderer):
+    def to_columnar(self, data):
+        return tree_to_columnar(data)
+
+
+def diagram_renderer_classes():
+    return columnar_renderer_classes(DiagramColumnarJSONRenderer, DiagramMessagePackRenderer)
+
+
+def tree_renderer_classes():
+    return columnar_renderer_classes(TreeColumnarJSONRenderer, TreeMessagePackRenderer)
@@ -0,0 +1,224 @@
+"""
+Headcount rollups per structure.
+
+A StructureHeadcount row holds, for one structure and one grade, the number
+of positions and the total `quantity` of the structure and all its
+descendants. Changes are applied as deltas along the ancestor chain of the
+structure concerned, so a position create/update/delete touches one row per
+level instead of recomputing the tree.
+
+Signals (see signals.py) cover single saves and deletes. Bulk code paths
+(queryset.update, bulk_create) do not send signals: they run inside
+`rollup_signals_suspended()` and call `update_position_rollups` themselves.
+"""
+import threading
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from .hierarchy import get_structure_parent_map, get_ancestor_ids
+from .models import Grade, Position, StructureHeadcount
+
+_state = threading.local()
+
+
+@contextmanager
+def rollup_signals_suspended():
+    """Ignore the rollup signals of the current thread (bulk code paths)."""
+    previous = getattr(_state, 'suspended', False)
+    _state.suspended = True
+    try:
+        yield
+    finally:
+        _state.suspended = previous
+
+
+def rollup_signals_active():
+    return not getattr(_state, 'suspended', False)
+
+
+def compute_headcounts(parent_map, positions):
+    """
+    Aggregate (structure_id, grade_id, quantity) rows over the hierarchy.
+    Returns {(structure_id, grade_id): [positions_count, headcount]}.
+    Works on plain data, so it can run from a migration.
+    """
+    totals = {}
+    chains = {}
+    for structure_id, grade_id, quantity in positions:
+        if structure_id is None:
+            continue
+        if structure_id not in chains:
+            chains[structure_id] = [structure_id] + get_ancestor_ids(structure_id, parent_map)
+        for chain_id in chains[structure_id]:
+            entry = totals.setdefault((chain_id, grade_id), [0, 0])
+            entry[0] += 1
+            entry[1] += quantity or 0
+    return totals
+
+
+def position_deltas(positions, sign=1, parent_map=None):
+    """Deltas of adding (sign=1) or removing (sign=-1) positions rows."""
+    if parent_map is None:
+        parent_map = get_structure_parent_map()
+    totals = compute_headcounts(parent_map, positions)
+    return {key: [sign * count, sign * headcount] for key, (count, headcount) in totals.items()}
+
+
+def merge_deltas(*deltas_list):
+    merged = {}
+    for deltas in deltas_list:
+        for key, (count, headcount) in deltas.items():
+            entry = merged.setdefault(key, [0, 0])
+            entry[0] += count
+            entry[1] += headcount
+    return {key: value for key, value in merged.items() if value != [0, 0]}
+
+
+# Missing rows inserted concurrently and deleted again before they could be locked
+LOCK_ATTEMPTS = 3
+
+
+def _lock_headcount_rows(deltas):
+    """
+    Lock the rollup rows of the `deltas` keys, inserting the missing ones
+    (with zero counts) first: `select_for_update` does not lock rows that
+    do not exist yet, and two transactions creating the same key would
+    conflict on the unique constraint. Conflicting inserts are skipped, the
+    row of the other transaction is locked instead.
+    """
+    structure_ids = {structure_id for structure_id, _ in deltas}
+    grade_ids = {grade_id for _, grade_id in deltas}
+    for _ in range(LOCK_ATTEMPTS):
+        rows = {
+            (row.structure_id, row.grade_id): row
+            for row in StructureHeadcount.objects.select_for_update().filter(
+                structure_id__in=structure_ids, grade_id__in=grade_ids
+            )
+        }
+        # Nothing to remove from a missing row (table out of date, see rebuild_headcounts)
+        missing = [key for key, (count, _) in deltas.items() if key not in rows and count > 0]
+        if not missing:
+            break
+        categories = dict(Grade.objects.filter(id__in={key[1] for key in missing}).values_list('id', 'category'))
+        StructureHeadcount.objects.bulk_create(
+            [
+                StructureHeadcount(structure_id=structure_id, grade_id=grade_id, category=categories.get(grade_id, ''))
+                for structure_id, grade_id in missing
+            ],
+            batch_size=500, ignore_conflicts=True
+        )
+    return rows
+
+
+@transaction.atomic
+def apply_headcount_deltas(deltas):
+    """
+    Add {(structure_id, grade_id): [positions, headcount]} deltas to the
+    rollup table: the rows are locked (and the missing ones inserted), then
+    written with one bulk update and delete.
+    """
+    deltas = {key: value for key, value in deltas.items() if value != [0, 0]}
+    if not deltas:
+        return
+
+    rows = _lock_headcount_rows(deltas)
+    now = timezone.now()
+    to_update, to_delete = [], []
+    for key, (count, headcount) in deltas.items():
+        row = rows.get(key)
+        if row is None:
+            continue
+        row.positions_count += count
+        row.headcount += headcount
+        row.updated_at = now
+        if row.positions_count <= 0:
+            to_delete.append(row.id)
+        else:
+            to_update.append(row)
+
+    StructureHeadcount.objects.bulk_update(to_update, ['positions_count', 'headcount', 'updated_at'], batch_size=500)
+    if to_delete:
+        StructureHeadcount.objects.filter(id__in=to_delete).delete()
+
+
+def update_position_rollups(removed=(), added=(), parent_map=None):
+    """
+    Apply position changes given as (structure_id, grade_id, quantity) rows:
+    `removed` before the change, `added` after it.
+    """
+    if parent_map is None:
+        parent_map = get_structure_parent_map()
+    apply_headcount_deltas(merge_deltas(
+        position_deltas(removed, -1, parent_map),
+        position_deltas(added, 1, parent_map),
+    ))
+
+
+def update_structure_move_rollups(structure_id, old_parent_id, new_parent_id):
+    """
+    Move the subtree totals of `structure_id` from the ancestors of its old
+    parent to the ancestors of its new parent.
+    """
+    if old_parent_id == new_parent_id:
+        return
+    parent_map = get_structure_parent_map()
+    old_chain = [old_parent_id] + get_ancestor_ids(old_parent_id, parent_map) if old_parent_id else []
+    new_chain = [new_parent_id] + get_ancestor_ids(new_parent_id, parent_map) if new_parent_id else []
+
+    deltas = []
+    rows = StructureHeadcount.objects.filter(structure_id=structure_id).values_list(
+        'grade_id', 'positions_count', 'headcount'
+    )
+    for grade_id, count, headcount in rows:
+        deltas.append({(chain_id, grade_id): [-count, -headcount] for chain_id in old_chain})
+        deltas.append({(chain_id, grade_id): [count, headcount] for chain_id in new_chain})
+    apply_headcount_deltas(merge_deltas(*deltas))
+
+
+@transaction.atomic
+def rebuild_headcounts():
+    """Recompute the whole rollup table from the positions."""
+    totals = compute_headcounts(
+        get_structure_parent_map(),
+        Position.objects.values_list('structure_id', 'grade_id', 'quantity').order_by()
+    )
+    categories = dict(Grade.objects.values_list('id', 'category'))
+    StructureHeadcount.objects.all().delete()
+    StructureHeadcount.objects.bulk_create(
+        [
+            StructureHeadcount(
+                structure_id=structure_id, grade_id=grade_id, category=categories.get(grade_id, ''),
+                positions_count=count, headcount=headcount
+            )
+            for (structure_id, grade_id), (count, headcount) in totals.items()
+        ],
+        batch_size=500
+    )
+    return len(totals)
+
+
+def get_structure_headcount(structure_id):
+    """Headcount of a structure subtree, by grade and by category (two queries)."""
+    rows = list(
+        StructureHeadcount.objects.filter(structure_id=structure_id)
+        .select_related('grade').order_by('category', 'grade__name')
+    )
+    by_category = StructureHeadcount.objects.filter(structure_id=structure_id).values('category').annotate(
+        positions_count=Sum('positions_count'), headcount=Sum('headcount')
+    ).order_by('category')
+    return {
+        "structure": structure_id,
+        "positions_count": sum(row.positions_count for row in rows),
+        "headcount": sum(row.headcount for row in rows),
+        "by_grade": [
+            {
+                "grade": row.grade_id, "grade_name": row.grade.name, "category": row.category,
+                "positions_count": row.positions_count, "headcount": row.headcount,
+            }
+            for row in rows
+        ],
+        "by_category": list(by_category),
+    }
@@ -1,9 +1,11 @@
 from rest_framework import serializers
-from rest_flex_fields.serializers import FlexFieldsModelSerializer
+from src.instrumentation import measure_serialization
+from src.serializers import FlexFieldsModelSerializer, ModelSerializer
 from django.contrib.contenttypes.models import ContentType
-from .models import Structure, Position, Grade, Task, Mission, Competence, OrganigramEdge, DiagramPosition, StructureType
+from django.db import models
+from .models import Structure, Position, Grade, Task, Mission, Competence, OrganigramEdge, DiagramPosition, StructureType, StructureHeadcount, ChartSnapshot, Job
 
-class ParentPositionSerializer(serializers.ModelSerializer):
+class ParentPositionSerializer(ModelSerializer):
     # This serializer is used to avoid recursion in PositionSerializer
     class Meta:
         model = Position
@@ -16,6 +18,45 @@ class GradeSerializer(FlexFieldsModelSerializer):
         read_only_fields = ("created_at", "updated_at")
 
 
+class StructureHeadcountSerializer(FlexFieldsModelSerializer):
+    class Meta:
+        model = StructureHeadcount
+        fields = '__all__'
+        read_only_fields = ("updated_at",)
+        expandable_fields = {
+            "grade": ("organigramme.serializers.GradeSerializer", {"many": False}),
+            "structure": ("organigramme.serializers.StructureSerializer", {"many": False}),
+        }
+
+
+class ChartSnapshotSerializer(FlexFieldsModelSerializer):
+    """Snapshot metadata; the frozen chart is read from the "chart" action."""
+    main_structure = serializers.PrimaryKeyRelatedField(queryset=Structure.objects.filter(is_main=True))
+
+    class Meta:
+        model = ChartSnapshot
+        exclude = ('manifest',)
+        read_only_fields = (
+            "main_structure_name", "structures_count", "positions_count", "new_blobs_count", "created_by",
+            "created_at",
+        )
+
+
+class JobSerializer(ModelSerializer):
+    """Status of a background job; an exported file is downloaded from the "result" action."""
+    progress = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Job
+        exclude = ('slot',)
+        read_only_fields = [field.name for field in Job._meta.fields]
+
+    def get_progress(self, job):
+        # jobs imports the serializers
+        from .jobs import get_job_progress
+        return get_job_progress(job)
+
+
 class StructureTypeSerializer(FlexFieldsModelSerializer):
     class Meta:
         model = StructureType
@@ -63,14 +104,88 @@ class DiagramPositionSerializer(FlexFieldsModelSerializer):
         read_only_fields = ("created_at", "updated_at")
 
 
+class DiagramPositionSyncItemSerializer(serializers.Serializer):
+    """One moved node in a bulk coordinate sync."""
+    content_type = serializers.ChoiceField(choices=['structure', 'position'])
+    object_id = serializers.IntegerField(min_value=1)
+    position_x = serializers.FloatField()
+    position_y = serializers.FloatField()
+
+
+class DiagramPositionSyncSerializer(serializers.Serializer):
+    """Payload of a bulk coordinate sync for one main structure."""
+    main_structure = serializers.PrimaryKeyRelatedField(queryset=Structure.objects.filter(is_main=True))
+    nodes = DiagramPositionSyncItemSerializer(many=True, allow_empty=False, max_length=5000)
+
+
+class PositionCoordinatesItemSerializer(serializers.Serializer):
+    """Coordinates of one position in a bulk update."""
+    id = serializers.IntegerField(min_value=1)
+    x = serializers.FloatField()
+    y = serializers.FloatField()
+
+
+class PositionCoordinatesSerializer(serializers.Serializer):
+    """Payload of a bulk update of position coordinates."""
+    updates = PositionCoordinatesItemSerializer(many=True, allow_empty=False, max_length=5000)
+
+
+class PositionListSerializer(serializers.ListSerializer):
+    """
+    Loads the parent and the diagram positions of all the positions of the
+    list in three queries, read by the method fields of PositionSerializer
+    instead of two queries per position.
+    """
+
+    def to_representation(self, data):
+        with measure_serialization():
+            positions = list(data.all() if isinstance(data, models.Manager) else data)
+            self.child.relations = load_position_relations(positions)
+            try:
+                return super().to_representation(positions)
+            finally:
+                self.child.relations = None
+
+
+def load_position_relations(positions):
+    """{"parents": {position id: parent position}, "diagram_positions": {position id: [diagram positions]}}"""
+    position_type = ContentType.objects.get_for_model(Position)
+    ids = [position.id for position in positions]
+    structure_ids = {position.id: position.structure_id for position in positions}
+
+    parent_ids = {}
+    edges = OrganigramEdge.objects.filter(
+        target_content_type=position_type, target_object_id__in=ids
+    ).order_by('id').values_list('target_object_id', 'structure_id', 'source_content_type_id', 'source_object_id')
+    for target_id, structure_id, source_type_id, source_id in edges:
+        # The first edge of the position's structure, as PositionSerializer.get_parent
+        if structure_id == structure_ids[target_id] and target_id not in parent_ids:
+            parent_ids[target_id] = source_id if source_type_id == position_type.id else None
+    sources = Position.objects.in_bulk([source_id for source_id in parent_ids.values() if source_id is not None])
+
+    diagram_positions = {}
+    for diagram_position in DiagramPosition.objects.filter(
+        content_type=position_type, object_id__in=ids
+    ).select_related('content_type').order_by('id'):
+        diagram_positions.setdefault(diagram_position.object_id, []).append(diagram_position)
+
+    return {
+        "parents": {position_id: sources.get(source_id) for position_id, source_id in parent_ids.items()},
+        "diagram_positions": diagram_positions,
+    }
+
+
 class PositionSerializer(FlexFieldsModelSerializer):
     parent = serializers.SerializerMethodField(read_only=True)
     diagram_positions = serializers.SerializerMethodField(read_only=True)
+    # Set by PositionListSerializer while serializing a list
+    relations = None
     
     class Meta:
         model = Position
         fields = '__all__'
         read_only_fields = ("created_at", "updated_at", "parent", "diagram_positions")
+        list_serializer_class = PositionListSerializer
 
         expandable_fields = {
             "structure": ("organigramme.serializers.StructureSerializer", {"many": False}),
@@ -85,7 +200,10 @@ class PositionSerializer(FlexFieldsModelSerializer):
         Get the parent position by finding the source of the edge
         where this position is the target.
         """
-        from .models import OrganigramEdge
+        if self.relations is not None:
+            parent = self.relations["parents"].get(obj.id)
+            return ParentPositionSerializer(parent, context=self.context).data if parent is not None else None
+
         position_content_type = ContentType.objects.get_for_model(Position)
 
         edge = OrganigramEdge.objects.filter(
@@ -104,11 +222,14 @@ class PositionSerializer(FlexFieldsModelSerializer):
         """
         Get diagram-specific positions for this position.
         """
-        content_type = ContentType.objects.get_for_model(obj)
-        diagram_positions = DiagramPosition.objects.filter(
-            content_type=content_type,
-            object_id=obj.id
-        )
+        if self.relations is not None:
+            diagram_positions = self.relations["diagram_positions"].get(obj.id, [])
+        else:
+            content_type = ContentType.objects.get_for_model(obj)
+            diagram_positions = DiagramPosition.objects.filter(
+                content_type=content_type,
+                object_id=obj.id
+            ).select_related('content_type').order_by('id')
         return DiagramPositionSerializer(diagram_positions, many=True, context=self.context).data
 
 class GenericRelatedField(serializers.Field):
@@ -188,7 +309,7 @@ class OrganigramEdgeSerializer(FlexFieldsModelSerializer):
         return data
 
 # This serializer is used to avoid recursion in StructureSerializer
-class StructureChildrenSerializer(serializers.ModelSerializer):
+class StructureChildrenSerializer(ModelSerializer):
     class Meta:
         model = Structure
         fields = ('id', 'name')
@@ -0,0 +1,381 @@
+"""
+Signal receivers keeping the StructureHeadcount rollups up to date,
+invalidating the cached snapshots (see versions.py), publishing the
+diagram deltas of the change feed (see feed.py) and appending to the change
+log of the incremental sync (see changelog.py).
+
+The values that matter (structure, grade, quantity of a position, parent of
+a structure) are remembered when an instance is loaded, so a save only
+applies the difference with what was counted.
+
+The bulk writes of the API mixins send no post_save: the `bulk_saved`
+receivers do the same work once for all the written rows.
+"""
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+
+from src.mixins import bulk_saved
+
+from .changelog import change, log_changes
+from .feed import broker, publish_change, diagrams_of_structure, edge_event
+from .models import Grade, Position, Structure, StructureHeadcount, DiagramPosition, OrganigramEdge
+from .nodes import get_node_kind
+from .rollups import (
+    rollup_signals_active, update_position_rollups, update_structure_move_rollups
+)
+from .versions import bump_chart_version, bump_diagram_version
+
+POSITION_ROLLUP_FIELDS = ('structure_id', 'grade_id', 'quantity')
+
+
+@receiver(post_init, sender=Position)
+def remember_position_rollup(sender, instance, **kwargs):
+    if instance.pk is not None and all(field in instance.__dict__ for field in POSITION_ROLLUP_FIELDS):
+        instance._rollup_snapshot = tuple(instance.__dict__[field] for field in POSITION_ROLLUP_FIELDS)
+
+
+@receiver(post_save, sender=Position)
+def update_position_rollup(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    current = tuple(getattr(instance, field) for field in POSITION_ROLLUP_FIELDS)
+    if rollup_signals_active():
+        if created:
+            previous = None
+        else:
+            previous = getattr(instance, '_rollup_snapshot', None)
+            if previous is None:
+                # Loaded with deferred fields: the stored row is already the new one
+                previous = current
+        if previous != current:
+            update_position_rollups(
+                removed=[previous] if previous else [],
+                added=[current]
+            )
+
+
+@receiver(post_delete, sender=Position)
+def remove_position_rollup(sender, instance, **kwargs):
+    if rollup_signals_active():
+        previous = getattr(instance, '_rollup_snapshot', None) or tuple(
+            getattr(instance, field) for field in POSITION_ROLLUP_FIELDS
+        )
+        update_position_rollups(removed=[previous])
+
+
+@receiver(post_init, sender=Structure)
+def remember_structure_parent(sender, instance, **kwargs):
+    if instance.pk is not None and 'parent_id' in instance.__dict__:
+        instance._rollup_parent_id = instance.__dict__['parent_id']
+
+
+@receiver(post_save, sender=Structure)
+def update_structure_rollup(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if rollup_signals_active() and not created and hasattr(instance, '_rollup_parent_id'):
+        update_structure_move_rollups(instance.id, instance._rollup_parent_id, instance.parent_id)
+
+
+@receiver(post_save, sender=Grade)
+def update_grade_category(sender, instance, created, raw=False, **kwargs):
+    if not raw and not created:
+        StructureHeadcount.objects.filter(grade=instance).exclude(
+            category=instance.category
+        ).update(category=instance.category)
+
+
+@receiver(post_save, sender=Structure)
+@receiver(post_delete, sender=Structure)
+@receiver(post_save, sender=Position)
+@receiver(post_delete, sender=Position)
+@receiver(post_save, sender=Grade)
+@receiver(post_delete, sender=Grade)
+def invalidate_chart_snapshots(sender, raw=False, **kwargs):
+    if not raw:
+        bump_chart_version()
+
+
+@receiver(post_save, sender=DiagramPosition)
+@receiver(post_delete, sender=DiagramPosition)
+def invalidate_diagram_snapshots(sender, instance, raw=False, **kwargs):
+    if not raw:
+        bump_diagram_version(instance.main_structure_id)
+
+
+# Change feed. Nothing is computed while no one follows a diagram.
+
+def _node_data(instance):
+    if isinstance(instance, Position):
+        return {
+            "title": instance.title, "abbreviation": instance.abbreviation, "structure_id": instance.structure_id,
+            "grade_id": instance.grade_id, "quantity": instance.quantity, "is_manager": instance.is_manager,
+        }
+    return {
+        "name": instance.name, "parent_id": instance.parent_id, "is_main": instance.is_main,
+        "type_id": instance.type_id, "manager_id": instance.manager_id,
+    }
+
+
+def _node_diagrams(instance):
+    if isinstance(instance, Position):
+        previous = getattr(instance, '_rollup_snapshot', None)
+        structure_ids = {instance.structure_id, previous[0] if previous else None}
+    else:
+        structure_ids = {instance.id, instance.parent_id, getattr(instance, '_rollup_parent_id', None)}
+    diagrams = set()
+    for structure_id in structure_ids - {None}:
+        diagrams |= diagrams_of_structure(structure_id)
+    return diagrams
+
+
+def _node_kind(instance):
+    return 'position' if isinstance(instance, Position) else 'structure'
+
+
+@receiver(post_save, sender=DiagramPosition)
+def publish_node_moved(sender, instance, raw=False, **kwargs):
+    if not raw and broker.has_subscribers():
+        publish_change({instance.main_structure_id}, {
+            "op": "node_moved", "kind": get_node_kind(instance.content_type_id), "id": instance.object_id,
+            "x": instance.position_x, "y": instance.position_y,
+        })
+
+
+@receiver(post_delete, sender=DiagramPosition)
+def publish_node_removed(sender, instance, **kwargs):
+    if broker.has_subscribers():
+        publish_change({instance.main_structure_id}, {
+            "op": "node_removed", "kind": get_node_kind(instance.content_type_id), "id": instance.object_id,
+        })
+
+
+@receiver(post_save, sender=Position)
+@receiver(post_save, sender=Structure)
+def publish_node_updated(sender, instance, raw=False, **kwargs):
+    if not raw and broker.has_subscribers():
+        publish_change(_node_diagrams(instance), {
+            "op": "node_updated", "kind": _node_kind(instance), "id": instance.id, "data": _node_data(instance),
+        })
+
+
+@receiver(post_delete, sender=Position)
+@receiver(post_delete, sender=Structure)
+def publish_node_deleted(sender, instance, **kwargs):
+    if broker.has_subscribers():
+        publish_change(_node_diagrams(instance), {"op": "node_deleted", "kind": _node_kind(instance), "id": instance.id})
+
+
+@receiver(post_save, sender=OrganigramEdge)
+def publish_edge_saved(sender, instance, created, raw=False, **kwargs):
+    if not raw and broker.has_subscribers():
+        publish_change(
+            diagrams_of_structure(instance.structure_id), edge_event(instance, "edge_added" if created else "edge_updated")
+        )
+
+
+@receiver(post_delete, sender=OrganigramEdge)
+def publish_edge_deleted(sender, instance, **kwargs):
+    if broker.has_subscribers():
+        publish_change(diagrams_of_structure(instance.structure_id), {"op": "edge_deleted", "id": instance.id})
+
+
+# Change log of the incremental sync
+
+def _previous_structure_id(instance):
+    if isinstance(instance, Position):
+        previous = getattr(instance, '_rollup_snapshot', None)
+        return previous[0] if previous else None
+    return getattr(instance, '_rollup_parent_id', None)
+
+
+def _structure_id(instance):
+    return instance.structure_id if isinstance(instance, Position) else instance.parent_id
+
+
+@receiver(post_save, sender=Position)
+@receiver(post_save, sender=Structure)
+def log_node_saved(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        log_changes([change(
+            _node_kind(instance), 'created' if created else 'updated', instance.id,
+            structure_id=_structure_id(instance),
+            previous_structure_id=None if created else _previous_structure_id(instance),
+        )])
+
+
+@receiver(post_delete, sender=Position)
+@receiver(post_delete, sender=Structure)
+def log_node_deleted(sender, instance, **kwargs):
+    log_changes([change(
+        _node_kind(instance), 'deleted', instance.id,
+        structure_id=_structure_id(instance), previous_structure_id=_previous_structure_id(instance),
+    )])
+
+
+@receiver(post_save, sender=OrganigramEdge)
+def log_edge_saved(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        log_changes([change('edge', 'created' if created else 'updated', instance.id, structure_id=instance.structure_id)])
+
+
+@receiver(post_delete, sender=OrganigramEdge)
+def log_edge_deleted(sender, instance, **kwargs):
+    log_changes([change('edge', 'deleted', instance.id, structure_id=instance.structure_id)])
+
+
+@receiver(post_save, sender=DiagramPosition)
+def log_diagram_position_saved(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        log_changes([change(
+            'diagram_position', 'created' if created else 'updated', instance.object_id,
+            main_structure_id=instance.main_structure_id, node_kind=get_node_kind(instance.content_type_id) or '',
+        )])
+
+
+@receiver(post_delete, sender=DiagramPosition)
+def log_diagram_position_deleted(sender, instance, **kwargs):
+    log_changes([change(
+        'diagram_position', 'deleted', instance.object_id,
+        main_structure_id=instance.main_structure_id, node_kind=get_node_kind(instance.content_type_id) or '',
+    )])
+
+
+# Bulk writes of the API mixins (src.mixins.bulk_saved)
+
+@receiver(bulk_saved, sender=Position)
+def update_positions_rollup(sender, instances, created, **kwargs):
+    if not rollup_signals_active():
+        return
+    removed, added = [], []
+    for instance in instances:
+        current = tuple(getattr(instance, field) for field in POSITION_ROLLUP_FIELDS)
+        previous = None if created else getattr(instance, '_rollup_snapshot', current)
+        if previous != current:
+            if previous:
+                removed.append(previous)
+            added.append(current)
+    if removed or added:
+        update_position_rollups(removed=removed, added=added)
+
+
+@receiver(bulk_saved, sender=Structure)
+def update_structures_rollup(sender, instances, created, **kwargs):
+    if rollup_signals_active() and not created:
+        for instance in instances:
+            if hasattr(instance, '_rollup_parent_id'):
+                update_structure_move_rollups(instance.id, instance._rollup_parent_id, instance.parent_id)
+
+
+@receiver(bulk_saved, sender=Grade)
+def update_grades_category(sender, instances, created, **kwargs):
+    if created:
+        return
+    grade_ids = {}
+    for instance in instances:
+        grade_ids.setdefault(instance.category, []).append(instance.id)
+    for category, ids in grade_ids.items():
+        StructureHeadcount.objects.filter(grade_id__in=ids).exclude(category=category).update(category=category)
+
+
+@receiver(bulk_saved, sender=Structure)
+@receiver(bulk_saved, sender=Position)
+@receiver(bulk_saved, sender=Grade)
+def invalidate_chart_snapshots_bulk(sender, **kwargs):
+    bump_chart_version()
+
+
+@receiver(bulk_saved, sender=DiagramPosition)
+def invalidate_diagram_snapshots_bulk(sender, instances, **kwargs):
+    bump_diagram_version(*(instance.main_structure_id for instance in instances))
+
+
+@receiver(bulk_saved, sender=DiagramPosition)
+def publish_nodes_moved(sender, instances, **kwargs):
+    if not broker.has_subscribers():
+        return
+    nodes = {}
+    for instance in instances:
+        nodes.setdefault(instance.main_structure_id, []).append(
+            [get_node_kind(instance.content_type_id), instance.object_id, instance.position_x, instance.position_y]
+        )
+    for main_structure_id, moved in nodes.items():
+        publish_change({main_structure_id}, {"op": "nodes_moved", "nodes": moved})
+
+
+@receiver(bulk_saved, sender=Position)
+@receiver(bulk_saved, sender=Structure)
+def publish_nodes_updated(sender, instances, **kwargs):
+    if broker.has_subscribers():
+        for instance in instances:
+            publish_change(_node_diagrams(instance), {
+                "op": "node_updated", "kind": _node_kind(instance), "id": instance.id, "data": _node_data(instance),
+            })
+
+
+@receiver(bulk_saved, sender=OrganigramEdge)
+def publish_edges_saved(sender, instances, created, **kwargs):
+    if broker.has_subscribers():
+        for instance in instances:
+            publish_change(
+                diagrams_of_structure(instance.structure_id), edge_event(instance, "edge_added" if created else "edge_updated")
+            )
+
+
+@receiver(bulk_saved, sender=Position)
+@receiver(bulk_saved, sender=Structure)
+def log_nodes_saved(sender, instances, created, **kwargs):
+    log_changes(
+        change(
+            _node_kind(instance), 'created' if created else 'updated', instance.id,
+            structure_id=_structure_id(instance),
+            previous_structure_id=None if created else _previous_structure_id(instance),
+        )
+        for instance in instances
+    )
+
+
+@receiver(bulk_saved, sender=OrganigramEdge)
+def log_edges_saved(sender, instances, created, **kwargs):
+    log_changes(
+        change('edge', 'created' if created else 'updated', instance.id, structure_id=instance.structure_id)
+        for instance in instances
+    )
+
+
+@receiver(bulk_saved, sender=DiagramPosition)
+def log_diagram_positions_saved(sender, instances, created, **kwargs):
+    log_changes(
+        change(
+            'diagram_position', 'created' if created else 'updated', instance.object_id,
+            main_structure_id=instance.main_structure_id, node_kind=get_node_kind(instance.content_type_id) or '',
+        )
+        for instance in instances
+    )
+
+
+# Must stay the last post_save and bulk_saved receivers: the ones above
+# compare the saved values with the snapshots taken when the instance was loaded.
+
+@receiver(post_save, sender=Position)
+def refresh_position_snapshot(sender, instance, raw=False, **kwargs):
+    if not raw:
+        instance._rollup_snapshot = tuple(getattr(instance, field) for field in POSITION_ROLLUP_FIELDS)
+
+
+@receiver(post_save, sender=Structure)
+def refresh_structure_snapshot(sender, instance, raw=False, **kwargs):
+    if not raw:
+        instance._rollup_parent_id = instance.parent_id
+
+
+@receiver(bulk_saved, sender=Position)
+def refresh_positions_snapshot(sender, instances, **kwargs):
+    for instance in instances:
+        refresh_position_snapshot(sender, instance)
+
+
+@receiver(bulk_saved, sender=Structure)
+def refresh_structures_snapshot(sender, instances, **kwargs):
+    for instance in instances:
+        refresh_structure_snapshot(sender, instance)
@@ -0,0 +1,179 @@
+"""
+Synthetic charts for the benchmarks (see the benchmark_api command).
+
+`generate_chart(positions)` builds one main structure with a tree shaped
+like the real ones: a general direction, directions, sub-directions,
+departments, services and offices, each unit having a random number of
+children (`fan_out`) until the wanted number of structures is reached, then
+a manager position and staff positions in every unit. Managers are linked
+to their staff and to the managers of the child units by edges, the grades
+are shared, every position has missions, competences and tasks, and the
+diagram is laid out.
+
+Rows are inserted with bulk statements and their ids read back by name,
+so a 50k positions chart is generated in seconds on SQLite as well.
+Generation is deterministic for a given `seed`.
+"""
+import random
+
+from django.db import transaction
+
+from .hierarchy import get_subtree_structure_ids
+from .layout import auto_organize_structure
+from .models import Structure, Position, Grade, StructureType, Mission, Competence, Task, OrganigramEdge
+from .nodes import get_node_content_type_ids
+from .rollups import rebuild_headcounts, rollup_signals_suspended
+from .versions import bump_chart_version
+
+BATCH_SIZE = 1000
+# Units per level, from the main structure down
+LEVEL_NAMES = ('Direction générale', 'Direction', 'Sous-direction', 'Département', 'Service', 'Bureau', 'Cellule')
+GRADES = (
+    ('Directeur', 'Cadre supérieur'), ('Chef de service', 'Cadre'), ('Ingénieur', 'Cadre'),
+    ('Technicien', 'Maîtrise'), ('Agent', 'Exécution'),
+)
+STAFF_TITLES = ('Chargé d\'études', 'Ingénieur', 'Technicien', 'Assistant', 'Agent')
+
+
+def _grades():
+    grades = {}
+    for name, category in GRADES:
+        grade = Grade.objects.filter(name=name, category=category).order_by('id').first()
+        grades[name] = grade or Grade.objects.create(name=name, category=category)
+    return grades
+
+
+def _structure_tree(structures_count, fan_out, rng):
+    """[(code, parent code, depth)] in breadth-first order, codes like "1.3.2"."""
+    tree = [('1', None, 0)]
+    queue = [0]
+    while queue and len(tree) < structures_count:
+        code, _, depth = tree[queue.pop(0)]
+        if depth + 1 >= len(LEVEL_NAMES):
+            continue
+        for index in range(1, rng.randint(*fan_out) + 1):
+            if len(tree) >= structures_count:
+                break
+            queue.append(len(tree))
+            tree.append((f'{code}.{index}', code, depth + 1))
+    return tree
+
+
+@transaction.atomic
+def generate_chart(positions, fan_out=(2, 6), staff=(2, 10), seed=0, name='Benchmark'):
+    """
+    Create a main structure with about `positions` positions (exactly, unless
+    the depth limit is hit with few structures) and return it.
+    """
+    rng = random.Random(seed)
+    grades = _grades()
+    structure_type = StructureType.objects.get_or_create(name='Synthétique')[0]
+    content_type_ids = get_node_content_type_ids()
+
+    # One manager and (staff[0] + staff[1]) / 2 staff positions per unit on average
+    structures_count = max(1, round(positions / (1 + sum(staff) / 2)))
+    tree = _structure_tree(structures_count, fan_out, rng)
+
+    main = Structure.objects.create(name=f'{name} {positions}', is_main=True, type=structure_type)
+    structure_ids = {'1': main.id}
+    depths = {}
+    for code, parent_code, depth in tree[1:]:
+        depths.setdefault(depth, []).append((code, parent_code))
+    for depth in sorted(depths):
+        level = depths[depth]
+        Structure.objects.bulk_create(
+            [
+                Structure(name=f'{LEVEL_NAMES[depth]} {code}', parent_id=structure_ids[parent_code], type=structure_type)
+                for code, parent_code in level
+            ],
+            batch_size=BATCH_SIZE
+        )
+        names = dict(Structure.objects.filter(
+            parent_id__in={structure_ids[parent_code] for _, parent_code in level}
+        ).values_list('name', 'id'))
+        structure_ids.update({code: names[f'{LEVEL_NAMES[depth]} {code}'] for code, _ in level})
+
+    # Staff spread over the units, every unit keeping its manager
+    staff_counts = {code: 0 for code, _, _ in tree}
+    weights = [rng.randint(*staff) for _ in tree]
+    for index in rng.choices(range(len(tree)), weights=weights, k=max(0, positions - len(tree))):
+        staff_counts[tree[index][0]] += 1
+
+    new_positions = []
+    for code, _, depth in tree:
+        structure_id = structure_ids[code]
+        new_positions.append(Position(
+            structure_id=structure_id, title=f'Responsable {code}', abbreviation=f'R{code}', is_manager=True,
+            grade=grades['Directeur' if depth < 2 else 'Chef de service'], category='Encadrement',
+        ))
+        for index in range(1, staff_counts[code] + 1):
+            title = rng.choice(STAFF_TITLES)
+            grade = grades[title] if title in grades else grades['Agent']
+            new_positions.append(Position(
+                structure_id=structure_id, title=f'{title} {code}-{index}', grade=grade,
+                category=grade.category, quantity=rng.randint(1, 4),
+                formation='Licence', experience=f'{rng.randint(0, 10)} ans',
+                mission_principal=f'Mission principale {code}-{index}',
+            ))
+    Position.objects.bulk_create(new_positions, batch_size=BATCH_SIZE)
+    position_ids = {
+        (structure_id, title): position_id for position_id, structure_id, title in
+        Position.objects.filter(structure_id__in=structure_ids.values()).values_list('id', 'structure_id', 'title')
+    }
+    for position in new_positions:
+        position.id = position_ids[(position.structure_id, position.title)]
+
+    managers = {code: position_ids[(structure_ids[code], f'Responsable {code}')] for code, _, _ in tree}
+    Structure.objects.bulk_update(
+        [Structure(id=structure_ids[code], manager_id=managers[code]) for code, _, _ in tree],
+        ['manager'], batch_size=BATCH_SIZE
+    )
+
+    def edge(structure_id, source_id, target_id):
+        return OrganigramEdge(
+            structure_id=structure_id,
+            source_content_type_id=content_type_ids['position'], source_object_id=source_id,
+            target_content_type_id=content_type_ids['position'], target_object_id=target_id,
+        )
+
+    codes = {structure_id: code for code, structure_id in structure_ids.items()}
+    edges = [
+        edge(position.structure_id, managers[codes[position.structure_id]], position.id)
+        for position in new_positions if not position.is_manager
+    ]
+    edges.extend(
+        edge(structure_ids[code], managers[parent_code], managers[code])
+        for code, parent_code, _ in tree[1:]
+    )
+    OrganigramEdge.objects.bulk_create(edges, batch_size=BATCH_SIZE)
+
+    for model, label in ((Mission, 'Mission'), (Competence, 'Compétence'), (Task, 'Tâche')):
+        model.objects.bulk_create(
+            [
+                model(position_id=position.id, description=f'{label} {index} du poste {position.title}')
+                for position in new_positions for index in (1, 2)
+            ],
+            batch_size=BATCH_SIZE
+        )
+
+    # Bulk inserts send no signal: refresh what the signal receivers maintain
+    rebuild_headcounts()
+    bump_chart_version()
+    auto_organize_structure(main.id)
+    return main
+
+
+def find_chart(positions, name='Benchmark'):
+    """The chart left by a previous `generate_chart(positions)`, or None."""
+    return Structure.objects.filter(name=f'{name} {positions}', is_main=True, parent=None).order_by('id').first()
+
+
+@transaction.atomic
+def delete_chart(main):
+    """Delete a generated chart: positions first, they protect their structure."""
+    structure_ids = get_subtree_structure_ids(main.id)
+    with rollup_signals_suspended():
+        Position.objects.filter(structure_id__in=structure_ids).delete()
+        main.delete()
+    rebuild_headcounts()
+    bump_chart_version()
@@ -1,3 +1,2159 @@
-from django.test import TestCase
+import asyncio
+import copy
+import gzip
+import hashlib
+import io
+import json
+import marshal
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, connections, transaction
+from django.db.models import Q, QuerySet, Sum
+from django.db.models.signals import post_save
+from django.http import HttpResponse
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase
+from django.utils import timezone
+from openpyxl import load_workbook
+from reportlab import rl_config
+from rest_framework import serializers, viewsets
+from rest_framework.routers import DefaultRouter
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from xhtml2pdf.context import pisaCSSParser
+
+from authentication.serializers import UserSerializer
+from src import pdf_service
+from src.async_views import async_routes, run_in_db_pool
+from src.connections import ConnectionPool, PoolTimeout, PooledDatabaseWrapperMixin, check_pool_sizes, get_pool_size
+from src.dynamic_api import generate_dynamic_serializer
+from src.export import EXPORT_CHUNK_SIZE, ExportError, compile_columns, stream_csv, stream_xlsx
+from src.instrumentation import measure_queries
+from src.mixins import BulkCreateModelMixin, BulkUpdateModelMixin, bulk_saved
+from src.profiling import RequestProfilingMiddleware, get_profile, list_profiles, summarize_profile
+from src.renderers import flatten_record, to_columnar
+from src.serializers import ModelSerializer
+
+from . import changelog, dashboard, feed, lod
+from .checks import check_job_backend
+from .feed import ALL_DIAGRAMS, ChangeBroker, broker
+from .changelog import get_current_token, get_changes, log_changes, change
+from .cloning import clone_structure_subtree
+from .diff import diff_charts
+from .history import create_snapshot, delete_snapshot, load_live_chart, load_snapshot_chart
+from .lod import collapse_diagram, compute_diagram_extents
+from .jobs import JOB_TYPES, LocalWorkers, job_type, start_local_workers, stop_local_workers, work
+from .views import StructureViewSet
+from .hierarchy import get_subtree_structure_ids
+from .importer import import_chart
+from .layout import auto_organize_structure
+from .moves import move_structure, move_position
+from .nodes import clear_node_registry
+from .pdf import FICHE_DE_POSTE_TEMPLATE, load_fiche_de_poste_contexts
+from .renderers import NODE_KINDS, DiagramColumnarJSONRenderer, DiagramMessagePackRenderer, tree_to_columnar
+from .rollups import rebuild_headcounts
+from .serializers import PositionSerializer
+from .synthetic import delete_chart, find_chart, generate_chart
+from .viewport import query_viewport
+from .models import Grade, StructureType, Structure, Position, Task, DiagramPosition, OrganigramEdge, Job, StructureHeadcount, \
+    ChangeLog, ChartSnapshot, SnapshotBlob
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class ChartTestCase(TestCase):
+    """
+    A small chart: DG (main) > DRH > Paie, DG > DFC, one position per
+    structure plus an agent position in Paie, and an authenticated client.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.grade_a = Grade.objects.create(name='A', category='Cadre')
+        cls.grade_b = Grade.objects.create(name='B', category='Maitrise')
+        cls.dg = Structure.objects.create(name='DG', is_main=True)
+        cls.drh = Structure.objects.create(name='DRH', parent=cls.dg)
+        cls.dfc = Structure.objects.create(name='DFC', parent=cls.dg)
+        cls.paie = Structure.objects.create(name='Paie', parent=cls.drh)
+        cls.director = Position.objects.create(title='Directeur', structure=cls.dg, grade=cls.grade_a)
+        cls.drh_head = Position.objects.create(title='DRH chef', structure=cls.drh, grade=cls.grade_a)
+        cls.dfc_head = Position.objects.create(title='DFC chef', structure=cls.dfc, grade=cls.grade_a)
+        cls.paie_head = Position.objects.create(title='Chef paie', structure=cls.paie, grade=cls.grade_a)
+        cls.paie_agent = Position.objects.create(title='Agent paie', structure=cls.paie, grade=cls.grade_b, quantity=3)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+
+class BulkMixinTests(ChartTestCase):
+
+    def test_bulk_create_returns_ids(self):
+        response = self.client.post('/api/tasks/bulk_create/', {'items': [
+            {'position': self.director.id, 'description': 'a'},
+            {'position': self.drh_head.id, 'description': 'b'},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['created_count'], 2)
+        ids = [item['id'] for item in response.data['items']]
+        self.assertNotIn(None, ids)
+        self.assertEqual(set(Task.objects.values_list('id', flat=True)), set(ids))
+
+    def test_bulk_update_skips_items_without_changes(self):
+        changed = Task.objects.create(position=self.director, description='a')
+        untouched = Task.objects.create(position=self.director, description='b')
+        updated_at = untouched.updated_at
+        response = self.client.post('/api/tasks/bulk_update/', {'items': [
+            {'id': changed.id, 'description': 'changed'},
+            {'id': untouched.id},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['updated_count'], 1)
+        changed.refresh_from_db()
+        untouched.refresh_from_db()
+        self.assertEqual(changed.description, 'changed')
+        self.assertEqual(untouched.updated_at, updated_at)
+
+    def test_bulk_update_reports_missing_ids(self):
+        task = Task.objects.create(position=self.director, description='a')
+        response = self.client.post('/api/tasks/bulk_update/', {'items': [
+            {'id': task.id, 'description': 'changed'},
+            {'id': task.id + 1000, 'description': 'changed'},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data['missing_ids'], [task.id + 1000])
+        task.refresh_from_db()
+        self.assertEqual(task.description, 'a')
+
+    def test_bulk_delete_reports_missing_ids(self):
+        task = Task.objects.create(position=self.director, description='a')
+        response = self.client.post('/api/tasks/bulk_delete/', {'ids': [task.id, task.id + 1000]}, format='json')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data['missing_ids'], [task.id + 1000])
+        self.assertTrue(Task.objects.filter(id=task.id).exists())
+
+        response = self.client.post('/api/tasks/bulk_delete/', {'ids': [task.id]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['deleted_count'], 1)
+
+    def test_bulk_writes_send_bulk_saved(self):
+        saved = []
+
+        def receiver(sender, instances, created, **kwargs):
+            saved.append(([instance.description for instance in instances], created))
+
+        bulk_saved.connect(receiver, sender=Task)
+        self.addCleanup(bulk_saved.disconnect, receiver, sender=Task)
+
+        response = self.client.post('/api/tasks/bulk_create/', {'items': [
+            {'position': self.director.id, 'description': 'a'},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 201)
+        task_id = response.data['items'][0]['id']
+        response = self.client.post('/api/tasks/bulk_update/', {'items': [
+            {'id': task_id, 'description': 'b'},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(saved, [(['a'], True), (['b'], False)])
+
+    def test_models_with_save_receivers_have_bulk_receivers(self):
+        for model in apps.get_app_config('organigramme').get_models():
+            if post_save.has_listeners(model):
+                self.assertTrue(bulk_saved.has_listeners(model), model)
+
+
+class DiagramPositionTests(ChartTestCase):
+
+    def test_create_answers_201_when_creating_and_updating(self):
+        data = {
+            'content_type': 'position', 'object_id': self.drh_head.id,
+            'main_structure': self.dg.id, 'position_x': 10, 'position_y': 20,
+        }
+        response = self.client.post('/api/diagram-positions/', data, format='json')
+        self.assertEqual(response.status_code, 201)
+        created_id = response.data['id']
+
+        data['position_x'] = 30
+        response = self.client.post('/api/diagram-positions/', data, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['id'], created_id)
+        self.assertEqual(DiagramPosition.objects.get(id=created_id).position_x, 30)
+
+    def test_bulk_sync_creates_then_updates(self):
+        nodes = [
+            {'content_type': 'structure', 'object_id': self.drh.id, 'position_x': 10, 'position_y': 20},
+            {'content_type': 'position', 'object_id': self.paie_agent.id, 'position_x': 30, 'position_y': 40},
+        ]
+        response = self.client.post('/api/diagram-positions/bulk-sync/', {
+            'main_structure': self.dg.id, 'nodes': nodes,
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['created_count'], response.data['updated_count']), (2, 0))
+
+        nodes[0]['position_x'] = 50
+        response = self.client.post('/api/diagram-positions/bulk-sync/', {
+            'main_structure': self.dg.id, 'nodes': nodes,
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['created_count'], response.data['updated_count']), (0, 2))
+        self.assertEqual(DiagramPosition.objects.filter(main_structure=self.dg).count(), 2)
+        self.assertEqual(
+            DiagramPosition.objects.get(main_structure=self.dg, object_id=self.drh.id).position_x, 50
+        )
+
+
+    def test_bulk_sync_updates_rows_created_meanwhile(self):
+        def create_meanwhile():
+            # Another writer creates the DRH row after the sync looked for the existing ones
+            DiagramPosition.objects.create(
+                content_type=ContentType.objects.get_for_model(Structure), object_id=self.drh.id,
+                main_structure=self.dg, position_x=1, position_y=1,
+            )
+            return timezone.now()
+
+        nodes = [
+            {'content_type': 'structure', 'object_id': self.drh.id, 'position_x': 10, 'position_y': 20},
+            {'content_type': 'position', 'object_id': self.paie_agent.id, 'position_x': 30, 'position_y': 40},
+        ]
+        with self.captureOnCommitCallbacks(execute=True), \
+                mock.patch('organigramme.views.timezone', now=mock.Mock(side_effect=create_meanwhile)):
+            response = self.client.post('/api/diagram-positions/bulk-sync/', {
+                'main_structure': self.dg.id, 'nodes': nodes,
+            }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['created_count'], response.data['updated_count']), (1, 1))
+        self.assertEqual(DiagramPosition.objects.filter(main_structure=self.dg).count(), 2)
+        self.assertEqual(
+            DiagramPosition.objects.values_list('position_x', 'position_y').get(object_id=self.drh.id), (10, 20)
+        )
+        self.assertEqual(sorted(ChangeLog.objects.filter(kind='diagram_position').values_list('object_id', 'action')), [
+            (self.drh.id, 'created'), (self.drh.id, 'updated'), (self.paie_agent.id, 'created'),
+        ])
+
+
+class PositionBulkUpdateTests(ChartTestCase):
+
+    def test_updates_coordinates_and_logs_them(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/positions/bulk-update/', {'updates': [
+                {'id': self.paie_agent.id, 'x': 10, 'y': 20},
+                {'id': self.drh_head.id, 'x': 30, 'y': 40},
+            ]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['updated_count'], 2)
+        self.assertEqual(Position.objects.values_list('position_x', 'position_y').get(id=self.paie_agent.id), (10, 20))
+        self.assertEqual(
+            sorted(ChangeLog.objects.filter(kind='position').values_list('object_id', 'action', 'structure_id')),
+            sorted([(self.paie_agent.id, 'updated', self.paie.id), (self.drh_head.id, 'updated', self.drh.id)])
+        )
+
+    def test_unknown_ids_update_nothing(self):
+        response = self.client.post('/api/positions/bulk-update/', {'updates': [
+            {'id': self.paie_agent.id, 'x': 10, 'y': 20},
+            {'id': 999999, 'x': 30, 'y': 40},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data['missing_ids'], [999999])
+        self.assertNotEqual(Position.objects.get(id=self.paie_agent.id).position_x, 10)
+
+    def test_rejects_invalid_coordinates(self):
+        response = self.client.post('/api/positions/bulk-update/', {'updates': [
+            {'id': self.paie_agent.id, 'x': 'left', 'y': 20},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/positions/bulk-update/', {'updates': []}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class CloneStructureTests(ChartTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # DRH reports to DG, and its head to the director
+        self.dg.manager = self.director
+        self.dg.save()
+        self.dfc.manager = self.dfc_head
+        self.dfc.save()
+        OrganigramEdge.objects.create(structure=self.dg, source=self.dg, target=self.drh)
+        OrganigramEdge.objects.create(structure=self.drh, source=self.director, target=self.drh_head)
+
+    def incoming_edge_sources(self, structure_copy, id_maps):
+        head_copy = Position.objects.get(id=id_maps['positions'][self.drh_head.id])
+        return {
+            (edge.source_content_type.model, edge.source_object_id, edge.structure_id)
+            for edge in OrganigramEdge.objects.filter(
+                Q(target_content_type__model='structure', target_object_id=structure_copy.id)
+                | Q(target_content_type__model='position', target_object_id=head_copy.id)
+            )
+        }
+
+    def test_clone_under_the_same_parent_keeps_incoming_edges(self):
+        structure_copy, id_maps = clone_structure_subtree(self.drh, parent_id=self.dg.id)
+        self.assertEqual(self.incoming_edge_sources(structure_copy, id_maps), {
+            ('structure', self.dg.id, self.dg.id),
+            ('position', self.director.id, structure_copy.id),
+        })
+
+    def test_clone_under_another_parent_repoints_incoming_edges(self):
+        structure_copy, id_maps = clone_structure_subtree(self.drh, parent_id=self.dfc.id)
+        self.assertEqual(structure_copy.parent_id, self.dfc.id)
+        self.assertEqual(self.incoming_edge_sources(structure_copy, id_maps), {
+            ('structure', self.dfc.id, self.dfc.id),
+            ('position', self.dfc_head.id, structure_copy.id),
+        })
+
+    def test_clone_under_a_parent_without_manager_drops_manager_edge(self):
+        structure_copy, id_maps = clone_structure_subtree(self.drh, parent_id=self.paie.id)
+        self.assertEqual(self.incoming_edge_sources(structure_copy, id_maps), {
+            ('structure', self.paie.id, self.paie.id),
+        })
+
+
+class MoveStructureTests(ChartTestCase):
+
+    def parent_edges(self, structure):
+        return list(OrganigramEdge.objects.filter(
+            target_content_type__model='structure', target_object_id=structure.id
+        ).values_list('source_object_id', 'structure_id'))
+
+    def test_move_rewrites_the_parent_edge(self):
+        OrganigramEdge.objects.create(structure=self.drh, source=self.drh, target=self.paie)
+        move_structure(self.paie, self.dfc.id)
+        self.assertEqual(self.parent_edges(self.paie), [(self.dfc.id, self.dfc.id)])
+
+    def test_move_of_a_root_structure_creates_the_parent_edge(self):
+        orphan = Structure.objects.create(name='Audit')
+        move_structure(orphan, self.dg.id)
+        orphan.refresh_from_db()
+        self.assertEqual(orphan.parent_id, self.dg.id)
+        self.assertEqual(self.parent_edges(orphan), [(self.dg.id, self.dg.id)])
+
+    def test_move_to_the_root_deletes_the_parent_edge(self):
+        OrganigramEdge.objects.create(structure=self.drh, source=self.drh, target=self.paie)
+        move_structure(self.paie, None)
+        self.assertEqual(self.parent_edges(self.paie), [])
+
+
+class FicheDePosteTests(ChartTestCase):
+
+    def test_cache_miss_queues_one_rendering_job(self):
+        url = f'/api/positions/{self.paie_agent.id}/generate_pdf/'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], 'pending')
+        job = Job.objects.get(kind='render_fiche_de_poste')
+        self.assertEqual(response.data['job'], str(job.id))
+        self.assertEqual(job.payload['position'], self.paie_agent.id)
+
+        # Polled from any process: the state is the job row
+        self.assertEqual(self.client.get(url).status_code, 202)
+        self.assertEqual(Job.objects.filter(kind='render_fiche_de_poste').count(), 1)
+        response = self.client.get(f'/api/positions/{self.paie_agent.id}/pdf-status/')
+        self.assertEqual(response.data, {'status': 'pending', 'job': str(job.id)})
+
+    def test_failed_rendering_is_reported_then_queued_again(self):
+        url = f'/api/positions/{self.paie_agent.id}/generate_pdf/'
+        self.client.get(url)
+        Job.objects.update(status='failed', error='Error generating PDF')
+        response = self.client.get(f'/api/positions/{self.paie_agent.id}/pdf-status/')
+        self.assertEqual(response.data['status'], 'failed')
+        self.assertEqual(response.data['error'], 'Error generating PDF')
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], 'pending')
+        self.assertEqual(Job.objects.filter(kind='render_fiche_de_poste').count(), 2)
+
+
+class PdfRenderCacheTests(ChartTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Same bytes for the same document: no timestamp nor random id
+        patcher = mock.patch.object(rl_config, 'invariant', 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(pdf_service.clear_render_caches)
+        self.context = load_fiche_de_poste_contexts([self.paie_agent.id])[self.paie_agent.id]
+
+    def render(self):
+        """
+        Inflated streams and objects of the rendered document, without what
+        differs between two renderings of the same document (lengths and
+        offsets, image names derived from object ids).
+        """
+        pdf = pdf_service.render_pdf(FICHE_DE_POSTE_TEMPLATE, self.context)
+        self.assertIsNotNone(pdf)
+        parts = re.split(rb'stream\r?\n(.*?)endstream', pdf[:pdf.rindex(b'xref')], flags=re.S)
+        for index in range(1, len(parts), 2):
+            try:
+                parts[index] = zlib.decompressobj().decompress(parts[index])
+            except zlib.error:
+                pass
+        return re.sub(rb'/Length \d+|FormXob\.[0-9a-f]+', b'', b'\n'.join(parts))
+
+    def test_warm_rendering_hits_the_caches_and_renders_the_same_document(self):
+        self.assertTrue(pdf_service.install_render_caches())
+        pdf_service.clear_render_caches()
+        cold = self.render()
+        css_hits, image_hits = pdf_service._css_cache.hits, pdf_service._image_cache.hits
+        warm = self.render()
+        self.assertGreater(pdf_service._css_cache.hits, css_hits)
+        self.assertGreater(pdf_service._image_cache.hits, image_hits)
+        self.assertEqual(warm, cold)
+
+    def test_cached_rendering_matches_the_library_output(self):
+        pdf_service.install_render_caches()
+        self.render()
+        cached = self.render()
+        pdf_service.uninstall_render_caches()
+        self.addCleanup(pdf_service.install_render_caches)
+        with mock.patch.object(rl_config, 'useA85', 0):
+            self.assertEqual(self.render(), cached)
+
+    def test_unsupported_versions_are_left_alone(self):
+        pdf_service.uninstall_render_caches()
+        self.addCleanup(pdf_service.install_render_caches)
+        with mock.patch.object(pdf_service.xhtml2pdf, '__version__', '0.3.0'), \
+                self.assertLogs('src.pdf_service', 'WARNING'):
+            self.assertFalse(pdf_service.install_render_caches())
+        self.assertIsNot(pisaCSSParser.parse, pdf_service._parse_css)
+
+    def test_caches_keep_the_most_recently_used_entries(self):
+        cache = pdf_service.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c'), len(cache)), (1, 3, 2))
+
+
+class ImportChartTests(ChartTestCase):
+    header = "structure;poste;grade;parent;effectif;missions;competences;grade_category\n"
+
+    def import_csv(self, rows, dry_run=False):
+        return import_chart(io.BytesIO((self.header + rows).encode('utf-8')), 'chart.csv', dry_run=dry_run)
+
+    def test_dry_run_writes_nothing(self):
+        chart_import = self.import_csv(
+            "DG / DRH / Formation;Chef formation;A;;1;m1|m2;c1;\n"
+            "DG / DRH / Formation;Formateur;Nouveau;Chef formation;4;m3;;Exec\n",
+            dry_run=True
+        )
+        self.assertEqual(chart_import.errors, [])
+        self.assertEqual(chart_import.summary, {
+            "grades": 1, "structures": 1, "positions": 2, "missions": 3, "competences": 1, "edges": 2,
+        })
+        self.assertFalse(Structure.objects.filter(name='Formation').exists())
+        self.assertFalse(Grade.objects.filter(name='Nouveau').exists())
+
+    def test_error_row_rejects_the_file(self):
+        chart_import = self.import_csv(
+            "DG / DRH;Adjoint DRH;A;DRH chef;1;;;\n"
+            "DG;X;ZZ;;1;;;\n"
+            "DG;Y;A;;abc;;;\n"
+        )
+        self.assertEqual([error['line'] for error in chart_import.errors], [3, 4])
+        self.assertFalse(Position.objects.filter(title='Adjoint DRH').exists())
+
+    def test_parent_cycle_is_rejected(self):
+        chart_import = self.import_csv(
+            "DG / DRH / Formation;A1;A;A2;1;;;\n"
+            "DG / DRH / Formation;A2;A;A1;1;;;\n"
+            "DG / DRH / Formation;A3;A;A2;1;;;\n"
+        )
+        self.assertEqual(len(chart_import.errors), 1)
+        self.assertEqual(chart_import.errors[0]['line'], 2)
+        self.assertIn('lines 2, 3', chart_import.errors[0]['error'])
+        self.assertFalse(Structure.objects.filter(name='Formation').exists())
+
+    def test_conflicting_categories_of_a_new_grade_are_rejected(self):
+        chart_import = self.import_csv(
+            "DG / DRH;P1;Nouveau;;1;;;Exec\n"
+            "DG / DRH;P2;Nouveau;;1;;;\n"
+            "DG / DRH;P3;Nouveau;;1;;;Exec\n"
+            "DG / DRH;P4;Nouveau;;1;;;Cadre\n"
+        )
+        self.assertEqual(chart_import.errors, [{
+            "line": 5, "error": "Conflicting grade_category 'Cadre' for the new grade 'Nouveau' ('Exec' on line 2)",
+        }])
+        self.assertFalse(Grade.objects.filter(name='Nouveau').exists())
+
+    def test_path_through_homonym_structures_is_rejected(self):
+        Structure.objects.create(name='Paie', parent=self.drh)
+        chart_import = self.import_csv(
+            "DG / DRH / Paie;Gestionnaire;A;;1;;;\n"
+            "DG / DRH / Paie / Retraites;Gestionnaire;A;;1;;;\n"
+            "DG / DFC;Comptable;A;;1;;;\n"
+        )
+        self.assertEqual([error['line'] for error in chart_import.errors], [2, 3])
+        self.assertIn("Ambiguous structure 'DG / DRH / Paie'", chart_import.errors[0]['error'])
+        self.assertFalse(Position.objects.filter(title__in=['Gestionnaire', 'Comptable']).exists())
+
+    def test_import_builds_structures_like_the_ui(self):
+        auto_organize_structure(self.dg.id)
+        chart_import = self.import_csv(
+            "DG / DRH / Formation;Chef formation;A;;1;;;\n"
+            "DG / DRH / Formation;Formateur;Nouveau;Chef formation;4;;;Exec\n"
+            "DG / DRH;Adjoint DRH;A;DRH chef;1;;;\n"
+            "Nouvelle Dir;Directeur ND;B;;2;;;\n"
+        )
+        self.assertEqual(chart_import.errors, [])
+
+        formation = Structure.objects.get(name='Formation')
+        new_chart = Structure.objects.get(name='Nouvelle Dir')
+        self.assertFalse(formation.is_main)
+        self.assertTrue(new_chart.is_main)
+        self.assertTrue(OrganigramEdge.objects.filter(
+            source_content_type__model='structure', source_object_id=self.drh.id,
+            target_content_type__model='structure', target_object_id=formation.id,
+        ).exists())
+        self.assertEqual(
+            dict(Position.objects.filter(title__in=['Chef formation', 'Formateur', 'Directeur ND'])
+                 .values_list('title', 'category')),
+            {'Chef formation': 'Cadre', 'Formateur': 'Exec', 'Directeur ND': 'Maitrise'}
+        )
+
+        def diagram_nodes(main_structure):
+            return set(DiagramPosition.objects.filter(main_structure=main_structure).values_list(
+                'content_type__model', 'object_id'
+            ))
+        formation_positions = set(formation.positions.values_list('id', flat=True))
+        adjoint = Position.objects.get(title='Adjoint DRH')
+        self.assertLessEqual(
+            {('structure', formation.id), ('position', adjoint.id)}
+            | {('position', position_id) for position_id in formation_positions},
+            diagram_nodes(self.dg)
+        )
+        self.assertEqual(diagram_nodes(new_chart), {
+            ('structure', new_chart.id), ('position', Position.objects.get(title='Directeur ND').id),
+        })
+
+
+class HeadcountRollupTests(ChartTestCase):
+
+    def assertRollupsMatchRebuild(self):
+        def rows():
+            return set(StructureHeadcount.objects.values_list(
+                'structure_id', 'grade_id', 'category', 'positions_count', 'headcount'
+            ))
+        incremental = rows()
+        rebuild_headcounts()
+        self.assertEqual(incremental, rows())
+
+    def test_rollups_after_create(self):
+        Position.objects.create(title='Comptable', structure=self.dfc, grade=self.grade_b, quantity=2)
+        self.assertRollupsMatchRebuild()
+        self.assertEqual(
+            StructureHeadcount.objects.get(structure=self.dg, grade=self.grade_b).headcount, 5
+        )
+
+    def test_rollups_and_change_log_after_bulk_writes(self):
+        class PositionBulkViewSet(BulkCreateModelMixin, BulkUpdateModelMixin, viewsets.ModelViewSet):
+            queryset = Position.objects.all()
+            serializer_class = PositionSerializer
+
+        def post(action, items):
+            request = APIRequestFactory().post('/', {'items': items}, format='json')
+            force_authenticate(request, self.user)
+            return PositionBulkViewSet.as_view({'post': action})(request)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = post('bulk_create', [
+                {'title': 'Comptable', 'structure': self.dfc.id, 'grade': self.grade_b.id, 'quantity': 2},
+            ])
+        self.assertEqual(response.status_code, 201)
+        created_id = response.data['items'][0]['id']
+        self.assertRollupsMatchRebuild()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = post('bulk_update', [
+                {'id': self.paie_agent.id, 'structure': self.dfc.id, 'quantity': 5},
+                {'id': created_id, 'quantity': 4},
+            ])
+        self.assertEqual(response.status_code, 200)
+        self.assertRollupsMatchRebuild()
+        self.assertEqual(StructureHeadcount.objects.get(structure=self.dfc, grade=self.grade_b).headcount, 9)
+        self.assertEqual(
+            list(ChangeLog.objects.filter(kind='position').order_by('id').values_list(
+                'object_id', 'action', 'structure_id', 'previous_structure_id'
+            )),
+            [
+                (created_id, 'created', self.dfc.id, None),
+                (self.paie_agent.id, 'updated', self.dfc.id, self.paie.id),
+                (created_id, 'updated', self.dfc.id, self.dfc.id),
+            ]
+        )
+
+    def test_rollups_after_structure_move(self):
+        move_structure(self.paie, self.dfc.id)
+        self.assertRollupsMatchRebuild()
+        self.assertFalse(StructureHeadcount.objects.filter(structure=self.drh, grade=self.grade_b).exists())
+
+    def test_rollups_after_position_moves(self):
+        move_position(self.paie_agent, 'structure', self.dfc.id)
+        self.assertRollupsMatchRebuild()
+        self.paie_head.structure = self.drh
+        self.paie_head.save()
+        self.assertRollupsMatchRebuild()
+
+    def test_rollups_after_delete(self):
+        self.paie_agent.delete()
+        self.assertRollupsMatchRebuild()
+        Position.objects.filter(id=self.paie_head.id).first().delete()
+        self.assertRollupsMatchRebuild()
+        self.assertFalse(StructureHeadcount.objects.filter(structure=self.paie).exists())
+
+
+class ChangeLogTests(ChartTestCase):
+
+    # The endpoint runs in the async pool, on another connection than the test transaction
+    def changes(self, since):
+        return get_changes(self.dg.id, since)
+
+    def test_changes_are_readable_as_soon_as_committed(self):
+        token = get_current_token()
+        with self.captureOnCommitCallbacks(execute=True):
+            position = Position.objects.create(title='Comptable', structure=self.dfc, grade=self.grade_b)
+        deleted_id = self.paie_agent.id
+        with self.captureOnCommitCallbacks(execute=True):
+            self.paie_agent.delete()
+
+        data = self.changes(token)
+        self.assertFalse(data['reset'])
+        self.assertEqual([row['id'] for row in data['positions']['upserted']], [position.id])
+        self.assertEqual(data['positions']['deleted'], [deleted_id])
+        self.assertEqual(data['token'], get_current_token())
+        self.assertEqual(self.changes(data['token'])['positions'], {'upserted': [], 'deleted': []})
+
+    def test_entries_of_a_transaction_are_written_together(self):
+        before = ChangeLog.objects.count()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with transaction.atomic():
+                log_changes([change('position', 'updated', self.director.id, structure_id=self.dg.id)] * 1500)
+            self.assertEqual(ChangeLog.objects.count(), before)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(ChangeLog.objects.count(), before + 1500)
+
+    def test_rolled_back_writes_are_not_logged(self):
+        before = ChangeLog.objects.count()
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    Position.objects.create(title='Comptable', structure=self.dfc, grade=self.grade_b)
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(ChangeLog.objects.count(), before)
+
+    def test_pruned_token_resets(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Position.objects.create(title='Comptable', structure=self.dfc, grade=self.grade_b)
+        self.assertTrue(self.changes(get_current_token() + 10)['reset'])
+
+    def logged_ids(self, since):
+        return list(ChangeLog.objects.filter(id__gt=since).order_by('id').values_list('object_id', flat=True))
+
+    def test_entries_keep_their_order_across_savepoints(self):
+        token = get_current_token()
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                log_changes([change('position', 'updated', 1)])
+                with transaction.atomic():
+                    log_changes([change('position', 'updated', 2)])
+                    with transaction.atomic():
+                        log_changes([change('position', 'updated', 3)])
+                log_changes([change('position', 'updated', 4)])
+                try:
+                    with transaction.atomic():
+                        log_changes([change('position', 'updated', 5)])
+                        with transaction.atomic():
+                            log_changes([change('position', 'updated', 6)])
+                        raise ValueError
+                except ValueError:
+                    pass
+                with transaction.atomic():
+                    log_changes([change('position', 'updated', 7)])
+                log_changes([change('position', 'updated', 8)])
+        self.assertEqual(self.logged_ids(token), [1, 2, 3, 4, 7, 8])
+
+    def test_entries_logged_first_in_a_rolled_back_savepoint(self):
+        token = get_current_token()
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                try:
+                    with transaction.atomic():
+                        self.paie_agent.quantity = 5
+                        self.paie_agent.save()
+                        raise ValueError
+                except ValueError:
+                    pass
+                self.drh_head.quantity = 2
+                self.drh_head.save()
+        self.assertEqual(self.logged_ids(token), [self.drh_head.id])
+
+        # The next transaction starts a new batch
+        with self.captureOnCommitCallbacks(execute=True):
+            self.paie_head.save()
+        self.assertEqual(self.logged_ids(token), [self.drh_head.id, self.paie_head.id])
+
+
+def retry_when_locked(function, *args):
+    """
+    Run `function` again while the shared in-memory SQLite database of the
+    tests reports a locked table (a file database waits for the lock).
+    """
+    while True:
+        try:
+            return function(*args)
+        except OperationalError as error:
+            if 'locked' not in str(error):
+                raise
+            time.sleep(0.001)
+
+
+class ChangeLogConcurrencyTests(TransactionTestCase):
+    """Writers and a syncing reader in their own threads, on their own connections."""
+
+    WRITERS = 4
+    TRANSACTIONS = 15
+
+    def write(self, writer):
+        try:
+            for number in range(self.TRANSACTIONS):
+                self.write_transaction(writer, number)
+        finally:
+            connection.close()
+
+    def write_transaction(self, writer, number):
+        # object_id: writer, transaction, rank of the entry in it
+        base = (writer * 100 + number) * 10
+        with transaction.atomic():
+            log_changes([change('position', 'updated', base + 1)])
+            with transaction.atomic():
+                log_changes([change('position', 'updated', base + 2), change('position', 'updated', base + 3)])
+            try:
+                with transaction.atomic():
+                    log_changes([change('position', 'updated', base + 9)])
+                    raise ValueError
+            except ValueError:
+                pass
+            log_changes([change('position', 'updated', base + 4)])
+
+    def test_a_syncing_reader_misses_no_entry(self):
+        writers = [threading.Thread(target=self.write, args=(writer,)) for writer in range(self.WRITERS)]
+        read, token = [], get_current_token()
+
+        def sync():
+            nonlocal token
+            entries = retry_when_locked(
+                lambda: list(ChangeLog.objects.filter(id__gt=token).order_by('id').values_list('id', 'object_id'))
+            )
+            if entries:
+                token = entries[-1][0]
+            read.extend(entries)
+
+        # The log is written in transactions of its own, which can be run again
+        write_entries = changelog.write_entries
+        with mock.patch.object(changelog, 'write_entries', lambda entries: retry_when_locked(write_entries, entries)):
+            for writer in writers:
+                writer.start()
+            while any(writer.is_alive() for writer in writers):
+                sync()
+            for writer in writers:
+                writer.join()
+        sync()
+
+        logged = list(ChangeLog.objects.order_by('id').values_list('id', 'object_id'))
+        self.assertEqual(read, logged)
+        self.assertEqual(len(logged), self.WRITERS * self.TRANSACTIONS * 4)
+        by_transaction = {}
+        for _, object_id in logged:
+            by_transaction.setdefault(object_id // 10, []).append(object_id % 10)
+        # In the order of the writes, without the rolled back savepoint
+        self.assertEqual(set(map(tuple, by_transaction.values())), {(1, 2, 3, 4)})
+
+
+class SnapshotStorageTests(ChartTestCase):
+
+    def test_blobs_are_addressed_by_their_content(self):
+        snapshot = create_snapshot(self.dg, 'v1')
+        self.assertEqual((snapshot.structures_count, snapshot.positions_count, snapshot.new_blobs_count), (4, 5, 4))
+        self.assertEqual(SnapshotBlob.objects.count(), 4)
+        for blob in SnapshotBlob.objects.all():
+            self.assertEqual(hashlib.sha256(zlib.decompress(bytes(blob.data))).hexdigest(), blob.hash)
+
+        # Nothing changed: the manifest points to the same blobs
+        self.assertEqual(create_snapshot(self.dg, 'v2').new_blobs_count, 0)
+        self.assertEqual(SnapshotBlob.objects.count(), 4)
+
+        # Only the structure holding the changed position gets a new blob
+        Task.objects.create(position=self.paie_agent, description='Calculer les salaires')
+        self.assertEqual(create_snapshot(self.dg, 'v3').new_blobs_count, 1)
+        self.dfc.name = 'Finances'
+        self.dfc.save()
+        self.assertEqual(create_snapshot(self.dg, 'v4').new_blobs_count, 1)
+        self.assertEqual(SnapshotBlob.objects.count(), 6)
+
+    def test_snapshot_keeps_the_chart_it_froze(self):
+        live = load_live_chart(self.dg.id)
+        snapshot = create_snapshot(self.dg, 'v1')
+        self.paie_agent.title = 'Gestionnaire paie'
+        self.paie_agent.save()
+        self.dfc.name = 'Finances'
+        self.dfc.save()
+
+        self.assertEqual(load_snapshot_chart(snapshot), live)
+        self.assertNotEqual(load_live_chart(self.dg.id), live)
+        agent = next(position for position in live['positions'] if position['id'] == self.paie_agent.id)
+        self.assertEqual((agent['title'], agent['tasks']), ('Agent paie', []))
+
+    def test_delete_keeps_the_shared_blobs(self):
+        first = create_snapshot(self.dg, 'v1')
+        self.paie_agent.quantity = 4
+        self.paie_agent.save()
+        second = create_snapshot(self.dg, 'v2')
+        self.assertEqual(SnapshotBlob.objects.count(), 5)
+
+        # Only the old blob of Paie is used by the first snapshot alone
+        self.assertEqual(delete_snapshot(first), 1)
+        self.assertEqual(SnapshotBlob.objects.count(), 4)
+        self.assertEqual(len(load_snapshot_chart(second)['structures']), 4)
+        self.assertEqual(delete_snapshot(second), 4)
+        self.assertEqual(SnapshotBlob.objects.count(), 0)
+
+    def test_blobs_written_meanwhile_are_not_written_again(self):
+        create_snapshot(self.dg, 'v1')
+        # As if a concurrent snapshot wrote them after this one looked them up
+        with mock.patch('organigramme.history._existing_hashes', return_value=set()):
+            snapshot = create_snapshot(self.dg, 'v2')
+        self.assertEqual(SnapshotBlob.objects.count(), 4)
+        self.assertEqual(load_snapshot_chart(snapshot), load_live_chart(self.dg.id))
+
+
+class SnapshotDiffTests(ChartTestCase):
+
+    def test_snapshot_creation_is_a_job(self):
+        response = self.client.post('/api/chart-snapshots/', {
+            'main_structure': self.dg.id, 'name': 'v1', 'decree_date': '2026-01-31',
+        }, format='json')
+        self.assertEqual(response.status_code, 202)
+        work('test', kinds=['create_snapshot'], once=True)
+        job = Job.objects.get(id=response.data['job'])
+        self.assertEqual(job.status, 'succeeded')
+        snapshot = ChartSnapshot.objects.get(id=job.result['id'])
+        self.assertEqual(snapshot.name, 'v1')
+
+        response = self.client.get(f'/api/chart-snapshots/{snapshot.id}/chart/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            {structure['name'] for structure in response.data['structures']}, {'DG', 'DRH', 'DFC', 'Paie'}
+        )
+
+    def test_diff_between_a_snapshot_and_the_live_chart(self):
+        snapshot = create_snapshot(self.dg, 'v1')
+        compta = Structure.objects.create(name='Compta', parent=self.dfc)
+        Position.objects.create(title='Comptable', structure=compta, grade=self.grade_b, quantity=2)
+        move_structure(self.paie, self.dfc.id)
+        self.drh_head.grade = self.grade_b
+        self.drh_head.save()
+        self.director.quantity = 4
+        self.director.save()
+
+        response = self.client.get('/api/chart-snapshots/diff/', {'base': snapshot.id, 'target': f'live:{self.dg.id}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['summary']['changes'], {
+            'structure_moved': 1, 'structure_added': 1, 'position_updated': 1,
+            'position_grade_changed': 1, 'position_added': 1,
+        })
+        moved = next(change for change in response.data['changes'] if change['op'] == 'structure_moved')
+        self.assertEqual((moved['from'], moved['to']), ('DG / DRH', 'DG / DFC'))
+
+        response = self.client.get('/api/chart-snapshots/diff/', {
+            'base': snapshot.id, 'target': snapshot.id, 'details': 'false',
+        })
+        self.assertEqual(response.data, {'summary': {
+            'base': response.data['summary']['base'], 'target': response.data['summary']['base'], 'changes': {},
+        }})
+
+    def test_diff_rejects_unknown_sides(self):
+        self.assertEqual(self.client.get('/api/chart-snapshots/diff/', {'base': 'x', 'target': 'x'}).status_code, 400)
+        self.assertEqual(
+            self.client.get('/api/chart-snapshots/diff/', {'base': 999, 'target': f'live:{self.dg.id}'}).status_code,
+            404
+        )
+
+
+class ChartDiffTests(ChartTestCase):
+
+    def rebuilt(self, chart, offset=1000):
+        """`chart` as recreated by an import: same content, new ids."""
+        chart = copy.deepcopy(chart)
+        for structure in chart['structures']:
+            structure['id'] += offset
+            for field in ('parent_id', 'manager_id'):
+                if structure[field] is not None:
+                    structure[field] += offset
+        for position in chart['positions']:
+            position['id'] += offset
+            position['structure_id'] += offset
+        return chart
+
+    def test_rebuilt_chart_is_matched_by_path_and_title(self):
+        self.drh.manager = self.drh_head
+        self.drh.save()
+        base = load_live_chart(self.dg.id)
+        target = self.rebuilt(base)
+        self.assertEqual(diff_charts(base, target)['changes'], [])
+
+        agent = next(position for position in target['positions'] if position['id'] == self.paie_agent.id + 1000)
+        agent['quantity'] = 5
+        self.assertEqual(diff_charts(base, target)['changes'], [{
+            'op': 'position_updated', 'id': self.paie_agent.id, 'title': 'Agent paie', 'structure': 'DG / DRH / Paie',
+            'changes': {'quantity': [3, 5]}, 'target_id': agent['id'], 'matched_by': 'structure_title',
+        }])
+
+    def test_removed_and_reassigned_nodes(self):
+        base = load_live_chart(self.dg.id)
+        self.paie_agent.structure = self.drh
+        self.paie_agent.save()
+        self.dfc_head.delete()
+        self.dfc.delete()
+        self.drh.manager = self.drh_head
+        self.drh.save()
+
+        result = diff_charts(base, load_live_chart(self.dg.id))
+        self.assertEqual(result['summary'], {
+            'base': {'structures': 4, 'positions': 5, 'headcount': 7},
+            'target': {'structures': 3, 'positions': 4, 'headcount': 6},
+            'changes': {'structure_removed': 1, 'structure_updated': 1, 'position_removed': 1, 'position_reassigned': 1},
+        })
+        changes = {change['op']: change for change in result['changes']}
+        self.assertEqual(changes['structure_removed']['path'], 'DG / DFC')
+        self.assertEqual(changes['structure_updated']['changes'], {'manager_id': [None, self.drh_head.id]})
+        self.assertEqual((changes['position_removed']['title'], changes['position_removed']['structure']), ('DFC chef', 'DG / DFC'))
+        reassigned = changes['position_reassigned']
+        self.assertEqual((reassigned['id'], reassigned['from'], reassigned['to']), (self.paie_agent.id, 'DG / DRH / Paie', 'DG / DRH'))
+        self.assertNotIn('matched_by', reassigned)
+
+    def test_texts_and_quantities_are_compared(self):
+        base = load_live_chart(self.dg.id)
+        self.dfc_head.quantity = 2
+        self.dfc_head.save()
+        Task.objects.create(position=self.dfc_head, description='Clôturer les comptes')
+
+        result = diff_charts(base, load_live_chart(self.dg.id))
+        self.assertEqual(result['summary']['target']['headcount'], 8)
+        self.assertEqual(result['changes'], [{
+            'op': 'position_updated', 'id': self.dfc_head.id, 'title': 'DFC chef', 'structure': 'DG / DFC',
+            'changes': {'quantity': [1, 2], 'tasks': [[], ['Clôturer les comptes']]},
+        }])
+
+
+class PositionListTests(ChartTestCase):
+
+    def test_list_loads_parents_and_diagram_positions_in_bulk(self):
+        position_type = ContentType.objects.get_for_model(Position)
+        OrganigramEdge.objects.create(
+            structure=self.paie, source_content_type=position_type, source_object_id=self.paie_head.id,
+            target_content_type=position_type, target_object_id=self.paie_agent.id,
+        )
+        auto_organize_structure(self.dg.id)
+        response = self.client.get('/api/positions/', {'page_size': 100})
+        self.assertEqual(response.status_code, 200)
+        listed = {row['id']: row for row in response.data['results']}
+        for position in Position.objects.all():
+            self.assertEqual(listed[position.id], self.client.get(f'/api/positions/{position.id}/').data)
+        self.assertEqual(listed[self.paie_agent.id]['parent']['id'], self.paie_head.id)
+        self.assertEqual(len(listed[self.director.id]['diagram_positions']), 1)
+
+        with self.assertNumQueries(5):
+            self.client.get('/api/positions/', {'page_size': 100})
+        for index in range(20):
+            Position.objects.create(title=f'Agent {index}', structure=self.dfc, grade=self.grade_b)
+        auto_organize_structure(self.dg.id)
+        with self.assertNumQueries(5):
+            self.client.get('/api/positions/', {'page_size': 100})
+
+
+def run_select_one():
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1')
+
+
+class DashboardTests(ChartTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def get_dashboard(self):
+        response = self.client.get('/api/dashboard/')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_statistics(self):
+        data = self.get_dashboard()
+        self.assertEqual(data['total_structures'], 4)
+        self.assertEqual(data['total_main_structures'], 1)
+        self.assertEqual(data['total_root_structures'], 1)
+        self.assertEqual(data['total_positions'], 5)
+        self.assertEqual(data['total_headcount'], 7)
+        self.assertEqual(data['total_grades'], 2)
+        self.assertEqual(data['by_category'], [
+            {"category": "Cadre", "grades": 1, "positions": 4, "headcount": 4},
+            {"category": "Maitrise", "grades": 1, "positions": 1, "headcount": 3},
+        ])
+        self.assertEqual(len(data['recent_changes']), 9)
+        self.assertEqual({change['action'] for change in data['recent_changes']}, {"created"})
+
+    def test_snapshot_is_served_from_the_cache_until_a_write_commits(self):
+        with mock.patch.object(dashboard, 'compute_dashboard', wraps=dashboard.compute_dashboard) as compute:
+            first = self.get_dashboard()
+            self.assertEqual(self.get_dashboard(), first)
+            self.assertEqual(compute.call_count, 1)
+
+            with self.captureOnCommitCallbacks() as callbacks:
+                Position.objects.create(title='Comptable', structure=self.dfc, grade=self.grade_b, quantity=2)
+            # Not committed yet: the snapshot of the current version is still served
+            self.assertEqual(self.get_dashboard(), first)
+            self.assertEqual(compute.call_count, 1)
+
+            for callback in callbacks:
+                callback()
+            data = self.get_dashboard()
+            self.assertEqual(compute.call_count, 2)
+        self.assertGreater(data['version'], first['version'])
+        self.assertEqual(data['total_positions'], 6)
+        self.assertEqual(data['total_headcount'], 9)
+
+    def test_bulk_paths_invalidate_the_snapshot(self):
+        version = self.get_dashboard()['version']
+        with self.captureOnCommitCallbacks(execute=True):
+            move_structure(self.paie, self.dfc.id)
+        moved = self.get_dashboard()
+        self.assertGreater(moved['version'], version)
+        self.assertEqual(
+            (moved['recent_changes'][0]['type'], moved['recent_changes'][0]['id']), ("structure", self.paie.id)
+        )
+
+    def test_evicted_version_still_invalidates(self):
+        version = self.get_dashboard()['version']
+        cache.delete('organigramme:version:chart')
+        with self.captureOnCommitCallbacks(execute=True):
+            Grade.objects.create(name='C', category='Execution')
+        data = self.get_dashboard()
+        self.assertNotEqual(data['version'], version)
+        self.assertEqual(data['total_grades'], 3)
+
+
+class ViewportTests(ChartTestCase):
+    """Structures are 300x60 and positions 120x40, from their top-left corner."""
+
+    BOX = dict(min_x=350, max_x=800, min_y=50, max_y=200)
+
+    def setUp(self):
+        super().setUp()
+        for node, x, y in (
+            (self.dg, 0, 0), (self.drh, 400, 100), (self.dfc, 100, 120),
+            (self.director, 0, 200), (self.drh_head, 200, 100), (self.paie_agent, 1000, 1000),
+        ):
+            DiagramPosition.objects.create(content_object=node, main_structure=self.dg, position_x=x, position_y=y)
+        # DFC in the box of another diagram
+        branch = Structure.objects.create(name='Filiale', is_main=True)
+        DiagramPosition.objects.create(content_object=self.dfc, main_structure=branch, position_x=500, position_y=100)
+        self.dg_drh = OrganigramEdge.objects.create(structure=self.dg, source=self.dg, target=self.drh)
+        self.dg_dfc = OrganigramEdge.objects.create(structure=self.dg, source=self.dg, target=self.dfc)
+        self.drh_head_edge = OrganigramEdge.objects.create(structure=self.drh, source=self.drh, target=self.drh_head)
+        OrganigramEdge.objects.create(structure=self.dg, source=self.dg, target=self.director)
+        # The head of Paie has no place in this diagram
+        OrganigramEdge.objects.create(structure=self.drh, source=self.drh, target=self.paie_head)
+
+    def test_nodes_intersecting_the_box(self):
+        result = query_viewport(self.dg.id, **self.BOX)
+        # DFC starts before the box but reaches into it, the head of DRH ends before it
+        self.assertEqual(
+            [(node['type'], node['id'], node['position_x'], node['position_y']) for node in result['nodes']],
+            [('structure', self.drh.id, 400, 100), ('structure', self.dfc.id, 100, 120)],
+        )
+        self.assertEqual(result['nodes'][0]['data']['name'], 'DRH')
+        self.assertEqual(result['nodes'][0]['data']['parent_id'], self.dg.id)
+        self.assertFalse(result['truncated'])
+
+    def test_edges_touching_the_box_carry_both_ends(self):
+        edges = {edge['id']: edge for edge in query_viewport(self.dg.id, **self.BOX)['edges']}
+        self.assertEqual(set(edges), {self.dg_drh.id, self.dg_dfc.id, self.drh_head_edge.id})
+        self.assertEqual(edges[self.dg_drh.id]['source'], {"type": "structure", "id": self.dg.id, "position": (0, 0)})
+        self.assertEqual(edges[self.dg_drh.id]['target'], {"type": "structure", "id": self.drh.id, "position": (400, 100)})
+        self.assertEqual(
+            edges[self.drh_head_edge.id]['target'], {"type": "position", "id": self.drh_head.id, "position": (200, 100)}
+        )
+        self.assertEqual(edges[self.drh_head_edge.id]['structure'], self.drh.id)
+
+    def test_limit_truncates_in_reading_order(self):
+        result = query_viewport(self.dg.id, limit=1, **self.BOX)
+        self.assertEqual([node['id'] for node in result['nodes']], [self.drh.id])
+        self.assertTrue(result['truncated'])
+        self.assertEqual({edge['id'] for edge in result['edges']}, {self.dg_drh.id, self.drh_head_edge.id})
+
+        result = query_viewport(self.dg.id, limit=2, **self.BOX)
+        self.assertEqual(len(result['nodes']), 2)
+        self.assertFalse(result['truncated'])
+
+    def test_empty_box_and_deleted_nodes(self):
+        self.assertEqual(
+            query_viewport(self.dg.id, min_x=2000, max_x=3000, min_y=2000, max_y=3000),
+            {"nodes": [], "edges": [], "truncated": False},
+        )
+        # The diagram row of a deleted node is left behind
+        Position.objects.filter(id=self.paie_agent.id).delete()
+        self.assertTrue(DiagramPosition.objects.filter(content_type__model='position', object_id=self.paie_agent.id))
+        self.assertEqual(query_viewport(self.dg.id, min_x=900, max_x=1100, min_y=900, max_y=1100)['nodes'], [])
+
+    def test_invalid_parameters_are_rejected(self):
+        url = '/api/diagram-positions/viewport/'
+        box = {key: str(value) for key, value in self.BOX.items()}
+        for params in (
+            box,
+            dict(box, main_structure='x'),
+            dict(box, main_structure=self.dg.id, min_x='left'),
+            dict(box, main_structure=self.dg.id, min_x='900'),
+            dict(box, main_structure=self.dg.id, limit='many'),
+        ):
+            self.assertEqual(self.client.get(url, params).status_code, 400, params)
+        params = {key: value for key, value in box.items() if key != 'max_y'}
+        response = self.client.get(url, dict(params, main_structure=self.dg.id))
+        self.assertEqual((response.status_code, response.json()), (400, {"error": "max_y is required"}))
+
+
+class CollapsedDiagramTests(ChartTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        rebuild_headcounts()
+        for node, x, y in (
+            (self.dg, 0, 0), (self.drh, -200, 100), (self.dfc, 200, 100), (self.paie, -200, 200),
+            (self.director, 0, 80), (self.paie_head, -300, 300), (self.paie_agent, -100, 300),
+        ):
+            DiagramPosition.objects.create(content_object=node, main_structure=self.dg, position_x=x, position_y=y)
+        edges = (
+            (self.dg, self.dg, self.drh), (self.dg, self.dg, self.dfc), (self.drh, self.drh, self.paie),
+            (self.drh, self.director, self.drh_head), (self.paie, self.paie_head, self.paie_agent),
+            (self.drh, self.director, self.paie_head),
+        )
+        self.edges = [
+            OrganigramEdge.objects.create(structure=structure, source=source, target=target)
+            for structure, source, target in edges
+        ]
+
+    def node_keys(self, view):
+        return [(node['type'], node['id'], node.get('collapsed')) for node in view['nodes']]
+
+    def edge_keys(self, view):
+        return [
+            (edge['source']['type'], edge['source']['id'], edge['target']['type'], edge['target']['id'], edge['aggregated'])
+            for edge in view['edges']
+        ]
+
+    def test_structures_below_the_depth_are_summarized(self):
+        view = collapse_diagram(self.dg.id, depth=1)
+        self.assertEqual(self.node_keys(view), [
+            ('structure', self.dg.id, False), ('structure', self.drh.id, True), ('structure', self.dfc.id, True),
+            ('position', self.director.id, None),
+        ])
+        drh = view['nodes'][1]
+        self.assertEqual(drh['summary'], {
+            "children_count": 1, "structures_count": 1, "positions_count": 3, "headcount": 5,
+            # DRH, Paie and the two placed positions of Paie; the head of DRH has no place
+            "bbox": {"min_x": -300, "min_y": 100, "max_x": 100, "max_y": 340},
+        })
+        self.assertEqual((drh['position_x'], drh['position_y'], drh['data']['name']), (-200, 100, 'DRH'))
+        self.assertEqual(view['nodes'][0]['summary']['headcount'], 7)
+
+    def test_edges_to_hidden_nodes_go_to_their_summary(self):
+        view = collapse_diagram(self.dg.id, depth=1)
+        # The director's edges to the heads of DRH and Paie are merged into one edge to DRH,
+        # the edges inside DRH are dropped
+        self.assertEqual(self.edge_keys(view), [
+            ('structure', self.dg.id, 'structure', self.drh.id, False),
+            ('structure', self.dg.id, 'structure', self.dfc.id, False),
+            ('position', self.director.id, 'structure', self.drh.id, True),
+        ])
+        self.assertEqual(view['edges'][2]['id'], self.edges[3].id)
+
+    def test_expanded_structures_show_their_content(self):
+        view = collapse_diagram(self.dg.id, depth=1, expand=[self.drh.id])
+        self.assertEqual(self.node_keys(view), [
+            ('structure', self.dg.id, False), ('structure', self.drh.id, False), ('structure', self.paie.id, True),
+            ('structure', self.dfc.id, True), ('position', self.director.id, None), ('position', self.drh_head.id, None),
+        ])
+        # Not placed in the diagram
+        self.assertEqual((view['nodes'][5]['position_x'], view['nodes'][5]['position_y']), (None, None))
+        self.assertIn(('position', self.director.id, 'structure', self.paie.id, True), self.edge_keys(view))
+        self.assertIn(('position', self.director.id, 'position', self.drh_head.id, False), self.edge_keys(view))
+        self.assertEqual(
+            self.node_keys(collapse_diagram(self.dg.id, depth=2)),
+            self.node_keys(collapse_diagram(self.dg.id, depth=1, expand=[self.drh.id, self.dfc.id])),
+        )
+
+    def test_subtree_root(self):
+        view = collapse_diagram(self.dg.id, root_id=self.drh.id, depth=0)
+        self.assertEqual(self.node_keys(view), [('structure', self.drh.id, True)])
+        self.assertEqual(view['edges'], [])
+        self.assertIsNone(collapse_diagram(self.dg.id, root_id=Structure.objects.create(name='Filiale').id))
+
+    def test_extents_are_cached_until_a_write_commits(self):
+        with mock.patch.object(lod, 'compute_diagram_extents', wraps=compute_diagram_extents) as compute:
+            collapse_diagram(self.dg.id)
+            collapse_diagram(self.dg.id, depth=2)
+            self.assertEqual(compute.call_count, 1)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                agent = DiagramPosition.objects.get(object_id=self.paie_agent.id, content_type__model='position')
+                agent.position_x = 500
+                agent.save()
+            view = collapse_diagram(self.dg.id)
+            self.assertEqual(compute.call_count, 2)
+        self.assertEqual(view['nodes'][1]['summary']['bbox']['max_x'], 620)
+
+
+def rows_of(table):
+    """Rows of a {"count", "columns"} table, with dotted keys."""
+    return [{name: column[row] for name, column in table["columns"].items()} for row in range(table["count"])]
+
+
+class ColumnarRenderersTests(ChartTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for node, x, y in ((self.dg, 0, 0), (self.drh, -200, 100.5), (self.paie_agent, -150, 200)):
+            DiagramPosition.objects.create(content_object=node, main_structure=self.dg, position_x=x, position_y=y)
+
+    def test_records_round_trip(self):
+        records = [
+            {"id": 1, "grade": {"name": "A", "category": "Cadre"}, "tags": [{"k": 1}]},
+            {"id": 2, "grade": None, "extra": True, "tags": []},
+        ]
+        table = to_columnar(records)
+        self.assertEqual(table["count"], 2)
+        self.assertEqual(rows_of(table), [
+            {"id": 1, "grade.name": "A", "grade.category": "Cadre", "tags": {"count": 1, "columns": {"k": [1]}},
+             "grade": None, "extra": None},
+            {"id": 2, "grade.name": None, "grade.category": None, "tags": [], "grade": None, "extra": True},
+        ])
+        # Lists of scalars and empty lists are left as they are
+        self.assertEqual(to_columnar({"count": 3, "results": [], "ids": [1, 2]}), {"count": 3, "results": [], "ids": [1, 2]})
+
+    @skipUnless(msgpack, 'msgpack is not installed')
+    def test_list_is_negotiated_in_every_format(self):
+        url = '/api/diagram-positions/'
+        params = {'main_structure': self.dg.id, 'ordering': 'id'}
+        rows = self.client.get(url, params).json()['results']
+        self.assertEqual(len(rows), 3)
+
+        response = self.client.get(url, params, HTTP_ACCEPT='application/vnd.columnar+json')
+        self.assertEqual(response['Content-Type'], 'application/vnd.columnar+json')
+        columnar = json.loads(response.content)['results']
+        self.assertEqual(rows_of(columnar), [flatten_record(row) for row in rows])
+
+        response = self.client.get(url, dict(params, format='msgpack'))
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.content, raw=False), json.loads(
+            self.client.get(url, dict(params, format='columnar')).content
+        ))
+
+    def test_diagram_payload_round_trip(self):
+        OrganigramEdge.objects.create(structure=self.dg, source=self.dg, target=self.drh)
+        # To a node outside of the payload
+        OrganigramEdge.objects.create(structure=self.drh, source=self.drh, target=self.paie)
+        DiagramPosition.objects.create(content_object=self.paie, main_structure=self.dg, position_x=900, position_y=900)
+        payload = query_viewport(self.dg.id, min_x=-300, max_x=400, min_y=0, max_y=300)
+        self.assertEqual(len(payload['nodes']), 3)
+
+        renderers = [DiagramColumnarJSONRenderer()] + ([DiagramMessagePackRenderer()] if msgpack else [])
+        for renderer in renderers:
+            rendered = renderer.render(payload)
+            if renderer.format == 'msgpack':
+                columnar = msgpack.unpackb(rendered, raw=False)
+            else:
+                columnar = json.loads(rendered)
+            nodes = columnar['nodes']
+            rebuilt = [
+                {
+                    "type": columnar['kinds'][kind], "id": node_id, "position_x": x, "position_y": y,
+                    # The columns of both kinds are filled with None for the other kind
+                    "data": {**{name[5:]: value for name, value in row.items() if value is not None}, "id": node_id},
+                }
+                for kind, node_id, x, y, row in zip(nodes['kinds'], nodes['ids'], nodes['xs'], nodes['ys'], rows_of(nodes))
+            ]
+            self.assertEqual(rebuilt, [
+                dict(node, data={key: value for key, value in node['data'].items() if value is not None})
+                for node in payload['nodes']
+            ])
+            index = {(node['type'], node['id']): position for position, node in enumerate(payload['nodes'])}
+            # Paie, the structure of the agent, is not in the payload
+            self.assertEqual(nodes['parents'], [-1, 0, -1])
+
+            edges = columnar['edges']
+            self.assertEqual(edges['count'], len(payload['edges']))
+            for position, edge in enumerate(payload['edges']):
+                for end in ('source', 'target'):
+                    self.assertEqual(NODE_KINDS[edges[f'{end}_kinds'][position]], edge[end]['type'])
+                    self.assertEqual(edges[f'{end}_ids'][position], edge[end]['id'])
+                    self.assertEqual(edges[f'{end}s'][position], index.get((edge[end]['type'], edge[end]['id']), -1))
+                    self.assertEqual(edges['columns'][f'{end}.position'][position], list(edge[end]['position']))
+            self.assertEqual(edges['targets'], [1, -1])
+
+    def test_tree_payload_round_trip(self):
+        tree = {
+            "id": 1, "name": "DG", "positions": [{"id": 10, "title": "Directeur"}],
+            "children": [
+                {"id": 2, "name": "DRH", "positions": [], "children": [
+                    {"id": 4, "name": "Paie", "positions": [{"id": 11, "title": "Agent"}], "children": []},
+                ]},
+                {"id": 3, "name": "DFC", "positions": [{"id": 12, "title": "Chef"}], "children": []},
+            ],
+        }
+        columnar = tree_to_columnar(tree)
+        structures, positions = columnar['structures'], columnar['positions']
+        self.assertEqual(structures['ids'], [1, 2, 4, 3])
+        self.assertEqual(structures['parents'], [-1, 0, 1, 0])
+        self.assertEqual(structures['columns'], {"name": ["DG", "DRH", "Paie", "DFC"]})
+        self.assertEqual(positions['ids'], [10, 11, 12])
+        self.assertEqual([structures['ids'][index] for index in positions['structures']], [1, 4, 3])
+        self.assertEqual(positions['columns'], {"title": ["Directeur", "Agent", "Chef"]})
+
+
+def drain(loop, queue):
+    """Run the deliveries scheduled on `loop`; return the (id, event) items of `queue`."""
+    loop.run_until_complete(asyncio.sleep(0))
+    return [queue.get_nowait() for _ in range(queue.qsize())]
+
+
+class ChangeBrokerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.broker = ChangeBroker(history_size=3)
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def test_events_reach_the_subscribers_of_their_diagram(self):
+        first, second = self.broker.subscribe(1, self.loop), self.broker.subscribe(2, self.loop)
+        self.broker.publish({1}, {"op": "node_deleted", "kind": "position", "id": 3})
+        self.broker.publish({ALL_DIAGRAMS}, {"op": "refresh"})
+        received = drain(self.loop, first)
+        self.assertEqual([event for _, event in received], [
+            {"op": "node_deleted", "kind": "position", "id": 3}, {"op": "refresh"},
+        ])
+        self.assertLess(received[0][0], received[1][0])
+        self.assertEqual([event for _, event in drain(self.loop, second)], [{"op": "refresh"}])
+
+        self.broker.unsubscribe(1, first)
+        self.broker.unsubscribe(2, second)
+        self.assertFalse(self.broker.has_subscribers())
+        self.broker.publish({1}, {"op": "refresh"})
+        self.assertEqual(drain(self.loop, first), [])
+
+    def test_history_since_an_event(self):
+        for index in range(3):
+            self.broker.publish({1}, {"op": "edge_deleted", "id": index})
+        history = self.broker.history_since(1, 0)
+        self.assertEqual([event['id'] for _, event in history], [0, 1, 2])
+        self.assertEqual(self.broker.history_since(1, history[1][0]), history[2:])
+        self.assertEqual(self.broker.history_since(2, 0), [])
+        # The first event is dropped: a client that missed it must reload
+        self.broker.publish({1}, {"op": "edge_deleted", "id": 3})
+        self.assertIsNone(self.broker.history_since(1, 0))
+        self.assertEqual(len(self.broker.history_since(1, history[0][0])), 3)
+
+    def test_a_slow_client_is_sent_a_refresh(self):
+        with mock.patch.object(feed, 'FEED_QUEUE_SIZE', 2):
+            queue = self.broker.subscribe(1, self.loop)
+        for index in range(3):
+            self.broker.publish({1}, {"op": "edge_deleted", "id": index})
+        self.assertEqual(drain(self.loop, queue), [(3, {"op": "refresh"})])
+
+    def test_concurrent_publishers_deliver_in_order(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(loop.call_soon_threadsafe, loop.stop)
+        publisher_count, event_count = 8, 500
+        with mock.patch.object(feed, 'FEED_QUEUE_SIZE', publisher_count * event_count):
+            queue = self.broker.subscribe(1, loop)
+
+        def publish(publisher):
+            for index in range(event_count):
+                self.broker.publish({1}, {"op": "edge_deleted", "id": (publisher, index)})
+
+        # Switch threads as often as possible to interleave the publishers
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            publishers = [threading.Thread(target=publish, args=(publisher,)) for publisher in range(publisher_count)]
+            for publisher in publishers:
+                publisher.start()
+            for publisher in publishers:
+                publisher.join()
+        finally:
+            sys.setswitchinterval(switch_interval)
+
+        async def read():
+            return [queue.get_nowait() for _ in range(queue.qsize())]
+
+        received = asyncio.run_coroutine_threadsafe(read(), loop).result(timeout=10)
+        ids = [event_id for event_id, _ in received]
+        self.assertEqual(len(ids), publisher_count * event_count)
+        self.assertEqual(ids, sorted(ids))
+        for publisher in range(publisher_count):
+            indexes = [event['id'][1] for _, event in received if event['id'][0] == publisher]
+            self.assertEqual(indexes, list(range(event_count)))
+
+
+class FeedDeltaTests(ChartTestCase):
+
+    def follow(self, main_structure_id):
+        """Subscribe to the feed of a diagram; returns a function reading the events received."""
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        queue = broker.subscribe(main_structure_id, loop)
+        self.addCleanup(broker.unsubscribe, main_structure_id, queue)
+        return lambda: [event for _, event in drain(loop, queue)]
+
+    def test_writes_are_published_once_committed(self):
+        received = self.follow(self.dg.id)
+        with self.captureOnCommitCallbacks() as callbacks:
+            DiagramPosition.objects.create(content_object=self.drh, main_structure=self.dg, position_x=10, position_y=20)
+        self.assertEqual(received(), [])
+        for callback in callbacks:
+            callback()
+        self.assertEqual(received(), [{"op": "node_moved", "kind": "structure", "id": self.drh.id, "x": 10, "y": 20}])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.paie.name = 'Paie et avantages'
+            self.paie.save()
+            edge = OrganigramEdge.objects.create(structure=self.drh, source=self.drh, target=self.paie)
+            edge_id = edge.id
+            edge.delete()
+            agent_id = self.paie_agent.id
+            self.paie_agent.delete()
+        self.assertEqual(received(), [
+            {"op": "node_updated", "kind": "structure", "id": self.paie.id, "data": {
+                "name": 'Paie et avantages', "parent_id": self.drh.id, "is_main": False, "type_id": None, "manager_id": None,
+            }},
+            {"op": "edge_added", "id": edge_id, "source": ["structure", self.drh.id], "target": ["structure", self.paie.id],
+             "edge_type": "smoothstep", "structure": self.drh.id},
+            {"op": "edge_deleted", "id": edge_id},
+            {"op": "node_deleted", "kind": "position", "id": agent_id},
+        ])
+
+    def test_rolled_back_writes_are_not_published(self):
+        received = self.follow(self.dg.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    DiagramPosition.objects.create(content_object=self.drh, main_structure=self.dg)
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(received(), [])
+
+    def test_only_the_diagrams_showing_the_node_are_notified(self):
+        branch = Structure.objects.create(name='Filiale', is_main=True)
+        in_dg, in_branch = self.follow(self.dg.id), self.follow(branch.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.drh_head.quantity = 2
+            self.drh_head.save()
+        self.assertEqual([event['id'] for event in in_dg()], [self.drh_head.id])
+        self.assertEqual(in_branch(), [])
+
+        # Moved to the branch: both diagrams are told
+        with self.captureOnCommitCallbacks(execute=True):
+            self.dfc.parent = branch
+            self.dfc.save()
+        self.assertEqual([(event['op'], event['id']) for event in in_dg()], [("node_updated", self.dfc.id)])
+        self.assertEqual([(event['op'], event['id']) for event in in_branch()], [("node_updated", self.dfc.id)])
+
+    def test_bulk_sync_publishes_one_delta(self):
+        received = self.follow(self.dg.id)
+        nodes = [
+            {'content_type': 'structure', 'object_id': self.drh.id, 'position_x': 10, 'position_y': 20},
+            {'content_type': 'position', 'object_id': self.paie_agent.id, 'position_x': 30, 'position_y': 40},
+        ]
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/diagram-positions/bulk-sync/', {
+                'main_structure': self.dg.id, 'nodes': nodes,
+            }, format='json')
+        self.assertEqual(response.status_code, 200)
+        events = received()
+        self.assertEqual([event['op'] for event in events], ["nodes_moved"])
+        self.assertEqual(sorted(map(tuple, events[0]['nodes'])), sorted([
+            ("structure", self.drh.id, 10, 20), ("position", self.paie_agent.id, 30, 40),
+        ]))
+
+
+class AsyncViewsTests(TestCase):
+
+    def test_async_routes_returns_new_patterns(self):
+        router = DefaultRouter()
+        router.register('structures', StructureViewSet, basename='structure')
+        patterns = router.urls
+        callbacks = [pattern.callback for pattern in patterns]
+        wrapped = async_routes(patterns, {'structure-tree'})
+        self.assertEqual([pattern.callback for pattern in patterns], callbacks)
+        for pattern, original in zip(wrapped, patterns):
+            self.assertEqual(pattern.name, original.name)
+            self.assertEqual(asyncio.iscoroutinefunction(pattern.callback), pattern.name == 'structure-tree')
+
+    def test_measure_queries_counts_the_async_pool(self):
+        with measure_queries() as metrics:
+            run_select_one()
+            async_to_sync(run_in_db_pool)(run_select_one)
+        self.assertEqual(metrics.queries, 2)
+
+
+class SerializationMetricsTests(ChartTestCase):
+
+    def test_serializers_are_timed_with_their_queries(self):
+        cases = [
+            (PositionSerializer, Position.objects.all()),
+            (generate_dynamic_serializer(Grade), Grade.objects.all()),
+            (UserSerializer, get_user_model().objects.all()),
+        ]
+        for serializer_class, queryset in cases:
+            instances = list(queryset)
+            with measure_queries() as metrics:
+                self.assertTrue(serializer_class(instances, many=True).data)
+            self.assertEqual(metrics.serialization_queries, metrics.queries, serializer_class)
+            self.assertGreater(metrics.serialization_seconds, 0, serializer_class)
+
+    def test_api_serializers_derive_from_the_measured_base(self):
+        subclasses, model_serializers = [serializers.ModelSerializer], []
+        while subclasses:
+            serializer_class = subclasses.pop()
+            subclasses.extend(serializer_class.__subclasses__())
+            if serializer_class.__module__ in ('organigramme.serializers', 'authentication.serializers'):
+                model_serializers.append(serializer_class)
+        self.assertTrue(model_serializers)
+        for serializer_class in model_serializers:
+            self.assertTrue(issubclass(serializer_class, ModelSerializer), serializer_class)
+
+class JobBackendCheckTests(TestCase):
+
+    def test_database_backend_needs_a_shared_cache(self):
+        local_cache = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        shared_cache = {'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'cache'}}
+        with self.settings(JOB_BACKEND='database', CACHES=local_cache):
+            self.assertEqual([error.id for error in check_job_backend(None)], ['organigramme.E002'])
+        with self.settings(JOB_BACKEND='database', CACHES=shared_cache):
+            self.assertEqual(check_job_backend(None), [])
+        with self.settings(JOB_BACKEND='local', CACHES=local_cache):
+            self.assertEqual(check_job_backend(None), [])
+        with self.settings(JOB_BACKEND='celery'):
+            self.assertEqual([error.id for error in check_job_backend(None)], ['organigramme.E001'])
+
+
+class LocalWorkersStartupTests(TransactionTestCase):
+    """Worker threads of the 'local' backend (the job rows are committed: the workers run in their own threads)."""
+
+    def setUp(self):
+        self.ran = threading.Event()
+        job_type('test_left_queued')(lambda job: self.ran.set())
+        self.addCleanup(JOB_TYPES.pop, 'test_left_queued')
+
+    def test_startup_runs_the_jobs_left_queued(self):
+        # Queued before the process stopped: no commit wakes the workers of the new one
+        job = Job.objects.create(kind='test_left_queued')
+        workers = LocalWorkers(1, poll_interval=60)
+        with mock.patch('organigramme.jobs._local_workers', workers), self.settings(JOB_BACKEND='local'):
+            start_local_workers()
+            self.assertTrue(self.ran.wait(5))
+            stop_local_workers(timeout=5)
+        self.assertEqual(Job.objects.get(id=job.id).status, 'succeeded')
+        self.assertEqual(workers.threads, [])
+
+    def test_database_backend_starts_no_thread(self):
+        workers = LocalWorkers(1, poll_interval=60)
+        with mock.patch('organigramme.jobs._local_workers', workers), self.settings(JOB_BACKEND='database'):
+            start_local_workers()
+        self.assertEqual(workers.threads, [])
+
+    def test_asgi_lifespan_starts_and_stops_the_workers(self):
+        from src.asgi import application
+        messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        with mock.patch('src.asgi.start_local_workers') as start, mock.patch('src.asgi.stop_local_workers') as stop:
+            async_to_sync(application)({'type': 'lifespan'}, receive, send)
+        start.assert_called_once_with()
+        stop.assert_called_once_with()
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+
+
+class OrganizePositionsTests(ChartTestCase):
+
+    def test_auto_organize_runs_as_a_job(self):
+        position_type = ContentType.objects.get_for_model(Position)
+        OrganigramEdge.objects.create(
+            structure=self.paie, source_content_type=position_type, source_object_id=self.paie_head.id,
+            target_content_type=position_type, target_object_id=self.paie_agent.id,
+        )
+        # The url is routed to AutoOrganizeDiagramView first (organigramme/urls.py)
+        request = APIRequestFactory().post(f'/api/structures/{self.paie.id}/auto-organize/')
+        force_authenticate(request, self.user)
+        response = StructureViewSet.as_view({'post': 'auto_organize'})(request, pk=self.paie.id)
+        self.assertEqual(response.status_code, 202)
+        work('test', kinds=['organize_positions'], once=True)
+        job = Job.objects.get(id=response.data['job'])
+        self.assertEqual(job.status, 'succeeded')
+        self.assertEqual({update['id'] for update in job.result['updates']}, {self.paie_head.id, self.paie_agent.id})
+        self.paie_head.refresh_from_db()
+        self.paie_agent.refresh_from_db()
+        self.assertLess(self.paie_head.position_y, self.paie_agent.position_y)
+
+        response = self.client.get(f'/api/positions/{self.paie_agent.id}/parent/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['id'], self.paie_head.id)
+        self.assertEqual(self.client.get(f'/api/positions/{self.paie_head.id}/parent/').status_code, 404)
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTests(SimpleTestCase):
+
+    def make_pool(self, **options):
+        return ConnectionPool(ping=lambda connection: not connection.closed, reset=lambda connection: True, **options)
+
+    def test_released_connections_are_reused(self):
+        pool = self.make_pool(max_size=2)
+        first = pool.acquire(FakeConnection)
+        pool.release(first)
+        self.assertIs(pool.acquire(FakeConnection), first)
+        self.assertEqual((pool.stats['opened'], pool.stats['reused']), (1, 1))
+
+    def test_a_full_pool_times_out(self):
+        pool = self.make_pool(max_size=1, timeout=0.01)
+        connection = pool.acquire(FakeConnection)
+        with self.assertRaises(PoolTimeout):
+            pool.acquire(FakeConnection)
+        pool.release(connection, reuse=False)
+        self.assertTrue(connection.closed)
+        self.assertIsNot(pool.acquire(FakeConnection), connection)
+
+    def test_unhealthy_connections_are_replaced(self):
+        pool = self.make_pool(max_size=1, health_check_idle=0)
+        connection = pool.acquire(FakeConnection)
+        pool.release(connection)
+        connection.closed = True
+        self.assertIsNot(pool.acquire(FakeConnection), connection)
+        self.assertEqual(pool.stats['unhealthy'], 1)
+
+    def test_pool_size_leaves_connections_to_the_requests(self):
+        databases = {'default': {'POOL': {'REQUEST_CONNECTIONS': 4}}}
+        with self.settings(DATABASES=databases, ASYNC_DB_WORKERS=8, JOB_BACKEND='local', JOB_LOCAL_WORKERS=2):
+            self.assertEqual(get_pool_size(databases['default']['POOL']), 14)
+            check_pool_sizes()
+        databases = {'default': {'POOL': {'MAX_SIZE': 10}}}
+        with self.settings(DATABASES=databases, ASYNC_DB_WORKERS=8, JOB_BACKEND='local', JOB_LOCAL_WORKERS=2):
+            with self.assertRaises(ImproperlyConfigured):
+                check_pool_sizes()
+        with self.settings(DATABASES=databases, ASYNC_DB_WORKERS=8, JOB_BACKEND='database'):
+            check_pool_sizes()
+
+
+def run_in_thread(function):
+    """Run `function` in a thread of its own, which releases its connections at the end like a request."""
+    result = {}
+
+    def target():
+        try:
+            result['value'] = function()
+        finally:
+            connections.close_all()
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+    return result.get('value')
+
+
+def backend_pid():
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_backend_pid()')
+        return cursor.fetchone()[0]
+
+
+@skipUnless(
+    isinstance(connection, PooledDatabaseWrapperMixin) and connection.settings_dict.get('POOL'),
+    'needs PostgreSQL with the in-process pool (SQL_POOL=process)'
+)
+class PostgresPoolTests(TestCase):
+
+    def test_threads_share_the_pool_connections(self):
+        pool = connection.get_pool()
+        pids = {run_in_thread(backend_pid) for _ in range(5)}
+        self.assertEqual(len(pids), 1)
+        self.assertGreaterEqual(pool.stats['reused'], 4)
+
+    def test_dead_connections_are_replaced(self):
+        pool = connection.get_pool()
+        pid = run_in_thread(backend_pid)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_terminate_backend(%s)', [pid])
+        health_check_idle, pool.health_check_idle = pool.health_check_idle, 0
+        try:
+            self.assertNotEqual(run_in_thread(backend_pid), pid)
+        finally:
+            pool.health_check_idle = health_check_idle
+
+    def test_a_transaction_left_open_is_rolled_back(self):
+        def leave_transaction_open():
+            connection.set_autocommit(False)
+            StructureType.objects.create(name='Temporaire')
+        run_in_thread(leave_transaction_open)
+        self.assertFalse(run_in_thread(lambda: StructureType.objects.filter(name='Temporaire').exists()))
+
+
+def session_cookie():
+    """Cookie header of a logged in superuser."""
+    user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+    client = Client()
+    client.force_login(user)
+    return f'{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}'
+
+
+def asgi_scope(path, cookie='', headers=()):
+    path, _, query = path.partition('?')
+    return {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+        'path': path, 'raw_path': path.encode(), 'query_string': query.encode(), 'root_path': '',
+        'headers': [(b'host', b'testserver'), (b'cookie', cookie.encode()), *headers],
+        'client': ('127.0.0.1', 1), 'server': ('testserver', 80),
+    }
+
+
+def asgi_get(path, cookie=''):
+    """GET `path` through the ASGI application of src/asgi.py: (status, headers, body messages)."""
+    from src.asgi import application
+    scope = asgi_scope(path, cookie)
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    async_to_sync(application)(scope, receive, send)
+    start, bodies = messages[0], messages[1:]
+    return start['status'], dict(start['headers']), bodies
+
+
+class AsgiStreamingTests(TransactionTestCase):
+    """Streamed responses read through the ASGI handler (the rows are committed: the request runs in its own thread)."""
+
+    def setUp(self):
+        self.cookie = session_cookie()
+
+    def test_csv_export_is_read_to_the_end(self):
+        Grade.objects.bulk_create([Grade(name=f'G{index:03}', category='Cadre') for index in range(300)])
+        with mock.patch('src.export.EXPORT_CHUNK_SIZE', 50):
+            status_code, headers, bodies = asgi_get('/api/grades/export/?file_format=csv', self.cookie)
+        self.assertEqual(status_code, 200)
+        self.assertEqual(headers[b'Content-Type'], b'text/csv')
+        self.assertEqual(bodies[-1], {'type': 'http.response.body'})
+        lines = b''.join(body.get('body', b'') for body in bodies).decode('utf-8-sig').splitlines()
+        self.assertEqual(lines[0], 'Grade,Catégorie,Description')
+        self.assertEqual(len(lines), 301)
+        self.assertEqual(lines[-1], 'G299,Cadre,')
+
+
+def feed_events(messages):
+    """(id, event) of the Server-Sent Events sent in `messages`."""
+    body = b''.join(message.get('body', b'') for message in messages[1:]).decode('utf-8')
+    events = []
+    for block in body.split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.splitlines() if ': ' in line and not line.startswith(':'))
+        if 'data' in fields:
+            events.append((int(fields['id']), json.loads(fields['data'])))
+    return events
+
+
+class DiagramFeedTests(TransactionTestCase):
+    """The feed read through src/asgi.py while the test writes in its own thread."""
+
+    def setUp(self):
+        # The content types are created again after each flush
+        clear_node_registry()
+        self.cookie = session_cookie()
+        self.dg = Structure.objects.create(name='DG', is_main=True)
+        self.drh = Structure.objects.create(name='DRH', parent=self.dg)
+
+    def follow(self, main_structure_id, query='', headers=(), cookie=None, during=None, expected_events=0):
+        """
+        Open the feed, run the coroutine function `during` once subscribed,
+        wait for `expected_events` events then disconnect. Returns the ASGI
+        messages sent.
+        """
+        from src.asgi import application
+        path = f'/api/diagram-feed/{main_structure_id}/?{query}'
+        scope = asgi_scope(path, self.cookie if cookie is None else cookie, headers)
+
+        async def run():
+            disconnected = asyncio.Event()
+            messages = []
+
+            async def receive():
+                await disconnected.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                messages.append(message)
+
+            async def wait_for(condition):
+                for _ in range(1000):
+                    if condition():
+                        return
+                    await asyncio.sleep(0.01)
+                self.fail('Timed out waiting for the feed')
+
+            feed_task = asyncio.ensure_future(application(scope, receive, send))
+            # The stream starts after the subscription, errors end the response
+            await wait_for(lambda: feed_task.done() or len(messages) >= 2)
+            if during is not None:
+                await during()
+            await wait_for(lambda: feed_task.done() or len(feed_events(messages)) >= expected_events)
+            disconnected.set()
+            await asyncio.wait_for(feed_task, 10)
+            return messages
+
+        return async_to_sync(run)()
+
+    def last_event_id(self, main_structure_id):
+        broker.publish({main_structure_id}, {"op": "refresh"})
+        return broker.history_since(main_structure_id, 0)[-1][0]
+
+    def test_requires_a_session_and_an_existing_structure(self):
+        messages = self.follow(self.dg.id, cookie='')
+        self.assertEqual(messages[0]['status'], 401)
+        self.assertEqual(json.loads(messages[1]['body']), {"error": "Not authenticated"})
+        self.assertEqual(self.follow(self.drh.id + 1000)[0]['status'], 404)
+        self.assertFalse(broker.has_subscribers())
+
+    def test_committed_writes_are_streamed(self):
+        def write():
+            DiagramPosition.objects.create(content_object=self.drh, main_structure=self.dg, position_x=10, position_y=20)
+            self.drh.name = 'Ressources humaines'
+            self.drh.save()
+
+        messages = self.follow(self.dg.id, during=sync_to_async(write), expected_events=2)
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertEqual(dict(messages[0]['headers'])[b'content-type'], b'text/event-stream')
+        self.assertEqual(messages[1]['body'], b'retry: 3000\n\n')
+        events = feed_events(messages)
+        self.assertEqual([event for _, event in events], [
+            {"op": "node_moved", "kind": "structure", "id": self.drh.id, "x": 10, "y": 20},
+            {"op": "node_updated", "kind": "structure", "id": self.drh.id, "data": {
+                "name": 'Ressources humaines', "parent_id": self.dg.id, "is_main": False, "type_id": None,
+                "manager_id": None,
+            }},
+        ])
+        self.assertLess(events[0][0], events[1][0])
+        # Unsubscribed on disconnect
+        self.assertNotIn(self.dg.id, broker.subscribed_diagrams())
+
+    def test_reconnection_replays_the_missed_events(self):
+        last_event_id = self.last_event_id(self.dg.id)
+        broker.publish({self.dg.id}, {"op": "edge_deleted", "id": 1})
+        broker.publish({self.dg.id}, {"op": "edge_deleted", "id": 2})
+        for headers, query in (([(b'last-event-id', str(last_event_id).encode())], ''), ((), f'last_event_id={last_event_id}')):
+            messages = self.follow(self.dg.id, query=query, headers=headers, expected_events=2)
+            self.assertEqual([event for _, event in feed_events(messages)], [
+                {"op": "edge_deleted", "id": 1}, {"op": "edge_deleted", "id": 2},
+            ])
+
+    def test_reconnection_after_the_history_is_dropped_is_sent_a_refresh(self):
+        last_event_id = self.last_event_id(self.dg.id)
+        # The event following the last one received is dropped
+        for index in range(feed.FEED_HISTORY_SIZE + 1):
+            broker.publish({self.dg.id}, {"op": "edge_deleted", "id": index})
+        messages = self.follow(self.dg.id, headers=[(b'last-event-id', str(last_event_id).encode())], expected_events=1)
+        self.assertEqual(feed_events(messages), [(last_event_id, {"op": "refresh"})])
+
+    def test_events_published_during_the_replay_are_sent_once(self):
+        last_event_id = self.last_event_id(self.dg.id)
+        history_since = broker.history_since
+
+        def publish_meanwhile(*args):
+            # Published after the subscription: in the history and in the queue
+            broker.publish({self.dg.id}, {"op": "edge_deleted", "id": 1})
+            return history_since(*args)
+
+        with mock.patch.object(broker, 'history_since', side_effect=publish_meanwhile):
+            messages = self.follow(
+                self.dg.id, headers=[(b'last-event-id', str(last_event_id).encode())], expected_events=1,
+                during=lambda: asyncio.sleep(0.1),
+            )
+        self.assertEqual([event for _, event in feed_events(messages)], [{"op": "edge_deleted", "id": 1}])
+
+
+class ExportTests(ChartTestCase):
+
+    def test_compile_columns(self):
+        headers, lookups = compile_columns(Position, [
+            {"header": "Poste", "schema": ["title"]}, {"header": "Catégorie", "schema": ["grade", "category"]},
+            'structure__parent__name',
+        ])
+        self.assertEqual(headers, ['Poste', 'Catégorie', 'structure__parent__name'])
+        self.assertEqual(lookups, ['title', 'grade__category', 'structure__parent__name'])
+        for column in ('missing', 'tasks__description', 'title__name', {"header": "Vide", "schema": []}):
+            with self.assertRaises(ExportError):
+                compile_columns(Position, [column])
+        with self.assertRaises(ExportError):
+            compile_columns(Position, [])
+
+    def test_csv_rows(self):
+        queryset = Position.objects.filter(structure=self.paie).order_by('title')
+        with mock.patch.object(QuerySet, 'iterator', autospec=True, side_effect=QuerySet.iterator) as iterator:
+            content = ''.join(stream_csv(queryset, *compile_columns(Position, ['title', 'structure__name', 'grade__name', 'abbreviation'])))
+        iterator.assert_called_once_with(mock.ANY, chunk_size=EXPORT_CHUNK_SIZE)
+        self.assertTrue(content.startswith('\ufeff'))
+        self.assertEqual(content[1:].splitlines(), [
+            'title,structure__name,grade__name,abbreviation',
+            'Agent paie,Paie,B,',
+            'Chef paie,Paie,A,',
+        ])
+
+    def test_xlsx_rows(self):
+        queryset = Position.objects.filter(structure=self.paie).order_by('title')
+        with mock.patch.object(QuerySet, 'iterator', autospec=True, side_effect=QuerySet.iterator) as iterator:
+            content = b''.join(stream_xlsx(queryset, ['Poste', 'Effectif'], ['title', 'quantity'], title='Paie'))
+        iterator.assert_called_once_with(mock.ANY, chunk_size=EXPORT_CHUNK_SIZE)
+        sheet = load_workbook(io.BytesIO(content))['Paie']
+        self.assertEqual(
+            [[cell.value for cell in row] for row in sheet.rows],
+            [['Poste', 'Effectif'], ['Agent paie', 3], ['Chef paie', 1]]
+        )
+
+    def test_export_endpoint_applies_the_list_filters(self):
+        response = self.client.get('/api/positions/export/', {'file_format': 'csv', 'search': 'paie', 'ordering': 'title'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="postes.csv"')
+        lines = b''.join(response.streaming_content).decode('utf-8-sig').splitlines()
+        self.assertEqual(lines[0], 'Poste,Abréviation,Structure,Grade,Catégorie,Effectif,Formation,Expérience')
+        self.assertEqual([line.split(',')[0] for line in lines[1:]], ['Agent paie', 'Chef paie'])
+
+        response = self.client.get('/api/positions/export/', {'file_format': 'csv', 'columns': 'title,grade__name', 'search': 'Directeur'})
+        self.assertEqual(b''.join(response.streaming_content).decode('utf-8-sig').splitlines(), ['title,grade__name', 'Directeur,A'])
+        self.assertEqual(self.client.get('/api/positions/export/', {'file_format': 'pdf'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/positions/export/', {'columns': 'tasks__description'}).status_code, 400)
+
+
+class BenchmarkSuiteTests(ChartTestCase):
+
+    def test_generated_chart_has_the_requested_shape(self):
+        main = generate_chart(120, seed=3)
+        structure_ids = get_subtree_structure_ids(main.id)
+        positions = Position.objects.filter(structure_id__in=structure_ids)
+        self.assertEqual(positions.count(), 120)
+        self.assertEqual(find_chart(120), main)
+
+        # Every unit has its manager, linked to its staff and to the managers of its units
+        managers = dict(Structure.objects.filter(id__in=structure_ids).values_list('id', 'manager_id'))
+        self.assertNotIn(None, managers.values())
+        self.assertEqual(OrganigramEdge.objects.filter(structure_id__in=structure_ids).count(), 119)
+        self.assertEqual(Task.objects.filter(position__in=positions).count(), 240)
+        self.assertEqual(
+            DiagramPosition.objects.filter(main_structure=main).count(), len(structure_ids) + 120
+        )
+        total = StructureHeadcount.objects.filter(structure=main).aggregate(Sum('headcount'))['headcount__sum']
+        self.assertEqual(total, positions.aggregate(Sum('quantity'))['quantity__sum'])
+
+        # Same seed, same chart
+        titles = sorted(positions.values_list('title', 'quantity'))
+        delete_chart(main)
+        self.assertIsNone(find_chart(120))
+        self.assertFalse(Position.objects.filter(structure_id__in=structure_ids).exists())
+        self.assertEqual(Position.objects.count(), 5)
+        main = generate_chart(120, seed=3)
+        self.assertEqual(
+            sorted(Position.objects.filter(structure__in=get_subtree_structure_ids(main.id)).values_list('title', 'quantity')),
+            titles
+        )
+
+    def run_benchmarks(self, directory, *args, **options):
+        stdout = io.StringIO()
+        call_command(
+            'benchmark_api', *args, sizes='60', iterations=2, only='positions.list,graphql.structureList',
+            output=f'{directory}/results.json', stdout=stdout, stderr=io.StringIO(), **options
+        )
+        with open(f'{directory}/results.json') as file:
+            return json.load(file), stdout.getvalue()
+
+    def test_benchmarks_report_timings_and_queries(self):
+        with tempfile.TemporaryDirectory() as directory:
+            report, _ = self.run_benchmarks(directory, '--keep')
+            chart, = report['charts']
+            self.assertEqual((chart['positions'], chart['reused'], report['iterations']), (60, False, 2))
+            self.assertEqual(set(chart['benchmarks']), {'positions.list', 'graphql.structureList'})
+            for result in chart['benchmarks'].values():
+                self.assertEqual(result['status'], 200)
+                self.assertGreater(result['queries'], 0)
+                self.assertLessEqual(result['ms']['min'], result['ms']['p50'])
+                self.assertLessEqual(result['ms']['p50'], result['ms']['max'])
+
+            # The kept chart is reused, and deleted at the end of this run
+            main = find_chart(60)
+            os.rename(f'{directory}/results.json', f'{directory}/previous.json')
+            report, output = self.run_benchmarks(directory, compare=f'{directory}/previous.json')
+            self.assertTrue(report['charts'][0]['reused'])
+            self.assertIsNone(find_chart(60))
+            self.assertFalse(Structure.objects.filter(id=main.id).exists())
+            self.assertIn('positions.list', output.split('Compared with')[1])
+
+    def test_failing_paths_are_reported(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch('organigramme.views.PositionViewSet.list', side_effect=ValueError('boom')):
+                report, _ = self.run_benchmarks(directory)
+        self.assertEqual(report['charts'][0]['benchmarks']['positions.list'], {'error': 'ValueError: boom'})
+        self.assertEqual(report['charts'][0]['benchmarks']['graphql.structureList']['status'], 200)
+
+    def test_options_are_checked(self):
+        with self.assertRaisesMessage(CommandError, 'Unknown benchmarks: nope'):
+            call_command('benchmark_api', only='nope', stderr=io.StringIO())
+        with self.assertRaises(CommandError):
+            call_command('benchmark_api', sizes='a,b', stderr=io.StringIO())
+
+
+def wait_in_pool():
+    time.sleep(0.05)
+    return 'done'
+
+
+class RequestProfilingTests(ChartTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.settings_override = self.settings(
+            PROFILING_ENABLED=True, PROFILING_DIR=directory.name, PROFILING_SAMPLE_INTERVAL=0.001
+        )
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        # The sampler keeps the interval it was created with
+        sampler = mock.patch('src.profiling._sampler', None)
+        sampler.start()
+        self.addCleanup(sampler.stop)
+        self.staff = Client()
+        self.staff.force_login(self.user)
+
+    def profiled_request(self, **settings_overrides):
+        """A request served by the middleware, its view waiting on the async pool."""
+        def view(request):
+            return HttpResponse(async_to_sync(run_in_db_pool)(wait_in_pool))
+
+        request = APIRequestFactory().get('/api/positions/', HTTP_X_PROFILE='1')
+        request.user = self.user
+        with self.settings(**settings_overrides):
+            return RequestProfilingMiddleware(view)(request)
+
+    def test_profiling_is_opt_in(self):
+        with self.settings(PROFILING_ENABLED=False, PROFILING_THRESHOLD_SECONDS=0):
+            response = self.staff.get('/api/positions/', HTTP_X_PROFILE='1')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-Profile-Id', response)
+        self.assertEqual(list_profiles(), [])
+
+        # The header is only honored for staff users
+        self.user.is_staff = False
+        self.user.save()
+        self.assertNotIn('X-Profile-Id', self.staff.get('/api/positions/', HTTP_X_PROFILE='1'))
+        self.assertEqual(list_profiles(), [])
+
+    def test_header_runs_the_request_under_cprofile(self):
+        response = self.staff.get('/api/positions/', HTTP_X_PROFILE='1')
+        self.assertEqual(response.status_code, 200)
+        profile, = list_profiles()
+        self.assertEqual(response['X-Profile-Id'], profile['id'])
+        self.assertEqual(
+            {key: profile[key] for key in ('kind', 'method', 'path', 'status', 'trigger', 'user')},
+            {'kind': 'cprofile', 'method': 'GET', 'path': '/api/positions/', 'status': 200, 'trigger': 'header',
+             'user': 'admin'}
+        )
+        self.assertIn('list', summarize_profile(*get_profile(profile['id'])))
+
+        # The work handed to the async pool is profiled with the request
+        response = self.profiled_request()
+        self.assertIn('wait_in_pool', summarize_profile(*get_profile(response['X-Profile-Id'])))
+
+    def test_slow_requests_keep_their_samples(self):
+        self.assertNotIn('X-Profile-Id', self.profiled_request(PROFILING_HEADER='X-Other', PROFILING_THRESHOLD_SECONDS=10))
+        self.assertEqual(list_profiles(), [])
+
+        response = self.profiled_request(PROFILING_HEADER='X-Other', PROFILING_THRESHOLD_SECONDS=0.01)
+        profile, path = get_profile(response['X-Profile-Id'])
+        self.assertEqual((profile['kind'], profile['trigger']), ('sampling', 'threshold'))
+        self.assertGreaterEqual(profile['duration_ms'], 50)
+        with gzip.open(path, 'rt') as file:
+            stacks = [line.rpartition(' ') for line in file.read().splitlines()]
+        self.assertTrue(all(count.isdigit() for _, _, count in stacks))
+        self.assertIn('wait_in_pool (organigramme/tests.py:', ' '.join(stack.rsplit(';', 1)[-1] for stack, _, _ in stacks))
+        summary = summarize_profile(profile, path)
+        self.assertIn('Inclusive time per function:', summary)
+        self.assertIn('wait_in_pool', summary.split('Innermost frames:')[1])
+
+    def test_only_the_last_profiles_are_kept(self):
+        with self.settings(PROFILING_MAX_PROFILES=2):
+            ids = [self.staff.get('/api/grades/', HTTP_X_PROFILE='1')['X-Profile-Id'] for _ in range(3)]
+        self.assertEqual([profile['id'] for profile in list_profiles()], ids[:0:-1])
+        self.assertIsNone(get_profile(ids[0]))
+
+    def test_admin_lists_and_serves_the_profiles(self):
+        profile_id = self.staff.get('/api/positions/', HTTP_X_PROFILE='1')['X-Profile-Id']
+        response = self.staff.get('/admin/profiles/')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, profile_id)
+
+        response = self.staff.get(f'/admin/profiles/{profile_id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'cumulative')
+        response = self.staff.get(f'/admin/profiles/{profile_id}/', {'download': 1})
+        self.assertIsInstance(marshal.loads(gzip.decompress(b''.join(response.streaming_content))), dict)
+        self.assertEqual(self.staff.get('/admin/profiles/unknown/').status_code, 404)
+
+        # Admin pages: the anonymous users are sent to the login page
+        self.assertEqual(Client().get('/admin/profiles/').status_code, 302)
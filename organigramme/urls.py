@@ -2,6 +2,8 @@ from django.urls import path
 from rest_framework.routers import DefaultRouter
 from rest_framework import routers
 
+from src.async_views import async_routes
+
 from .views import (
     GradeViewSet,
     StructureViewSet,
@@ -12,6 +14,9 @@ from .views import (
     TaskViewSet,
     CompetenceViewSet,
     DiagramPositionViewSet,
+    StructureHeadcountViewSet,
+    ChartSnapshotViewSet,
+    JobViewSet,
     AutoOrganizeDiagramView,
     StructureTypeViewSet
 )
@@ -27,8 +32,16 @@ router.register(r"missions", MissionViewSet, basename="mission")
 router.register(r"tasks", TaskViewSet, basename="task")
 router.register(r"competences", CompetenceViewSet, basename="competence")
 router.register(r"diagram-positions", DiagramPositionViewSet, basename="diagram-position")
+router.register(r"structure-headcounts", StructureHeadcountViewSet, basename="structure-headcount")
+router.register(r"chart-snapshots", ChartSnapshotViewSet, basename="chart-snapshot")
+router.register(r"jobs", JobViewSet, basename="job")
+
+# Heavy reads served asynchronously under ASGI (see src/async_views.py)
+ASYNC_ROUTES = {
+    "structure-tree", "structure-diagram-summary", "structure-changes", "diagram-position-viewport",
+}
 
 urlpatterns = [
     path("structures/<int:structure_id>/auto-organize/", AutoOrganizeDiagramView.as_view(), name="auto-organize"),
-    *router.urls
+    *async_routes(router.urls, ASYNC_ROUTES)
 ]
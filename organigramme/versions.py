@@ -0,0 +1,65 @@
+"""
+Version counters for cached snapshots.
+
+Derived data (dashboard statistics, diagram extents) is cached under keys
+that include a version. Writes bump the version instead of deleting keys,
+so the next read computes a fresh snapshot and stale ones simply expire.
+
+- the "chart" version changes with any structure, position or grade write
+  (signals.py, and the bulk code paths that send no signal);
+- each diagram has its own version for coordinate-only writes.
+
+The counters live in the cache: with several processes, the cache backend
+must be shared (Redis, Memcached, database) for the invalidation to reach
+every process.
+"""
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+CHART_SCOPE = 'chart'
+
+
+def diagram_scope(main_structure_id):
+    return f'diagram:{main_structure_id}'
+
+
+def _version_key(scope):
+    return f'organigramme:version:{scope}'
+
+
+def get_cache_version(scope):
+    key = _version_key(scope)
+    version = cache.get(key)
+    if version is None:
+        # The version must outlive the snapshots it points to
+        cache.add(key, 1, None)
+        version = cache.get(key, 1)
+    return version
+
+
+def _bump(scope):
+    key = _version_key(scope)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Evicted or never set: any new value invalidates the old snapshots
+        cache.set(key, int(timezone.now().timestamp() * 1000), None)
+
+
+def bump_cache_version(scope):
+    """
+    Bump `scope` once the current transaction commits, so a concurrent
+    request cannot cache the data from before the write under the new
+    version.
+    """
+    transaction.on_commit(lambda: _bump(scope))
+
+
+def bump_chart_version():
+    bump_cache_version(CHART_SCOPE)
+
+
+def bump_diagram_version(*main_structure_ids):
+    for main_structure_id in set(main_structure_ids):
+        bump_cache_version(diagram_scope(main_structure_id))
@@ -0,0 +1,148 @@
+"""
+Viewport queries on a diagram.
+
+A diagram can hold thousands of nodes while only a window of it is visible.
+`query_viewport` returns the nodes of a main structure's diagram whose box
+intersects a bounding box, and the edges attached to them, so the frontend
+can load a chart incrementally while panning and zooming.
+
+Coordinates are the top-left corner of a node (see layout.py for the node
+sizes). The range filter runs on the (main_structure, position_x,
+position_y) index, widened by the largest node size so that nodes starting
+just before the box are found; the exact intersection is then checked in
+Python on the few extra rows.
+"""
+from django.db.models import Q
+
+from .layout import NODE_WIDTH, NODE_HEIGHT, POSITION_WIDTH, POSITION_HEIGHT
+from .models import Structure, Position, DiagramPosition, OrganigramEdge
+from .nodes import get_node_content_type_ids
+
+NODE_SIZES = {
+    'structure': (NODE_WIDTH, NODE_HEIGHT),
+    'position': (POSITION_WIDTH, POSITION_HEIGHT),
+}
+MAX_NODE_WIDTH = max(width for width, _ in NODE_SIZES.values())
+MAX_NODE_HEIGHT = max(height for _, height in NODE_SIZES.values())
+
+MAX_VIEWPORT_NODES = 5000
+
+
+def _intersects(kind, x, y, min_x, max_x, min_y, max_y):
+    width, height = NODE_SIZES[kind]
+    return x <= max_x and x + width >= min_x and y <= max_y and y + height >= min_y
+
+
+def load_node_data(structure_ids, position_ids):
+    """Display data of the visible nodes, one query per node kind."""
+    structures = {
+        row['id']: row
+        for row in Structure.objects.filter(id__in=structure_ids).values(
+            'id', 'name', 'parent_id', 'is_main', 'type_id', 'type__name', 'type__color', 'manager_id'
+        )
+    }
+    positions = {
+        row['id']: row
+        for row in Position.objects.filter(id__in=position_ids).values(
+            'id', 'title', 'abbreviation', 'structure_id', 'is_manager', 'quantity',
+            'grade_id', 'grade__name', 'grade__color', 'grade__category'
+        )
+    }
+    return {'structure': structures, 'position': positions}
+
+
+def query_viewport(main_structure_id, min_x, max_x, min_y, max_y, limit=MAX_VIEWPORT_NODES):
+    """
+    Nodes and edges of the diagram of `main_structure_id` intersecting the
+    box. Returns {"nodes", "edges", "truncated"}: at most `limit` nodes are
+    returned, `truncated` tells that the box holds more (zoom in).
+
+    Each edge has at least one end in the box; the coordinates of both ends
+    are included so that it can be drawn up to a node that is not loaded.
+    """
+    content_type_ids = get_node_content_type_ids()
+    kinds = {content_type_id: kind for kind, content_type_id in content_type_ids.items()}
+
+    rows = DiagramPosition.objects.filter(
+        main_structure_id=main_structure_id,
+        position_x__gte=min_x - MAX_NODE_WIDTH, position_x__lte=max_x,
+        position_y__gte=min_y - MAX_NODE_HEIGHT, position_y__lte=max_y,
+        content_type_id__in=list(kinds),
+    ).order_by('position_y', 'position_x').values_list('content_type_id', 'object_id', 'position_x', 'position_y')
+
+    visible = []
+    truncated = False
+    for content_type_id, object_id, x, y in rows.iterator():
+        kind = kinds[content_type_id]
+        if not _intersects(kind, x, y, min_x, max_x, min_y, max_y):
+            continue
+        if len(visible) >= limit:
+            truncated = True
+            break
+        visible.append((kind, object_id, x, y))
+
+    ids = {'structure': set(), 'position': set()}
+    coordinates = {}
+    for kind, object_id, x, y in visible:
+        ids[kind].add(object_id)
+        coordinates[(kind, object_id)] = (x, y)
+    data = load_node_data(ids['structure'], ids['position'])
+
+    nodes = [
+        {
+            "type": kind,
+            "id": object_id,
+            "position_x": x,
+            "position_y": y,
+            "data": data[kind][object_id],
+        }
+        # Diagram positions of deleted nodes are skipped
+        for kind, object_id, x, y in visible if object_id in data[kind]
+    ]
+
+    edges = []
+    if visible:
+        touching = Q()
+        for kind, object_ids in ids.items():
+            if object_ids:
+                touching |= Q(source_content_type_id=content_type_ids[kind], source_object_id__in=object_ids)
+                touching |= Q(target_content_type_id=content_type_ids[kind], target_object_id__in=object_ids)
+        edge_rows = list(
+            OrganigramEdge.objects.filter(touching).values_list(
+                'id', 'structure_id', 'edge_type',
+                'source_content_type_id', 'source_object_id', 'target_content_type_id', 'target_object_id'
+            )
+        )
+
+        # Coordinates of the ends outside of the box, in one query
+        outside = {}
+        for _, _, _, source_ct, source_id, target_ct, target_id in edge_rows:
+            for content_type_id, object_id in ((source_ct, source_id), (target_ct, target_id)):
+                kind = kinds.get(content_type_id)
+                if kind and (kind, object_id) not in coordinates:
+                    outside.setdefault(content_type_id, set()).add(object_id)
+        if outside:
+            condition = Q()
+            for content_type_id, object_ids in outside.items():
+                condition |= Q(content_type_id=content_type_id, object_id__in=object_ids)
+            far_rows = DiagramPosition.objects.filter(condition, main_structure_id=main_structure_id).values_list(
+                'content_type_id', 'object_id', 'position_x', 'position_y'
+            )
+            for content_type_id, object_id, x, y in far_rows:
+                coordinates[(kinds[content_type_id], object_id)] = (x, y)
+
+        for edge_id, structure_id, edge_type, source_ct, source_id, target_ct, target_id in edge_rows:
+            source = (kinds.get(source_ct), source_id)
+            target = (kinds.get(target_ct), target_id)
+            # Edges to nodes drawn in another diagram are not part of this one
+            if source not in coordinates or target not in coordinates:
+                continue
+            edges.append({
+                "id": edge_id,
+                "structure": structure_id,
+                "edge_type": edge_type,
+                "source": {"type": source[0], "id": source_id, "position": coordinates[source]},
+                "target": {"type": target[0], "id": target_id, "position": coordinates[target]},
+            })
+
+    return {"nodes": nodes, "edges": edges, "truncated": truncated}
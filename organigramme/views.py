@@ -1,5 +1,7 @@
-from django.db import transaction
-from django.db.models import Q
+import uuid
+
+from django.db import IntegrityError, transaction
+from django.db.models import Q, Exists
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
@@ -12,9 +14,44 @@ from .models import *
 from .serializers import *
 from django.contrib.contenttypes.models import ContentType
 from django.db import transaction
+from django.utils import timezone
+
+from .hierarchy import get_subtree_structure_ids
+from .cloning import clone_position, clone_structure_subtree
+from .moves import move_structure, move_position
+from .importer import import_chart, ChartImportError
+from .rollups import get_structure_headcount
+from .dashboard import get_dashboard
+from .viewport import query_viewport, MAX_VIEWPORT_NODES
+from .lod import collapse_diagram, MAX_SUMMARY_DEPTH
+from .versions import bump_chart_version, bump_diagram_version
+from .feed import broker, publish_change, diagrams_of_structure
+from .history import load_snapshot_chart, load_live_chart, delete_snapshot
+from .diff import diff_charts
+from .jobs import enqueue, cancel_job, RUNNING, SUCCEEDED, QUEUED
+from .changelog import change, get_changes, get_current_token, diagram_changes, log_changes, MAX_CHANGES
+from .nodes import get_node_model, get_node_content_type, get_node_content_type_id, get_node_content_type_ids
+from .pdf import (
+    get_fiche_de_poste_signatures, get_cached_fiche_de_poste, submit_fiche_de_poste,
+    get_fiche_de_poste_status, fiche_de_poste_filename, load_structure_fiches_de_poste,
+    stream_fiche_de_poste_zip, stream_fiche_de_poste_merged, get_export_progress
+)
+from src.renderers import columnar_renderer_classes
+from .renderers import diagram_renderer_classes, tree_renderer_classes
+from src.mixins import BulkCreateModelMixin, BulkUpdateModelMixin, BulkDeleteModelMixin, ExportModelMixin, get_missing_ids
+from django.http import FileResponse, StreamingHttpResponse
+from django.core.files.storage import default_storage
+from django.urls import reverse
+
+
+def job_accepted(request, job):
+    """202 answer of an enqueued job (see organigramme.jobs), pointing to its status."""
+    url = request.build_absolute_uri(reverse('job-detail', args=[job.id]))
+    return Response(
+        {"job": str(job.id), "kind": job.kind, "status": job.status, "status_url": url},
+        status=status.HTTP_202_ACCEPTED, headers={"Location": url}
+    )
 
-from src.utils import render_to_pdf_rest
-from django.http import HttpResponse
 
 class StructureTypeViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
     """CRUD for Grade model."""
@@ -27,7 +64,7 @@ class StructureTypeViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
     search_fields = ['name']
 
 
-class GradeViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
+class GradeViewSet(ExportModelMixin, FlexFieldsMixin, viewsets.ModelViewSet):
     """CRUD for Grade model."""
 
     queryset = Grade.objects.all().order_by("id")
@@ -36,6 +73,12 @@ class GradeViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
     filterset_class = GradeFilter
     filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
     search_fields = ['name']
+    export_columns = [
+        {"header": "Grade", "schema": ["name"]},
+        {"header": "Catégorie", "schema": ["category"]},
+        {"header": "Description", "schema": ["description"]},
+    ]
+    export_filename = "grades"
 
     @action(detail=False, methods=['post'])
     def bulk_create(self, request):
@@ -97,142 +140,265 @@ class GradeViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
             
         return Response(response_data, status=status.HTTP_201_CREATED)
 
-class StructureViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
+class StructureViewSet(ExportModelMixin, FlexFieldsMixin, viewsets.ModelViewSet):
     """CRUD for Structure model + tree auto‑organize."""
 
     queryset = Structure.objects.all()
     serializer_class = StructureSerializer
     permit_list_expands = ['manager', 'manager.grade', 'positions', 'edges', 'children', 'parent','type']
     permission_classes = [IsAuthenticated]
+    # SQL queries per request, logged when exceeded (see src/instrumentation.py)
+    query_budgets = {
+        'list': 10, 'retrieve': 8, 'tree': 10, 'diagram_summary': 12, 'changes': 12, 'headcount': 5,
+    }
     filterset_class = StructureFilter
     filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
     search_fields = ['name']
-
-    @action(detail=True, methods=['get'])
+    export_columns = [
+        {"header": "Structure", "schema": ["name"]},
+        {"header": "Type", "schema": ["type", "name"]},
+        {"header": "Structure parente", "schema": ["parent", "name"]},
+        {"header": "Responsable", "schema": ["manager", "title"]},
+        {"header": "Principale", "schema": ["is_main"]},
+    ]
+    export_filename = "structures"
+
+    @action(detail=True, methods=['get'], renderer_classes=tree_renderer_classes())
     def tree(self, request, pk=None):
         """Retrieve the structure as a tree."""
         instance = self.get_object()
         serializer = self.get_serializer(instance, expand=['children.positions.grade', 'children.manager', 'positions.grade', 'manager'])
         return Response(serializer.data)
 
-    @action(detail=True, methods=["post"], url_path="auto-organize")
-    def auto_organize(self, request, pk=None):
-        """Auto‑organize positions into a tree layout with children under parents."""
+    @action(detail=True, methods=['post'], url_path='clone')
+    def clone_structure(self, request, pk=None):
+        """
+        Clone the structure with its whole subtree: child structures,
+        positions (with missions, competences and tasks), edges and diagram positions.
+        Optional payload: {"parent": <structure id or null>, "offset_x": 0, "offset_y": 0}
+        """
         structure = self.get_object()
-        positions = Position.objects.filter(structure=structure)
-        edges = OrganigramEdge.objects.filter(structure=structure).select_related('source', 'target')
+        parent_id = request.data.get('parent', structure.parent_id)
 
-        if not positions.exists():
+        if parent_id is not None:
+            if not Structure.objects.filter(id=parent_id).exists():
+                return Response(
+                    {"error": f"Structure with id {parent_id} not found"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            if int(parent_id) in get_subtree_structure_ids(structure.id):
+                return Response(
+                    {"error": "A structure cannot be cloned under its own subtree"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            parent_id = int(parent_id)
+
+        try:
+            offset_x = float(request.data.get('offset_x', 0))
+            offset_y = float(request.data.get('offset_y', 0))
+        except (TypeError, ValueError):
             return Response(
-                {"message": "No positions to organize"}, status=status.HTTP_200_OK
+                {"error": "offset_x and offset_y must be numbers"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        structure_copy, id_maps = clone_structure_subtree(
+            structure, parent_id=parent_id, offset_x=offset_x, offset_y=offset_y
+        )
+        return Response(
+            {
+                "message": f"Cloned {len(id_maps['structures'])} structures and {len(id_maps['positions'])} positions",
+                "data": self.get_serializer(structure_copy).data,
+                "structures": id_maps['structures'],
+                "positions": id_maps['positions']
+            },
+            status=status.HTTP_201_CREATED
+        )
+
+    @action(detail=True, methods=['post'], url_path='move')
+    def move(self, request, pk=None):
+        """
+        Move the structure and its subtree under a new parent structure.
+        Expected payload: {"parent": <structure id or null>}
+        Returns only the diagram coordinates that changed.
+        """
+        structure = self.get_object()
+        if 'parent' not in request.data:
+            return Response(
+                {"error": "parent is required in the request payload"},
+                status=status.HTTP_400_BAD_REQUEST
             )
         
-        # Build parent-child mappings
-        children_map = {}
-        parent_map = {}
-        position_map = {p.id: p for p in positions}
+        try:
+            parent_id = request.data['parent']
+            diagrams = move_structure(structure, int(parent_id) if parent_id is not None else None)
+        except (TypeError, ValueError) as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
-        for edge in edges:
-            if edge.source_id in position_map and edge.target_id in position_map:
-                children_map.setdefault(edge.source_id, []).append(edge.target_id)
-                parent_map[edge.target_id] = edge.source_id
+        return Response({
+            "message": "Structure moved successfully",
+            "data": self.get_serializer(structure).data,
+            "diagrams": diagrams
+        })
+
+    @action(detail=True, methods=['get', 'post'], url_path='export-fiches')
+    def export_fiches(self, request, pk=None):
+        """
+        Export the fiche de poste of every position of the structure subtree.
+        Query params: output=zip (default) or pdf (one merged document).
+        POST queues a background job and answers 202: the file is downloaded
+        from /api/jobs/<id>/result/ once done. GET streams it in the request,
+        job=<id> choosing the progress job id (sent back in X-Export-Job).
+        """
+        structure = self.get_object()
+        output = request.query_params.get('output', 'zip')
+        if output not in ('zip', 'pdf'):
+            return Response(
+                {"error": "output must be 'zip' or 'pdf'"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if request.method == 'POST':
+            job = enqueue('export_fiches', {"structure": structure.id, "output": output}, user=request.user)
+            return job_accepted(request, job)
 
-        # Find root nodes (nodes without parents)
-        root_ids = [p.id for p in positions if p.id not in parent_map]
-        
-        if not root_ids:
+        documents = load_structure_fiches_de_poste(structure.id)
+        if not documents:
             return Response(
-                {"message": "No root positions found (circular references may exist)"},
+                {"error": "No position found in this structure"},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        job_id = request.query_params.get('job') or uuid.uuid4().hex
+        if output == 'zip':
+            response = StreamingHttpResponse(
+                stream_fiche_de_poste_zip(documents, job_id), content_type='application/zip'
+            )
+        else:
+            response = StreamingHttpResponse(
+                stream_fiche_de_poste_merged(documents, job_id), content_type='application/pdf'
+            )
+        filename = f"FICHES_DE_POSTE_{structure.name}.{output}"
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        response['X-Export-Job'] = job_id
+        return response
+
+    @action(detail=False, methods=['get'], url_path='export-fiches-status')
+    def export_fiches_status(self, request):
+        """Progress of an export-fiches job: ?job=<id>."""
+        progress = get_export_progress(request.query_params.get('job', ''))
+        if progress is None:
+            return Response({"error": "Export job not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(progress)
+
+    @action(detail=True, methods=['get'], url_path='diagram-summary', renderer_classes=diagram_renderer_classes())
+    def diagram_summary(self, request, pk=None):
+        """
+        Collapsed view of this structure's diagram for low zoom levels.
+        Query params:
+          - depth: levels expanded below the root (default 1)
+          - expand: comma separated ids of collapsed structures to open
+          - root: structure of the diagram to start from (default: this one),
+            to load only the subtree of a node being expanded
+        """
+        structure = self.get_object()
+        params = request.query_params
+        try:
+            depth = int(params.get('depth', 1))
+            expand = [int(value) for value in params.get('expand', '').split(',') if value.strip()]
+            root_id = int(params['root']) if params.get('root') else None
+        except (TypeError, ValueError):
+            return Response(
+                {"error": "depth and root must be integers and expand a comma separated list of ids"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not 0 <= depth <= MAX_SUMMARY_DEPTH:
+            return Response(
+                {"error": f"depth must be between 0 and {MAX_SUMMARY_DEPTH}"},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Constants for spacing
-        NODE_WIDTH = 200  # Approximate width of a node in pixels
-        HORIZONTAL_PADDING = 100  # Minimum space between nodes
-        VERTICAL_SPACING = 250  # Vertical space between levels
-        
-        # Calculate positions using a tree-based approach
-        node_positions = {}
-        
-        def calculate_subtree_width(node_id):
-            """Calculate the width required for a subtree in units."""
-            if not children_map.get(node_id):
-                return 1  # Base unit for leaf nodes
-            
-            # Sum up all children's widths plus padding between them
-            children = children_map[node_id]
-            if not children:
-                return 1
-                
-            total = sum(calculate_subtree_width(child_id) for child_id in children)
-            # Add padding between children (N-1 gaps for N children)
-            return max(1, total + (len(children) - 1) * 0.5)
+        result = collapse_diagram(structure.id, root_id=root_id, depth=depth, expand=expand)
+        if result is None:
+            return Response(
+                {"error": f"Structure {root_id} is not part of the diagram of structure {structure.id}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response(dict(main_structure=structure.id, root=root_id or structure.id, depth=depth, **result))
 
-        def position_node(node_id, x_offset, level):
-            """Recursively position nodes and return the next x_offset."""
-            node = position_map[node_id]
-            
-            if node_id in children_map and children_map[node_id]:
-                # This is a parent node with children
-                children = children_map[node_id]
-                
-                # Calculate positions of all children first
-                child_positions = []
-                current_x = x_offset
-                
-                for child_id in children:
-                    child_width = calculate_subtree_width(child_id)
-                    current_x = position_node(child_id, current_x, level + 1)
-                    child_positions.append((child_id, current_x - child_width / 2))
-                    current_x += 0.5  # Add padding between children
-                
-                # Position this node centered over its children
-                if child_positions:
-                    first_child_x = child_positions[0][1]
-                    last_child_x = child_positions[-1][1] + calculate_subtree_width(children[-1])
-                    node_x = (first_child_x + last_child_x) / 2
-                else:
-                    node_x = x_offset
-                
-                node_positions[node_id] = (node_x, level * VERTICAL_SPACING + 100)
-                return current_x
-            else:
-                # This is a leaf node
-                node_positions[node_id] = (x_offset, level * VERTICAL_SPACING + 100)
-                return x_offset + 1  # Leaf nodes take 1 unit width
-
-        # Position all root nodes
-        x_offset = 0
-        for root_id in root_ids:
-            x_offset = position_node(root_id, x_offset, 0)
-
-        # Apply the calculated positions
-        updates = []
-        with transaction.atomic():
-            for node_id, (x, y) in node_positions.items():
-                # Scale x position using the node width and padding
-                x_pos = x * (NODE_WIDTH + HORIZONTAL_PADDING) + 100
-                Position.objects.filter(id=node_id).update(
-                    position_x=x_pos,
-                    position_y=y
-                )
-                updates.append({
-                    "id": node_id,
-                    "position_x": x_pos,
-                    "position_y": y
-                })
+    @action(detail=True, methods=['get'], url_path='changes', renderer_classes=columnar_renderer_classes())
+    def changes(self, request, pk=None):
+        """
+        Incremental sync of this structure's chart and diagram (see
+        organigramme.changelog). Query params:
+          - since: token of the last sync; without it only the current token
+            is returned, to read before loading the chart
+          - limit: log entries read at most (default and max MAX_CHANGES)
+        """
+        structure = self.get_object()
+        params = request.query_params
+        try:
+            since = int(params['since']) if params.get('since') else None
+            limit = int(params.get('limit', MAX_CHANGES))
+        except (TypeError, ValueError):
+            return Response({"error": "since and limit must be integers"}, status=status.HTTP_400_BAD_REQUEST)
+        if (since is not None and since < 0) or not 1 <= limit <= MAX_CHANGES:
+            return Response(
+                {"error": f"since must be >= 0 and limit between 1 and {MAX_CHANGES}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
-        return Response(
-            {
-                "message": "Chart organized as hierarchical tree with children under parents",
-                "updates": updates
-            },
-            status=status.HTTP_200_OK,
-        )
+        if since is None:
+            return Response({"main_structure": structure.id, "token": get_current_token()})
+        return Response(get_changes(structure.id, since, limit))
 
+    @action(detail=True, methods=['get'], url_path='headcount')
+    def headcount(self, request, pk=None):
+        """Positions and headcount of the structure subtree, by grade and by category."""
+        structure = self.get_object()
+        return Response(get_structure_headcount(structure.id))
 
-class TaskViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
-    """CRUD for Position model + bulk update."""
+    @action(detail=False, methods=['post'], url_path='import')
+    def import_chart(self, request):
+        """
+        Import an org chart from a CSV or XLSX file (multipart field "file"),
+        one row per position (see organigramme.importer for the columns).
+        With ?dry_run=true the file is only validated, in the request;
+        otherwise the import runs as a background job (202).
+        """
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({"error": "file is required"}, status=status.HTTP_400_BAD_REQUEST)
+        dry_run = str(request.query_params.get('dry_run', request.data.get('dry_run', ''))).lower() in ('1', 'true')
+        if not dry_run:
+            job = enqueue('import_chart', {"filename": upload.name}, user=request.user, files={"file": upload})
+            return job_accepted(request, job)
+
+        try:
+            chart_import = import_chart(upload, upload.name, dry_run=True)
+        except ChartImportError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if chart_import.errors:
+            return Response(
+                {"message": "The file contains errors, nothing was imported",
+                 "errors": chart_import.errors, "summary": chart_import.summary},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response({"message": "The file is valid", "dry_run": True, "summary": chart_import.summary})
+
+    @action(detail=True, methods=["post"], url_path="auto-organize")
+    def auto_organize(self, request, pk=None):
+        """
+        Auto‑organize positions into a tree layout with children under parents,
+        in a background job (202, see organigramme.layout.organize_structure_positions).
+        """
+        structure = self.get_object()
+        job = enqueue('organize_positions', {"structure": structure.id}, user=request.user)
+        return job_accepted(request, job)
+
+
+class TaskViewSet(BulkCreateModelMixin, BulkUpdateModelMixin, BulkDeleteModelMixin, FlexFieldsMixin, viewsets.ModelViewSet):
+    """CRUD for Task model + bulk create/update/delete."""
     queryset = Task.objects.all()
     serializer_class = TaskSerializer
     permission_classes = [IsAuthenticated]
@@ -240,7 +406,7 @@ class TaskViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
     filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
     search_fields = ['description']
 
-class MissionViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
+class MissionViewSet(ExportModelMixin, FlexFieldsMixin, viewsets.ModelViewSet):
     """CRUD for Mission model + bulk operations."""
     queryset = Mission.objects.all()
     serializer_class = MissionSerializer
@@ -248,6 +414,12 @@ class MissionViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
     filterset_class = MissionFilter
     filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
     search_fields = ['description']
+    export_columns = [
+        {"header": "Poste", "schema": ["position", "title"]},
+        {"header": "Structure", "schema": ["position", "structure", "name"]},
+        {"header": "Mission", "schema": ["description"]},
+    ]
+    export_filename = "missions"
 
     @action(detail=False, methods=['post'])
     def bulk_create(self, request):
@@ -333,15 +505,27 @@ class CompetenceViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
         )
 
     
-class PositionViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
+class PositionViewSet(ExportModelMixin, FlexFieldsMixin, viewsets.ModelViewSet):
     """CRUD for Position model + bulk update."""
     queryset = Position.objects.all()
     serializer_class = PositionSerializer
     permit_list_expands = ['structure', 'grade', 'parent']
     permission_classes = [IsAuthenticated]
+    query_budgets = {'list': 10, 'retrieve': 8}
     filterset_class = PositionFilter
     filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
     search_fields = ['title']
+    export_columns = [
+        {"header": "Poste", "schema": ["title"]},
+        {"header": "Abréviation", "schema": ["abbreviation"]},
+        {"header": "Structure", "schema": ["structure", "name"]},
+        {"header": "Grade", "schema": ["grade", "name"]},
+        {"header": "Catégorie", "schema": ["grade", "category"]},
+        {"header": "Effectif", "schema": ["quantity"]},
+        {"header": "Formation", "schema": ["formation"]},
+        {"header": "Expérience", "schema": ["experience"]},
+    ]
+    export_filename = "postes"
 
     def create(self, request, *args, **kwargs):
         mutable_data = request.data.copy()
@@ -373,69 +557,99 @@ class PositionViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
     
     @action(detail=True, methods=['get'], url_path='generate_pdf')
     def generate_pdf(self, request, pk=None):
-        try:
-            from django.contrib.contenttypes.models import ContentType
-            
-            position = Position.objects.get(id=pk) 
-            missions = Mission.objects.filter(position=position)
-            competences = Competence.objects.filter(position=position)
-
-            # Get the content type for Position model
-            position_type = ContentType.objects.get_for_model(position)
-            
-            # Query using target_content_type and target_object_id
-            edge = OrganigramEdge.objects.filter(
-                target_content_type=position_type,
-                target_object_id=position.id,
-                structure=position.structure
-            ).first()
-            
-            # If edge exists, prefetch the source
-            if edge and edge.source_content_type:
-                edge.source = edge.source_content_type.get_object_for_this_type(pk=edge.source_object_id)
-            
-            context = { 
-                "position" : position,
-                "missions" : missions, 
-                "competences" : competences,
-                "parent" : edge.source if edge else None
-            }  
+        """
+        Download the fiche de poste of a position.
 
-            pdf = render_to_pdf_rest('organigramme/fiche_de_poste.html', context)
+        Cached documents are served from storage. Otherwise the rendering is
+        queued as a background job and a 202 is returned at once: the
+        document can be polled through `pdf-status` (or its job), then
+        downloaded here.
+        """
+        try:
+            position = Position.objects.get(id=pk)
+        except Position.DoesNotExist:
+            return Response({"error": "Position not found"}, status=404)
 
+        signature = get_fiche_de_poste_signatures([position.id])[position.id]
+        path = get_cached_fiche_de_poste(position.id, signature)
+        if path:
+            return self._fiche_de_poste_response(position, path)
 
+        submit_fiche_de_poste(position.id, signature, user=request.user)
+        return Response(
+            {
+                **get_fiche_de_poste_status(position.id, signature),
+                "status_url": request.build_absolute_uri(reverse('position-pdf-status', args=[position.id])),
+            },
+            status=status.HTTP_202_ACCEPTED
+        )
 
-            if pdf:
-                # Create response with correct headers to allow download in frontend
-                response = HttpResponse(pdf, content_type='application/pdf')
-                filename = f"FICHE_DE_POSTE_{context['position'].title}.pdf"
-                response['Content-Disposition'] = f'attachment; filename="{filename}"'
-                return response
-            return Response({"error": "Error generating PDF"}, status=500)
-        except Position.DoesNotExist:
-            return Response({"error": "Position not found"}, status=404)
+    @action(detail=True, methods=['get'], url_path='pdf-status')
+    def pdf_status(self, request, pk=None):
+        """Rendering status of the current fiche de poste of a position."""
+        position = self.get_object()
+        signature = get_fiche_de_poste_signatures([position.id])[position.id]
+        return Response(get_fiche_de_poste_status(position.id, signature))
+
+    def _fiche_de_poste_response(self, position, path):
+        # Create response with correct headers to allow download in frontend
+        return FileResponse(
+            default_storage.open(path, 'rb'),
+            as_attachment=True,
+            filename=fiche_de_poste_filename(position),
+            content_type='application/pdf'
+        )
 
     @action(detail=False, methods=["post"], url_path="bulk-update")
     def bulk_update(self, request):
-        updates = request.data.get("updates", [])
-        if not updates:
-            return Response(
-                {"detail": "No updates provided."},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
+        """
+        Update the coordinates of many positions in a single request.
+        Expected payload: {"updates": [{"id": 3, "x": 10, "y": 20}, ...]}
+        Nothing is updated when one of the ids is not found (404 with the
+        `missing_ids`).
+        """
+        serializer = PositionCoordinatesSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        # Last write wins when the same position is sent twice
+        coordinates = {update['id']: (update['x'], update['y']) for update in serializer.validated_data['updates']}
 
-        instances = [
-            Position(
-                id=u["id"], position_x=u["x"], position_y=u["y"]
+        with transaction.atomic():
+            positions = list(
+                self.filter_queryset(self.get_queryset()).select_for_update().filter(id__in=coordinates)
             )
-            for u in updates
-        ]
-        Position.objects.bulk_update(instances, ["position_x", "position_y"])
+            missing_ids = get_missing_ids(list(coordinates), [position.id for position in positions])
+            if missing_ids:
+                return Response(
+                    {"detail": "Some positions were not found for update.", "missing_ids": missing_ids},
+                    status=status.HTTP_404_NOT_FOUND,
+                )
+            now = timezone.now()
+            for position in positions:
+                position.position_x, position.position_y = coordinates[position.id]
+                position.updated_at = now
+            # bulk_update sends no signal: the change log and the feed are updated here
+            Position.objects.bulk_update(positions, ["position_x", "position_y", "updated_at"], batch_size=500)
+            bump_chart_version()
+            log_changes([
+                change('position', 'updated', position.id,
+                       structure_id=position.structure_id, previous_structure_id=position.structure_id)
+                for position in positions
+            ])
+            if broker.has_subscribers():
+                diagrams = {}
+                for position in positions:
+                    if position.structure_id not in diagrams:
+                        diagrams[position.structure_id] = diagrams_of_structure(position.structure_id)
+                    publish_change(diagrams[position.structure_id], {
+                        "op": "node_updated", "kind": "position", "id": position.id,
+                        "data": {"position_x": position.position_x, "position_y": position.position_y},
+                    })
+
         return Response(
-            {"message": f"Successfully updated {len(instances)} positions"},
+            {"message": f"Successfully updated {len(positions)} positions", "updated_count": len(positions)},
             status=status.HTTP_200_OK,
         )
-        
+
     @action(detail=True, methods=['get'], url_path='parent')
     def get_parent_position(self, request, pk=None):
         """
@@ -444,18 +658,20 @@ class PositionViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
         """
         try:
             position = self.get_object()
+            # A generic foreign key can be neither filtered on nor select_related
             edge = OrganigramEdge.objects.filter(
-                target=position,
+                target_content_type=ContentType.objects.get_for_model(Position),
+                target_object_id=position.id,
                 structure=position.structure
-            ).select_related('source').first()
+            ).first()
             
-            if not edge:
+            if not edge or not isinstance(edge.source, Position):
                 return Response(
                     {"detail": "No parent position found"}, 
                     status=status.HTTP_404_NOT_FOUND
                 )
             
-            serializer = PositionSerializer(edge.source, context=self.context)
+            serializer = PositionSerializer(edge.source, context=self.get_serializer_context())
             return Response(serializer.data)
         except Position.DoesNotExist:
             return Response(
@@ -469,112 +685,173 @@ class PositionViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
         Update the source of the edge related to this position.
         Expected payload: {"source_id": <new_source_position_id>}
         """
+        position = self.get_object()
+        new_source_id = request.data.get('source_id')
+        
+        if not new_source_id:
+            return Response(
+                {"error": "source_id is required in the request payload"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
         try:
-            position = self.get_object()
-            new_source_id = request.data.get('source_id')
-            
-            if not new_source_id:
-                return Response(
-                    {"error": "source_id is required in the request payload"},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            
-            # Get the edge where this position is the target
-            edge = OrganigramEdge.objects.filter(
-                target=position,
-                organigram=position.organigram
-            ).first()
-            
-            if not edge:
-                return Response(
-                    {"error": "No edge found for this position"},
-                    status=status.HTTP_404_NOT_FOUND
-                )
-            
-            # Get the new source position
-            try:
-                new_source = Position.objects.get(id=new_source_id, organigram=position.organigram)
-            except Position.DoesNotExist:
-                return Response(
-                    {"error": "Source position not found or not in the same organigram"},
-                    status=status.HTTP_404_NOT_FOUND
-                )
-            
-            # Update the edge source
-            edge.source = new_source
-            edge.save()
-            
-            return Response({
-                "message": "Edge source updated successfully",
-                "data": OrganigramEdgeSerializer(edge).data
-            })
-            
-        except Exception as e:
+            move_position(position, 'position', int(new_source_id))
+        except (TypeError, ValueError) as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        edge = OrganigramEdge.objects.filter(
+            target_content_type=ContentType.objects.get_for_model(Position),
+            target_object_id=position.id
+        ).first()
+        return Response({
+            "message": "Edge source updated successfully",
+            "data": OrganigramEdgeSerializer(edge).data
+        })
+
+    @action(detail=True, methods=['post'], url_path='move')
+    def move(self, request, pk=None):
+        """
+        Move the position (and the positions reporting to it) under a new parent.
+        Expected payload: {"parent": {"type": "structure" | "position", "id": <id>}}
+        Returns only the diagram coordinates that changed.
+        """
+        position = self.get_object()
+        parent = request.data.get('parent')
+        
+        if not isinstance(parent, dict) or 'type' not in parent or 'id' not in parent:
             return Response(
-                {"error": str(e)},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                {"error": "parent must be an object with 'type' and 'id' keys"},
+                status=status.HTTP_400_BAD_REQUEST
             )
-            
+        
+        try:
+            diagrams = move_position(position, parent['type'], int(parent['id']))
+        except (TypeError, ValueError) as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        return Response({
+            "message": "Position moved successfully",
+            "data": self.get_serializer(position).data,
+            "diagrams": diagrams
+        })
+
     @action(detail=True, methods=['post'], url_path='clone')
     def clone_position(self, request, pk=None):
         """
-        Create a clone of the position with all its related data.
+        Create a clone of the position with its missions, competences, tasks
+        and incoming edge.
         """
+        original_position = self.get_object()
         try:
-            with transaction.atomic():
-                # Get the original position
-                original_position = self.get_object()
-                
-                # Create a copy of the position
-                position_copy = Position.objects.get(id=original_position.id)
-                position_copy.pk = None
-                position_copy.title = f"{original_position.title} (Copie)"
-                position_copy.save()
-                
-                # Clone related missions
-                for mission in Mission.objects.filter(position=original_position):
-                    mission_copy = Mission.objects.get(id=mission.id)
-                    mission_copy.pk = None
-                    mission_copy.position = position_copy
-                    mission_copy.save()
-                
-                # Clone related competences
-                for competence in Competence.objects.filter(position=original_position):
-                    competence_copy = Competence.objects.get(id=competence.id)
-                    competence_copy.pk = None
-                    competence_copy.position = position_copy
-                    competence_copy.save()
-                
-                # Clone related tasks
-                for task in Task.objects.filter(position=original_position):
-                    task_copy = Task.objects.get(id=task.id)
-                    task_copy.pk = None
-                    task_copy.position = position_copy
-                    task_copy.save()
-                
-                # Clone the edge relationship if it exists
-                edge = OrganigramEdge.objects.filter(
-                    target=original_position,
-                    organigram=original_position.organigram
-                ).first()
-                
-                if edge:
-                    OrganigramEdge.objects.create(
-                        source=edge.source,
-                        target=position_copy,
-                        organigram=edge.organigram
-                    )
-                
-                # Return the cloned position
-                serializer = self.get_serializer(position_copy)
-                return Response(serializer.data, status=status.HTTP_201_CREATED)
-                
+            position_copy = clone_position(original_position)
         except Exception as e:
             return Response(
                 {"detail": f"Error cloning position: {str(e)}"},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
+        serializer = self.get_serializer(position_copy)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+class ChartSnapshotViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
+    """
+    Named snapshots of a main structure's chart (see organigramme.history).
+    Snapshots are immutable: they are created, read and deleted only.
+    """
+    serializer_class = ChartSnapshotSerializer
+    permission_classes = [IsAuthenticated]
+    query_budgets = {'list': 5, 'chart': 5, 'diff': 16}
+    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    filterset_fields = ['main_structure', 'decree_date']
+    search_fields = ['name', 'main_structure_name']
+    ordering_fields = ['created_at', 'decree_date', 'name']
+    http_method_names = ['get', 'post', 'delete', 'head', 'options']
+
+    def get_queryset(self):
+        queryset = ChartSnapshot.objects.order_by('-created_at')
+        # The manifest is only read by the chart and delete actions
+        if self.action in ('chart', 'destroy'):
+            return queryset
+        return queryset.defer('manifest')
+
+    def create(self, request, *args, **kwargs):
+        """Validate the snapshot and freeze the chart in a background job (202)."""
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        job = enqueue('create_snapshot', {
+            "main_structure": data['main_structure'].id,
+            "name": data['name'],
+            "decree_date": data['decree_date'].isoformat() if data.get('decree_date') else None,
+            "description": data.get('description'),
+        }, user=request.user)
+        return job_accepted(request, job)
+
+    def perform_destroy(self, instance):
+        delete_snapshot(instance)
+
+    @action(detail=True, methods=['get'], url_path='chart', renderer_classes=columnar_renderer_classes())
+    def chart(self, request, pk=None):
+        """The frozen chart: structures, positions (with their texts), edges and coordinates."""
+        snapshot = self.get_object()
+        return Response(dict(snapshot=self.get_serializer(snapshot).data, **load_snapshot_chart(snapshot)))
+
+    def _load_diff_side(self, value):
+        """
+        (chart, error response) for a snapshot id, or "live:<structure id>"
+        for the current chart of a main structure.
+        """
+        value = str(value).strip()
+        if value.startswith('live:'):
+            structure_id = value[len('live:'):]
+            if not structure_id.isdigit() or not Structure.objects.filter(id=structure_id).exists():
+                return None, Response(
+                    {"error": f"Structure '{structure_id}' not found"}, status=status.HTTP_404_NOT_FOUND
+                )
+            return load_live_chart(int(structure_id)), None
+        if not value.isdigit():
+            return None, Response(
+                {"error": f"'{value}' is not a snapshot id or live:<structure id>"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        snapshot = ChartSnapshot.objects.filter(id=value).first()
+        if snapshot is None:
+            return None, Response({"error": f"Snapshot {value} not found"}, status=status.HTTP_404_NOT_FOUND)
+        return load_snapshot_chart(snapshot), None
+
+    @action(detail=False, methods=['get'], url_path='diff', renderer_classes=columnar_renderer_classes())
+    def diff(self, request):
+        """
+        What changed between two charts (see organigramme.diff). Query params:
+          - base, target: a snapshot id, or live:<structure id> for the
+            current chart of a main structure
+          - details: false to only return the summary
+        """
+        charts = []
+        for param in ('base', 'target'):
+            if not request.query_params.get(param):
+                return Response({"error": "base and target are required"}, status=status.HTTP_400_BAD_REQUEST)
+            chart, error = self._load_diff_side(request.query_params[param])
+            if error is not None:
+                return error
+            charts.append(chart)
+
+        result = diff_charts(*charts)
+        if str(request.query_params.get('details', 'true')).lower() in ('0', 'false'):
+            result.pop('changes')
+        return Response(result)
+
+
+class StructureHeadcountViewSet(FlexFieldsMixin, viewsets.ReadOnlyModelViewSet):
+    """Precomputed subtree headcounts per structure and grade (read only)."""
+    queryset = StructureHeadcount.objects.all().order_by('structure_id', 'category', 'grade_id')
+    serializer_class = StructureHeadcountSerializer
+    permit_list_expands = ['grade', 'structure']
+    permission_classes = [IsAuthenticated]
+    filterset_class = StructureHeadcountFilter
+    filter_backends = [DjangoFilterBackend, OrderingFilter]
+
+
 class DiagramPositionViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
     """
     CRUD for DiagramPosition model.
@@ -582,11 +859,14 @@ class DiagramPositionViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
     """
     serializer_class = DiagramPositionSerializer
     permission_classes = [IsAuthenticated]
+    query_budgets = {'list': 5, 'viewport': 8, 'bulk_sync': 12}
+    renderer_classes = columnar_renderer_classes()
     filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
-    filterset_fields = ['main_structure', 'content_type', 'object_id']
+    # content_type is resolved by name in get_queryset, not by the filter backend
+    filterset_fields = ['main_structure', 'object_id']
     
     def get_queryset(self):
-        queryset = DiagramPosition.objects.all()
+        queryset = DiagramPosition.objects.select_related('content_type')
         
         # Filter by content type and object ID if provided
         content_type = self.request.query_params.get('content_type')
@@ -594,14 +874,13 @@ class DiagramPositionViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
         main_structure = self.request.query_params.get('main_structure')
         
         if content_type and object_id:
-            try:
-                content_type = ContentType.objects.get(model=content_type.lower())
-                queryset = queryset.filter(
-                    content_type=content_type,
-                    object_id=object_id
-                )
-            except ContentType.DoesNotExist:
+            content_type_id = get_node_content_type_id(content_type)
+            if content_type_id is None:
                 return DiagramPosition.objects.none()
+            queryset = queryset.filter(
+                content_type_id=content_type_id,
+                object_id=object_id
+            )
                 
         if main_structure:
             queryset = queryset.filter(main_structure_id=main_structure)
@@ -609,8 +888,14 @@ class DiagramPositionViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
         return queryset
     
     def create(self, request, *args, **kwargs):
-        # Handle creation of a new diagram position
-        data = request.data.copy()
+        """
+        Create or update the position of a node in a main structure's diagram.
+        The node kind is resolved through the in-process node registry, the
+        node and main structure are checked with one query and the row is
+        written with a single update_or_create. Answers 201 in both cases,
+        as it always did.
+        """
+        data = request.data
         
         # Get the content type and object ID from the request
         content_type_str = data.get('content_type')
@@ -623,88 +908,257 @@ class DiagramPositionViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
+        content_type_id = get_node_content_type_id(content_type_str)
+        if content_type_id is None:
+            return Response(
+                {"error": f"Invalid content_type: {content_type_str}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        model_class = get_node_model(content_type_str)
+        
         try:
-            # Get the content type model
-            content_type = ContentType.objects.get(model=content_type_str.lower())
-            model_class = content_type.model_class()
-            
-            # Convert object_id to integer
-            try:
-                object_id = int(object_id)
-            except (ValueError, TypeError):
-                return Response(
-                    {"error": "object_id must be a valid integer"},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            
-            # Get the object instance to verify it exists
-            try:
-                obj = model_class.objects.get(id=object_id)
-            except model_class.DoesNotExist:
-                return Response(
-                    {"error": f"{content_type.model} with id {object_id} does not exist"},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            
-            # Get the main structure
-            try:
-                main_structure = Structure.objects.get(id=main_structure_id, is_main=True)
-            except Structure.DoesNotExist:
-                return Response(
-                    {"error": f"Main structure with id {main_structure_id} not found or not marked as main"},
-                    status=status.HTTP_400_BAD_REQUEST
+            object_id = int(object_id)
+            main_structure_id = int(main_structure_id)
+        except (ValueError, TypeError):
+            return Response(
+                {"error": "object_id and main_structure must be valid integers"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            position_x = float(data.get('position_x', 0))
+            position_y = float(data.get('position_y', 0))
+        except (ValueError, TypeError):
+            return Response(
+                {"error": "position_x and position_y must be numbers"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # Check the main structure and the target object in one query:
+        # None -> no such main structure, False -> no such object
+        target_exists = Structure.objects.filter(
+            id=main_structure_id, is_main=True
+        ).annotate(
+            target_exists=Exists(model_class.objects.filter(id=object_id))
+        ).values_list('target_exists', flat=True).first()
+        
+        if target_exists is None:
+            return Response(
+                {"error": f"Main structure with id {main_structure_id} not found or not marked as main"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not target_exists:
+            return Response(
+                {"error": f"{model_class._meta.model_name} with id {object_id} does not exist"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        diagram_position, _ = DiagramPosition.objects.update_or_create(
+            content_type_id=content_type_id,
+            object_id=object_id,
+            main_structure_id=main_structure_id,
+            defaults={'position_x': position_x, 'position_y': position_y}
+        )
+        # Served from the ContentType cache, avoids a query while serializing
+        diagram_position.content_type = get_node_content_type(content_type_str)
+        
+        serializer = self.get_serializer(diagram_position)
+        headers = self.get_success_headers(serializer.data)
+        return Response(
+            serializer.data,
+            status=status.HTTP_201_CREATED,
+            headers=headers
+        )
+
+    @action(detail=False, methods=['post'], url_path='bulk-sync')
+    def bulk_sync(self, request):
+        """
+        Upsert the coordinates of many nodes of one diagram in a single request.
+        Expected payload:
+        {
+            "main_structure": <id>,
+            "nodes": [{"content_type": "position", "object_id": 3, "position_x": 10, "position_y": 20}, ...]
+        }
+        Every node must belong to the main structure's subtree.
+        """
+        serializer = DiagramPositionSyncSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        main_structure = serializer.validated_data['main_structure']
+
+        # Last write wins when the same node is sent twice
+        coordinates = {}
+        for node in serializer.validated_data['nodes']:
+            key = (node['content_type'], node['object_id'])
+            coordinates[key] = (node['position_x'], node['position_y'])
+
+        structure_ids = {object_id for kind, object_id in coordinates if kind == 'structure'}
+        position_ids = {object_id for kind, object_id in coordinates if kind == 'position'}
+
+        # Validate membership against the main structure's subtree
+        subtree_ids = set(get_subtree_structure_ids(main_structure.id))
+        member_position_ids = set()
+        if position_ids:
+            member_position_ids = set(
+                Position.objects.filter(
+                    id__in=position_ids, structure_id__in=subtree_ids
+                ).values_list('id', flat=True)
+            )
+        invalid_nodes = [
+            {"content_type": "structure", "object_id": object_id}
+            for object_id in sorted(structure_ids - subtree_ids)
+        ] + [
+            {"content_type": "position", "object_id": object_id}
+            for object_id in sorted(position_ids - member_position_ids)
+        ]
+        if invalid_nodes:
+            return Response(
+                {
+                    "error": f"Some nodes do not belong to main structure {main_structure.id}",
+                    "invalid_nodes": invalid_nodes
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        content_type_ids = get_node_content_type_ids()
+        kinds = {content_type_id: kind for kind, content_type_id in content_type_ids.items()}
+
+        def node_filter(keys):
+            keys = list(keys)
+            return (
+                Q(content_type_id=content_type_ids['structure'],
+                  object_id__in=[object_id for kind, object_id in keys if kind == 'structure'])
+                | Q(content_type_id=content_type_ids['position'],
+                    object_id__in=[object_id for kind, object_id in keys if kind == 'position'])
+            )
+
+        with transaction.atomic():
+            # Concurrent syncs of the same diagram run one after the other:
+            # each one sees the rows the previous one created
+            list(Structure.objects.select_for_update().filter(pk=main_structure.pk).values_list('pk', flat=True))
+            existing = DiagramPosition.objects.filter(main_structure=main_structure).filter(
+                node_filter(coordinates)
+            )
+
+            now = timezone.now()
+            to_update = []
+            for diagram_position in existing:
+                key = (kinds[diagram_position.content_type_id], diagram_position.object_id)
+                diagram_position.position_x, diagram_position.position_y = coordinates.pop(key)
+                diagram_position.updated_at = now
+                to_update.append(diagram_position)
+
+            to_create = [
+                DiagramPosition(
+                    content_type_id=content_type_ids[kind],
+                    object_id=object_id,
+                    main_structure=main_structure,
+                    position_x=x,
+                    position_y=y
                 )
-            
-            # Check if a position already exists for this object and main structure
-            existing_position = DiagramPosition.objects.filter(
-                content_type=content_type,
-                object_id=object_id,
-                main_structure=main_structure
-            ).first()
-            
-            # Prepare data for the serializer
-            position_data = {
-                'content_type': content_type.model,
-                'object_id': object_id,
-                'main_structure': main_structure.id,
-                'position_x': data.get('position_x', 0),
-                'position_y': data.get('position_y', 0)
-            }
-            
-            if existing_position:
-                # Update the existing position
-                serializer = self.get_serializer(existing_position, data=position_data, partial=True)
-            else:
-                # Create a new position
-                serializer = self.get_serializer(data=position_data)
-            
-            serializer.is_valid(raise_exception=True)
-            self.perform_create(serializer)
-            headers = self.get_success_headers(serializer.data)
-            return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
-            
-        except ContentType.DoesNotExist:
+                for (kind, object_id), (x, y) in coordinates.items()
+            ]
+
+            # A row created meanwhile by a writer not holding the lock (single
+            # create, layout) fails the insert: it is re-selected and updated
+            while to_create:
+                try:
+                    with transaction.atomic():
+                        DiagramPosition.objects.bulk_create(to_create, batch_size=500)
+                    break
+                except IntegrityError:
+                    conflicting = list(
+                        DiagramPosition.objects.select_for_update().filter(main_structure=main_structure).filter(
+                            node_filter((kinds[row.content_type_id], row.object_id) for row in to_create)
+                        )
+                    )
+                    if not conflicting:
+                        raise
+                    for diagram_position in conflicting:
+                        key = (kinds[diagram_position.content_type_id], diagram_position.object_id)
+                        diagram_position.position_x, diagram_position.position_y = coordinates.pop(key)
+                        diagram_position.updated_at = now
+                        to_update.append(diagram_position)
+                    conflicting_ids = {(row.content_type_id, row.object_id) for row in conflicting}
+                    to_create = [row for row in to_create if (row.content_type_id, row.object_id) not in conflicting_ids]
+
+            DiagramPosition.objects.bulk_update(
+                to_update, ['position_x', 'position_y', 'updated_at'], batch_size=500
+            )
+            bump_diagram_version(main_structure.id)
+            log_changes(
+                diagram_changes(main_structure.id, 'updated', [
+                    (kinds[row.content_type_id], row.object_id) for row in to_update
+                ])
+                + diagram_changes(main_structure.id, 'created', list(coordinates))
+            )
+            publish_change({main_structure.id}, {
+                "op": "nodes_moved",
+                "nodes": [
+                    [kinds[row.content_type_id], row.object_id, row.position_x, row.position_y]
+                    for row in to_update + to_create
+                ],
+            })
+
+        return Response(
+            {
+                "message": f"Synced {len(to_update) + len(to_create)} diagram positions",
+                "updated_count": len(to_update),
+                "created_count": len(to_create)
+            },
+            status=status.HTTP_200_OK
+        )
+
+
+    @action(detail=False, methods=['get'], url_path='viewport', renderer_classes=diagram_renderer_classes())
+    def viewport(self, request):
+        """
+        Nodes and edges of a diagram intersecting a bounding box, for lazy
+        loading while panning and zooming.
+        Query params: main_structure, min_x, max_x, min_y, max_y and an
+        optional limit on the number of nodes (default and maximum 5000).
+        """
+        params = request.query_params
+        main_structure_id = params.get('main_structure')
+        try:
+            main_structure_id = int(main_structure_id)
+        except (TypeError, ValueError):
             return Response(
-                {"error": f"Invalid content_type: {content_type_str}"},
+                {"error": "main_structure is required and must be a valid integer"},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        except model_class.DoesNotExist:
+        try:
+            bounds = {name: float(params[name]) for name in ('min_x', 'max_x', 'min_y', 'max_y')}
+            limit = int(params.get('limit', MAX_VIEWPORT_NODES))
+        except KeyError as e:
+            return Response({"error": f"{e.args[0]} is required"}, status=status.HTTP_400_BAD_REQUEST)
+        except (TypeError, ValueError):
             return Response(
-                {"error": f"{content_type_str} with id {object_id} does not exist"},
-                status=status.HTTP_404_NOT_FOUND
+                {"error": "min_x, max_x, min_y and max_y must be numbers and limit an integer"},
+                status=status.HTTP_400_BAD_REQUEST
             )
-        except Structure.DoesNotExist:
+        if bounds['min_x'] > bounds['max_x'] or bounds['min_y'] > bounds['max_y']:
             return Response(
-                {"error": f"Main structure with id {main_structure_id} does not exist or is not a main structure"},
+                {"error": "min_x and min_y must not be greater than max_x and max_y"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not Structure.objects.filter(id=main_structure_id, is_main=True).exists():
+            return Response(
+                {"error": f"Main structure with id {main_structure_id} not found or not marked as main"},
                 status=status.HTTP_404_NOT_FOUND
             )
 
+        result = query_viewport(
+            main_structure_id, limit=max(1, min(limit, MAX_VIEWPORT_NODES)), **bounds
+        )
+        return Response(dict(main_structure=main_structure_id, bbox=bounds, **result))
 
 class OrganigramEdgeViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
     """CRUD for OrganigramEdge model."""
 
     serializer_class = OrganigramEdgeSerializer
     permission_classes = [IsAuthenticated]
+    query_budgets = {'list': 5}
+    renderer_classes = columnar_renderer_classes()
     filterset_class = OrganigramEdgeFilter
     filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
     search_fields = ['title','source','target']
@@ -718,166 +1172,79 @@ class OrganigramEdgeViewSet(FlexFieldsMixin, viewsets.ModelViewSet):
 
 
 class DashboardViewSet(viewsets.ViewSet):
-    """Read‑only stats dashboard."""
+    """Read‑only stats dashboard, served from a cached snapshot (see organigramme.dashboard)."""
 
     permission_classes = [IsAuthenticated]
+    query_budgets = {'list': 8}
 
     def list(self, request):
-        stats = {
-            "total_organigrams": Organigram.objects.count(),
-            "total_positions": Position.objects.count(),
-            "total_grades": Grade.objects.count(),
-            "recent_organigrams": [
-                {
-                    "id": str(org.id),
-                    "name": org.name,
-                    "created_at": org.created_at.isoformat(),
-                }
-                for org in Organigram.objects.order_by("-created_at")[:5]
-            ],
-        }
-        return Response(stats)
-
-from collections import defaultdict
+        return Response(get_dashboard())
 
-
-def auto_organize_structure(main_structure_id, x_spacing=250, y_spacing=500):
-    main_structure = Structure.objects.prefetch_related('children', 'positions').get(id=main_structure_id)
     
-    # Define node dimensions
-    NODE_WIDTH = 300
-    NODE_HEIGHT = 60
-    POSITION_WIDTH = 120
-    POSITION_HEIGHT = 40
-
-    # Use a dictionary to store calculated positions to avoid excessive DB writes
-    positions = {}
-
-    def get_all_descendants(node):
-        descendants = [node]
-        for child in node.children.all():
-            descendants.extend(get_all_descendants(child))
-        return descendants
-
-    def get_subtree_extents(node):
-        """
-        Returns (min_x, max_x) for the entire subtree rooted at `node`.
-        Handles both Structure and Position nodes.
-        """
-        key = f"structure-{node.id}"
-        min_x = max_x = positions[key]['x'] if key in positions else 0
-
-        all_descendants = get_all_descendants(node)
-        node_keys = [f"structure-{d.id}" for d in all_descendants]
-        pos_keys = [f"position-{p.id}" for d in all_descendants for p in d.positions.all()]
-        all_keys = node_keys + pos_keys
-        xs = [positions[k]['x'] for k in all_keys if k in positions]
-        if xs:
-            min_x = min(xs)
-            max_x = max(xs)
-        return min_x, max_x
-
-    def shift_subtree(node, shift_amount):
-        nodes_to_shift = get_all_descendants(node)
-        for n in nodes_to_shift:
-            key = f"structure-{n.id}"
-            if key in positions:
-                positions[key]['x'] += shift_amount
-            # Also shift associated positions
-            for p in n.positions.all():
-                pos_key = f"position-{p.id}"
-                if pos_key in positions:
-                    positions[pos_key]['x'] += shift_amount
-
-    def layout_dfs(node, level=0):
-        # Unified children: structures and positions
-        structure_children = list(node.children.all())
-        position_children = list(node.positions.all())
-        all_children = structure_children + position_children
-
-        # Recursively layout all Structure children
-        for child in structure_children:
-            layout_dfs(child, level + 1)
-
-        # Assign y position for all children
-        base_y = (level + 1) * (NODE_HEIGHT + y_spacing)
-        for pos in position_children:
-            positions[f"position-{pos.id}"] = {'x': 0, 'y': base_y}
-
-        # Calculate widths
-        child_widths = []
-        for child in all_children:
-            if isinstance(child, Structure):
-                # The width of a structure is the span of its subtree
-                min_x, max_x = get_subtree_extents(child)
-                width = max_x - min_x if max_x > min_x else NODE_WIDTH
-            else:
-                width = POSITION_WIDTH
-            child_widths.append(width)
-
-        # Layout all children horizontally, side by side
-        total_width = sum(child_widths) + (len(all_children) - 1) * x_spacing if all_children else 0
-        start_x = -total_width / 2
-        current_x = start_x
-        for i, child in enumerate(all_children):
-            if isinstance(child, Structure):
-                min_x, max_x = get_subtree_extents(child)
-                width = child_widths[i]
-                center = current_x + width / 2
-                shift = center - positions[f"structure-{child.id}"]['x']
-                shift_subtree(child, shift)
-            else:
-                positions[f"position-{child.id}"]['x'] = current_x + POSITION_WIDTH / 2
-            current_x += child_widths[i] + x_spacing
-
-        # Position the current structure node above its children
-        positions[f"structure-{node.id}"] = {'x': 0, 'y': level * (NODE_HEIGHT + y_spacing)}
-        if all_children:
-            min_x = min(
-                positions[f"structure-{c.id}"]['x'] if isinstance(c, Structure) else positions[f"position-{c.id}"]['x']
-                for c in all_children if f"structure-{getattr(c, 'id', None)}" in positions or f"position-{getattr(c, 'id', None)}" in positions
-            )
-            max_x = max(
-                positions[f"structure-{c.id}"]['x'] if isinstance(c, Structure) else positions[f"position-{c.id}"]['x']
-                for c in all_children if f"structure-{getattr(c, 'id', None)}" in positions or f"position-{getattr(c, 'id', None)}" in positions
-            )
-            positions[f"structure-{node.id}"]['x'] = (min_x + max_x) / 2
-
-
-    # Start layout process
-    layout_dfs(main_structure)
-
-    # Normalize all positions to be positive
-    min_x_overall = min((p['x'] for p in positions.values()), default=0)
-    x_offset = -min_x_overall if min_x_overall < 0 else 0
-
-    # Save all positions to the database in a single transaction
-    structure_content_type = ContentType.objects.get_for_model(Structure)
-    position_content_type = ContentType.objects.get_for_model(Position)
-
-    with transaction.atomic():
-        # Clear old positions for this organigram
-        DiagramPosition.objects.filter(main_structure=main_structure).delete()
-        
-        for key, pos in positions.items():
-            obj_type, obj_id = key.split('-')
-            content_type = structure_content_type if obj_type == 'structure' else position_content_type
-            
-            DiagramPosition.objects.create(
-                content_type=content_type,
-                object_id=int(obj_id),
-                main_structure=main_structure,
-                position_x=pos['x'] + x_offset,
-                position_y=pos['y']
-            )
-
-
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 
 
 class AutoOrganizeDiagramView(APIView):
+    """Lay out the whole diagram of a main structure, in a background job (202)."""
+    permission_classes = [IsAuthenticated]
+
     def post(self, request, structure_id):
-        auto_organize_structure(structure_id)
-        return Response({"status": "Diagram auto-organized"}, status=status.HTTP_200_OK)
\ No newline at end of file
+        if not Structure.objects.filter(id=structure_id).exists():
+            return Response({"error": "Structure not found"}, status=status.HTTP_404_NOT_FOUND)
+        job = enqueue('auto_organize', {"structure": structure_id}, user=request.user)
+        return job_accepted(request, job)
+
+
+class JobViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Background jobs (see organigramme.jobs): status, result and cancellation.
+    Users see their own jobs, staff see every job.
+    """
+    serializer_class = JobSerializer
+    permission_classes = [IsAuthenticated]
+    query_budgets = {'list': 4, 'retrieve': 4, 'result': 4}
+    filter_backends = [DjangoFilterBackend, OrderingFilter]
+    filterset_fields = ['kind', 'status']
+    ordering_fields = ['created_at', 'finished_at']
+
+    def get_queryset(self):
+        queryset = Job.objects.order_by('-created_at')
+        if not self.request.user.is_staff:
+            queryset = queryset.filter(created_by=self.request.user)
+        return queryset
+
+    @action(detail=True, methods=['get'], url_path='result')
+    def result(self, request, pk=None):
+        """
+        What the job produced: the exported file, or its JSON result. 202
+        while it is queued or running, 409 when it failed or was cancelled.
+        """
+        job = self.get_object()
+        if job.status in (QUEUED, RUNNING):
+            return Response(self.get_serializer(job).data, status=status.HTTP_202_ACCEPTED)
+        if job.status != SUCCEEDED:
+            return Response(
+                {"error": job.error or f"Job {job.status}", "status": job.status, "result": job.result},
+                status=status.HTTP_409_CONFLICT
+            )
+        result = job.result or {}
+        if isinstance(result, dict) and result.get('file'):
+            try:
+                file = default_storage.open(result['file'], 'rb')
+            except FileNotFoundError:
+                return Response({"error": "The job file was deleted"}, status=status.HTTP_410_GONE)
+            return FileResponse(
+                file, as_attachment=True, filename=result.get('filename'), content_type=result.get('content_type')
+            )
+        return Response(result)
+
+    @action(detail=True, methods=['post'], url_path='cancel')
+    def cancel(self, request, pk=None):
+        """Cancel a job that has not started yet."""
+        job = self.get_object()
+        if not cancel_job(job):
+            return Response({"error": "Only a queued job can be cancelled"}, status=status.HTTP_409_CONFLICT)
+        job.refresh_from_db()
+        return Response(self.get_serializer(job).data)
\ No newline at end of file
@@ -3,14 +3,105 @@ ASGI config for src project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Besides the Django application, it serves the Server-Sent Events change
+feed of the diagrams (organigramme.feed) at /api/diagram-feed/<id>/. The
+feed's broker is in-process: run a single worker, e.g.
+
+    uvicorn src.asgi:application --host 0.0.0.0 --port 8080
+
+This is the serving mode of docker-compose.yml. Each request runs its
+synchronous code in a thread of its own, and the heavy read endpoints run
+in the bounded pool of src/async_views.py: a slow request no longer holds
+up the others. Streaming responses (exports) are read in the request's
+thread too (StreamingASGIHandler). As request threads do not live on, their database
+connections are reused through the in-process pool (SQL_POOL=process, see
+src/connections.py).
+
 For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 """
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
+from django.core.handlers.asgi import ASGIHandler
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'src.settings')
 
-application = get_asgi_application()
+
+def _read_stream(iterator, size):
+    """The next parts of a streaming response, joined up to `size` bytes; b'' at the end."""
+    parts, length = [], 0
+    for part in iterator:
+        part = bytes(part)
+        parts.append(part)
+        length += len(part)
+        if length >= size:
+            break
+    return b''.join(parts)
+
+
+class StreamingASGIHandler(ASGIHandler):
+    """
+    Django 3.2 iterates streaming responses (exports) in the event loop:
+    their database queries raise SynchronousOnlyOperation once the headers
+    are sent, and their blocking work stalls the other requests and the
+    feeds. They are iterated in the request's thread instead, where the
+    view ran, one block of parts at a time.
+    """
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+        headers = [
+            (header.encode('ascii') if isinstance(header, str) else bytes(header),
+             value.encode('latin1') if isinstance(value, str) else bytes(value))
+            for header, value in response.items()
+        ]
+        headers += [(b'Set-Cookie', cookie.output(header='').encode('ascii').strip()) for cookie in response.cookies.values()]
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+        try:
+            # Access `__iter__` and not `streaming_content`, as Django does
+            iterator = await sync_to_async(iter, thread_sensitive=True)(response)
+            while True:
+                block = await sync_to_async(_read_stream, thread_sensitive=True)(iterator, self.chunk_size)
+                if not block:
+                    break
+                await send({'type': 'http.response.body', 'body': block, 'more_body': True})
+            await send({'type': 'http.response.body'})
+        finally:
+            await sync_to_async(response.close, thread_sensitive=True)()
+
+
+django.setup(set_prefix=False)
+django_application = StreamingASGIHandler()
+
+# Imported once Django is set up
+from organigramme.feed import FEED_PATH, diagram_feed_application  # noqa: E402
+from organigramme.jobs import start_local_workers, stop_local_workers  # noqa: E402
+
+
+async def lifespan(receive, send):
+    """Run the job workers of the 'local' backend along with the server (see organigramme.jobs)."""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await sync_to_async(start_local_workers)()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await sync_to_async(stop_local_workers)()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'http' and FEED_PATH.match(scope['path']):
+        return await diagram_feed_application(scope, receive, send)
+    # Django 3.2 runs the synchronous code (middleware, sync views) of every
+    # request in one shared thread; in a context of its own, a request gets
+    # its own thread
+    async with ThreadSensitiveContext():
+        return await django_application(scope, receive, send)
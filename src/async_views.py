@@ -0,0 +1,104 @@
+"""
+Async serving of the heavy read endpoints (ASGI mode, see src/asgi.py).
+
+Under ASGI, Django 3.2 runs every synchronous view of every request in one
+shared thread: a 4 second tree serialization delays all the other requests
+of the process. src/asgi.py gives each request its own thread, and the
+endpoints wrapped with `async_view` (tree, diagram summary, viewport,
+changes) run in a bounded pool of ASYNC_DB_WORKERS threads instead:
+
+- the event loop stays free while they run, for the other requests and the
+  change feeds;
+- a burst of big reads queues in the pool instead of taking every thread
+  and every database connection, so the fast endpoints keep answering;
+- the pool size bounds the database connections they open.
+
+The wrapped view is the regular DRF view, run and rendered in the pool:
+authentication, permissions, content negotiation and the payloads are
+unchanged. Under WSGI the wrapped views still work (Django runs them in
+an event loop of the request thread).
+"""
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.urls import URLPattern
+
+from .connections import healthy_connections
+from .instrumentation import count_queries, measure_serialization
+from .profiling import profile_current_thread
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_db_executor():
+    """The bounded pool running the database work of the async views."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'ASYNC_DB_WORKERS', 8), thread_name_prefix='async-db'
+            )
+        return _executor
+
+
+def _in_pool_thread(func, *args, **kwargs):
+    # Pool threads are not request threads: open, check and recycle their
+    # connections like a request would (CONN_MAX_AGE, src/connections.py)
+    close_old_connections()
+    try:
+        with ExitStack() as stack:
+            stack.enter_context(healthy_connections())
+            stack.enter_context(count_queries())
+            stack.enter_context(profile_current_thread())
+            return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_in_db_pool(func, *args, **kwargs):
+    """
+    Run the synchronous `func` in the bounded pool and await its result.
+    Context variables (request measures, profiling) follow it in the pool.
+    """
+    return await sync_to_async(
+        _in_pool_thread, thread_sensitive=False, executor=get_db_executor()
+    )(func, *args, **kwargs)
+
+
+def _render(view, request, *args, **kwargs):
+    response = view(request, *args, **kwargs)
+    # Render in the pool too: serialization is most of the work
+    if hasattr(response, 'render') and callable(response.render):
+        with measure_serialization():
+            response.render()
+    return response
+
+
+def async_view(view):
+    """
+    Async version of a synchronous view (a DRF `as_view()` callable): the
+    view runs and renders in the bounded pool. Attributes of the view
+    (csrf_exempt, the viewset class and actions) are kept.
+    """
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        return await run_in_db_pool(_render, view, request, *args, **kwargs)
+    return wrapper
+
+
+def async_routes(patterns, names):
+    """
+    The url patterns (router urls), with the views of those named in `names`
+    wrapped with `async_view`. The given patterns are left unchanged.
+    """
+    return [
+        URLPattern(pattern.pattern, async_view(pattern.callback), pattern.default_args, pattern.name)
+        if isinstance(pattern, URLPattern) and pattern.name in names else pattern
+        for pattern in patterns
+    ]
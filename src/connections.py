@@ -0,0 +1,280 @@
+"""
+Database connection reuse.
+
+Opening a PostgreSQL connection costs a TCP (or TLS) handshake, the
+authentication and a backend process start, a few milliseconds per
+request without reuse. Three modes, chosen by SQL_POOL (see settings):
+
+- persistent connections (CONN_MAX_AGE > 0), for WSGI workers and the
+  long lived threads (async pool, job workers): each thread keeps its
+  connection between requests;
+- the in-process pool ('process'), for ASGI: Django 3.2 runs each request
+  in a new thread, whose connection cannot outlive it. The backend
+  src.db_backends.postgresql keeps the connections in a pool of the
+  process instead: Django "closes" a connection at the end of the request
+  and the next request of any thread takes it back;
+- an external pooler ('pgbouncer', transaction pooling): Django connects
+  and disconnects on every request, to the local pooler, which is cheap.
+
+Reused connections may have died meanwhile (database restart, firewall
+dropping idle connections): a connection idle for more than
+CONN_HEALTH_CHECK_IDLE_SECONDS answers a "SELECT 1" before being used
+again, instead of failing the request.
+
+The CONN_HEALTH_CHECKS and POOL keys of the database settings are read by
+this module only: Django 3.2 ignores them. Django 4.1 reads
+CONN_HEALTH_CHECKS too, with the same meaning; the pool of Django 5.1
+(OPTIONS "pool", psycopg 3) is unrelated to POOL.
+
+The pool is shared with the long lived threads of the process, the async
+view pool (ASYNC_DB_WORKERS) and the local job workers (JOB_LOCAL_WORKERS):
+its default size leaves REQUEST_CONNECTIONS more for the request threads,
+and a smaller MAX_SIZE is refused at startup (`check_pool_sizes`).
+"""
+import collections
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+
+
+def get_health_check_idle():
+    return getattr(settings, 'CONN_HEALTH_CHECK_IDLE_SECONDS', 30)
+
+
+# Persistent connections
+
+def close_unhealthy_connections():
+    """
+    Close the persistent connections of this thread that were idle for long
+    and do not answer any more; they are opened again on first use.
+    """
+    now = time.monotonic()
+    for connection in connections.all():
+        released_at = connection.__dict__.get('released_at')
+        if (
+            connection.connection is None or released_at is None or connection.in_atomic_block
+            or not connection.settings_dict.get('CONN_HEALTH_CHECKS', True)
+            or now - released_at < get_health_check_idle()
+        ):
+            continue
+        if not connection.is_usable():
+            connection.close()
+
+
+def mark_connections_released():
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is not None:
+            connection.__dict__['released_at'] = now
+
+
+@contextmanager
+def healthy_connections():
+    """Around a unit of work (request, job) reusing this thread's connections."""
+    close_unhealthy_connections()
+    try:
+        yield
+    finally:
+        mark_connections_released()
+
+
+class ConnectionHealthMiddleware:
+    """Health check of the persistent connections. Place it first."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with healthy_connections():
+            return self.get_response(request)
+
+
+# In-process pool
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    At most `max_size` connections of a database, shared by the threads of
+    the process. Backend hooks: `ping(connection)` tells if it answers,
+    `reset(connection)` makes it ready for the next user and tells if it
+    can be reused.
+    """
+
+    def __init__(self, ping, reset, max_size=10, timeout=30, max_age=600, health_check_idle=30):
+        self.ping = ping
+        self.reset = reset
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_age = max_age
+        self.health_check_idle = health_check_idle
+        # (connection, opened at, released at), the most recently released last
+        self.idle = collections.deque()
+        self.opened_at = {}
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def acquire(self, connect):
+        """A connection of the pool, or a new one from `connect()`. Waits `timeout` seconds for a free slot."""
+        if not self.slots.acquire(timeout=self.timeout):
+            self.stats['timeouts'] += 1
+            raise PoolTimeout(f'No database connection available after {self.timeout} seconds')
+        try:
+            now = time.monotonic()
+            while True:
+                with self.lock:
+                    if not self.idle:
+                        break
+                    connection, opened_at, released_at = self.idle.pop()
+                if self.max_age is not None and now - opened_at >= self.max_age:
+                    self.stats['expired'] += 1
+                    self._discard(connection)
+                elif now - released_at >= self.health_check_idle and not self.ping(connection):
+                    self.stats['unhealthy'] += 1
+                    self._discard(connection)
+                else:
+                    self.stats['reused'] += 1
+                    self.opened_at[id(connection)] = opened_at
+                    return connection
+            connection = connect()
+            self.stats['opened'] += 1
+            self.opened_at[id(connection)] = time.monotonic()
+            return connection
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, connection, reuse=True):
+        """Give a connection back; it is closed when it cannot be reused."""
+        opened_at = self.opened_at.pop(id(connection), None)
+        try:
+            reusable = reuse and opened_at is not None and self.reset(connection)
+        except Exception:
+            reusable = False
+        if reusable:
+            with self.lock:
+                self.idle.append((connection, opened_at, time.monotonic()))
+        else:
+            self._discard(connection)
+        if opened_at is not None:
+            self.slots.release()
+
+    def _discard(self, connection):
+        self.stats['closed'] += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, collections.deque()
+        for connection, _, _ in idle:
+            self._discard(connection)
+
+
+def get_reserved_connections():
+    """Connections the long lived threads of the process may hold at once: async view pool and local job workers."""
+    reserved = getattr(settings, 'ASYNC_DB_WORKERS', 8)
+    if getattr(settings, 'JOB_BACKEND', 'local') == 'local':
+        reserved += getattr(settings, 'JOB_LOCAL_WORKERS', 2)
+    return reserved
+
+
+def get_pool_size(options):
+    """MAX_SIZE of the POOL settings; by default the reserved connections plus REQUEST_CONNECTIONS."""
+    return options.get('MAX_SIZE') or get_reserved_connections() + options.get('REQUEST_CONNECTIONS', 10)
+
+
+def check_pool_sizes():
+    """
+    Refuse a pool no larger than the connections the long lived threads may
+    hold: the requests would wait TIMEOUT seconds for one, then fail.
+    """
+    reserved = get_reserved_connections()
+    for alias, settings_dict in settings.DATABASES.items():
+        options = settings_dict.get('POOL')
+        if options and get_pool_size(options) <= reserved:
+            raise ImproperlyConfigured(
+                f"DATABASES[{alias!r}]['POOL']['MAX_SIZE'] is {get_pool_size(options)}: it must be more than the "
+                f"{reserved} connections of the async view pool (ASYNC_DB_WORKERS) and the local job workers "
+                f"(JOB_LOCAL_WORKERS), or the requests wait for a connection"
+            )
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(key, create):
+    """The pool of `key` (a database), made by `create()` on first use."""
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = create()
+        return pool
+
+
+class PooledDatabaseWrapperMixin:
+    """
+    Database backend taking its connections from the process pool when the
+    database settings have a POOL dict (MAX_SIZE or REQUEST_CONNECTIONS,
+    TIMEOUT, MAX_AGE), and
+    connecting directly otherwise. The backend implements `ping_connection`,
+    `reset_connection` and `adopt_connection` (state Django reads when
+    connecting, for a connection of the pool).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.settings_dict.get('POOL'):
+            # A connection left open at the end of a request keeps its slot:
+            # Django releases it every time, the pool keeps it
+            self.settings_dict['CONN_MAX_AGE'] = 0
+        # Pool of the current connection, None when it is not pooled
+        self.pool = None
+
+    def get_pool(self):
+        options = self.settings_dict['POOL']
+
+        def create():
+            return ConnectionPool(
+                ping=self.ping_connection,
+                reset=self.reset_connection,
+                max_size=get_pool_size(options),
+                timeout=options.get('TIMEOUT', 30),
+                max_age=options.get('MAX_AGE', 600),
+                health_check_idle=get_health_check_idle(),
+            )
+        # One pool per server database: the test runner connects to the same
+        # alias with another NAME ("postgres", then the test database)
+        key = (self.alias, *(self.settings_dict.get(name) for name in ('HOST', 'PORT', 'NAME', 'USER')))
+        return get_pool(key, create)
+
+    def get_new_connection(self, conn_params):
+        if not self.settings_dict.get('POOL'):
+            self.pool = None
+            return super().get_new_connection(conn_params)
+        pool = self.get_pool()
+        try:
+            connection = pool.acquire(lambda: super(PooledDatabaseWrapperMixin, self).get_new_connection(conn_params))
+        except PoolTimeout as e:
+            raise self.Database.OperationalError(str(e)) from e
+        self.pool = pool
+        self.adopt_connection(connection)
+        return connection
+
+    def _close(self):
+        if self.connection is not None and self.pool is not None:
+            with self.wrap_database_errors:
+                # Closed inside an atomic block, Django keeps a reference to it until the block exits
+                self.pool.release(self.connection, reuse=not self.in_atomic_block)
+            return
+        super()._close()
@@ -0,0 +1,36 @@
+"""
+PostgreSQL backend with the in-process connection pool of
+src/connections.py, enabled by a POOL dict in the database settings.
+"""
+from django.db.backends.postgresql import base
+from psycopg2 import extensions
+
+from src.connections import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+
+    def ping_connection(self, connection):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            # Outside autocommit the ping opened a transaction
+            if connection.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+        except base.Database.Error:
+            return False
+        return True
+
+    def reset_connection(self, connection):
+        if connection.closed:
+            return False
+        transaction_status = connection.info.transaction_status
+        if transaction_status == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            connection.rollback()
+        return True
+
+    def adopt_connection(self, connection):
+        # What get_new_connection sets for a new connection
+        self.isolation_level = self.settings_dict['OPTIONS'].get('isolation_level', connection.isolation_level)
@@ -8,12 +8,21 @@ from django_filters import rest_framework as drf_filters
 import django_filters
 import graphene
 from graphene_django import DjangoObjectType
+from graphene_django.converter import convert_django_field
 from graphql import GraphQLError
 from polymorphic.models import PolymorphicModel
 from django.db import transaction
 from django.contrib.contenttypes.models import ContentType
 from graphene_file_upload.scalars import Upload
 
+from .serializers import ModelSerializer
+
+
+@convert_django_field.register(models.BinaryField)
+def convert_binary_field(field, registry=None):
+    # graphene-django has no converter for binary columns: expose them as base64
+    return graphene.Base64(description=getattr(field, 'help_text', None), required=not field.null)
+
 class StandardResultsSetPagination(PageNumberPagination):
     page_size = 10
     page_size_query_param = 'page_size'
@@ -57,7 +66,7 @@ def generate_dynamic_serializer(model_class: Type[models.Model], expand_fields=N
     # Create the serializer class
     return type(
         f'{model_class.__name__}Serializer',
-        (serializers.ModelSerializer,),
+        (ModelSerializer,),
         {
             'Meta': type('Meta', (), meta_attrs),
             **properties,
@@ -0,0 +1,295 @@
+"""
+Per-request instrumentation.
+
+`RequestMetricsMiddleware` measures, for every request:
+
+- the number of SQL queries and the time spent in the database,
+- the serialization time (the serializers deriving from the bases of
+  src/serializers.py and the rendering of the response), with the queries run meanwhile: N+1
+  patterns in serializer methods show up as queries during serialization,
+- the total latency.
+
+Requests are tagged by view: "PositionViewSet.list", "StructureViewSet.tree",
+"graphql:<operation name>"... The measures are sent back in a Server-Timing
+header (shown by the browser dev tools) and aggregated per tag in the
+process, read from GET /api/metrics/ along with the PDF rendering metrics.
+
+Views can declare query budgets, per action or for all ("*"):
+
+    class PositionViewSet(...):
+        query_budgets = {'list': 10, 'retrieve': 8}
+
+A request running more queries than its budget is logged as a warning and
+counted in the metrics. QUERY_BUDGET_DEFAULT applies to the views without
+a budget (None: no default).
+"""
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+
+from .pdf_service import get_render_metrics
+
+logger = logging.getLogger(__name__)
+
+# Latencies kept per tag for the percentiles
+LATENCY_SAMPLES = 500
+
+_current = ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    __slots__ = (
+        'tag', 'budget', 'start', 'queries', 'db_seconds', 'serialization_seconds', 'serialization_queries',
+        'serialization_depth',
+    )
+
+    def __init__(self):
+        self.tag = None
+        self.budget = None
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serialization_seconds = 0.0
+        self.serialization_queries = 0
+        self.serialization_depth = 0
+
+
+def get_request_metrics():
+    """Measures of the current request, None outside of a request."""
+    return _current.get()
+
+
+def _count_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.db_seconds += time.perf_counter() - start
+        metrics.queries += 1
+        if metrics.serialization_depth:
+            metrics.serialization_queries += 1
+
+
+def count_queries():
+    """
+    Context manager counting the queries of this thread's connections in the
+    current request. The middleware covers the request thread; code running
+    the request's work in other threads enters it there (src/async_views.py).
+    """
+    stack = ExitStack()
+    if _current.get() is not None:
+        for connection in connections.all():
+            # Counted once when nested (a request served inside measure_queries)
+            if _count_query not in connection.execute_wrappers:
+                stack.enter_context(connection.execute_wrapper(_count_query))
+    return stack
+
+
+@contextmanager
+def measure_queries():
+    """
+    Context manager measuring the queries run inside, outside of a request
+    (benchmarks, commands): those of this thread, of the threads entering
+    `count_queries` for it (the async pool) and of the requests served
+    inside, e.g. by the test client. Yields the RequestMetrics.
+    """
+    metrics = RequestMetrics()
+    token = _current.set(metrics)
+    try:
+        with count_queries():
+            yield metrics
+    finally:
+        _current.reset(token)
+
+
+def _add_to_enclosing(enclosing, metrics):
+    enclosing.queries += metrics.queries
+    enclosing.db_seconds += metrics.db_seconds
+    enclosing.serialization_seconds += metrics.serialization_seconds
+    enclosing.serialization_queries += metrics.serialization_queries
+
+
+class measure_serialization:
+    """Context manager adding the time spent inside to the serialization time."""
+
+    def __enter__(self):
+        self.metrics = _current.get()
+        if self.metrics is not None:
+            self.metrics.serialization_depth += 1
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.metrics is not None:
+            self.metrics.serialization_depth -= 1
+            # Nested serializers are part of the outer one
+            if not self.metrics.serialization_depth:
+                self.metrics.serialization_seconds += time.perf_counter() - self.start
+
+
+# Aggregates
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def _record(metrics, total_seconds, status_code, over_budget):
+    with _stats_lock:
+        entry = _stats.setdefault(metrics.tag, {
+            "count": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0,
+            "queries": 0, "max_queries": 0, "db_seconds": 0.0,
+            "serialization_seconds": 0.0, "serialization_queries": 0,
+            "budget": metrics.budget, "budget_violations": 0,
+            "latencies": deque(maxlen=LATENCY_SAMPLES),
+        })
+        entry["count"] += 1
+        entry["errors"] += int(status_code >= 500)
+        entry["total_seconds"] += total_seconds
+        entry["max_seconds"] = max(entry["max_seconds"], total_seconds)
+        entry["queries"] += metrics.queries
+        entry["max_queries"] = max(entry["max_queries"], metrics.queries)
+        entry["db_seconds"] += metrics.db_seconds
+        entry["serialization_seconds"] += metrics.serialization_seconds
+        entry["serialization_queries"] += metrics.serialization_queries
+        entry["budget"] = metrics.budget
+        entry["budget_violations"] += int(over_budget)
+        entry["latencies"].append(total_seconds)
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else None
+
+
+def get_request_stats():
+    """
+    Aggregated measures of this process per tag: counts, averages, the max
+    and the p50/p95 latency of the last requests, budget violations.
+    """
+    with _stats_lock:
+        stats = {}
+        for tag, entry in _stats.items():
+            count = entry["count"] or 1
+            latencies = sorted(entry["latencies"])
+            stats[tag] = dict(
+                {key: value for key, value in entry.items() if key != "latencies"},
+                avg_seconds=entry["total_seconds"] / count,
+                avg_queries=entry["queries"] / count,
+                p50_seconds=_percentile(latencies, 0.5),
+                p95_seconds=_percentile(latencies, 0.95),
+            )
+        return stats
+
+
+def reset_request_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+# Tags and budgets
+
+def _graphql_operation(request):
+    name = request.GET.get('operationName')
+    if not name and request.content_type == 'application/json':
+        try:
+            body = json.loads(request.body or b'{}')
+        except ValueError:
+            body = {}
+        if isinstance(body, dict):
+            name = body.get('operationName')
+    return name or 'anonymous'
+
+
+def _view_tag(request, view_func):
+    view_class = getattr(view_func, 'cls', None) or getattr(view_func, 'view_class', None)
+    if view_class is not None and view_class.__name__ == 'GraphQLView':
+        return f'graphql:{_graphql_operation(request)}', None
+    if view_class is None:
+        return getattr(view_func, '__name__', 'view'), None
+    actions = getattr(view_func, 'actions', None) or {}
+    action = actions.get(request.method.lower(), request.method.lower())
+    budgets = getattr(view_class, 'query_budgets', None) or {}
+    return f'{view_class.__name__}.{action}', budgets.get(action, budgets.get('*'))
+
+
+def _server_timing(metrics, total_seconds):
+    return ', '.join([
+        f'db;dur={metrics.db_seconds * 1000:.1f};desc="{metrics.queries} queries"',
+        f'ser;dur={metrics.serialization_seconds * 1000:.1f};desc="{metrics.serialization_queries} queries"',
+        f'total;dur={total_seconds * 1000:.1f}',
+    ])
+
+
+class RequestMetricsMiddleware:
+    """See the module docstring. Place it first, so the whole request is timed."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.server_timing = getattr(settings, 'SERVER_TIMING_HEADER', True)
+        self.default_budget = getattr(settings, 'QUERY_BUDGET_DEFAULT', None)
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        enclosing = _current.get()
+        token = _current.set(metrics)
+        try:
+            with count_queries():
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+            if enclosing is not None:
+                _add_to_enclosing(enclosing, metrics)
+
+        total_seconds = time.perf_counter() - metrics.start
+        if metrics.tag is None:
+            # No view was resolved (404, static files...)
+            return response
+        budget = metrics.budget if metrics.budget is not None else self.default_budget
+        over_budget = budget is not None and metrics.queries > budget
+        if over_budget:
+            logger.warning(
+                'Query budget exceeded: %s ran %d queries (budget %d) for %s %s',
+                metrics.tag, metrics.queries, budget, request.method, request.get_full_path()
+            )
+        _record(metrics, total_seconds, response.status_code, over_budget)
+        if self.server_timing:
+            response['Server-Timing'] = _server_timing(metrics, total_seconds)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics = _current.get()
+        if metrics is not None:
+            metrics.tag, metrics.budget = _view_tag(request, view_func)
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered after the view: time it as serialization
+        metrics = _current.get()
+        if metrics is not None:
+            timer = measure_serialization().__enter__()
+            response.add_post_render_callback(lambda rendered: timer.__exit__(None, None, None))
+        return response
+
+
+@api_view(['GET', 'DELETE'])
+@permission_classes([IsAdminUser])
+def metrics_view(request):
+    """
+    GET: request measures per view and PDF rendering metrics of this process.
+    DELETE: reset the request measures.
+    """
+    if request.method == 'DELETE':
+        reset_request_stats()
+        return Response(status=204)
+    return Response({"requests": get_request_stats(), "pdf": get_render_metrics()})
@@ -1,19 +1,115 @@
-from rest_framework import status
+from rest_framework import status, serializers
 from rest_framework.response import Response
 from rest_framework.decorators import action
 from django.db import transaction
+from django.dispatch import Signal
+from django.utils import timezone
+
+from src.export import export_response, ExportError
+from src.utils import bulk_create_with_pks
+
+
+BULK_BATCH_SIZE = 500
+
+# Sent after a `bulk_create` / `bulk_update` of the mixins below with the
+# written `instances` and `created`, since these statements send no
+# post_save. The apps keeping state up to date on saves (rollups, change
+# log...) connect batched receivers to it.
+bulk_saved = Signal()
+
+
+def get_auto_now_fields(model):
+    """
+    Return the names of the `auto_now` fields of a model.
+    `bulk_update` does not call `pre_save`, so these have to be set by hand.
+    """
+    return [
+        field.name for field in model._meta.concrete_fields
+        if getattr(field, 'auto_now', False)
+    ]
+
+
+def get_bulk_update_fields(model, validated_items):
+    """
+    Compute the `update_fields` for a bulk update: the union of the concrete
+    fields present in the validated payloads, plus the `auto_now` fields.
+    """
+    concrete_fields = {
+        field.name: field for field in model._meta.concrete_fields
+        if not field.primary_key
+    }
+    update_fields = []
+    for attrs in validated_items:
+        for name in attrs:
+            if name in concrete_fields and name not in update_fields:
+                update_fields.append(name)
+    if update_fields:
+        for name in get_auto_now_fields(model):
+            if name not in update_fields:
+                update_fields.append(name)
+    return update_fields
+
+
+def has_many_to_many_data(model, validated_items):
+    """Check whether any validated payload writes a many-to-many relation."""
+    m2m_names = {field.name for field in model._meta.many_to_many}
+    return any(m2m_names.intersection(attrs) for attrs in validated_items)
+
+
+def get_missing_ids(ids, found_ids):
+    """Return the requested ids (in request order) that were not found."""
+    found = {str(pk) for pk in found_ids}
+    return [pk for pk in ids if str(pk) not in found]
+
+
+class BulkListSerializer(serializers.ListSerializer):
+    """
+    List serializer used for bulk updates.
+    Each item is validated against its own instance (matched by id), so unique
+    validators and partial updates behave as they do for a single update.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.instance_map = {str(obj.pk): obj for obj in (self.instance or [])}
+
+    def to_internal_value(self, data):
+        if not isinstance(data, list):
+            raise serializers.ValidationError(
+                {'non_field_errors': ['Expected a list of items.']}
+            )
+
+        ret = []
+        errors = []
+        for item in data:
+            self.child.instance = self.instance_map.get(str(item.get('id')))
+            self.child.initial_data = item
+            try:
+                validated = self.child.run_validation(item)
+            except serializers.ValidationError as exc:
+                errors.append(exc.detail)
+            else:
+                ret.append(validated)
+                errors.append({})
+        self.child.instance = None
+
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return ret
+
 
 class BulkCreateModelMixin:
     """
     Mixin to add bulk create functionality to ModelViewSets.
-    Supports creating multiple objects in a single request with a single database transaction.
-    
+    Items are validated with a list serializer and inserted with `bulk_create`,
+    in a single database transaction, then `bulk_saved` is sent.
+
     To use this mixin:
     1. Add it to your ViewSet inheritance chain
     2. Ensure your ViewSet has a valid serializer_class
-    
+
     Example usage in API:
-    POST /api/your-endpoint/bulk-create/
+    POST /api/your-endpoint/bulk_create/
     {
         "items": [
             { "field1": "value1", "field2": "value2" },
@@ -21,7 +117,7 @@ class BulkCreateModelMixin:
         ]
     }
     """
-    
+
     @action(detail=False, methods=['post'])
     def bulk_create(self, request, *args, **kwargs):
         """
@@ -29,44 +125,60 @@ class BulkCreateModelMixin:
         The request data should contain an 'items' key with a list of objects to create.
         """
         items = request.data.get('items', [])
-        
+
         if not items:
             return Response(
                 {'detail': 'No items provided for bulk creation.'},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        
+
+        serializer = self.get_serializer(data=items, many=True)
+        serializer.is_valid(raise_exception=True)
+
         # Use a transaction to ensure atomicity - either all succeed or none
         with transaction.atomic():
-            # Create a list serializer with many=True
-            serializer = self.get_serializer(data=items, many=True)
-            serializer.is_valid(raise_exception=True)
-            self.perform_bulk_create(serializer)
-            
+            created_count = self.perform_bulk_create(serializer)
+
         headers = self.get_success_headers(serializer.data)
         return Response(
             {
-                'detail': f'Successfully created {len(serializer.data)} items.',
+                'detail': f'Successfully created {created_count} items.',
+                'created_count': created_count,
                 'items': serializer.data
             },
             status=status.HTTP_201_CREATED,
             headers=headers
         )
-    
+
     def perform_bulk_create(self, serializer):
         """
-        Perform the bulk create operation.
+        Insert the validated items with `bulk_create`, send `bulk_saved` and
+        return the number of created rows. Falls back to `serializer.save()`
+        when many-to-many data is written, since `bulk_create` cannot set
+        those relations.
         Override this method if you need custom behavior during bulk creation.
         """
-        serializer.save()
-    
+        model = serializer.child.Meta.model
+        validated_items = serializer.validated_data
+
+        if has_many_to_many_data(model, validated_items):
+            serializer.save()
+            return len(serializer.instance)
+
+        objs = [model(**attrs) for attrs in validated_items]
+        # The response returns the ids, which plain bulk_create leaves unset on SQLite
+        created = bulk_create_with_pks(model, objs, batch_size=BULK_BATCH_SIZE)
+        serializer.instance = created
+        bulk_saved.send(sender=model, instances=created, created=True)
+        return len(created)
+
     def get_success_headers(self, data):
         """
         Return success headers for the creation response.
         """
         try:
             return {'Location': str(data[0].get('id', ''))}
-        except (TypeError, KeyError, IndexError):
+        except (TypeError, KeyError, IndexError, AttributeError):
             return {}
 
 
@@ -74,17 +186,18 @@ class BulkDeleteModelMixin:
     """
     Mixin to add bulk delete functionality to ModelViewSets.
     Supports deleting multiple objects in a single request with a single database transaction.
-    
+    Nothing is deleted when one of the ids is not found (404 with the `missing_ids`).
+
     To use this mixin:
     1. Add it to your ViewSet inheritance chain
-    
+
     Example usage in API:
-    POST /api/your-endpoint/bulk-delete/
+    POST /api/your-endpoint/bulk_delete/
     {
         "ids": [1, 2, 3, 4]
     }
     """
-    
+
     @action(detail=False, methods=['post'])
     def bulk_delete(self, request, *args, **kwargs):
         """
@@ -92,56 +205,57 @@ class BulkDeleteModelMixin:
         The request data should contain an 'ids' key with a list of object IDs to delete.
         """
         ids = request.data.get('ids', [])
-        
+
         if not ids:
             return Response(
                 {'detail': 'No IDs provided for bulk deletion.'},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        
+
         # Use a transaction to ensure atomicity - either all succeed or none
         with transaction.atomic():
-            queryset = self.filter_queryset(self.get_queryset())
-            # Filter objects by provided IDs
-            filtered_queryset = queryset.filter(id__in=ids)
-            
-            if filtered_queryset.count() == 0:
+            queryset = self.filter_queryset(self.get_queryset()).filter(id__in=ids)
+            missing_ids = get_missing_ids(ids, queryset.values_list('id', flat=True))
+            if missing_ids:
                 return Response(
-                    {'detail': 'No matching objects found for deletion.'},
+                    {'detail': 'Some objects were not found for deletion.', 'missing_ids': missing_ids},
                     status=status.HTTP_404_NOT_FOUND
                 )
-            
-            # Count before deletion to report number of deleted objects
-            deletion_count = filtered_queryset.count()
-            
-            # Perform deletion with pre_delete and post_delete signals
-            self.perform_bulk_delete(filtered_queryset)
-            
+            deletion_count = self.perform_bulk_delete(queryset)
+
         return Response(
-            {'detail': f'Successfully deleted {deletion_count} objects.'},
+            {
+                'detail': f'Successfully deleted {deletion_count} objects.',
+                'deleted_count': deletion_count
+            },
             status=status.HTTP_200_OK
         )
-    
+
     def perform_bulk_delete(self, queryset):
         """
-        Perform the bulk delete operation.
+        Perform the bulk delete operation and return the number of deleted rows
+        of the viewset's model (cascaded rows are not counted).
         Override this method if you need custom behavior during bulk deletion.
         """
         # This will trigger pre_delete and post_delete signals for each object
-        queryset.delete()
+        _, deleted_per_model = queryset.delete()
+        return deleted_per_model.get(queryset.model._meta.label, 0)
 
 
 class BulkUpdateModelMixin:
     """
     Mixin to add bulk update functionality to ModelViewSets.
-    Supports updating multiple objects in a single request with a single database transaction.
-    
+    Items are validated against their instances with a list serializer and
+    written with one `bulk_update` on the fields actually sent. Items without
+    any field to write are left untouched, the others are sent with `bulk_saved`.
+    Nothing is updated when one of the ids is not found (404 with the `missing_ids`).
+
     To use this mixin:
     1. Add it to your ViewSet inheritance chain
     2. Ensure your ViewSet has a valid serializer_class
-    
+
     Example usage in API:
-    POST /api/your-endpoint/bulk-update/
+    POST /api/your-endpoint/bulk_update/
     {
         "items": [
             {"id": 1, "field1": "new value1"},
@@ -149,7 +263,7 @@ class BulkUpdateModelMixin:
         ]
     }
     """
-    
+
     @action(detail=False, methods=['post'])
     def bulk_update(self, request, *args, **kwargs):
         """
@@ -158,53 +272,136 @@ class BulkUpdateModelMixin:
         Each object must include its ID and the fields to update.
         """
         items = request.data.get('items', [])
-        
+
         if not items:
             return Response(
                 {'detail': 'No items provided for bulk update.'},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        
+
+        if not all(isinstance(item, dict) and item.get('id') is not None for item in items):
+            return Response(
+                {'detail': 'All items must have an ID for bulk update.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
         # Use a transaction to ensure atomicity - either all succeed or none
         with transaction.atomic():
-            # Extract IDs from items
-            ids = [item.get('id') for item in items if 'id' in item]
-            
-            if not ids:
+            # Get the objects to update; ids outside the queryset are reported
+            queryset = self.filter_queryset(self.get_queryset())
+            ids = [item['id'] for item in items]
+            instances = list(queryset.filter(id__in=ids))
+            missing_ids = get_missing_ids(ids, [instance.id for instance in instances])
+            if missing_ids:
                 return Response(
-                    {'detail': 'All items must have an ID for bulk update.'},
-                    status=status.HTTP_400_BAD_REQUEST
+                    {'detail': 'Some objects were not found for update.', 'missing_ids': missing_ids},
+                    status=status.HTTP_404_NOT_FOUND
                 )
-            
-            # Get the objects to update
-            queryset = self.filter_queryset(self.get_queryset())
-            instances = queryset.filter(id__in=ids)
-            
-            # Create a mapping of id -> instance for quick access
             id_to_instance = {str(instance.id): instance for instance in instances}
-            
-            updated_instances = []
-            for item in items:
-                item_id = str(item.get('id'))
-                if item_id in id_to_instance:
-                    instance = id_to_instance[item_id]
-                    # Create serializer for this instance
-                    serializer = self.get_serializer(instance, data=item, partial=True)
-                    serializer.is_valid(raise_exception=True)
-                    self.perform_update(serializer)
-                    updated_instances.append(serializer.data)
-            
+
+            serializer = BulkListSerializer(
+                instance=[id_to_instance[str(item['id'])] for item in items],
+                child=self.get_serializer(partial=True),
+                data=items,
+                partial=True,
+                context=self.get_serializer_context(),
+            )
+            serializer.is_valid(raise_exception=True)
+            updated_count = self.perform_bulk_update(serializer)
+
         return Response(
             {
-                'detail': f'Successfully updated {len(updated_instances)} items.',
-                'items': updated_instances
+                'detail': f'Successfully updated {updated_count} items.',
+                'updated_count': updated_count,
+                'items': serializer.data
             },
             status=status.HTTP_200_OK
         )
-    
-    def perform_update(self, serializer):
+
+    def perform_bulk_update(self, serializer):
         """
-        Perform the update operation.
-        Override this method if you need custom behavior during update.
+        Apply the validated items to their instances, write them with a single
+        `bulk_update` and send `bulk_saved`. Returns the number of updated rows.
+        Falls back to updating the instances one by one through the serializer
+        when many-to-many data is written.
+        Override this method if you need custom behavior during bulk update.
         """
-        serializer.save()
+        model = serializer.child.Meta.model
+        # Items with only their id change nothing, and do not touch updated_at
+        changes = [
+            (instance, attrs) for instance, attrs in zip(serializer.instance, serializer.validated_data)
+            if attrs
+        ]
+        if not changes:
+            return 0
+        instances = [instance for instance, _ in changes]
+        validated_items = [attrs for _, attrs in changes]
+
+        if has_many_to_many_data(model, validated_items):
+            for instance, attrs in changes:
+                serializer.child.update(instance, attrs)
+            return len(changes)
+
+        update_fields = get_bulk_update_fields(model, validated_items)
+        if not update_fields:
+            return 0
+
+        now = timezone.now()
+        auto_now_fields = get_auto_now_fields(model)
+        for instance, attrs in zip(instances, validated_items):
+            for name, value in attrs.items():
+                if name in update_fields:
+                    setattr(instance, name, value)
+            for name in auto_now_fields:
+                setattr(instance, name, now)
+
+        updated_count = model.objects.bulk_update(
+            instances, update_fields, batch_size=BULK_BATCH_SIZE
+        )
+        bulk_saved.send(sender=model, instances=instances, created=False)
+        # Django < 4.0 does not return the number of matched rows
+        if updated_count is None:
+            updated_count = len(instances)
+        return updated_count
+
+
+class ExportModelMixin:
+    """
+    Mixin to add a streaming CSV / XLSX export of the filtered list to ModelViewSets.
+    The filter, search and ordering query parameters of the list apply.
+
+    To use this mixin:
+    1. Add it to your ViewSet inheritance chain
+    2. Set `export_columns` (and optionally `export_filename`)
+
+    Example usage in API:
+    GET /api/your-endpoint/export/?file_format=csv&columns=name,structure__name
+    POST /api/your-endpoint/export/?file_format=xlsx
+    {
+        "columns": [
+            { "header": "Structure", "schema": ["structure", "name"] }
+        ]
+    }
+    """
+    export_columns = None
+    export_filename = None
+
+    @action(detail=False, methods=['get', 'post'])
+    def export(self, request, *args, **kwargs):
+        """Stream the filtered list as a CSV or XLSX file."""
+        queryset = self.filter_queryset(self.get_queryset())
+
+        columns = request.data.get('columns') if request.method == 'POST' else None
+        if not columns and request.query_params.get('columns'):
+            columns = [column.strip() for column in request.query_params['columns'].split(',') if column.strip()]
+        columns = columns or self.export_columns
+
+        file_format = request.query_params.get('file_format') or (
+            request.data.get('file_format') if request.method == 'POST' else None
+        ) or 'xlsx'
+        filename = self.export_filename or queryset.model._meta.verbose_name_plural
+
+        try:
+            return export_response(queryset, columns, file_format, filename)
+        except ExportError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,329 @@
+"""
+PDF rendering service.
+
+Every HTML -> PDF conversion of the project goes through `render_pdf`
+(xhtml2pdf). Within a process the service keeps warm what does not change
+between two renderings:
+
+- compiled templates (`get_pdf_template`),
+- file resolution of `link_callback` (memoized),
+- the parsed stylesheets without side effects (xhtml2pdf's default CSS),
+- encoded image streams, so a logo drawn on every page of every document
+  is decoded and compressed once.
+
+The last two hook into xhtml2pdf and reportlab: they are only active once
+`install_render_caches` has been called (at startup, see
+organigramme.apps), which checks the library versions first. Both caches
+keep the most recently used entries only.
+
+Render timings are recorded per template (`get_render_metrics`).
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from io import BytesIO
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.template.loader import get_template
+import reportlab
+import xhtml2pdf
+from reportlab import rl_config
+from reportlab.pdfbase.pdfdoc import PDFImageXObject
+from xhtml2pdf import pisa
+from xhtml2pdf.context import pisaCSSParser
+
+logger = logging.getLogger(__name__)
+
+# Versions whose internals the stylesheet and image caches were written against
+SUPPORTED_XHTML2PDF_VERSIONS = ('0.2.',)
+SUPPORTED_REPORTLAB_VERSIONS = ('3.', '4.')
+
+CSS_CACHE_SIZE = getattr(settings, 'PDF_CSS_CACHE_SIZE', 32)
+IMAGE_CACHE_SIZE = getattr(settings, 'PDF_IMAGE_CACHE_SIZE', 128)
+
+
+class LRUCache:
+    """Thread-safe mapping keeping the `maxsize` most recently used entries."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Templates
+
+@lru_cache(maxsize=64)
+def _get_cached_template(template_name):
+    return get_template(template_name)
+
+
+def get_pdf_template(template_name):
+    """Compiled template, cached per process unless DEBUG is on."""
+    if settings.DEBUG:
+        return get_template(template_name)
+    return _get_cached_template(template_name)
+
+
+# Files
+
+def _resolve_static(path):
+    found = finders.find(path)
+    if found:
+        return found
+    return os.path.join(settings.STATIC_ROOT, path)
+
+
+@lru_cache(maxsize=1024)
+def link_callback(uri, rel):
+    """
+    Convert HTML links to absolute paths for xhtml2pdf.
+    Results are memoized: templates reference the same few files.
+    """
+    # Handle static files
+    if uri.startswith(settings.STATIC_URL):
+        return _resolve_static(uri[len(settings.STATIC_URL):])
+
+    # Handle absolute paths
+    if uri.startswith('/'):
+        return os.path.join(settings.MEDIA_ROOT, uri.replace('/', '', 1))
+
+    # Handle relative paths
+    if uri.startswith('media/'):
+        return os.path.join(settings.MEDIA_ROOT, uri.replace('media/', '', 1))
+
+    # Handle file:// paths with both forward and backward slashes
+    if uri.startswith('file://'):
+        # Remove the 'file://' or 'file:///' prefix and normalize slashes
+        path = uri.replace('file://', '')
+        if path.startswith('/'):
+            path = path[1:]
+
+        # Normalize path separators (important for Windows paths)
+        path = os.path.normpath(path)
+
+        if os.path.exists(path):
+            return path
+        logger.warning("File not found at normalized path: %s", path)
+
+    # Default case - return the URI as is
+    return uri
+
+
+# Stylesheets
+
+# At-rules that register page templates, frames or fonts on the rendering
+# context: a stylesheet using them must be parsed again for each document.
+_CONTEXT_AT_RULES = ('@page', '@frame', '@font-face', '@import')
+
+_css_cache = LRUCache(CSS_CACHE_SIZE)
+_original_css_parse = pisaCSSParser.parse
+
+
+def _parse_css(parser, src):
+    if any(rule in src for rule in _CONTEXT_AT_RULES):
+        return _original_css_parse(parser, src)
+    key = hashlib.sha1(src.encode('utf-8')).digest()
+    stylesheet = _css_cache.get(key)
+    if stylesheet is None:
+        stylesheet = _original_css_parse(parser, src)
+        _css_cache.set(key, stylesheet)
+    return stylesheet
+
+
+# Images
+
+_image_cache = LRUCache(IMAGE_CACHE_SIZE)
+_original_load_image = PDFImageXObject.loadImageFromSRC
+
+
+def _image_cache_key(image):
+    """Key of an image by content (None when it cannot be identified)."""
+    source = getattr(image, 'fileName', None)
+    if isinstance(source, BytesIO):
+        data = source.getvalue()
+    elif isinstance(source, str) and os.path.isfile(source):
+        return source, os.path.getmtime(source), rl_config.useA85
+    else:
+        # Images built in memory, e.g. the alpha mask of a PNG
+        data = getattr(image, '_data', None)
+    if isinstance(data, bytes):
+        return hashlib.sha1(data).digest(), getattr(image, 'mode', None), rl_config.useA85
+    return None
+
+
+def _load_image(xobject, image):
+    image_key = _image_cache_key(image)
+    if image_key is None:
+        return _original_load_image(xobject, image)
+    # The transparency handling depends on the requested mask
+    key = image_key + (repr(getattr(xobject, 'mask', None)),)
+    loaded = _image_cache.get(key)
+    if loaded is None:
+        before = dict(xobject.__dict__)
+        _original_load_image(xobject, image)
+        # The soft mask (alpha channel) is an object registered in the document
+        # it is drawn in: not shared, but built again from the decoded alpha
+        # channel (its own stream is cached)
+        alpha = image._dataA if hasattr(xobject, '_smask') else None
+        _image_cache.set(key, ({
+            name: value for name, value in xobject.__dict__.items()
+            if name != '_smask' and (name not in before or before[name] is not value)
+        }, alpha))
+    else:
+        attributes, alpha = loaded
+        if alpha is not None:
+            image._dataA = alpha
+            xobject._checkTransparency(image)
+        xobject.__dict__.update(attributes)
+
+
+# Installation
+
+_install_lock = threading.Lock()
+_installed = False
+_original_use_a85 = rl_config.useA85
+
+
+def _is_supported(version, prefixes):
+    return any(str(version).startswith(prefix) for prefix in prefixes)
+
+
+def install_render_caches():
+    """
+    Route xhtml2pdf's stylesheet parsing and reportlab's image loading
+    through the caches above, and write the image streams without ASCII85
+    encoding (smaller documents, and the encoding was a large part of the
+    rendering time). Does nothing, with a warning, for library versions the
+    caches were not written against. Returns whether the caches are active.
+    """
+    global _installed
+    with _install_lock:
+        if _installed:
+            return True
+        if not (_is_supported(xhtml2pdf.__version__, SUPPORTED_XHTML2PDF_VERSIONS)
+                and _is_supported(reportlab.Version, SUPPORTED_REPORTLAB_VERSIONS)):
+            logger.warning(
+                "PDF render caches disabled: unsupported xhtml2pdf %s / reportlab %s",
+                xhtml2pdf.__version__, reportlab.Version
+            )
+            return False
+        pisaCSSParser.parse = _parse_css
+        PDFImageXObject.loadImageFromSRC = _load_image
+        rl_config.useA85 = 0
+        _installed = True
+        return True
+
+
+def uninstall_render_caches():
+    """Restore the original xhtml2pdf and reportlab behaviour."""
+    global _installed
+    with _install_lock:
+        pisaCSSParser.parse = _original_css_parse
+        PDFImageXObject.loadImageFromSRC = _original_load_image
+        rl_config.useA85 = _original_use_a85
+        _installed = False
+    _css_cache.clear()
+    _image_cache.clear()
+
+
+# Rendering
+
+_metrics_lock = threading.Lock()
+_metrics = {}
+
+
+def _record(template_name, template_seconds, pdf_seconds, size, error):
+    with _metrics_lock:
+        entry = _metrics.setdefault(template_name, {
+            "count": 0, "errors": 0, "template_seconds": 0.0, "pdf_seconds": 0.0,
+            "max_seconds": 0.0, "bytes": 0,
+        })
+        entry["count"] += 1
+        entry["errors"] += int(error)
+        entry["template_seconds"] += template_seconds
+        entry["pdf_seconds"] += pdf_seconds
+        entry["max_seconds"] = max(entry["max_seconds"], template_seconds + pdf_seconds)
+        entry["bytes"] += size
+
+
+def get_render_metrics():
+    """
+    Render timings of this process, per template: count, errors, total and
+    average template / PDF time in seconds, slowest rendering and output size.
+    """
+    with _metrics_lock:
+        metrics = {}
+        for template_name, entry in _metrics.items():
+            count = entry["count"] or 1
+            metrics[template_name] = dict(
+                entry,
+                avg_seconds=(entry["template_seconds"] + entry["pdf_seconds"]) / count,
+            )
+        return metrics
+
+
+def reset_render_metrics():
+    with _metrics_lock:
+        _metrics.clear()
+
+
+def render_pdf(template_name, context=None):
+    """
+    Render `template_name` with `context` to PDF bytes.
+    Returns None when xhtml2pdf reports an error.
+    """
+    started = time.perf_counter()
+    html = get_pdf_template(template_name).render(context or {})
+    rendered = time.perf_counter()
+
+    result = BytesIO()
+    # Ensure HTML content is UTF-8 encoded
+    pdf = pisa.pisaDocument(
+        BytesIO(html.encode('UTF-8')), result,
+        encoding='UTF-8', pdf_language='ar', link_callback=link_callback
+    )
+    finished = time.perf_counter()
+
+    content = None if pdf.err else result.getvalue()
+    _record(template_name, rendered - started, finished - rendered, len(content or b''), pdf.err)
+    return content
+
+
+def clear_render_caches():
+    """Drop every per-process cache (templates, files, stylesheets, images)."""
+    _get_cached_template.cache_clear()
+    link_callback.cache_clear()
+    _css_cache.clear()
+    _image_cache.clear()
@@ -0,0 +1,371 @@
+"""
+Request profiling, opt-in (PROFILING_ENABLED).
+
+`RequestProfilingMiddleware` profiles requests in two ways:
+
+- on demand: a staff user sends the PROFILING_HEADER header ("X-Profile: 1")
+  and the request runs under cProfile. The profile is a pstats dump, read
+  with `python -m pstats` or snakeviz once gunzipped;
+- automatically: with PROFILING_THRESHOLD_SECONDS set, every request is
+  watched by a sampling thread taking its stack each
+  PROFILING_SAMPLE_INTERVAL seconds. Requests slower than the threshold
+  keep their samples, stored as folded stacks ("a;b;c 12" per line) that
+  flamegraph.pl and speedscope open. The overhead is one stack walk per
+  interval, none of cProfile's per-call cost.
+
+Profiles are stored gzipped in PROFILING_DIR with a JSON description (path,
+view, duration, queries), and only the last PROFILING_MAX_PROFILES are kept.
+They are listed in the admin at /admin/profiles/.
+"""
+import cProfile
+import gzip
+import json
+import logging
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from io import StringIO
+
+from django.conf import settings
+from django.contrib import admin
+from django.http import FileResponse, Http404
+from django.template.response import TemplateResponse
+from django.utils import timezone
+
+from .instrumentation import get_request_metrics
+
+logger = logging.getLogger(__name__)
+
+# Frames kept per sampled stack, from the innermost
+MAX_STACK_DEPTH = 200
+# Rows of the summaries shown in the admin
+SUMMARY_ROWS = 40
+
+PROFILE_KINDS = {'cprofile': '.prof.gz', 'sampling': '.folded.gz'}
+
+
+def get_profiling_dir():
+    return getattr(settings, 'PROFILING_DIR', os.path.join(settings.BASE_DIR, 'profiles'))
+
+
+# Sampling
+
+def _frame_label(frame):
+    code = frame.f_code
+    # "organigramme/views.py": the file name alone is ambiguous (views.py, utils.py...)
+    filename = '/'.join(code.co_filename.replace(os.sep, '/').rsplit('/', 2)[-2:])
+    return f'{code.co_name} ({filename}:{code.co_firstlineno})'
+
+
+def _folded_stack(frame):
+    labels = []
+    while frame is not None and len(labels) < MAX_STACK_DEPTH:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class StackSampler:
+    """
+    Background thread taking the stack of the watched threads at a fixed
+    interval. Started on the first `watch`, asleep while nothing is watched.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._condition = threading.Condition()
+        self._watched = {}
+        self._thread = None
+
+    def watch(self, thread_id, samples=None):
+        """Start sampling a thread, into `samples` (a Counter) if given."""
+        samples = Counter() if samples is None else samples
+        with self._condition:
+            self._watched[thread_id] = samples
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='request-sampler', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return samples
+
+    def unwatch(self, thread_id):
+        with self._condition:
+            self._watched.pop(thread_id, None)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._watched:
+                    self._condition.wait()
+            time.sleep(self.interval)
+            with self._condition:
+                watched = list(self._watched.items())
+            frames = sys._current_frames()
+            for thread_id, samples in watched:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    samples[_folded_stack(frame)] += 1
+
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+
+def get_sampler():
+    global _sampler
+    with _sampler_lock:
+        if _sampler is None:
+            _sampler = StackSampler(getattr(settings, 'PROFILING_SAMPLE_INTERVAL', 0.005))
+        return _sampler
+
+
+# Storage
+
+def _profile_path(profile_id, kind):
+    return os.path.join(get_profiling_dir(), profile_id + PROFILE_KINDS[kind])
+
+
+def save_profile(kind, data, info):
+    """Store a profile (bytes) and its description; drop the oldest beyond the cap."""
+    directory = get_profiling_dir()
+    os.makedirs(directory, exist_ok=True)
+    profile_id = f"{timezone.now():%Y%m%d-%H%M%S-%f}-{uuid.uuid4().hex[:6]}"
+    with gzip.open(_profile_path(profile_id, kind), 'wb') as file:
+        file.write(data)
+    info = dict(info, id=profile_id, kind=kind, created_at=timezone.now().isoformat())
+    with open(os.path.join(directory, profile_id + '.json'), 'w') as file:
+        json.dump(info, file)
+    prune_profiles()
+    return profile_id
+
+
+def list_profiles():
+    """Descriptions of the stored profiles, newest first."""
+    directory = get_profiling_dir()
+    try:
+        names = sorted((name for name in os.listdir(directory) if name.endswith('.json')), reverse=True)
+    except FileNotFoundError:
+        return []
+    profiles = []
+    for name in names:
+        try:
+            with open(os.path.join(directory, name)) as file:
+                info = json.load(file)
+            info['size'] = os.path.getsize(_profile_path(info['id'], info['kind']))
+        except (OSError, ValueError, KeyError):
+            continue
+        profiles.append(info)
+    return profiles
+
+
+def get_profile(profile_id):
+    """(description, path of the gzipped profile), or None."""
+    for info in list_profiles():
+        if info['id'] == profile_id:
+            return info, _profile_path(profile_id, info['kind'])
+    return None
+
+
+def prune_profiles():
+    directory = get_profiling_dir()
+    for info in list_profiles()[getattr(settings, 'PROFILING_MAX_PROFILES', 200):]:
+        for path in (_profile_path(info['id'], info['kind']), os.path.join(directory, info['id'] + '.json')):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class _LoadedStats:
+    """A stored cProfile dump, in the shape pstats.Stats reads from a profiler."""
+
+    def __init__(self, data):
+        self.stats = marshal.loads(data)
+
+    def create_stats(self):
+        pass
+
+
+def summarize_profile(info, path):
+    """Text summary of a stored profile: the top functions, or the hottest stacks."""
+    with gzip.open(path, 'rb') as file:
+        data = file.read()
+    if info['kind'] == 'cprofile':
+        output = StringIO()
+        pstats.Stats(_LoadedStats(data), stream=output).sort_stats('cumulative').print_stats(SUMMARY_ROWS)
+        return output.getvalue()
+
+    stacks = Counter()
+    for line in data.decode('utf-8').splitlines():
+        stack, _, count = line.rpartition(' ')
+        stacks[stack] = int(count)
+    total = sum(stacks.values()) or 1
+    # Time per function, including its callees (each function counted once per sample)
+    functions = Counter()
+    for stack, count in stacks.items():
+        for label in set(stack.split(';')):
+            functions[label] += count
+    lines = [f'{total} samples', '', 'Inclusive time per function:']
+    lines.extend(f'{count * 100 / total:6.1f}%  {label}' for label, count in functions.most_common(SUMMARY_ROWS))
+    lines.extend(['', 'Innermost frames:'])
+    leaves = Counter()
+    for stack, count in stacks.items():
+        leaves[stack.rsplit(';', 1)[-1]] += count
+    lines.extend(f'{count * 100 / total:6.1f}%  {label}' for label, count in leaves.most_common(SUMMARY_ROWS))
+    return '\n'.join(lines)
+
+
+# Profiling session of the current request: ('cprofile', [profilers]) or ('sampling', samples)
+_session = ContextVar('request_profiling', default=None)
+
+
+@contextmanager
+def profile_current_thread():
+    """
+    Profile what runs inside in the current request's profile, for the work
+    a request hands to another thread (src/async_views.py).
+    """
+    session = _session.get()
+    if session is None:
+        yield
+        return
+    kind, target = session
+    if kind == 'sampling':
+        sampler = get_sampler()
+        thread_id = threading.get_ident()
+        sampler.watch(thread_id, target)
+        try:
+            yield
+        finally:
+            sampler.unwatch(thread_id)
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            target.append(profiler)
+
+
+# Middleware
+
+def _header_name():
+    return 'HTTP_' + getattr(settings, 'PROFILING_HEADER', 'X-Profile').upper().replace('-', '_')
+
+
+class RequestProfilingMiddleware:
+    """See the module docstring. Place it after AuthenticationMiddleware."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = getattr(settings, 'PROFILING_ENABLED', False)
+        self.threshold = getattr(settings, 'PROFILING_THRESHOLD_SECONDS', None)
+        self.header = _header_name()
+
+    def __call__(self, request):
+        if not self.enabled:
+            return self.get_response(request)
+        if request.META.get(self.header) and getattr(request, 'user', None) is not None and request.user.is_staff:
+            return self.profile(request)
+        if self.threshold is not None:
+            return self.sample(request)
+        return self.get_response(request)
+
+    def profile(self, request):
+        profilers = [cProfile.Profile()]
+        token = _session.set(('cprofile', profilers))
+        start = time.perf_counter()
+        profilers[0].enable()
+        try:
+            response = self.get_response(request)
+        finally:
+            profilers[0].disable()
+            _session.reset(token)
+        duration = time.perf_counter() - start
+        self.store('cprofile', _dump_stats(profilers), request, response, duration, 'header')
+        return response
+
+    def sample(self, request):
+        sampler = get_sampler()
+        thread_id = threading.get_ident()
+        samples = sampler.watch(thread_id)
+        token = _session.set(('sampling', samples))
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            sampler.unwatch(thread_id)
+            _session.reset(token)
+        duration = time.perf_counter() - start
+        if duration >= self.threshold and samples:
+            folded = ''.join(f'{stack} {count}\n' for stack, count in samples.items())
+            self.store('sampling', folded.encode('utf-8'), request, response, duration, 'threshold')
+        return response
+
+    def store(self, kind, data, request, response, duration, trigger):
+        metrics = get_request_metrics()
+        user = getattr(request, 'user', None)
+        info = {
+            "method": request.method,
+            "path": request.get_full_path()[:500],
+            "view": metrics.tag if metrics is not None else None,
+            "queries": metrics.queries if metrics is not None else None,
+            "status": response.status_code,
+            "duration_ms": round(duration * 1000, 1),
+            "trigger": trigger,
+            "user": user.get_username() if user is not None and user.is_authenticated else None,
+        }
+        try:
+            profile_id = save_profile(kind, data, info)
+        except OSError:
+            logger.exception('Could not store the profile of %s %s', request.method, request.path)
+            return
+        response['X-Profile-Id'] = profile_id
+
+
+def _dump_stats(profilers):
+    # Profile.dump_stats only writes to files: marshal the stats the same way
+    stats = pstats.Stats(profilers[0])
+    for profiler in profilers[1:]:
+        stats.add(profiler)
+    return marshal.dumps(stats.stats)
+
+
+# Admin
+
+def profiles_view(request):
+    """Stored profiles, newest first."""
+    context = dict(
+        admin.site.each_context(request),
+        title='Profils des requêtes',
+        profiles=list_profiles(),
+        enabled=getattr(settings, 'PROFILING_ENABLED', False),
+        threshold=getattr(settings, 'PROFILING_THRESHOLD_SECONDS', None),
+        header=getattr(settings, 'PROFILING_HEADER', 'X-Profile'),
+    )
+    return TemplateResponse(request, 'admin/request_profiles.html', context)
+
+
+def profile_view(request, profile_id):
+    """Summary of a profile; ?download=1 returns the gzipped file."""
+    found = get_profile(profile_id)
+    if found is None:
+        raise Http404('Profile not found')
+    info, path = found
+    if request.GET.get('download'):
+        return FileResponse(open(path, 'rb'), as_attachment=True, filename=os.path.basename(path))
+    context = dict(
+        admin.site.each_context(request),
+        title=f"Profil {info['method']} {info['path']}",
+        profile=info,
+        summary=summarize_profile(info, path),
+    )
+    return TemplateResponse(request, 'admin/request_profile.html', context)
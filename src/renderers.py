@@ -0,0 +1,100 @@
+"""
+Columnar renderers.
+
+Lists of objects are sent column by column instead of row by row: a list
+of n dicts becomes {"count": n, "columns": {key: [n values]}}, nested dicts
+being flattened into dotted keys ("grade.name"). Keys are written once per
+list instead of once per row, which makes large payloads several times
+smaller and faster to parse.
+
+Two encodings are negotiated with the Accept header (or ?format=):
+
+- application/vnd.columnar+json   (format "columnar")
+- application/msgpack             (format "msgpack", needs the msgpack package)
+
+Views with a better columnar shape for their payload (e.g. rows referring
+to each other by index) subclass the renderers and override `to_columnar`.
+"""
+from rest_framework.renderers import JSONRenderer
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import msgpack
+except ImportError:  # Optional: the msgpack renderer is then not offered
+    msgpack = None
+
+
+def flatten_record(record, prefix=''):
+    """{"a": {"b": 1}} -> {"a.b": 1}; lists of dicts become columnar."""
+    flat = {}
+    for key, value in record.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            flat.update(flatten_record(value, f'{name}.'))
+        else:
+            flat[name] = to_columnar(value) if isinstance(value, list) else value
+    return flat
+
+
+def records_to_columns(records):
+    """Turn a list of dicts into {"count", "columns"}; missing keys are None."""
+    rows = [flatten_record(record) for record in records]
+    names = {}
+    for row in rows:
+        for name in row:
+            names.setdefault(name, None)
+    return {
+        "count": len(rows),
+        "columns": {name: [row.get(name) for row in rows] for name in names},
+    }
+
+
+def is_records(value):
+    return isinstance(value, list) and bool(value) and all(isinstance(item, dict) for item in value)
+
+
+def to_columnar(data):
+    """Convert every list of dicts found in `data` to columns."""
+    if is_records(data):
+        return records_to_columns(data)
+    if isinstance(data, dict):
+        return {key: to_columnar(value) for key, value in data.items()}
+    return data
+
+
+class ColumnarJSONRenderer(JSONRenderer):
+    media_type = 'application/vnd.columnar+json'
+    format = 'columnar'
+
+    def to_columnar(self, data):
+        return to_columnar(data)
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return super().render(self.to_columnar(data), accepted_media_type, renderer_context)
+
+
+class ColumnarMessagePackRenderer(ColumnarJSONRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        # Dates, decimals, UUIDs... are encoded as in JSON
+        return msgpack.packb(self.to_columnar(data), default=JSONEncoder().default, use_bin_type=True)
+
+
+def columnar_renderer_classes(json_renderer=ColumnarJSONRenderer, msgpack_renderer=ColumnarMessagePackRenderer):
+    """
+    The default renderers followed by the columnar ones (msgpack only when
+    installed), for the `renderer_classes` of a view or action.
+    """
+    renderers = list(api_settings.DEFAULT_RENDERER_CLASSES) + [json_renderer]
+    if msgpack is not None:
+        renderers.append(msgpack_renderer)
+    return renderers
@@ -0,0 +1,24 @@
+"""
+Base serializers of the API.
+
+The model serializers derive from these instead of the rest_framework and
+rest_flex_fields ones, so that their `to_representation` is timed as
+serialization by the request metrics (src/instrumentation.py), with the
+queries it runs: method fields and nested serializers. The rendering is
+timed by the middleware.
+"""
+from rest_flex_fields.serializers import FlexFieldsSerializerMixin
+from rest_framework import serializers
+
+from .instrumentation import measure_serialization
+
+
+class ModelSerializer(serializers.ModelSerializer):
+
+    def to_representation(self, instance):
+        with measure_serialization():
+            return super().to_representation(instance)
+
+
+class FlexFieldsModelSerializer(FlexFieldsSerializerMixin, ModelSerializer):
+    pass
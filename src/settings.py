@@ -69,6 +69,10 @@ GRAPHENE = {
 
 
 MIDDLEWARE = [
+    # First, to time the whole request (see src/instrumentation.py)
+    'src.instrumentation.RequestMetricsMiddleware',
+    # Before any query, to drop dead persistent connections (see src/connections.py)
+    'src.connections.ConnectionHealthMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -77,6 +81,8 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # After the authentication, to know the staff users (see src/profiling.py)
+    'src.profiling.RequestProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'auditlog.middleware.AuditlogMiddleware',
@@ -120,18 +126,46 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'src.wsgi.application'
 
+# Connection reuse (src/connections.py). SQL_POOL:
+# - '' (default): persistent connections, kept SQL_CONN_MAX_AGE seconds by
+#   each thread; for WSGI workers;
+# - 'process': in-process pool of SQL_POOL_SIZE connections per process,
+#   for ASGI (docker-compose), where each request runs in a new thread;
+# - 'pgbouncer': SQL_HOST/SQL_PORT point to a PgBouncer in transaction
+#   mode; connections are opened per request and server side cursors,
+#   which do not survive transaction pooling, are disabled.
+SQL_POOL = os.environ.get('SQL_POOL', '')
+
 DATABASES = {
      'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        'ENGINE': 'src.db_backends.postgresql' if SQL_POOL == 'process' else 'django.db.backends.postgresql',
         #'NAME': 'organigramme',
-        'NAME': 'org',
-        'HOST': 'localhost',
-        'PORT': 5432,
-        'USER': 'rouini',
-        'PASSWORD': '1813830',
-         
+        'NAME': os.environ.get('SQL_DATABASE', 'org'),
+        'HOST': os.environ.get('SQL_HOST', 'localhost'),
+        'PORT': int(os.environ.get('SQL_PORT', 5432)),
+        'USER': os.environ.get('SQL_USER', 'rouini'),
+        'PASSWORD': os.environ.get('SQL_PASSWORD', '1813830'),
+        'CONN_MAX_AGE': 0 if SQL_POOL else int(os.environ.get('SQL_CONN_MAX_AGE', 60)),
+        # Idle persistent connections are checked before reuse. Read by
+        # src/connections.py, ignored by Django 3.2 (Django 4.1+ reads it too)
+        'CONN_HEALTH_CHECKS': True,
+        'DISABLE_SERVER_SIDE_CURSORS': SQL_POOL == 'pgbouncer',
+        # In-process pool of src.db_backends.postgresql, not a Django setting
+        'POOL': {
+            # Default: ASYNC_DB_WORKERS + JOB_LOCAL_WORKERS + REQUEST_CONNECTIONS.
+            # Must be more than the first two (checked at startup)
+            'MAX_SIZE': int(os.environ.get('SQL_POOL_SIZE', 0)) or None,
+            # Connections left to the request threads by the default size
+            'REQUEST_CONNECTIONS': 10,
+            # Seconds a request waits for a free connection
+            'TIMEOUT': 30,
+            # Seconds before a pooled connection is replaced
+            'MAX_AGE': 600,
+        } if SQL_POOL == 'process' else None,
     }
 }
+# Persistent or pooled connections idle for longer are checked ("SELECT 1") before reuse
+CONN_HEALTH_CHECK_IDLE_SECONDS = 30
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -191,6 +225,14 @@ CACHES = {
         }
     }
 }
+# CACHE_BACKEND=database: a cache shared by all the processes, in the
+# django_cache table (`manage.py createcachetable`, run by entrypoint.sh).
+# Needed by JOB_BACKEND 'database' below.
+if os.environ.get('CACHE_BACKEND') == 'database':
+    CACHES['default'].update(
+        BACKEND='django.core.cache.backends.db.DatabaseCache',
+        LOCATION='django_cache',
+    )
 
 LANGUAGE_CODE = 'fr'
 
@@ -234,6 +276,7 @@ CORS_ALLOW_HEADERS = [
     "user-agent",
     "x-csrftoken",
     "x-requested-with",
+    "x-profile",
 ]
 
 # CSRF settings
@@ -264,4 +307,52 @@ MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'mediafiles')
 
 # Whitenoise settings
-STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
\ No newline at end of file
+STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
+# Fiche de poste PDFs: rendered documents are kept in the default storage
+# under PDF_CACHE_DIR and cache misses are rendered by a background job,
+# in a process pool.
+PDF_CACHE_DIR = 'pdf_cache'
+PDF_RENDER_WORKERS = 2
+# Parsed stylesheets and encoded images kept per rendering process (src.pdf_service)
+PDF_CSS_CACHE_SIZE = 32
+PDF_IMAGE_CACHE_SIZE = 128
+# Dashboard snapshots are invalidated on every write; this only bounds
+# how long an unused snapshot stays in the cache.
+DASHBOARD_CACHE_TIMEOUT = 300
+# Subtree extents of the diagrams (collapsed views), recomputed after writes
+DIAGRAM_EXTENTS_CACHE_TIMEOUT = 3600
+# Change log of the incremental sync: entries older than this are pruned
+# by `manage.py prune_changelog` (see organigramme.changelog)
+CHANGELOG_RETENTION_DAYS = 30
+# Request instrumentation (src/instrumentation.py): Server-Timing response
+# header, and query budget of the views that declare none (None: no budget)
+SERVER_TIMING_HEADER = True
+QUERY_BUDGET_DEFAULT = None
+# Request profiling (src/profiling.py), listed at /admin/profiles/: cProfile
+# for staff requests sent with the header, sampling of the requests slower
+# than the threshold (None: off). Only the last PROFILING_MAX_PROFILES are kept.
+PROFILING_ENABLED = False
+PROFILING_HEADER = 'X-Profile'
+PROFILING_THRESHOLD_SECONDS = None
+PROFILING_SAMPLE_INTERVAL = 0.005
+PROFILING_DIR = os.path.join(BASE_DIR, 'profiles')
+PROFILING_MAX_PROFILES = 200
+# ASGI mode (src/asgi.py): threads running the heavy read endpoints
+# (src/async_views.py); each may hold a database connection, counted in
+# the size of the in-process pool (POOL above)
+ASYNC_DB_WORKERS = 8
+# Background jobs of the heavy operations (organigramme.jobs): run by
+# JOB_LOCAL_WORKERS threads of the web process ('local'), or by
+# `manage.py run_jobs` worker processes ('database'), which needs a cache
+# shared by the processes instead of the LocMemCache above (CACHE_BACKEND).
+# JOB_CONCURRENCY overrides the number of jobs of a type running at once,
+# e.g. {"export_fiches": 2}.
+JOB_BACKEND = os.environ.get('JOB_BACKEND', 'local')
+JOB_WORKER_PROCESSES = 2
+JOB_LOCAL_WORKERS = 2
+JOB_POLL_INTERVAL = 1
+JOB_CONCURRENCY = {}
+# Exported files and uploads of the jobs, in the default storage; finished
+# jobs are deleted with their files by `manage.py prune_jobs`
+JOB_FILES_DIR = 'jobs'
+JOB_RETENTION_DAYS = 7
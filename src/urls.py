@@ -5,6 +5,8 @@ from rest_framework.routers import DefaultRouter
 from graphene_django.views import GraphQLView
 from django.conf import settings
 from .schema import schema  # Import the schema directly
+from .instrumentation import metrics_view
+from .profiling import profiles_view, profile_view
 from django.views.decorators.csrf import ensure_csrf_cookie, csrf_exempt
 from django.http import HttpResponse
 
@@ -15,9 +17,12 @@ def csrf_view(request):
     return HttpResponse("CSRF cookie set")
 
 urlpatterns = [
+    path('admin/profiles/', admin.site.admin_view(profiles_view), name='request-profiles'),
+    path('admin/profiles/<str:profile_id>/', admin.site.admin_view(profile_view), name='request-profile'),
     path('admin/', admin.site.urls),
     path('csrf/', csrf_view, name='csrf'),
     path('auth/', include('authentication.urls')),
+    path('api/metrics/', metrics_view, name='metrics'),
     path('api/', include('organigramme.urls')),
     path('graphql/', csrf_exempt(GraphQLView.as_view(graphiql=True, schema=schema))),
     # Add REST API URLs
@@ -5,7 +5,8 @@ from django.http import HttpResponse
 from django.template.loader import get_template
 from num2words import num2words
 import math
-from xhtml2pdf import pisa  
+from src.pdf_service import render_pdf
+from src.export import compile_columns, iter_export_rows
 from rest_framework.pagination import PageNumberPagination
 from django.apps import apps 
 import sys 
@@ -27,16 +28,13 @@ def getValue(current_object,item):
     return current_object 
 
 def excelGenerator(filtered_queryset, columns): 
-    rows = [] 
-    for item in filtered_queryset: 
-        row = {}
-        for col in columns:
-
-            row[col["header"]] = getValue(item, col)
-        
-        rows.append(row)
-    print(rows)
-    return rows 
+    """
+    Return the rows of the queryset as {header: value} dicts.
+    Columns are projected with `values_list` (see src.export); use
+    `src.export.export_response` to stream large exports instead.
+    """
+    headers, lookups = compile_columns(filtered_queryset.model, columns)
+    return [dict(zip(headers, row)) for row in iter_export_rows(filtered_queryset, lookups)]
 
 from django.http import JsonResponse
 
@@ -53,36 +51,15 @@ class CustomPagination(PageNumberPagination):
 
 
 def render_to_pdf(template_src, context_dict={}):
-    template = get_template(template_src)
-    html = template.render(context_dict)
-    result = BytesIO()
-
-    # Ensure HTML content is UTF-8 encoded
-    html_bytes = html.encode("UTF-8")
-
-    # Generate PDF using xhtml2pdf
-    pdf = pisa.pisaDocument(BytesIO(html_bytes), result, encoding='UTF-8', pdf_language='ar')
-
-    if not pdf.err:
+    pdf = render_pdf(template_src, context_dict)
+    if pdf is not None:
         # Return PDF response
-        return HttpResponse(result.getvalue(), content_type='application/pdf')
+        return HttpResponse(pdf, content_type='application/pdf')
     return None
- 
- 
-def render_to_pdf_rest(template_src, context_dict={}):
-    template = get_template(template_src)
-    html = template.render(context_dict)
-    result = BytesIO()
-
-    # Ensure HTML content is UTF-8 encoded
-    html_bytes = html.encode("UTF-8")
 
-    # Generate PDF using xhtml2pdf
-    pdf = pisa.pisaDocument(BytesIO(html_bytes), result, encoding='UTF-8', pdf_language='ar')
 
-    if not pdf.err:
-        return result.getvalue()  # Return PDF content as bytes
-    return None
+def render_to_pdf_rest(template_src, context_dict={}):
+    return render_pdf(template_src, context_dict)  # Return PDF content as bytes
 
 from io import BytesIO
 from django.template.loader import get_template
@@ -248,22 +225,6 @@ from django.shortcuts import render
 from django.http import HttpResponse
 from django.template.loader import render_to_string
 
-def render_to_pdf(template_src, context_dict={}):
-    template = get_template(template_src)
-    html = template.render(context_dict)
-    result = BytesIO()
-
-    # Ensure HTML content is UTF-8 encoded
-    html_bytes = html.encode("UTF-8")
-
-    # Generate PDF using xhtml2pdf
-    pdf = pisa.pisaDocument(BytesIO(html_bytes), result, encoding='UTF-8', pdf_language='ar')
-
-    if not pdf.err:
-        # Return PDF response
-        return HttpResponse(result.getvalue(), content_type='application/pdf')
-    return None
-
 from django.templatetags.static import static
 
 
@@ -513,4 +474,31 @@ from django.templatetags.static import static
 #     for item in array: 
 #         if remove(item) != "0" and remove(item) != "00" and remove(item) != "000" and remove(item) != "0000"  : 
 #             new_array.append(item)
-#     return new_array
\ No newline at end of file
+#     return new_array
+
+def bulk_create_with_pks(model, objs, batch_size=500):
+    """
+    Insert `objs` and make sure their primary keys are set afterwards.
+    Uses a single bulk INSERT when the backend returns ids from bulk inserts
+    (PostgreSQL); otherwise falls back to one INSERT per object. Like
+    `bulk_create`, neither sends the save signals.
+    """
+    from django.db import connections, router
+
+    using = router.db_for_write(model)
+    connection = connections[using]
+    if connection.features.can_return_rows_from_bulk_insert:
+        return model.objects.bulk_create(objs, batch_size=batch_size)
+    # What Model.save() does for an insert, without the signals
+    meta = model._meta
+    fields = [field for field in meta.local_concrete_fields if field is not meta.auto_field]
+    returning_fields = meta.db_returning_fields
+    for obj in objs:
+        results = model._base_manager._insert(
+            [obj], fields=fields, returning_fields=returning_fields, using=using
+        )
+        for value, field in zip(results[0], returning_fields):
+            setattr(obj, field.attname, value)
+        obj._state.adding = False
+        obj._state.db = using
+    return objs
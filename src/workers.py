@@ -0,0 +1,60 @@
+"""
+Process pools for CPU bound work (PDF rendering, exports), and the
+spawned job worker processes (organigramme.jobs).
+
+Workers are spawned rather than forked so they never share the parent's
+database connections. This module does not import any model, so it can be
+unpickled by a fresh worker before Django is set up; the work itself is
+referenced by dotted path and imported once the worker is ready.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from importlib import import_module
+
+_executors = {}
+
+
+def init_django_worker(settings_module):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    import django
+    django.setup()
+
+
+def call_in_worker(function_path, *args, **kwargs):
+    """Import `module.function` and call it (runs in the worker process)."""
+    module_path, function_name = function_path.rsplit('.', 1)
+    return getattr(import_module(module_path), function_name)(*args, **kwargs)
+
+
+def run_django_process(settings_module, function_path, *args, **kwargs):
+    """Target of a spawned process: set Django up, then call `function_path`."""
+    init_django_worker(settings_module)
+    return call_in_worker(function_path, *args, **kwargs)
+
+
+def get_process_pool(name, max_workers):
+    """Return the named process pool, created on first use."""
+    executor = _executors.get(name)
+    if executor is None:
+        executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_django_worker,
+            initargs=(os.environ.get('DJANGO_SETTINGS_MODULE', 'src.settings'),),
+        )
+        _executors[name] = executor
+    return executor
+
+
+def submit_to_pool(name, max_workers, function_path, *args, **kwargs):
+    """
+    Run `function_path(*args, **kwargs)` in the named pool and return the
+    future. A pool broken by a crashed worker is replaced once.
+    """
+    try:
+        return get_process_pool(name, max_workers).submit(call_in_worker, function_path, *args, **kwargs)
+    except BrokenProcessPool:
+        _executors.pop(name, None)
+        return get_process_pool(name, max_workers).submit(call_in_worker, function_path, *args, **kwargs)
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'src.settings')
 
 application = get_wsgi_application()
+
+# Job workers of the 'local' backend (see organigramme.jobs)
+from organigramme.jobs import start_local_workers  # noqa: E402
+
+start_local_workers()